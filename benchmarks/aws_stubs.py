@@ -0,0 +1,262 @@
+"""Stand-ins for the AWS clients used by the Lambdas, so that the handlers can
+be benchmarked end to end without talking to AWS.
+
+Each stub sleeps for a configurable latency to model the round trip of the
+real service, and returns a response shaped like the real one.  `install`
+swaps the stubs in for the clients created by the Lambda modules.
+
+Importing this module imports `bench_common`, which makes the Lambda modules
+importable.
+"""
+
+import io
+import json
+import os
+import random
+import threading
+import time
+import zlib
+
+from typing import Dict, List
+
+import bench_common  # noqa: F401  Adds lambda/ to the import path.
+import image_context
+import lambda_common
+import sns_publisher
+
+from PIL import Image
+
+# The topic ARNs the handlers publish to.  The stub SNS client accepts any.
+os.environ.setdefault('SNS_ANALYZE_IMAGE_TOPIC_ARN', 'arn:aws:sns:stub:analyze_image')
+os.environ.setdefault(
+    'SNS_UPDATE_SPAM_SCORE_TOPIC_ARN', 'arn:aws:sns:stub:update_spam_score'
+)
+os.environ.setdefault('IMAGE_CONFIDENCE_THRESHOLD', '0.6')
+
+
+class StubLatency:
+    """Models the latency of a service as a base latency with random jitter."""
+
+    def __init__(self, mean_ms: float, jitter_fraction: float = 0.2, seed: int = 0):
+        """Creates an instance.
+
+        :param mean_ms: The mean latency.
+        :param jitter_fraction: The standard deviation of the latency, as a
+            fraction of the mean.
+        :param seed: The seed for the jitter.
+        """
+        self.__mean_ms = mean_ms
+        self.__jitter_fraction = jitter_fraction
+        self.__rng = random.Random(seed)
+        self.__lock = threading.Lock()
+
+    def sleep(self):
+        """Sleeps for one sample of the latency."""
+        if self.__mean_ms <= 0:
+            return
+        with self.__lock:
+            latency_ms = self.__rng.gauss(
+                self.__mean_ms, self.__mean_ms * self.__jitter_fraction
+            )
+        time.sleep(max(0.0, latency_ms) / 1000)
+
+
+class StubS3Client:
+    """Serves the same image for every object."""
+
+    def __init__(self, image_bytes: bytes, latency: StubLatency):
+        self.__image_bytes = image_bytes
+        self.__latency = latency
+        self.calls = 0
+
+    def get_object(self, Bucket: str, Key: str) -> dict:
+        self.calls += 1
+        self.__latency.sleep()
+        return {
+            'Body': io.BytesIO(self.__image_bytes),
+            'ETag': f'"{Bucket}/{Key}"',
+            'ContentLength': len(self.__image_bytes),
+        }
+
+    def head_object(self, Bucket: str, Key: str) -> dict:
+        self.calls += 1
+        self.__latency.sleep()
+        return {'ETag': f'"{Bucket}/{Key}"', 'ContentLength': len(self.__image_bytes)}
+
+
+class StubRekognitionClient:
+    """Detects the same text in every image, and the same moderation labels in
+    every image except a fixed fraction, in which it detects explicit content.
+    """
+
+    def __init__(self, latency: StubLatency, spam_fraction: float = 0.0):
+        """Creates an instance.
+
+        :param latency: The latency of the requests.
+        :param spam_fraction: The fraction of images with explicit content,
+            chosen by a hash of their key.
+        """
+        self.__latency = latency
+        self.__spam_fraction = spam_fraction
+        self.calls = 0
+
+    def detect_text(self, Image: dict) -> dict:
+        self.calls += 1
+        self.__latency.sleep()
+        words = ['low', 'mortgage', 'rates', 'call', 'now']
+        return {
+            'TextDetections': [
+                {'DetectedText': word, 'Confidence': 99.0, 'Id': i, 'Type': 'WORD'}
+                for i, word in enumerate(words)
+            ]
+        }
+
+    def detect_moderation_labels(self, Image: dict) -> dict:
+        self.calls += 1
+        self.__latency.sleep()
+        key = Image['S3Object']['Name'].encode('utf-8')
+        if zlib.crc32(key) % 1000 < self.__spam_fraction * 1000:
+            return {
+                'ModerationLabels': [{'Name': 'Explicit Nudity', 'Confidence': 95.0}]
+            }
+        return {'ModerationLabels': [{'Name': 'Suggestive', 'Confidence': 40.0}]}
+
+
+class StubSnsClient:
+    """Records the published messages, per publishing thread, so a benchmark
+    can deliver them to the subscribed handler.
+    """
+
+    def __init__(self, latency: StubLatency):
+        self.__latency = latency
+        self.__lock = threading.Lock()
+        self.__messages: Dict[int, List[str]] = {}
+        self.calls = 0
+
+    def publish(self, TopicArn: str, Message: str) -> dict:
+        self.calls += 1
+        self.__latency.sleep()
+        self.__record([Message])
+        return {'MessageId': 'stub', 'ResponseMetadata': {'HTTPStatusCode': 200}}
+
+    def publish_batch(self, TopicArn: str, PublishBatchRequestEntries: list) -> dict:
+        self.calls += 1
+        self.__latency.sleep()
+        self.__record([entry['Message'] for entry in PublishBatchRequestEntries])
+        return {
+            'Successful': [
+                {'Id': entry['Id'], 'MessageId': 'stub'}
+                for entry in PublishBatchRequestEntries
+            ],
+            'Failed': [],
+            'ResponseMetadata': {'HTTPStatusCode': 200},
+        }
+
+    def take_messages(self) -> List[str]:
+        """
+        :return: The messages published by the calling thread since the last
+            call, which are then forgotten.
+        """
+        with self.__lock:
+            return self.__messages.pop(threading.get_ident(), [])
+
+    def __record(self, messages: List[str]):
+        with self.__lock:
+            self.__messages.setdefault(threading.get_ident(), []).extend(messages)
+
+
+class StubLambdaContext:
+    """Stands in for the context passed to a Lambda handler."""
+
+    function_version = '$LATEST'
+
+    def __init__(self, request_id: str = 'stub-request'):
+        self.aws_request_id = request_id
+
+
+class StubClients:
+    """The installed stub clients."""
+
+    def __init__(self, s3: StubS3Client, rekognition, sns: StubSnsClient):
+        self.s3 = s3
+        self.rekognition = rekognition
+        self.sns = sns
+
+
+def make_image_bytes(width: int = 1024, height: int = 768, seed: int = 0) -> bytes:
+    """
+    :param width: The width of the image.
+    :param height: The height of the image.
+    :param seed: The seed for the image content.
+    :return: A noisy JPEG image, sized like a typical photo upload.
+    """
+    rng = random.Random(seed)
+    size = width * height * 3
+    image = Image.frombytes(
+        'RGB', (width, height), rng.getrandbits(size * 8).to_bytes(size, 'little')
+    )
+    output = io.BytesIO()
+    image.save(output, format='JPEG', quality=85)
+    return output.getvalue()
+
+
+def sns_event(messages: List[str]) -> dict:
+    """
+    :param messages: The messages to deliver.
+    :return: An SNS event delivering the messages.
+    """
+    return {
+        'Records': [
+            {'Sns': {'MessageId': f'message-{i}', 'Message': message}}
+            for i, message in enumerate(messages)
+        ]
+    }
+
+
+def analyze_image_message(image_url: str, root_trace_id: str = 'root') -> str:
+    """
+    :param image_url: The URL of the image.
+    :param root_trace_id: The root trace id.
+    :return: The message the analyze_image Lambda would publish for the image.
+    """
+    return json.dumps(
+        {
+            'ImageURL': image_url,
+            'PostID': 'post',
+            'AccountID': 'account',
+            'SourceDevice': 'iOS',
+            'CreatedTimestamp': '1572457843',
+            'RootTraceID': root_trace_id,
+        }
+    )
+
+
+def install(
+    image_bytes: bytes,
+    s3_latency_ms: float = 30,
+    rekognition_latency_ms: float = 150,
+    sns_latency_ms: float = 20,
+    spam_fraction: float = 0.0,
+) -> StubClients:
+    """Replaces the AWS clients used by the Lambdas with stubs.
+
+    :param image_bytes: The image served for every S3 object.
+    :param s3_latency_ms: The mean latency of S3 requests.
+    :param rekognition_latency_ms: The mean latency of Rekognition requests.
+    :param sns_latency_ms: The mean latency of SNS publishes.
+    :param spam_fraction: The fraction of images Rekognition detects explicit
+        content in.
+    :return: The installed stubs.
+    """
+    clients = StubClients(
+        StubS3Client(image_bytes, StubLatency(s3_latency_ms, seed=1)),
+        StubRekognitionClient(
+            StubLatency(rekognition_latency_ms, seed=2), spam_fraction=spam_fraction
+        ),
+        StubSnsClient(StubLatency(sns_latency_ms, seed=3)),
+    )
+    image_context._s3 = clients.s3
+    lambda_common._rekognition_client = clients.rekognition
+    lambda_common._sns = clients.sns
+    sns_publisher._sns = clients.sns
+    return clients
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""Measures the time for a detection Lambda to score a batch of images,
+handled one at a time or concurrently, using stubbed AWS clients.
+
+* `sync` -- `DetectionHandler.handle_request`, which scores the images of the
+  batch one after another.
+* `async-N` -- the same handler run through `SyncDetectionHandlerAdapter`,
+  scoring up to N images of the batch at once.
+
+Every image in a batch has a different URL, so each is fetched and sent to
+Rekognition separately.
+
+Usage:
+    python benchmarks/bench_async_detection.py --batch-size 10 --concurrency 1,4,10
+"""
+
+import argparse
+import contextlib
+import io
+import time
+
+import aws_stubs
+import bench_common
+
+from async_handler import SyncDetectionHandlerAdapter
+from detect_adult_content import DetectAdultContentHandler
+from detect_spammy_words import DetectSpammyWordsHandler
+from image_context import ImageContext
+
+_HANDLERS = {
+    'detect_adult_content': DetectAdultContentHandler,
+    'detect_spammy_words': DetectSpammyWordsHandler,
+}
+
+
+def run_benchmark(
+    handler_name: str, mode: str, handle_request, batch_size: int, batches: int
+) -> dict:
+    """Handles `batches` events of `batch_size` records each.
+
+    :param handler_name: The name of the handler.
+    :param mode: The name of the way the handler is run.
+    :param handle_request: Handles an event.
+    :param batch_size: The number of records per event.
+    :param batches: The number of events.
+    :return: The results.
+    """
+    latencies = []
+    for batch in range(batches):
+        event = aws_stubs.sns_event(
+            [
+                aws_stubs.analyze_image_message(
+                    f's3://bucket/{handler_name}-{mode}-{batch}-{i}.jpg',
+                    root_trace_id=f'root-{batch}-{i}',
+                )
+                for i in range(batch_size)
+            ]
+        )
+        ImageContext.clear_shared()
+        start = time.perf_counter()
+        # The handlers log every step, which would swamp the results.
+        with contextlib.redirect_stdout(io.StringIO()):
+            response = handle_request(event, aws_stubs.StubLambdaContext())
+        latencies.append(bench_common.elapsed_ms(start))
+        assert response['statusCode'] == 200, response
+    total_s = sum(latencies) / 1000
+    return {
+        'handler': handler_name,
+        'mode': mode,
+        'batch_latency': bench_common.summarize_latencies(latencies),
+        'images_per_second': batch_size * batches / total_s,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--batch-size', type=int, default=10)
+    parser.add_argument('--batches', type=int, default=5)
+    parser.add_argument('--concurrency', default='1,4,10')
+    parser.add_argument('--s3-ms', type=float, default=30)
+    parser.add_argument('--rekognition-ms', type=float, default=150)
+    parser.add_argument('--sns-ms', type=float, default=20)
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+
+    aws_stubs.install(
+        aws_stubs.make_image_bytes(),
+        s3_latency_ms=args.s3_ms,
+        rekognition_latency_ms=args.rekognition_ms,
+        sns_latency_ms=args.sns_ms,
+    )
+
+    results = []
+    for handler_name, handler_class in _HANDLERS.items():
+        modes = [('sync', handler_class().handle_request)]
+        for concurrency in args.concurrency.split(','):
+            adapter = SyncDetectionHandlerAdapter(
+                handler_class, max_concurrency=int(concurrency)
+            )
+            modes.append((f'async-{concurrency}', adapter.handle_request))
+        for mode, handle_request in modes:
+            results.append(
+                run_benchmark(
+                    handler_name, mode, handle_request, args.batch_size, args.batches
+                )
+            )
+    bench_common.emit_results('async_detection', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
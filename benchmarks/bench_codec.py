@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""Measures the cost of encoding and decoding the SNS payloads in each wire
+format.
+
+For each configuration this reports the mean time to encode an
+`UpdateSpamScorePayload` with `to_json` and to decode it with `from_json`, the
+size of the encoded message and the traced memory allocated per decode:
+
+* `json-stdlib` -- JSON with the standard library.
+* `json-orjson` -- JSON with `orjson`, if it is installed.
+* `msgpack-v1` -- MessagePack in a base64 envelope, if `msgpack` is installed.
+* `legacy` -- for comparison, the previous decoder, which parsed the message,
+  re-serialized the nested image payload and parsed it again, building the
+  required field sets on every call.
+
+Usage:
+    python benchmarks/bench_codec.py --iterations 100000
+"""
+
+import argparse
+import json
+import time
+import tracemalloc
+
+import bench_common
+import lambda_common
+import payload_codec
+
+from lambda_common import Constants, ImagePayload, UpdateSpamScorePayload
+from payload_codec import PayloadCodec
+
+
+def _payload() -> UpdateSpamScorePayload:
+    return UpdateSpamScorePayload(
+        ImagePayload(
+            's3://scalyr-serverless-demo/images/2020/01/15/green.png',
+            'xyz123',
+            '789',
+            'iOS',
+            '1572457843',
+            'Root=1-5dc424fe-34aaedd01ccd08b4a54a3bd8',
+        ),
+        'detect_adult_content',
+        0.4,
+        '7a1bd8e4-3b4f-4c2a-9a67-0d1c5b8e1f20',
+    )
+
+
+def _legacy_from_json(message: str) -> UpdateSpamScorePayload:
+    parsed = lambda_common.parse_json(
+        message,
+        required_fields=frozenset(
+            {
+                Constants.IMAGE_PAYLOAD,
+                Constants.SCORER,
+                Constants.SCORE,
+                Constants.SCORER_TRACE_ID,
+            }
+        ),
+    )
+    image_payload = lambda_common.parse_json(
+        json.dumps(parsed[Constants.IMAGE_PAYLOAD]),
+        required_fields=frozenset(ImagePayload.REQUIRED_FIELDS),
+    )
+    return UpdateSpamScorePayload(
+        ImagePayload.from_dict(image_payload),
+        parsed[Constants.SCORER],
+        parsed[Constants.SCORE],
+        parsed[Constants.SCORER_TRACE_ID],
+    )
+
+
+def _mean_us(operation, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        operation()
+    return bench_common.elapsed_ms(start) * 1000 / iterations
+
+
+def _allocated_bytes(operation, iterations: int) -> float:
+    tracemalloc.start()
+    try:
+        for _ in range(iterations):
+            operation()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def run_benchmark(name: str, codec: PayloadCodec, iterations: int, decode) -> dict:
+    """Measures one configuration.
+
+    :param name: The name of the configuration.
+    :param codec: The codec the payload classes use.
+    :param iterations: The number of times to repeat each operation.
+    :param decode: Decodes a message into an `UpdateSpamScorePayload`.
+    :return: The results.
+    """
+    original_codec = lambda_common._payload_codec
+    lambda_common._payload_codec = codec
+    try:
+        payload = _payload()
+        message = payload.to_json()
+        assert decode(message).to_dict() == payload.to_dict()
+        return {
+            'configuration': name,
+            'message_bytes': len(message.encode('utf-8')),
+            'encode_mean_us': _mean_us(payload.to_json, iterations),
+            'decode_mean_us': _mean_us(lambda: decode(message), iterations),
+            'decode_peak_bytes': _allocated_bytes(lambda: decode(message), 1),
+        }
+    finally:
+        lambda_common._payload_codec = original_codec
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=100000)
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+
+    stdlib = PayloadCodec(fast_json=False)
+    configurations = [
+        ('legacy', stdlib, _legacy_from_json),
+        ('json-stdlib', stdlib, UpdateSpamScorePayload.from_json),
+    ]
+    if payload_codec.orjson is not None:
+        configurations.append(
+            ('json-orjson', PayloadCodec(), UpdateSpamScorePayload.from_json)
+        )
+    if payload_codec.msgpack is not None:
+        configurations.append(
+            (
+                'msgpack-v1',
+                PayloadCodec(payload_codec.MSGPACK_V1),
+                UpdateSpamScorePayload.from_json,
+            )
+        )
+
+    results = [
+        run_benchmark(name, codec, args.iterations, decode)
+        for name, codec, decode in configurations
+    ]
+    bench_common.emit_results('codec', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
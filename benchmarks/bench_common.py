@@ -0,0 +1,85 @@
+"""Helpers shared by the benchmark scripts in this directory.
+
+The benchmarks exercise the Lambda code in `lambda/` in-process, so importing
+this module adds that directory to the import path, the same way it is laid
+out when deployed to AWS Lambda.
+
+Each benchmark prints its results as JSON so they can be tracked over time.
+"""
+
+import json
+import os
+import platform
+import sys
+import time
+
+from typing import List, Sequence
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda')
+sys.path.insert(0, os.path.normpath(LAMBDA_DIR))
+# The AWS clients are created at import time and need a region, even though
+# the benchmarks never talk to AWS.
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+# The benchmarks deliver the same SNS message ids over and over, which the
+# handlers would otherwise skip as redeliveries.
+os.environ.setdefault('DEDUP_STORE', 'none')
+
+
+def percentile(sorted_samples: Sequence[float], fraction: float) -> float:
+    """
+    :param sorted_samples: The samples, in ascending order.
+    :param fraction: The percentile to compute, from 0 to 1.
+    :return: The nearest-rank percentile of the samples.
+    """
+    if not sorted_samples:
+        return 0.0
+    rank = min(
+        len(sorted_samples) - 1, max(0, round(fraction * len(sorted_samples)) - 1)
+    )
+    return sorted_samples[rank]
+
+
+def summarize_latencies(samples_ms: List[float]) -> dict:
+    """
+    :param samples_ms: The latencies of the individual operations.
+    :return: A summary of the latency distribution.
+    """
+    ordered = sorted(samples_ms)
+    return {
+        'count': len(ordered),
+        'mean_ms': sum(ordered) / len(ordered) if ordered else 0.0,
+        'p50_ms': percentile(ordered, 0.50),
+        'p90_ms': percentile(ordered, 0.90),
+        'p99_ms': percentile(ordered, 0.99),
+        'max_ms': ordered[-1] if ordered else 0.0,
+    }
+
+
+def elapsed_ms(start: float) -> float:
+    """
+    :param start: A value previously returned by `time.perf_counter`.
+    :return: The milliseconds elapsed since `start`.
+    """
+    return (time.perf_counter() - start) * 1000
+
+
+def emit_results(benchmark: str, results, output_path: str = None):
+    """Prints the results of a benchmark as JSON, and optionally writes them
+    to a file.
+
+    :param benchmark: The name of the benchmark.
+    :param results: The JSON-serializable results.
+    :param output_path: If not None, the file to write the results to.
+    """
+    document = {
+        'benchmark': benchmark,
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+    serialized = json.dumps(document, indent=2, sort_keys=True)
+    print(serialized)
+    if output_path is not None:
+        with open(output_path, 'w') as file:
+            file.write(serialized + '\n')
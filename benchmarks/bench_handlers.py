@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""Measures the pipeline's own overhead by driving every Lambda handler
+in-process with stubbed AWS clients.
+
+By default the stubs respond instantly, so the results reflect only the time
+and memory spent in the pipeline code: parsing, logging, hashing, scoring and
+building the SNS messages.  Use `--s3-ms`, `--rekognition-ms` and `--sns-ms`
+to model service latency as well.
+
+For each handler this reports:
+
+* `latency` -- the distribution of per-invocation latency.
+* `peak_kib` -- the peak traced memory above the starting point while
+  invoking the handler `--alloc-invocations` times, from `tracemalloc`.
+* `retained_bytes_per_invocation` -- the traced memory still held afterwards,
+  divided by the number of invocations.
+
+It also reports the end-to-end throughput of the whole pipeline, and,
+separately, the cost of the JSON codecs for the SNS payloads.
+
+Usage:
+    python benchmarks/bench_handlers.py --invocations 200 --output handlers.json
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import time
+import tracemalloc
+
+import aws_stubs
+import bench_common
+
+import analyze_image
+import update_spam_score
+
+from detect_adult_content import DetectAdultContentHandler
+from detect_known_bad_content import DetectKnownBadContentHandler
+from detect_spammy_words import DetectSpammyWordsHandler
+from lambda_common import ImagePayload, UpdateSpamScorePayload
+
+_DETECTION_HANDLERS = {
+    'detect_known_bad_content': DetectKnownBadContentHandler,
+    'detect_spammy_words': DetectSpammyWordsHandler,
+    'detect_adult_content': DetectAdultContentHandler,
+}
+
+
+def _image_payload(i: int) -> ImagePayload:
+    # Every invocation uses a different image URL, so that no invocation
+    # reuses the image fetched by a previous one.
+    return ImagePayload(
+        f's3://bucket/image-{i}.jpg',
+        f'post-{i}',
+        'account',
+        'iOS',
+        '1572457843',
+        f'root-{i}',
+    )
+
+
+def _analyze_image_event(i: int) -> dict:
+    payload = _image_payload(i).to_dict()
+    del payload['RootTraceID']
+    return {'body': json.dumps(payload)}
+
+
+def _detection_event(i: int) -> dict:
+    return aws_stubs.sns_event([_image_payload(i).to_json()])
+
+
+def _update_spam_score_event(i: int) -> dict:
+    return aws_stubs.sns_event(
+        [
+            UpdateSpamScorePayload(
+                _image_payload(i), 'detect_adult_content', 0.4, f'scorer-{i}'
+            ).to_json()
+        ]
+    )
+
+
+def _handlers() -> dict:
+    """
+    :return: For each handler, a function that invokes it for the i'th image.
+    """
+    handlers = {
+        'analyze_image': lambda i: analyze_image.handler(
+            _analyze_image_event(i), aws_stubs.StubLambdaContext(f'request-{i}')
+        ),
+    }
+    for name, handler_class in _DETECTION_HANDLERS.items():
+        handlers[name] = lambda i, handler_class=handler_class: (
+            handler_class().handle_request(
+                _detection_event(i), aws_stubs.StubLambdaContext(f'request-{i}')
+            )
+        )
+    handlers['update_spam_score'] = lambda i: update_spam_score.handler(
+        _update_spam_score_event(i), aws_stubs.StubLambdaContext(f'request-{i}')
+    )
+    return handlers
+
+
+def _measure_latency(invoke, invocations: int, offset: int) -> dict:
+    latencies = []
+    for i in range(invocations):
+        start = time.perf_counter()
+        invoke(offset + i)
+        latencies.append(bench_common.elapsed_ms(start))
+    return bench_common.summarize_latencies(latencies)
+
+
+def _measure_allocations(invoke, invocations: int, offset: int) -> dict:
+    tracemalloc.start()
+    try:
+        baseline, _ = tracemalloc.get_traced_memory()
+        for i in range(invocations):
+            invoke(offset + i)
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        'peak_kib': (peak - baseline) / 1024,
+        'retained_bytes_per_invocation': (current - baseline) / invocations,
+    }
+
+
+def _measure_throughput(clients: aws_stubs.StubClients, images: int) -> dict:
+    """Runs every image through the whole pipeline, one after another, feeding
+    each handler's published messages to the next.
+    """
+    handlers = _handlers()
+    start = time.perf_counter()
+    for i in range(images):
+        handlers['analyze_image'](i)
+        for message in clients.sns.take_messages():
+            for handler_class in _DETECTION_HANDLERS.values():
+                handler_class().handle_request(
+                    aws_stubs.sns_event([message]), aws_stubs.StubLambdaContext()
+                )
+        for message in clients.sns.take_messages():
+            update_spam_score.handler(
+                aws_stubs.sns_event([message]), aws_stubs.StubLambdaContext()
+            )
+    elapsed_s = time.perf_counter() - start
+    return {'images': images, 'images_per_second': images / elapsed_s}
+
+
+def _measure_codecs(iterations: int) -> dict:
+    image_payload = _image_payload(0)
+    serialized = UpdateSpamScorePayload(
+        image_payload, 'detect_adult_content', 0.4, 'scorer'
+    ).to_json()
+
+    results = {}
+    for name, operation in (
+        ('ImagePayload.to_json', image_payload.to_json),
+        (
+            'UpdateSpamScorePayload.from_json',
+            lambda: UpdateSpamScorePayload.from_json(serialized),
+        ),
+    ):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            operation()
+        results[name] = {
+            'iterations': iterations,
+            'mean_us': bench_common.elapsed_ms(start) * 1000 / iterations,
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--invocations', type=int, default=200)
+    parser.add_argument('--alloc-invocations', type=int, default=50)
+    parser.add_argument('--throughput-images', type=int, default=100)
+    parser.add_argument('--codec-iterations', type=int, default=100000)
+    parser.add_argument('--s3-ms', type=float, default=0)
+    parser.add_argument('--rekognition-ms', type=float, default=0)
+    parser.add_argument('--sns-ms', type=float, default=0)
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+
+    clients = aws_stubs.install(
+        aws_stubs.make_image_bytes(640, 480),
+        s3_latency_ms=args.s3_ms,
+        rekognition_latency_ms=args.rekognition_ms,
+        sns_latency_ms=args.sns_ms,
+    )
+
+    results = {'handlers': {}}
+    # The handlers log every step, which would swamp the results.  The logs are
+    # discarded rather than buffered, so they do not count as retained memory.
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for name, invoke in _handlers().items():
+            # Warm up, as a Lambda container would be after its first request.
+            invoke(0)
+            latency = _measure_latency(invoke, args.invocations, 1)
+            allocations = _measure_allocations(
+                invoke, args.alloc_invocations, 1 + args.invocations
+            )
+            results['handlers'][name] = dict(latency=latency, **allocations)
+            clients.sns.take_messages()
+
+        results['throughput'] = _measure_throughput(clients, args.throughput_images)
+    results['codecs'] = _measure_codecs(args.codec_iterations)
+
+    bench_common.emit_results('handlers', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
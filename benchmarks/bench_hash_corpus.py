@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""Compares cold start cost of the memory-mapped hash corpus against parsing
+the same corpus from JSON or CSV.
+
+Each loader runs in a fresh interpreter, like a Lambda cold start, and reports
+the time to load the corpus, the time of the first exact lookup, and the
+resident set size added by the load.  RSS is read from `/proc`, so this
+benchmark requires Linux (as does AWS Lambda).
+
+Usage:
+    python benchmarks/bench_hash_corpus.py --sizes 100000,1000000
+"""
+
+import argparse
+import csv
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+
+import bench_common
+from hash_corpus import write_hash_corpus
+
+# Executed in a child interpreter.  Prints a JSON object with the measurements.
+_LOADER_SCRIPT = '''
+import json, os, sys, time
+sys.path.insert(0, {lambda_dir!r})
+
+def current_rss_kb():
+    # ru_maxrss is a high-water mark inherited across exec, so read the
+    # current resident set size instead.
+    with open('/proc/self/statm') as file:
+        return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+
+fmt, path, target = sys.argv[1], sys.argv[2], int(sys.argv[3])
+rss_before = current_rss_kb()
+start = time.perf_counter()
+if fmt == 'mmap':
+    from hash_corpus import HashCorpus
+    corpus = HashCorpus(path)
+    load_ms = (time.perf_counter() - start) * 1000
+    start = time.perf_counter()
+    found = corpus.find_exact(target)
+else:
+    from array import array
+    hashes, image_ids = array('Q'), []
+    if fmt == 'json':
+        with open(path) as file:
+            for entry in json.load(file):
+                hashes.append(int(entry['hash'], 16))
+                image_ids.append(entry['id'])
+    else:
+        import csv
+        with open(path, newline='') as file:
+            for row in csv.reader(file):
+                hashes.append(int(row[0], 16))
+                image_ids.append(row[1])
+    load_ms = (time.perf_counter() - start) * 1000
+    start = time.perf_counter()
+    found = next(
+        (image_ids[i] for i, h in enumerate(hashes) if h == target), None
+    )
+lookup_ms = (time.perf_counter() - start) * 1000
+rss_after = current_rss_kb()
+print(json.dumps({{
+    'load_ms': load_ms,
+    'first_lookup_ms': lookup_ms,
+    'rss_added_kb': rss_after - rss_before,
+    'found': found is not None,
+}}))
+'''
+
+
+def _write_corpora(directory: str, size: int, seed: int) -> (dict, int):
+    """Writes the same random corpus in each of the formats.
+
+    :return: The paths keyed by format, and a hash present in the corpus.
+    """
+    rng = random.Random(seed)
+    entries = [(rng.getrandbits(64), f'known-bad-{i}') for i in range(size)]
+    paths = {
+        'mmap': os.path.join(directory, 'corpus.bin'),
+        'json': os.path.join(directory, 'corpus.json'),
+        'csv': os.path.join(directory, 'corpus.csv'),
+    }
+    write_hash_corpus(paths['mmap'], entries)
+    with open(paths['json'], 'w') as file:
+        json.dump([{'hash': f'{h:016x}', 'id': i} for h, i in entries], file)
+    with open(paths['csv'], 'w', newline='') as file:
+        writer = csv.writer(file)
+        for hash_value, image_id in entries:
+            writer.writerow([f'{hash_value:016x}', image_id])
+    return paths, entries[rng.randrange(size)][0]
+
+
+def run_benchmark(size: int, seed: int) -> list:
+    """Measures each loader against a corpus of the given size.
+
+    :param size: The number of entries in the corpus.
+    :param seed: The seed for the random hashes.
+    :return: The results, one per format.
+    """
+    script = _LOADER_SCRIPT.format(lambda_dir=bench_common.LAMBDA_DIR)
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        paths, target = _write_corpora(directory, size, seed)
+        for fmt, path in paths.items():
+            output = subprocess.check_output(
+                [sys.executable, '-c', script, fmt, path, str(target)]
+            )
+            result = json.loads(output)
+            result.update(
+                {'format': fmt, 'size': size, 'file_bytes': os.path.getsize(path)}
+            )
+            results.append(result)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='100000,1000000')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+
+    results = []
+    for size in (int(x) for x in args.sizes.split(',')):
+        results.extend(run_benchmark(size, args.seed))
+    bench_common.emit_results('hash_corpus', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""Measures query latency of the known bad content hash indexes.
+
+Builds each index backend over random 64-bit hashes and queries it with a mix
+of near-duplicates of indexed hashes (which should match) and random hashes
+(which should not).
+
+Usage:
+    python benchmarks/bench_hash_index.py --sizes 10000,1000000,10000000
+"""
+
+import argparse
+import random
+import time
+
+from array import array
+
+import bench_common
+from hash_index import create_hash_index
+
+
+def _perturb(hash_value: int, bit_count: int, rng: random.Random) -> int:
+    for bit in rng.sample(range(64), bit_count):
+        hash_value ^= 1 << bit
+    return hash_value
+
+
+def run_benchmark(
+    backend: str, size: int, queries: int, max_distance: int, seed: int
+) -> dict:
+    """Builds a single index and measures queries against it.
+
+    :param backend: The name of the index backend.
+    :param size: The number of hashes to index.
+    :param queries: The number of queries to issue.
+    :param max_distance: The search radius of each query.
+    :param seed: The seed for the random hashes.
+    :return: The results.
+    """
+    rng = random.Random(seed)
+    hashes = array('Q', (rng.getrandbits(64) for _ in range(size)))
+    image_ids = [f'known-bad-{i}' for i in range(size)]
+
+    targets = []
+    for i in range(queries):
+        if i % 2 == 0:
+            base = hashes[rng.randrange(size)]
+            targets.append(_perturb(base, rng.randint(0, max_distance), rng))
+        else:
+            targets.append(rng.getrandbits(64))
+
+    index = create_hash_index(backend, hashes=hashes, image_ids=image_ids)
+    start = time.perf_counter()
+    # The indexes are built lazily, so the first query pays for the build.
+    index.find_closest(0, 0)
+    build_ms = bench_common.elapsed_ms(start)
+
+    latencies = []
+    matches = 0
+    for target in targets:
+        start = time.perf_counter()
+        closest_hash, _ = index.find_closest(target, max_distance)
+        latencies.append(bench_common.elapsed_ms(start))
+        if closest_hash is not None:
+            matches += 1
+
+    return {
+        'backend': backend,
+        'size': size,
+        'max_distance': max_distance,
+        'build_ms': build_ms,
+        'matches': matches,
+        'query_latency': bench_common.summarize_latencies(latencies),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='10000,1000000,10000000')
+    parser.add_argument('--backends', default='mih')
+    parser.add_argument('--queries', type=int, default=1000)
+    parser.add_argument('--max-distance', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+
+    results = []
+    for size in (int(x) for x in args.sizes.split(',')):
+        for backend in args.backends.split(','):
+            results.append(
+                run_benchmark(backend, size, args.queries, args.max_distance, args.seed)
+            )
+    bench_common.emit_results('hash_index', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
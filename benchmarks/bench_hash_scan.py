@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""Finds the corpus size at which the vectorized scan stops beating
+multi-index hashing.
+
+For each corpus size, measures the first query of both engines, which
+includes building the index, then the single query latency once built, and
+the per-query cost of the scan engine's batch `top_k`.  The reported crossover
+is the smallest size at which the median multi-index query is faster than the
+median scan once built.  For each size, `mih_break_even_queries` is how many
+queries a container must answer before multi-index hashing has made up for
+its slower first query, if ever.
+
+Usage:
+    python benchmarks/bench_hash_scan.py --sizes 1000,10000,100000,1000000
+"""
+
+import argparse
+import math
+import random
+import time
+
+from array import array
+from typing import Union
+
+import bench_common
+from hash_index import create_hash_index
+
+
+def _perturbed_targets(hashes, count: int, max_bits: int, rng: random.Random):
+    targets = []
+    for _ in range(count):
+        target = hashes[rng.randrange(len(hashes))]
+        for bit in rng.sample(range(64), rng.randint(0, max_bits)):
+            target ^= 1 << bit
+        targets.append(target)
+    return targets
+
+
+def _measure_queries(index, targets, max_distance: int) -> dict:
+    # The index is built on the first query, which is the cost the first
+    # request of a container pays.
+    start = time.perf_counter()
+    index.find_closest(targets[0], max_distance)
+    first_query_ms = bench_common.elapsed_ms(start)
+    latencies = []
+    for target in targets:
+        start = time.perf_counter()
+        index.find_closest(target, max_distance)
+        latencies.append(bench_common.elapsed_ms(start))
+    return {
+        'first_query_ms': first_query_ms,
+        **bench_common.summarize_latencies(latencies),
+    }
+
+
+def _break_even_queries(scan: dict, mih: dict) -> Union[int, None]:
+    """
+    :return: The number of queries after which multi-index hashing has taken
+        less time in total than the scan, or None if it never does.
+    """
+    saved_ms = scan['p50_ms'] - mih['p50_ms']
+    if saved_ms <= 0:
+        return None
+    return max(
+        0, math.ceil((mih['first_query_ms'] - scan['first_query_ms']) / saved_ms)
+    )
+
+
+def run_benchmark(
+    size: int, queries: int, batch_size: int, max_distance: int, seed: int
+) -> dict:
+    """Measures both engines against one corpus size.
+
+    :param size: The number of hashes in the corpus.
+    :param queries: The number of single queries to issue per engine.
+    :param batch_size: The number of queries per `top_k` batch.
+    :param max_distance: The search radius of each query.
+    :param seed: The seed for the random hashes.
+    :return: The results.
+    """
+    rng = random.Random(seed)
+    hashes = array('Q', (rng.getrandbits(64) for _ in range(size)))
+    image_ids = [f'known-bad-{i}' for i in range(size)]
+    targets = _perturbed_targets(hashes, queries, max_distance, rng)
+
+    result = {'size': size}
+    for backend in ('scan', 'mih'):
+        index = create_hash_index(backend, hashes=hashes, image_ids=image_ids)
+        result[backend] = _measure_queries(index, targets, max_distance)
+    result['mih_break_even_queries'] = _break_even_queries(
+        result['scan'], result['mih']
+    )
+
+    scan = create_hash_index('scan', hashes=hashes, image_ids=image_ids)
+    batch = targets[:batch_size]
+    start = time.perf_counter()
+    scan.top_k(batch, 5)
+    result['scan_top_k_per_query_ms'] = bench_common.elapsed_ms(start) / len(batch)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='1000,10000,30000,100000,300000,1000000')
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--max-distance', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+
+    sizes = [int(x) for x in args.sizes.split(',')]
+    results = [
+        run_benchmark(size, args.queries, args.batch_size, args.max_distance, args.seed)
+        for size in sizes
+    ]
+    crossover = next(
+        (r['size'] for r in results if r['mih']['p50_ms'] < r['scan']['p50_ms']), None
+    )
+    bench_common.emit_results(
+        'hash_scan', {'crossover_size': crossover, 'sizes': results}, args.output
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""Measures the peak memory and CPU time of producing the 8x8 grayscale
+thumbnail used for perceptual hashing, by image size and decode path.
+
+* `full` -- the previous path: the image is read by joining its chunks,
+  decoded at full resolution, then converted to grayscale and resized.
+* `reduced` -- `image_decode.read_limited`, then
+  `image_decode.decode_reduced`, which decodes JPEG images in draft mode,
+  then resizes.
+
+Each measurement runs in a fresh process, so that its peak RSS is not
+inflated by earlier measurements.  The image is read from a file, standing in
+for an S3 response body, so the peak includes the encoded image.  It reports
+the peak RSS above the process's RSS before reading, and the mean CPU time
+per thumbnail.
+
+Usage:
+    python benchmarks/bench_image_decode.py --megapixels 1,12,40
+"""
+
+import argparse
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import bench_common
+
+from PIL import Image
+
+import image_decode
+
+_THUMBNAIL_SIZE = 8
+
+
+def _make_jpeg(megapixels: float) -> bytes:
+    """Builds a JPEG photo-like image with a 4:3 aspect ratio."""
+    height = int((megapixels * 1000000 * 3 / 4) ** 0.5)
+    width = height * 4 // 3
+    noise = Image.effect_noise((max(1, width // 32), max(1, height // 32)), 64)
+    image = Image.merge(
+        'RGB',
+        [
+            noise.resize((width, height), Image.BICUBIC),
+            noise.transpose(Image.FLIP_LEFT_RIGHT).resize((width, height)),
+            noise.transpose(Image.FLIP_TOP_BOTTOM).resize((width, height)),
+        ],
+    )
+    output = io.BytesIO()
+    image.save(output, 'JPEG', quality=90)
+    return output.getvalue()
+
+
+def _thumbnail_full(stream, content_length: int):
+    chunks = []
+    while True:
+        chunk = stream.read(image_decode.READ_CHUNK_BYTES)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    image = Image.open(io.BytesIO(b''.join(chunks)))
+    image.load()
+    return image.convert('L').resize((_THUMBNAIL_SIZE, _THUMBNAIL_SIZE), Image.LANCZOS)
+
+
+def _thumbnail_reduced(stream, content_length: int):
+    data = image_decode.read_limited(stream, content_length)
+    min_size = _THUMBNAIL_SIZE * 8
+    image = image_decode.decode_reduced(data, (min_size, min_size), 'L')
+    return image.resize((_THUMBNAIL_SIZE, _THUMBNAIL_SIZE), Image.LANCZOS)
+
+
+_PATHS = {'full': _thumbnail_full, 'reduced': _thumbnail_reduced}
+
+
+def _max_rss_kib() -> int:
+    # ru_maxrss carries over from the parent across exec on Linux, so the
+    # peak RSS of the process's own address space is read from /proc there.
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _run_child(path: str, image_path: str, repetitions: int):
+    """Runs in the child process, printing the measurements as JSON."""
+    content_length = os.path.getsize(image_path)
+    thumbnail = _PATHS[path]
+    baseline_kib = _max_rss_kib()
+    start = time.process_time()
+    for _ in range(repetitions):
+        with open(image_path, 'rb', buffering=0) as stream:
+            thumbnail(stream, content_length)
+    cpu_s = time.process_time() - start
+    print(
+        json.dumps(
+            {
+                'peak_rss_mib': (_max_rss_kib() - baseline_kib) / 1024,
+                'cpu_ms': cpu_s * 1000 / repetitions,
+            }
+        )
+    )
+
+
+def run_benchmark(megapixels: float, repetitions: int) -> dict:
+    """Measures both paths for one image size.
+
+    :param megapixels: The size of the image.
+    :param repetitions: The number of thumbnails to produce per path.
+    :return: The results.
+    """
+    data = _make_jpeg(megapixels)
+    results = {'megapixels': megapixels, 'jpeg_bytes': len(data)}
+    with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as image_file:
+        image_file.write(data)
+    try:
+        for path in _PATHS:
+            output = subprocess.run(
+                [
+                    sys.executable,
+                    os.path.abspath(__file__),
+                    '--child',
+                    path,
+                    image_file.name,
+                    '--repetitions',
+                    str(repetitions),
+                ],
+                check=True,
+                stdout=subprocess.PIPE,
+                universal_newlines=True,
+            ).stdout
+            results[path] = json.loads(output.splitlines()[-1])
+    finally:
+        os.unlink(image_file.name)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--megapixels', default='1,12,40')
+    parser.add_argument('--repetitions', type=int, default=5)
+    parser.add_argument('--child', nargs=2, metavar=('PATH', 'IMAGE'))
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+
+    if args.child:
+        _run_child(args.child[0], args.child[1], args.repetitions)
+        return
+
+    results = [
+        run_benchmark(float(megapixels), args.repetitions)
+        for megapixels in args.megapixels.split(',')
+    ]
+    bench_common.emit_results('image_decode', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
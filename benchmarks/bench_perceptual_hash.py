@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""Compares the cost of computing perceptual hashes with `imagehash` against
+the shared-downscale engine in `perceptual_hash`.
+
+For each image this reports the mean time per image of:
+
+* `imagehash_ahash` -- the average hash alone with `imagehash`, which is what
+  the known bad scorer computed before.
+* `imagehash_all` -- all four hashes with `imagehash`, each converting and
+  resizing the image itself.
+* `engine_all` -- the shared grayscale downscale plus all four hashes from
+  `perceptual_hash.compute_hashes`.
+* `engine_batch_all` -- the four hashes of `--batch` stacked thumbnails with
+  one `perceptual_hash.hash_batch` call, excluding the downscales.
+
+Usage:
+    python benchmarks/bench_perceptual_hash.py --width 1024 --height 768
+"""
+
+import argparse
+import time
+
+import bench_common
+
+import imagehash
+import numpy as np
+
+from PIL import Image
+
+import perceptual_hash
+
+_IMAGEHASH_FUNCTIONS = (
+    imagehash.average_hash,
+    imagehash.dhash,
+    imagehash.phash,
+    imagehash.whash,
+)
+
+
+def _make_image(width: int, height: int, seed: int) -> Image.Image:
+    rng = np.random.default_rng(seed)
+    coarse = (rng.random((max(1, height // 32), max(1, width // 32))) * 255).astype(
+        np.uint8
+    )
+    return Image.fromarray(coarse).resize((width, height), Image.BICUBIC)
+
+
+def _engine_all(image: Image.Image):
+    size = perceptual_hash.DOWNSCALE_SIZE
+    thumbnail = image.convert('L').resize((size, size), Image.LANCZOS)
+    return perceptual_hash.compute_hashes(thumbnail)
+
+
+def _mean_ms(operation, images) -> float:
+    start = time.perf_counter()
+    for image in images:
+        operation(image)
+    return bench_common.elapsed_ms(start) / len(images)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--width', type=int, default=1024)
+    parser.add_argument('--height', type=int, default=768)
+    parser.add_argument('--images', type=int, default=20)
+    parser.add_argument('--batch', type=int, default=1000)
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+
+    images = [_make_image(args.width, args.height, seed) for seed in range(args.images)]
+    size = perceptual_hash.DOWNSCALE_SIZE
+    thumbnails = np.stack(
+        [
+            np.asarray(image.resize((size, size), Image.LANCZOS))
+            for image in images * (args.batch // len(images) + 1)
+        ][: args.batch]
+    )
+
+    start = time.perf_counter()
+    perceptual_hash.hash_batch(thumbnails)
+    batch_ms = bench_common.elapsed_ms(start)
+
+    results = {
+        'image_size': [args.width, args.height],
+        'mean_ms_per_image': {
+            'imagehash_ahash': _mean_ms(imagehash.average_hash, images),
+            'imagehash_all': _mean_ms(
+                lambda image: [function(image) for function in _IMAGEHASH_FUNCTIONS],
+                images,
+            ),
+            'engine_all': _mean_ms(_engine_all, images),
+            'engine_batch_all': batch_ms / args.batch,
+        },
+    }
+    bench_common.emit_results('perceptual_hash', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""Measures the cost of building a `PhraseMatcher` from a large phrase list
+and of scanning lines of detected text with it.
+
+A synthetic list of phrases of one to four words is drawn from a fixed
+vocabulary, so that phrases share prefixes as real lists do.  This reports
+the time and traced memory to build the matcher, and the mean time to scan a
+line with it and with a naive baseline that checks each phrase in turn, as
+the handler's previous exact-match lookup would have had to in order to find
+phrases inside lines.
+
+Usage:
+    python benchmarks/bench_phrase_matcher.py --phrases 100000
+"""
+
+import argparse
+import random
+import time
+import tracemalloc
+
+from typing import List
+
+import bench_common
+
+from phrase_matcher import PhraseMatcher, normalize
+
+_VOCABULARY_SIZE = 20000
+
+
+def _phrases(count: int, rng: random.Random) -> List[str]:
+    vocabulary = [f'w{i:05d}' for i in range(_VOCABULARY_SIZE)]
+    return [
+        ' '.join(rng.choice(vocabulary) for _ in range(rng.randint(1, 4)))
+        for _ in range(count)
+    ]
+
+
+def _lines(phrases: List[str], count: int, rng: random.Random) -> List[str]:
+    # Mostly words that are in no phrase, as in real images, with the
+    # occasional phrase.
+    lines = []
+    for _ in range(count):
+        words = [f'x{rng.randrange(_VOCABULARY_SIZE):05d}' for _ in range(8)]
+        if rng.random() < 0.2:
+            words.insert(rng.randrange(len(words)), rng.choice(phrases))
+        lines.append(' '.join(words))
+    return lines
+
+
+class _NaiveMatcher:
+    """Checks for each distinct normalized phrase in the normalized line."""
+
+    def __init__(self, phrases: List[str]):
+        self.__phrases = list(
+            dict.fromkeys(f" {' '.join(normalize(phrase))} " for phrase in phrases)
+        )
+
+    def count_matches(self, text: str) -> int:
+        text = f" {' '.join(normalize(text))} "
+        return sum(text.count(phrase) for phrase in self.__phrases)
+
+
+def _scan_mean_us(matcher, lines: List[str]) -> float:
+    start = time.perf_counter()
+    for line in lines:
+        matcher.count_matches(line)
+    return bench_common.elapsed_ms(start) * 1000 / len(lines)
+
+
+def run_benchmark(phrase_count: int, line_count: int, naive_line_count: int) -> dict:
+    """Measures one phrase list size.
+
+    :param phrase_count: The number of phrases.
+    :param line_count: The number of lines to scan with the matcher.
+    :param naive_line_count: The number of lines to scan with the baseline.
+    :return: The results.
+    """
+    rng = random.Random(phrase_count)
+    phrases = _phrases(phrase_count, rng)
+    lines = _lines(phrases, line_count, rng)
+
+    start = time.perf_counter()
+    matcher = PhraseMatcher(phrases)
+    build_ms = bench_common.elapsed_ms(start)
+    # Tracing slows the build, so the memory is measured in a second build.
+    tracemalloc.start()
+    try:
+        traced_matcher = PhraseMatcher(phrases)
+        memory_bytes, _ = tracemalloc.get_traced_memory()
+        del traced_matcher
+    finally:
+        tracemalloc.stop()
+
+    naive = _NaiveMatcher(phrases)
+    naive_lines = lines[:naive_line_count]
+    assert [matcher.count_matches(line) for line in naive_lines] == [
+        naive.count_matches(line) for line in naive_lines
+    ]
+    return {
+        'phrases': phrase_count,
+        'build_ms': build_ms,
+        'matcher_mib': memory_bytes / (1024 * 1024),
+        'scan_mean_us': _scan_mean_us(matcher, lines),
+        'naive_scan_mean_us': _scan_mean_us(naive, naive_lines),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--phrases', default='1000,100000')
+    parser.add_argument('--lines', type=int, default=10000)
+    parser.add_argument('--naive-lines', type=int, default=100)
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+
+    results = [
+        run_benchmark(int(phrase_count), args.lines, args.naive_lines)
+        for phrase_count in args.phrases.split(',')
+    ]
+    bench_common.emit_results('phrase_matcher', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""Measures how close an `AdaptiveRateLimiter` keeps callers to a service's
+TPS quota, and how often they are throttled, under a burst of concurrent
+callers.
+
+A stub service admits calls at `--quota-tps` using a token bucket, and
+throttles the rest.  `--threads` callers call it in a loop for `--duration-s`
+seconds, either:
+
+* `unlimited` -- calling as fast as they can, and retrying throttled calls
+  after the same jittered backoff, as the Lambdas did before rate limiting.
+* `adaptive` -- through a shared limiter whose ceiling, `--max-tps`, is above
+  the quota, as when the configured quota is wrong, so that it has to find
+  the real one from the throttles.
+
+Usage:
+    python benchmarks/bench_rate_limiter.py --quota-tps 50 --threads 32
+"""
+
+import argparse
+import threading
+import time
+
+import bench_common
+
+from rate_limiter import AdaptiveRateLimiter
+
+
+class _StubService:
+    """Admits calls at a fixed rate, and throttles the rest."""
+
+    def __init__(self, quota_tps: float, latency_ms: float):
+        self.__quota_tps = quota_tps
+        self.__latency_s = latency_ms / 1000
+        self.__lock = threading.Lock()
+        self.__tokens = 1.0
+        self.__updated = time.monotonic()
+        self.successes = 0
+        self.throttles = 0
+
+    def call(self) -> bool:
+        """
+        :return: True if the call was admitted, or False if it was throttled.
+        """
+        time.sleep(self.__latency_s)
+        with self.__lock:
+            now = time.monotonic()
+            self.__tokens = min(
+                self.__quota_tps,
+                self.__tokens + (now - self.__updated) * self.__quota_tps,
+            )
+            self.__updated = now
+            if self.__tokens < 1:
+                self.throttles += 1
+                return False
+            self.__tokens -= 1
+            self.successes += 1
+            return True
+
+
+def run_benchmark(mode: str, args) -> dict:
+    """Runs the callers against a fresh service.
+
+    :param mode: `unlimited` or `adaptive`.
+    :param args: The command line arguments.
+    :return: The results.
+    """
+    service = _StubService(args.quota_tps, args.latency_ms)
+    limiter = AdaptiveRateLimiter('bench', args.max_tps)
+    end = time.monotonic() + args.duration_s
+
+    def call_until_end():
+        attempts = 0
+        while time.monotonic() < end:
+            if mode == 'adaptive':
+                limiter.acquire(args.duration_s)
+            if service.call():
+                attempts = 0
+                if mode == 'adaptive':
+                    limiter.on_success()
+                continue
+            attempts += 1
+            if mode == 'adaptive':
+                limiter.on_throttle()
+            time.sleep(limiter.backoff_s(attempts))
+
+    threads = [threading.Thread(target=call_until_end) for _ in range(args.threads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed_s = bench_common.elapsed_ms(start) / 1000
+
+    calls = service.successes + service.throttles
+    return {
+        'mode': mode,
+        'quota_tps': args.quota_tps,
+        'success_tps': service.successes / elapsed_s,
+        'quota_used': service.successes / elapsed_s / args.quota_tps,
+        'throttled_fraction': service.throttles / calls if calls else 0.0,
+        'final_rate_tps': limiter.rate if mode == 'adaptive' else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--quota-tps', type=float, default=50)
+    parser.add_argument('--max-tps', type=float, default=80)
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--latency-ms', type=float, default=20)
+    parser.add_argument('--duration-s', type=float, default=10)
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+
+    results = [run_benchmark(mode, args) for mode in ('unlimited', 'adaptive')]
+    bench_common.emit_results('rate_limiter', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""Measures score store throughput under concurrent updates for the same
+images.
+
+Each worker merges scores from every scorer into a small, shared set of images,
+so that the workers contend on the same keys, as happens when the detection
+Lambdas report on a popular image at the same time.  After each run the store
+is checked to make sure no scorer's update was lost.
+
+The `memory` backend is driven by threads.  The `sqlite` backend is driven by
+threads and by processes, since separate processes sharing one database file
+is how it would be deployed.
+
+Usage:
+    python benchmarks/bench_score_store.py --workers 1,4,16
+"""
+
+import argparse
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+
+import bench_common
+from score_store import create_score_store
+
+_SCORERS = ['detect_known_bad_content', 'detect_spammy_words', 'detect_adult_content']
+
+
+def _run_updates(store, worker: int, updates: int, images: int):
+    for i in range(updates):
+        store.merge_score(
+            'account',
+            f's3://bucket/image-{i % images}.png',
+            f'{_SCORERS[i % len(_SCORERS)]}-{worker}',
+            (i % 100) / 100,
+        )
+
+
+def _process_worker(path: str, worker: int, updates: int, images: int):
+    _run_updates(create_score_store('sqlite', path=path), worker, updates, images)
+
+
+def run_benchmark(
+    backend: str, mode: str, workers: int, updates: int, images: int
+) -> dict:
+    """Runs one configuration.
+
+    :param backend: `memory` or `sqlite`.
+    :param mode: `threads` or `processes`.
+    :param workers: The number of concurrent workers.
+    :param updates: The number of merges per worker.
+    :param images: The number of distinct images the merges are spread over.
+    :return: The results.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'scores.db')
+        store = create_score_store(backend, path=path)
+
+        if mode == 'threads':
+            runners = [
+                threading.Thread(target=_run_updates, args=(store, w, updates, images))
+                for w in range(workers)
+            ]
+        else:
+            runners = [
+                multiprocessing.Process(
+                    target=_process_worker, args=(path, w, updates, images)
+                )
+                for w in range(workers)
+            ]
+
+        start = time.perf_counter()
+        for runner in runners:
+            runner.start()
+        for runner in runners:
+            runner.join()
+        elapsed_s = time.perf_counter() - start
+
+        # Count the distinct scorers each image should end up with.
+        expected = {}
+        for i in range(updates):
+            expected.setdefault(i % images, set()).add(_SCORERS[i % len(_SCORERS)])
+        lost = sum(
+            len(scorers) * workers
+            - len(store.get_scores('account', f's3://bucket/image-{image}.png'))
+            for image, scorers in expected.items()
+        )
+
+    total = workers * updates
+    return {
+        'backend': backend,
+        'mode': mode,
+        'workers': workers,
+        'updates': total,
+        'updates_per_second': total / elapsed_s,
+        'lost_updates': lost,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', default='1,4,16')
+    parser.add_argument('--updates', type=int, default=3000)
+    parser.add_argument('--images', type=int, default=10)
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+
+    results = []
+    for workers in (int(x) for x in args.workers.split(',')):
+        for backend, mode in (
+            ('memory', 'threads'),
+            ('sqlite', 'threads'),
+            ('sqlite', 'processes'),
+        ):
+            results.append(
+                run_benchmark(backend, mode, workers, args.updates, args.images)
+            )
+    bench_common.emit_results('score_store', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
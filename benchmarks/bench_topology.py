@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""Compares the end-to-end latency of the fan-out and fused pipeline
+topologies, using stubbed AWS clients.
+
+The latency of an image is measured from the analyze_image Lambda publishing
+it to the moment its final spam verdict is computed.
+
+* `fanout` -- the three detection Lambdas run concurrently, each fetching the
+  image itself, and each publishes its score to the update spam score topic,
+  which invokes the update_spam_score Lambda once per score.  The image is
+  scored when the last of the three updates finishes.
+* `fused` -- the DetectAll Lambda runs the three scorers concurrently against
+  one shared fetch of the image and updates the scores directly.
+* `cascade` -- the DetectAll Lambda in cascade mode, which runs the scorers one
+  at a time, cheapest first, and skips the rest once the image is known to be
+  spam.  Rekognition detects explicit content in `--spam-fraction` of the
+  images.
+
+Each SNS delivery adds `--delivery-ms` and each Lambda invocation adds
+`--invoke-ms` of modeled overhead, on top of the stubbed service latencies.
+
+Usage:
+    python benchmarks/bench_topology.py --images 50
+"""
+
+import argparse
+import contextlib
+import io
+import threading
+import time
+
+import aws_stubs
+import bench_common
+import lambda_common
+import sns_publisher
+import update_spam_score
+
+from detect_adult_content import DetectAdultContentHandler
+from detect_all import DetectAllHandler
+from detect_known_bad_content import DetectKnownBadContentHandler
+from detect_spammy_words import DetectSpammyWordsHandler
+from image_context import ImageContext
+
+_SCORERS = [
+    DetectKnownBadContentHandler,
+    DetectSpammyWordsHandler,
+    DetectAdultContentHandler,
+]
+
+
+class _Topology:
+    def __init__(
+        self, delivery_ms: float, invoke_ms: float, sns: aws_stubs.StubSnsClient
+    ):
+        self.delivery_ms = delivery_ms
+        self.invoke_ms = invoke_ms
+        self.sns = sns
+        self.invocations = 0
+
+    def invoke(self, handler, event: dict):
+        """Delivers an event to a Lambda, including the modeled delivery and
+        invocation overhead.
+        """
+        self.invocations += 1
+        time.sleep((self.delivery_ms + self.invoke_ms) / 1000)
+        return handler(event, aws_stubs.StubLambdaContext())
+
+
+def _score_fanout(topology: _Topology, message: str):
+    def run_detection_lambda(scorer_class):
+        topology.invoke(scorer_class().handle_request, aws_stubs.sns_event([message]))
+        for score_message in topology.sns.take_messages():
+            topology.invoke(
+                update_spam_score.handler, aws_stubs.sns_event([score_message])
+            )
+
+    threads = [
+        threading.Thread(target=run_detection_lambda, args=(scorer_class,))
+        for scorer_class in _SCORERS
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def _score_fused(topology: _Topology, message: str):
+    topology.invoke(DetectAllHandler().handle_request, aws_stubs.sns_event([message]))
+
+
+def _score_cascade(topology: _Topology, message: str):
+    topology.invoke(
+        DetectAllHandler(cascade=True).handle_request, aws_stubs.sns_event([message])
+    )
+
+
+_TOPOLOGIES = {
+    'fanout': _score_fanout,
+    'fused': _score_fused,
+    'cascade': _score_cascade,
+}
+
+
+def run_benchmark(name: str, images: int, clients: aws_stubs.StubClients, args) -> dict:
+    """Scores `images` images with one topology.
+
+    :param name: `fanout`, `fused` or `cascade`.
+    :param images: The number of images to score.
+    :param clients: The installed stub clients.
+    :param args: The command line arguments.
+    :return: The results.
+    """
+    topology = _Topology(args.delivery_ms, args.invoke_ms, clients.sns)
+    score = _TOPOLOGIES[name]
+
+    original_for_payload = ImageContext.for_payload
+    if name == 'fanout':
+        # Separate Lambdas do not share memory, so each scorer must fetch the
+        # image itself.
+        ImageContext.for_payload = classmethod(lambda cls, payload: cls(payload))
+    calls_before = (clients.s3.calls, clients.rekognition.calls, clients.sns.calls)
+
+    latencies = []
+    rekognition_requests = []
+    try:
+        for i in range(images):
+            message = aws_stubs.analyze_image_message(
+                f's3://bucket/{name}-{i}.jpg', root_trace_id=f'root-{i}'
+            )
+            rekognition_calls_before = clients.rekognition.calls
+            start = time.perf_counter()
+            # The handlers log every step, which would swamp the results.
+            with contextlib.redirect_stdout(io.StringIO()):
+                score(topology, message)
+            latencies.append(bench_common.elapsed_ms(start))
+            rekognition_requests.append(
+                clients.rekognition.calls - rekognition_calls_before
+            )
+    finally:
+        ImageContext.for_payload = original_for_payload
+
+    return {
+        'topology': name,
+        'latency': bench_common.summarize_latencies(latencies),
+        'lambda_invocations_per_image': topology.invocations / images,
+        's3_requests_per_image': (clients.s3.calls - calls_before[0]) / images,
+        'rekognition_requests_per_image': (clients.rekognition.calls - calls_before[1])
+        / images,
+        'rekognition_requests_p50': bench_common.percentile(
+            sorted(rekognition_requests), 0.5
+        ),
+        'sns_publishes_per_image': (clients.sns.calls - calls_before[2]) / images,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--images', type=int, default=50)
+    parser.add_argument('--s3-ms', type=float, default=30)
+    parser.add_argument('--rekognition-ms', type=float, default=150)
+    parser.add_argument('--sns-ms', type=float, default=20)
+    parser.add_argument('--delivery-ms', type=float, default=50)
+    parser.add_argument('--invoke-ms', type=float, default=10)
+    parser.add_argument('--spam-fraction', type=float, default=0.6)
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+
+    clients = aws_stubs.install(
+        aws_stubs.make_image_bytes(),
+        s3_latency_ms=args.s3_ms,
+        rekognition_latency_ms=args.rekognition_ms,
+        sns_latency_ms=args.sns_ms,
+        spam_fraction=args.spam_fraction,
+    )
+    # The SNS publishes go through the stub client.
+    assert lambda_common._sns is clients.sns
+    assert sns_publisher._sns is clients.sns
+
+    results = [run_benchmark(name, args.images, clients, args) for name in _TOPOLOGIES]
+    bench_common.emit_results('topology', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""Measures the throughput of a detection handler run as a long-running
+worker consuming a local SQLite work queue, using stubbed AWS clients.
+
+The queue is filled with one message per image, then a `Worker` drains it.
+This reports the images scored per second of wall time, and per second of
+CPU time used by the process, which is the throughput per core once the
+worker is CPU bound.
+
+Every image has a different URL, so each is fetched and sent to Rekognition
+separately.
+
+Usage:
+    python benchmarks/bench_worker.py --images 200 --concurrency 1,8,32
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import tempfile
+import time
+
+import aws_stubs
+import bench_common
+
+from image_context import ImageContext
+from work_queue import SqliteWorkQueue, WorkQueue
+from worker import Worker, load_handler_class
+
+
+def run_benchmark(handler_name: str, images: int, concurrency: int) -> dict:
+    """Scores `images` images with a worker.
+
+    :param handler_name: The name of the handler.
+    :param images: The number of images.
+    :param concurrency: The concurrency of the worker.
+    :return: The results.
+    """
+    handler_class = load_handler_class(handler_name)
+    with tempfile.TemporaryDirectory() as directory:
+        queue = SqliteWorkQueue(os.path.join(directory, 'queue.db'))
+        messages = [
+            aws_stubs.analyze_image_message(
+                f's3://bucket/{handler_name}-{concurrency}-{i}.jpg',
+                root_trace_id=f'root-{i}',
+            )
+            for i in range(images)
+        ]
+        for start in range(0, images, WorkQueue.MAX_BATCH_SIZE):
+            queue.send_messages(messages[start : start + WorkQueue.MAX_BATCH_SIZE])
+
+        ImageContext.clear_shared()
+        worker = Worker(queue, handler_class, concurrency=concurrency, wait_time_s=0.1)
+        start_cpu = time.process_time()
+        start = time.perf_counter()
+        # The handlers log every step, which would swamp the results.
+        with contextlib.redirect_stdout(io.StringIO()):
+            stats = worker.run(exit_when_idle=True)
+        elapsed_s = bench_common.elapsed_ms(start) / 1000
+        cpu_s = time.process_time() - start_cpu
+        assert stats['processed'] == images and len(queue) == 0, stats
+
+    return {
+        'handler': handler_name,
+        'concurrency': concurrency,
+        'images': images,
+        'images_per_second': images / elapsed_s,
+        'images_per_cpu_second': images / cpu_s,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--handlers', default='detect_adult_content,detect_spammy_words'
+    )
+    parser.add_argument('--images', type=int, default=200)
+    parser.add_argument('--concurrency', default='1,8,32')
+    parser.add_argument('--s3-ms', type=float, default=30)
+    parser.add_argument('--rekognition-ms', type=float, default=150)
+    parser.add_argument('--sns-ms', type=float, default=20)
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+
+    aws_stubs.install(
+        aws_stubs.make_image_bytes(),
+        s3_latency_ms=args.s3_ms,
+        rekognition_latency_ms=args.rekognition_ms,
+        sns_latency_ms=args.sns_ms,
+    )
+
+    results = [
+        run_benchmark(handler_name, args.images, int(concurrency))
+        for handler_name in args.handlers.split(',')
+        for concurrency in args.concurrency.split(',')
+    ]
+    bench_common.emit_results('worker', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
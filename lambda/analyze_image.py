@@ -1,5 +1,3 @@
-import traceback
-
 from lambda_common import (
     publish_to_analyze_image_sns_topic,
     return_message,
@@ -9,6 +7,18 @@ from lambda_common import (
     LogContext,
 )
 
+# The fields required in the body of a request.  The root trace id is assigned
+# here.
+REQUIRED_FIELDS = frozenset(
+    {
+        Constants.IMAGE_URL,
+        Constants.POST_ID,
+        Constants.ACCOUNT_ID,
+        Constants.SOURCE_DEVICE,
+        Constants.CREATED_TIMESTAMP,
+    }
+)
+
 
 def handler(event, context):
     root_span_id = context.aws_request_id
@@ -24,18 +34,10 @@ def handler(event, context):
         log_context.log_start_message()
 
         if 'body' not in event:
+            log_context.log_end_message(400, 'No POST data received')
             return return_message(400, 'Error: no POST data received')
 
-        body = parse_json(
-            event['body'],
-            required_fields={
-                Constants.IMAGE_URL,
-                Constants.POST_ID,
-                Constants.ACCOUNT_ID,
-                Constants.SOURCE_DEVICE,
-                Constants.CREATED_TIMESTAMP,
-            },
-        )
+        body = parse_json(event['body'], required_fields=REQUIRED_FIELDS)
 
         log_context.log(
             f"analyzing_image image={body[Constants.IMAGE_URL]} "
@@ -59,7 +61,10 @@ def handler(event, context):
             f"{root_span_id}",
         )
     except HandlerError as e:
-        print(f"[ERROR] {e}: ")
-        traceback.print_exc()
+        log_context.log_error(str(e), e)
         log_context.log_end_message(e.status_code, f"Failed due to exception: {e}")
         return e.create_response()
+    except Exception as e:
+        # Emit the end message so the invocation's buffered logs are written.
+        log_context.log_end_message(500, f"Failed due to exception: {e!r}")
+        raise
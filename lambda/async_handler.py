@@ -0,0 +1,396 @@
+"""Detection handlers that score the images of a batch concurrently with
+asyncio.
+
+See `AsyncDetectionHandler`.
+"""
+
+import os
+
+from typing import Awaitable, Callable, Dict, Iterable, List, Union
+
+from aws_clients import lazy_import
+from dedup_store import DedupStore
+from image_context import ImageContext
+from lambda_common import (
+    DetectionHandler,
+    HandlerError,
+    ImagePayload,
+    LogContext,
+    S3FetchError,
+    complete_sns_records,
+    get_cached_score,
+    get_dedup_keys,
+    get_dedup_store,
+    get_record_trace_id,
+    get_score_cache,
+    handling_image_record,
+    is_duplicate_record,
+    log_error,
+    log_score_computed,
+    mark_records_processed,
+    publish_to_update_spam_score_sns_topic_async,
+    receive_records_from_sns_topic,
+    run_blocking,
+    set_invocation_deadline,
+)
+from score_cache import ScoreCache
+from sns_publisher import SnsBatchPublisher
+
+_asyncio = lazy_import('asyncio')
+
+
+async def _gather_limited(awaitables: Iterable[Awaitable], limit: int) -> list:
+    """Awaits the awaitables concurrently, at most `limit` at a time.
+
+    :param awaitables: The awaitables.
+    :param limit: The most to await at once.
+    :return: The result of each awaitable, or the exception it raised, in
+        order.
+    """
+    semaphore = _asyncio.Semaphore(limit)
+
+    async def limited(awaitable: Awaitable):
+        async with semaphore:
+            return await awaitable
+
+    results = await _asyncio.gather(
+        *(limited(awaitable) for awaitable in awaitables), return_exceptions=True
+    )
+    for result in results:
+        # Cancellation and the like are not failures of the awaitable.
+        if isinstance(result, BaseException) and not isinstance(result, Exception):
+            raise result
+    return results
+
+
+class AsyncDetectionHandler:
+    """Base class for handlers that calculate spam scores for many images at
+    once with asyncio.
+
+    Scorers spend most of their time waiting on S3, Rekognition and SNS, so
+    scoring the images of a batch concurrently overlaps those waits.  Unlike a
+    `DetectionHandler`, an instance keeps no state for the image it is
+    scoring, so it may score any number of images at the same time, up to
+    `max_concurrency`.
+
+    Derived classes override the coroutine `_score_image`.  They should read
+    the image through the `_async` methods of the `ImageContext` they are
+    given, and call `rekognition_async` rather than `rekognition`, so that
+    they never block the event loop.
+
+    Use `SyncDetectionHandlerAdapter` to run a `DetectionHandler` this way.
+    """
+
+    # See `DetectionHandler.SCORER_VERSION`.
+    SCORER_VERSION = DetectionHandler.SCORER_VERSION
+
+    def __init__(
+        self,
+        handler_name: str,
+        score_cache: ScoreCache = None,
+        max_concurrency: int = None,
+        dedup_store: DedupStore = None,
+    ):
+        """Creates an instance.
+
+        :param handler_name: The name of the handler deriving this class.
+        :param score_cache: The cache of previously computed scores.  If None,
+            the cache configured by the environment is used, if any.
+        :param max_concurrency: The most images scored at once.  If None, set
+            by the `DETECTION_MAX_CONCURRENCY` environment variable (default
+            8).
+        :param dedup_store: The store of the records already processed.  If
+            None, the store configured by the environment is used, if any.
+        """
+        if max_concurrency is None:
+            max_concurrency = int(os.environ.get('DETECTION_MAX_CONCURRENCY', '8'))
+        if max_concurrency < 1:
+            raise ValueError(f"Invalid max_concurrency: {max_concurrency}")
+        self.__handler_name = handler_name
+        self.__score_cache = (
+            score_cache if score_cache is not None else get_score_cache()
+        )
+        self.__max_concurrency = max_concurrency
+        self.__dedup_store = (
+            dedup_store if dedup_store is not None else get_dedup_store()
+        )
+
+    @property
+    def handler_name(self) -> str:
+        """
+        :return: The name of the handler, which is also the name of its
+            scoring algorithm.
+        """
+        return self.__handler_name
+
+    @property
+    def max_concurrency(self) -> int:
+        """
+        :return: The most images scored at once.
+        """
+        return self.__max_concurrency
+
+    def handle_request(self, event: dict, context) -> dict:
+        """Handles a Lambda invocation, running `handle_request_async` in a new
+        event loop.
+
+        :param event: The event passed into the Lambda invocation.
+        :param context: The context passed into the Lambda invocation.
+        :return: The response to return for the Lambda invocation.
+        """
+        return _asyncio.run(self.handle_request_async(event, context))
+
+    async def handle_request_async(self, event: dict, context) -> dict:
+        """Handles a Lambda invocation, scoring the images of its records
+        concurrently.
+
+        As with `DetectionHandler.handle_request`, a failure scoring one record
+        does not prevent the others from being scored, the scores are
+        published in batches once every record has been scored, and records
+        that were already scored are skipped if a dedup store is enabled.
+
+        :param event: The event passed into the Lambda invocation.
+        :param context: The context passed into the Lambda invocation.
+        :return: The response to return for the Lambda invocation.
+        """
+        # The records' tasks inherit the deadline.
+        set_invocation_deadline(context)
+        try:
+            records = receive_records_from_sns_topic(event)
+        except HandlerError as e:
+            log_error(None, str(e), e)
+            return e.create_response(for_sns_topic=True)
+
+        publisher = SnsBatchPublisher()
+        processed_keys: Dict[str, List[str]] = {}
+        trace_ids = [
+            get_record_trace_id(context, records, index)
+            for index in range(len(records))
+        ]
+        outcomes = await _gather_limited(
+            (
+                self._handle_record_async(
+                    record, context, trace_id, publisher, processed_keys
+                )
+                for record, trace_id in zip(records, trace_ids)
+            ),
+            self.__max_concurrency,
+        )
+        # Flushing the publisher blocks on SNS.
+        response = await run_blocking(
+            complete_sns_records,
+            records,
+            trace_ids,
+            outcomes,
+            'Hello, you have reached {}.'.format(self.__handler_name),
+            publisher=publisher,
+        )
+        # Only once the scores are published, so that a failed publish is
+        # retried on redelivery.
+        await run_blocking(
+            mark_records_processed, self.__dedup_store, response, processed_keys
+        )
+        return response
+
+    async def _handle_record_async(
+        self,
+        record: dict,
+        context,
+        trace_id: str,
+        publisher: SnsBatchPublisher,
+        processed_keys: Dict[str, List[str]],
+    ) -> Union[LogContext, None]:
+        """Scores the image in a single SNS record and buffers its score in
+        the publisher.
+
+        A `HandlerError` is raised if the record could not be processed.
+
+        :param record: The SNS record.
+        :param context: The context passed into the Lambda invocation.
+        :param trace_id: The id of the trace for processing this record.
+        :param publisher: The publisher to buffer the score in.
+        :param processed_keys: The dedup keys of the records scored, by SNS
+            MessageId, which this record's keys are added to.
+        :return: The record's log context, whose end message is emitted once
+            the publisher has been flushed, or None if the record was a
+            duplicate.
+        """
+        with handling_image_record(self.__handler_name, record, context, trace_id) as (
+            image_payload,
+            log_context,
+        ):
+            keys = get_dedup_keys(
+                self.__handler_name,
+                record,
+                image_payload.root_trace_id,
+                self.__handler_name,
+            )
+            # The store may be a database, so it is read off the event loop.
+            if await run_blocking(
+                is_duplicate_record, self.__dedup_store, keys, log_context
+            ):
+                log_context.log_end_message(200, "Skipped duplicate")
+                return None
+
+            score = await self.score_image(image_payload, log_context)
+
+            await publish_to_update_spam_score_sns_topic_async(
+                image_payload,
+                self.__handler_name,
+                score,
+                trace_id,
+                log_context=log_context,
+                publisher=publisher,
+            )
+
+            if keys:
+                processed_keys[record['Sns']['MessageId']] = keys
+            return log_context
+
+    async def score_images(
+        self, image_payloads: List[ImagePayload], log_contexts: List[LogContext]
+    ) -> List[Union[float, Exception]]:
+        """Scores a batch of images concurrently, at most `max_concurrency` at
+        a time.
+
+        :param image_payloads: The images to score.
+        :param log_contexts: The log context to report the scoring of each
+            image with.
+        :return: The spam score of each image, or the exception raised scoring
+            it.
+        """
+        return await _gather_limited(
+            (
+                self.score_image(image_payload, log_context)
+                for image_payload, log_context in zip(image_payloads, log_contexts)
+            ),
+            self.__max_concurrency,
+        )
+
+    async def score_image(
+        self,
+        image_payload: ImagePayload,
+        log_context: LogContext,
+        image_context: ImageContext = None,
+    ) -> float:
+        """Scores an image, consulting the score cache if one is enabled.
+
+        :param image_payload: The image to score.
+        :param log_context: The log context to report the scoring with.
+        :param image_context: The context to read the image through.  If None,
+            the context shared by the process is used.
+        :return: The spam score from 0 to 1.
+        """
+        if image_context is None:
+            image_context = ImageContext.for_payload(image_payload)
+
+        with log_context.span(f"score.{self.__handler_name}"):
+            score = await self.__score_image_with_cache(
+                image_payload, log_context, image_context
+            )
+
+        log_score_computed(log_context, self.__handler_name, image_payload, score)
+        return score
+
+    async def __score_image_with_cache(
+        self,
+        image_payload: ImagePayload,
+        log_context: LogContext,
+        image_context: ImageContext,
+    ) -> float:
+        """Like `DetectionHandler`'s, returns the cached score for the image if
+        there is one, otherwise scores it with `_score_image` and caches the
+        result.
+        """
+        if self.__score_cache is None:
+            return await self._score_image(image_payload, log_context, image_context)
+
+        try:
+            content_id = await image_context.etag_async(log_context)
+        except S3FetchError:
+            content_id = None
+        key, score = get_cached_score(
+            self.__score_cache,
+            self.__handler_name,
+            self.SCORER_VERSION,
+            content_id,
+            log_context,
+        )
+        if score is None:
+            score = await self._score_image(image_payload, log_context, image_context)
+            if key is not None:
+                self.__score_cache.put(key, score)
+        return score
+
+    # noinspection PyMethodMayBeStatic
+    async def _score_image(
+        self,
+        _image_payload: ImagePayload,
+        _log_context: LogContext,
+        _image_context: ImageContext,
+    ) -> float:
+        """Derived classes must override this to define how they will calculate
+        spam scores.
+
+        :param _image_payload: The image to score.
+        :param _log_context: The log context to report the scoring with.
+        :param _image_context: The context to read the image through.
+        :return: The spam score from 0 to 1.
+        """
+        return 0
+
+
+class SyncDetectionHandlerAdapter(AsyncDetectionHandler):
+    """Runs a `DetectionHandler` as an `AsyncDetectionHandler`, so that the
+    existing handlers can score the images of a batch concurrently::
+
+        SyncDetectionHandlerAdapter(DetectAdultContentHandler).handle_request(
+            event, context
+        )
+
+    Each image is scored by the handler's own `score_image`, on a thread.
+    Since a `DetectionHandler` scores one image at a time, the adapter keeps a
+    pool of handlers, creating more as needed, up to one per image being
+    scored.  The handlers' own score caches are used.  Records are deduplicated
+    by the adapter, as the handlers' `handle_request` is not used.
+    """
+
+    def __init__(
+        self,
+        handler_factory: Callable[[], DetectionHandler],
+        max_concurrency: int = None,
+        dedup_store: DedupStore = None,
+    ):
+        """Creates an instance.
+
+        :param handler_factory: Creates a handler, such as the handler's class.
+        :param max_concurrency: See `AsyncDetectionHandler`.
+        :param dedup_store: See `AsyncDetectionHandler`.
+        """
+        handler = handler_factory()
+        super().__init__(
+            handler.handler_name,
+            max_concurrency=max_concurrency,
+            dedup_store=dedup_store,
+        )
+        self.__handler_factory = handler_factory
+        # The handlers not scoring an image.  Only used from the event loop.
+        self.__idle_handlers = [handler]
+
+    async def score_image(
+        self,
+        image_payload: ImagePayload,
+        log_context: LogContext,
+        image_context: ImageContext = None,
+    ) -> float:
+        """See `AsyncDetectionHandler.score_image`."""
+        if self.__idle_handlers:
+            handler = self.__idle_handlers.pop()
+        else:
+            handler = self.__handler_factory()
+        try:
+            return await run_blocking(
+                handler.score_image, image_payload, log_context, image_context
+            )
+        finally:
+            self.__idle_handlers.append(handler)
@@ -0,0 +1,464 @@
+"""The AWS clients used by the Lambdas, and the lazy loading of their heavy
+dependencies.
+
+Cold starts are paid for by the first invocation of each container, so the
+modules and AWS clients that not every invocation needs are loaded on first
+use, with `lazy_import` and `lazy_client`, rather than while the container
+initializes.  A `ColdStartTracker` records what initializing and lazy loading
+cost, for the invocation that paid it to report.
+
+Clients are built by `create_aws_client`, with connection and retry settings
+tuned for each service, and hooks that record every call in the log context
+of the invocation that made it.
+"""
+
+import contextvars
+import importlib
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+from typing import Dict, List, Set, Tuple
+
+# When this container began initializing.  Every handler imports this module
+# early, so this is close to when the runtime started loading the handler.
+_INIT_START_TIME = time.time()
+
+
+class ColdStartTracker:
+    """Records the one-time costs a container pays to get ready to handle
+    requests, so they can be reported in the logs of the invocation that paid
+    them.
+
+    The first start message emitted by the container reports that it is a
+    cold start, along with the time from the start of initialization to the
+    first invocation and any costs recorded during initialization.  Costs
+    recorded later, such as a client built on first use, are reported in the
+    end message of the invocation that built it.  Each cost is reported once.
+
+    The clients built by `create_aws_client` also record the time to first byte
+    of the first call to each service as `ttfb_ms.<service>`, since that call
+    pays for resolving the endpoint, loading credentials, and opening the
+    connection.
+    """
+
+    def __init__(self, init_start_time: float):
+        """Creates an instance.
+
+        :param init_start_time: When the container began initializing, as
+            returned by `time.time`.
+        """
+        self.__init_start_time = init_start_time
+        self.__lock = threading.Lock()
+        self.__started = False
+        # The (field, milliseconds) costs not yet reported.
+        self.__pending: List[Tuple[str, int]] = []
+        # The fields recorded with `record_once`.
+        self.__recorded_once: Set[str] = set()
+
+    def record(self, field: str, duration_ms: float):
+        """Records a one-time cost.
+
+        :param field: The name of the log field to report it with, such as
+            `client_ms.sns`.
+        :param duration_ms: How long it took.
+        """
+        with self.__lock:
+            self.__pending.append((field, int(duration_ms)))
+
+    def record_once(self, field: str, duration_ms: float):
+        """Records a cost unless one was already recorded for the field by
+        this method, such as the latency of the first call to a service.
+
+        :param field: The name of the log field to report it with.
+        :param duration_ms: How long it took.
+        """
+        with self.__lock:
+            if field in self.__recorded_once:
+                return
+            self.__recorded_once.add(field)
+            self.__pending.append((field, int(duration_ms)))
+
+    @contextmanager
+    def timed(self, field: str):
+        """Records how long the body of the `with` statement takes.
+
+        :param field: The name of the log field to report it with.
+        """
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(field, (time.perf_counter() - start_time) * 1000)
+
+    def take_start_fields(self) -> str:
+        """
+        :return: The fields to append to a start message.  This is empty
+            unless this is the container's first invocation.
+        """
+        with self.__lock:
+            if self.__started:
+                return ''
+            self.__started = True
+        init_to_handler_ms = round((time.time() - self.__init_start_time) * 1000)
+        return (
+            f" cold_start=true init_to_handler_ms={init_to_handler_ms}"
+            f"{self.take_fields()}"
+        )
+
+    def take_fields(self) -> str:
+        """
+        :return: The fields for the costs recorded since they were last taken.
+        """
+        with self.__lock:
+            pending = self.__pending
+            self.__pending = []
+        return ''.join(f" {field}={duration_ms}" for field, duration_ms in pending)
+
+
+# The one-time costs of this container.
+_cold_start = ColdStartTracker(_INIT_START_TIME)
+
+
+def get_cold_start_tracker() -> ColdStartTracker:
+    """
+    :return: The tracker of the one-time costs of this container, which
+        `LogContext` reports in the invocation that paid them.
+    """
+    return _cold_start
+
+
+def timed_cold_start_cost(field: str):
+    """Returns a context manager that records how long its body takes as a
+    one-time cost of the container, such as loading a data file.  See
+    `ColdStartTracker`.
+
+    :param field: The name of the log field to report it with, such as
+        `load_ms.spam_phrases`.
+    """
+    return _cold_start.timed(field)
+
+
+class _LazyModule:
+    """Stands in for a module that is only imported when one of its attributes
+    is first used.
+    """
+
+    def __init__(self, name: str):
+        self.__name = name
+        self.__module = None
+        self.__lock = threading.Lock()
+
+    def __getattr__(self, attribute: str):
+        module = self.__module
+        if module is None:
+            with self.__lock:
+                if self.__module is None:
+                    with _cold_start.timed(f"import_ms.{self.__name}"):
+                        self.__module = importlib.import_module(self.__name)
+                module = self.__module
+        return getattr(module, attribute)
+
+
+def lazy_import(name: str):
+    """Returns a stand-in for a module that imports it the first time one of
+    its attributes is used, and records how long the import took with the
+    container's `ColdStartTracker`.
+
+    Use this for heavy modules that are not needed by every invocation, so
+    that they do not add to the container's initialization time.
+
+    :param name: The fully qualified name of the module, such as `PIL.Image`.
+    :return: The stand-in.
+    """
+    return _LazyModule(name)
+
+
+_boto3 = lazy_import('boto3')
+_botocore_config = lazy_import('botocore.config')
+
+# The log context of the invocation running in the current thread (or asyncio
+# task).  Set by `record_aws_calls_in`, and used by the client hooks to
+# attribute calls to the invocation that made them.
+_current_log_context = contextvars.ContextVar('current_log_context', default=None)
+
+
+def record_aws_calls_in(log_context):
+    """Makes a log context the one the AWS calls made from the current thread
+    (and threads started with a copy of its `contextvars` context) are
+    recorded in.  See `create_aws_client` for the fields recorded.
+
+    :param log_context: The `LogContext` of the invocation.
+    """
+    _current_log_context.set(log_context)
+
+
+# The error codes AWS services use to report throttling.
+_THROTTLING_ERROR_CODES = frozenset(
+    [
+        'Throttling',
+        'ThrottlingException',
+        'ThrottledException',
+        'RequestThrottledException',
+        'TooManyRequestsException',
+        'ProvisionedThroughputExceededException',
+        'RequestLimitExceeded',
+        'SlowDown',
+        'ThrottlingError',
+    ]
+)
+
+
+class AwsClientSettings:
+    """The connection and retry settings for the client of one AWS service."""
+
+    def __init__(
+        self,
+        max_pool_connections: int = 10,
+        connect_timeout_s: float = 2,
+        read_timeout_s: float = 10,
+        max_attempts: int = 4,
+        retry_mode: str = 'adaptive',
+    ):
+        """Creates an instance.
+
+        :param max_pool_connections: The maximum number of connections kept
+            open to the service.  This bounds how many calls can be in flight
+            at once, so it should be at least the number of threads that use
+            the client concurrently.
+        :param connect_timeout_s: How long to wait to establish a connection.
+        :param read_timeout_s: How long to wait for a response.
+        :param max_attempts: The maximum number of attempts for each call,
+            including the first.
+        :param retry_mode: The botocore retry mode.  Both `standard` and
+            `adaptive` draw retries from botocore's retry quota, which acts as
+            the retry budget: once too many calls are failing, retries stop
+            until calls succeed again.  `adaptive` also rate limits the client
+            after it is throttled.
+        """
+        self.max_pool_connections = max_pool_connections
+        self.connect_timeout_s = connect_timeout_s
+        self.read_timeout_s = read_timeout_s
+        self.max_attempts = max_attempts
+        self.retry_mode = retry_mode
+
+    def with_environment_overrides(self, service_name: str) -> 'AwsClientSettings':
+        """Returns a copy of these settings, overridden by any environment
+        variables for the service.  For example, for `s3`:
+
+        * `S3_CLIENT_MAX_POOL_CONNECTIONS`
+        * `S3_CLIENT_CONNECT_TIMEOUT_S`
+        * `S3_CLIENT_READ_TIMEOUT_S`
+        * `S3_CLIENT_MAX_ATTEMPTS`
+        * `S3_CLIENT_RETRY_MODE`
+
+        :param service_name: The name of the AWS service.
+        :return: The settings.
+        """
+        prefix = f"{service_name.upper().replace('-', '_')}_CLIENT_"
+
+        def get(name: str, default, convert):
+            value = os.environ.get(prefix + name, None)
+            return default if value is None else convert(value)
+
+        return AwsClientSettings(
+            max_pool_connections=get(
+                'MAX_POOL_CONNECTIONS', self.max_pool_connections, int
+            ),
+            connect_timeout_s=get('CONNECT_TIMEOUT_S', self.connect_timeout_s, float),
+            read_timeout_s=get('READ_TIMEOUT_S', self.read_timeout_s, float),
+            max_attempts=get('MAX_ATTEMPTS', self.max_attempts, int),
+            retry_mode=get('RETRY_MODE', self.retry_mode, str),
+        )
+
+
+# The default settings for the services the Lambdas use.  The S3 and
+# Rekognition clients are shared by scorers running concurrently, so they get
+# larger pools.  Rekognition calls are slow, so they get a longer read timeout.
+# The Rekognition client makes a single attempt: `_call_rekognition`'s rate
+# limiter is the only thing that reacts to throttling, rather than competing
+# with botocore's retries and adaptive rate limiting.
+DEFAULT_AWS_CLIENT_SETTINGS = {
+    's3': AwsClientSettings(max_pool_connections=32, read_timeout_s=10),
+    'rekognition': AwsClientSettings(
+        max_pool_connections=32,
+        read_timeout_s=20,
+        max_attempts=1,
+        retry_mode='standard',
+    ),
+    'sns': AwsClientSettings(max_pool_connections=16, read_timeout_s=5),
+    # Used by the workers, whose receives wait up to 20 seconds for messages.
+    'sqs': AwsClientSettings(max_pool_connections=16, read_timeout_s=25),
+}
+
+
+def create_aws_client(service_name: str, settings: AwsClientSettings = None):
+    """Creates a client for an AWS service with tuned connection and retry
+    settings, and hooks that record every call in the current invocation's
+    `LogContext`.
+
+    Each call adds to the following end message fields, where `<service>` is
+    the service name:
+
+    * `aws_calls.<service>` -- the number of calls.
+    * `aws_ms.<service>` -- the total latency of the calls, including retries.
+    * `aws_retries.<service>` -- the number of retries, if any.
+    * `aws_throttles.<service>` -- the number of throttled attempts, if any.
+
+    The latency of the container's first successful call to each service is
+    also recorded as a one-time cost, `ttfb_ms.<service>`.  See
+    `ColdStartTracker`.
+
+    :param service_name: The name of the AWS service, such as `s3`.
+    :param settings: The settings for the client.  If None, the defaults for
+        the service are used.  Either way, they may be overridden by
+        environment variables.  See `AwsClientSettings.with_environment_overrides`.
+    :return: The client.
+    """
+    if settings is None:
+        settings = DEFAULT_AWS_CLIENT_SETTINGS.get(service_name, AwsClientSettings())
+    settings = settings.with_environment_overrides(service_name)
+
+    Config = _botocore_config.Config
+    options = dict(
+        max_pool_connections=settings.max_pool_connections,
+        connect_timeout=settings.connect_timeout_s,
+        read_timeout=settings.read_timeout_s,
+        # botocore counts `max_attempts` as retries after the first attempt.
+        retries={
+            'max_attempts': settings.max_attempts - 1,
+            'mode': settings.retry_mode,
+        },
+    )
+    # Older versions of botocore, such as the one bundled with the Lambda
+    # runtime, do not support TCP keep-alive.
+    if 'tcp_keepalive' in getattr(Config, 'OPTION_DEFAULTS', {}):
+        options['tcp_keepalive'] = True
+    client = _boto3.client(service_name, config=Config(**options))
+
+    events = client.meta.events
+    # The start time is recorded before the parameters are built rather than
+    # on `before-call`, since handlers that return a response for
+    # `before-call`, such as botocore's `Stubber`, stop it reaching later ones.
+    events.register('before-parameter-build', _before_aws_call)
+    events.register('after-call', _after_aws_call)
+    events.register('after-call-error', _after_aws_call)
+    # Registered first, since the retry handler stops the event from reaching
+    # handlers registered after it.
+    events.register_first('needs-retry', _on_aws_needs_retry)
+    return client
+
+
+def _before_aws_call(context: dict = None, **_kwargs):
+    if context is not None:
+        context['pipeline_start_time'] = time.perf_counter()
+
+
+def _after_aws_call(model=None, context: dict = None, parsed: dict = None, **_kwargs):
+    if context is None or model is None:
+        return
+    service = model.service_model.service_name
+    start_time = context.get('pipeline_start_time')
+    latency_ms = None
+    if start_time is not None:
+        latency_ms = (time.perf_counter() - start_time) * 1000
+        if parsed is not None:
+            # `after-call` is emitted once the response headers are parsed,
+            # before a streaming body, such as an S3 object, is read.
+            _cold_start.record_once(f"ttfb_ms.{service}", latency_ms)
+    log_context = _current_log_context.get()
+    if log_context is None:
+        return
+    log_context.increment_end_field(f"aws_calls.{service}")
+    if latency_ms is not None:
+        log_context.increment_end_field(f"aws_ms.{service}", int(latency_ms))
+    retries = 0
+    if parsed is not None:
+        retries = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+    if retries:
+        log_context.increment_end_field(f"aws_retries.{service}", retries)
+
+
+def _on_aws_needs_retry(response=None, operation=None, **_kwargs):
+    log_context = _current_log_context.get()
+    if log_context is None or response is None or operation is None:
+        return None
+    error_code = response[1].get('Error', {}).get('Code')
+    if error_code in _THROTTLING_ERROR_CODES:
+        service = operation.service_model.service_name
+        log_context.increment_end_field(f"aws_throttles.{service}")
+    # Never decide whether to retry.  That is left to botocore's retry handler.
+    return None
+
+
+class AwsClientRegistry:
+    """Builds each AWS client the first time it is used, and caches it for the
+    lifetime of the container.
+
+    Clients are built with `create_aws_client`.  The time taken to build each
+    client is recorded with the container's `ColdStartTracker`.
+    """
+
+    def __init__(self, settings: Dict[str, AwsClientSettings] = None):
+        """Creates an instance.
+
+        :param settings: The settings for each service's client.  Services
+            without settings use the defaults.
+        """
+        self.__settings = settings if settings is not None else {}
+        self.__clients = {}
+        self.__lock = threading.Lock()
+
+    def get(self, service_name: str):
+        """
+        :param service_name: The name of the AWS service, such as `s3`.
+        :return: The client for the service, built if needed.
+        """
+        client = self.__clients.get(service_name)
+        if client is not None:
+            return client
+        with self.__lock:
+            client = self.__clients.get(service_name)
+            if client is None:
+                with _cold_start.timed(f"client_ms.{service_name}"):
+                    client = create_aws_client(
+                        service_name, self.__settings.get(service_name)
+                    )
+                self.__clients[service_name] = client
+            return client
+
+    def lazy(self, service_name: str) -> '_LazyClient':
+        """
+        :param service_name: The name of the AWS service, such as `s3`.
+        :return: A stand-in for the service's client, which only builds the
+            client when one of its methods is first used.
+        """
+        return _LazyClient(self, service_name)
+
+
+class _LazyClient:
+    """Stands in for an AWS client, forwarding to the client held by an
+    `AwsClientRegistry`.
+    """
+
+    def __init__(self, registry: AwsClientRegistry, service_name: str):
+        self.__registry = registry
+        self.__service_name = service_name
+
+    def __getattr__(self, attribute: str):
+        return getattr(self.__registry.get(self.__service_name), attribute)
+
+
+# The clients shared by everything running in this container.
+_aws_clients = AwsClientRegistry()
+
+
+def lazy_client(service_name: str) -> _LazyClient:
+    """
+    :param service_name: The name of the AWS service, such as `s3`.
+    :return: A stand-in for the container's client for the service, which is
+        built by `create_aws_client` the first time one of its methods is used,
+        and shared by every stand-in for the service.
+    """
+    return _aws_clients.lazy(service_name)
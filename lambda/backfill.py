@@ -0,0 +1,354 @@
+"""Re-scores a backlog of images, such as the historical archive after a rule
+or corpus change, by replaying analyze image requests through the scorers.
+
+The input is a JSONL file holding one analyze image request body per line,
+with the same fields `analyze_image.handler` requires.  Blank lines are
+skipped.  The file is streamed, so its size does not matter: at most
+`--workers * 4` chunks of `--chunk-lines` lines are read ahead.
+
+Each chunk is scored in a pool of worker processes, each of which runs every
+scorer against each image and updates its spam scores directly, as
+`DetectAllHandler` does.  The scores are merged into the durable score store
+given by `--score-store` and `--score-store-path`, which default to the
+`SPAM_SCORE_STORE` and `SPAM_SCORE_STORE_PATH` environment variables.  The
+in-memory store is refused, since its scores would be lost when the workers
+exit.
+
+Lines that are not valid requests are counted as `invalid` and skipped.
+Images that failed with a retriable error are counted as `failed`, and their
+lines are appended to `--failures` if given, so that they can be backfilled
+again.
+
+Progress and throughput are reported on stderr every `--progress-interval-s`
+seconds, when the checkpoint is also saved.  The checkpoint holds the byte
+offset up to which every line has been scored, so a backfill that is
+interrupted resumes from there when run again with the same checkpoint.
+Images scored after the checkpoint was saved are scored again on resume,
+which is harmless since merging an image's score again replaces it.
+
+Usage:
+    python lambda/backfill.py images.jsonl --workers 8 \
+        --score-store sqlite --score-store-path /mnt/efs/spam_scores.db
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import uuid
+
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Callable, Dict, List, Tuple, Union
+
+from analyze_image import REQUIRED_FIELDS
+from detect_all import DetectAllHandler
+from lambda_common import Constants, HandlerError, ImagePayload, parse_json
+from score_store import create_score_store
+
+# The outcomes counted for the lines of the input.
+OUTCOMES = ('processed', 'invalid', 'failed')
+
+# The score store backends that outlive the worker processes.
+DURABLE_SCORE_STORES = ('sqlite',)
+
+# The handler used by a worker process, created by `init_worker`.
+_handler: Union[DetectAllHandler, None] = None
+
+
+class _BackfillContext:
+    """Stands in for the context passed to a Lambda handler."""
+
+    function_version = 'backfill'
+
+    def __init__(self, request_id: str):
+        self.aws_request_id = request_id
+
+
+def init_worker(score_store_backend: str, score_store_path: str):
+    """Creates the handler of a worker process, which updates the scores in
+    the given store.
+
+    :param score_store_backend: The score store backend, one of
+        `DURABLE_SCORE_STORES`.
+    :param score_store_path: The path to the score store.
+    """
+    global _handler
+    _handler = DetectAllHandler(
+        score_store=create_score_store(score_store_backend, path=score_store_path)
+    )
+
+
+def score_lines(lines: List[Tuple[int, bytes]]) -> Dict[str, object]:
+    """Scores the images in a chunk of lines of the input.  Run in the worker
+    processes, once they are initialized by `init_worker`.
+
+    :param lines: The lines, each with its offset in the input.
+    :return: The number of lines with each of the `OUTCOMES`, and under
+        `failed_lines` the lines that failed.
+    """
+    if _handler is None:
+        raise RuntimeError('The worker has no score store.  See init_worker')
+
+    result = {outcome: 0 for outcome in OUTCOMES}
+    result['failed_lines'] = []
+    for offset, line in lines:
+        try:
+            body = parse_json(line.decode('utf-8'), required_fields=REQUIRED_FIELDS)
+        except (HandlerError, UnicodeDecodeError) as e:
+            print(f"[ERROR] Invalid request at offset {offset}: {e}", file=sys.stderr)
+            result['invalid'] += 1
+            continue
+
+        root_trace_id = str(uuid.uuid4())
+        payload = ImagePayload(
+            body[Constants.IMAGE_URL],
+            body[Constants.POST_ID],
+            body[Constants.ACCOUNT_ID],
+            body[Constants.SOURCE_DEVICE],
+            body[Constants.CREATED_TIMESTAMP],
+            root_trace_id,
+        )
+        event = {
+            'Records': [
+                {'Sns': {'MessageId': root_trace_id, 'Message': payload.to_json()}}
+            ]
+        }
+        response = _handler.handle_request(event, _BackfillContext(root_trace_id))
+        if response.get('batchItemFailures'):
+            result['failed'] += 1
+            result['failed_lines'].append(
+                line if line.endswith(b'\n') else line + b'\n'
+            )
+        else:
+            result['processed'] += 1
+    return result
+
+
+def read_checkpoint(path: str) -> dict:
+    """
+    :param path: The path to the checkpoint.
+    :return: The checkpoint, or a checkpoint for the start of the input if
+        there is none.
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'offset': 0, **{outcome: 0 for outcome in OUTCOMES}}
+
+
+def write_checkpoint(path: str, checkpoint: dict):
+    """Replaces the checkpoint, so that it is never left half written.
+
+    :param path: The path to the checkpoint.
+    :param checkpoint: The checkpoint.
+    """
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+def _read_chunks(f, offset: int, chunk_lines: int):
+    """Yields the chunks of non-blank lines of the input from `offset`, each
+    with the offset just past its last line.
+    """
+    chunk = []
+    for line in f:
+        if line.strip():
+            chunk.append((offset, line))
+        offset += len(line)
+        if len(chunk) >= chunk_lines:
+            yield chunk, offset
+            chunk = []
+    if chunk:
+        yield chunk, offset
+
+
+def run_backfill(
+    input_path: str,
+    workers: int,
+    checkpoint_path: str,
+    chunk_lines: int = 32,
+    progress_interval_s: float = 10,
+    failures_path: str = None,
+    score_store_backend: str = 'sqlite',
+    score_store_path: str = None,
+    score_chunk: Callable[[List[Tuple[int, bytes]]], dict] = score_lines,
+) -> dict:
+    """Scores the images in the input, resuming from the checkpoint if it
+    exists.
+
+    A `ValueError` is raised if the scores would not be merged into a durable
+    store.
+
+    :param input_path: The path to the JSONL input.
+    :param workers: The number of worker processes.
+    :param checkpoint_path: The path to the checkpoint.
+    :param chunk_lines: The number of lines sent to a worker at once.
+    :param progress_interval_s: How often to report progress and save the
+        checkpoint.
+    :param failures_path: If not None, the file the lines that failed are
+        appended to.
+    :param score_store_backend: The backend of the store the scores are
+        merged into, one of `DURABLE_SCORE_STORES`.
+    :param score_store_path: The path to the store.  Required by
+        `score_lines`.
+    :param score_chunk: Scores a chunk of lines, as `score_lines`.
+    :return: The final checkpoint.
+    """
+    initializer = None
+    if score_store_path is not None or score_chunk is score_lines:
+        if score_store_backend not in DURABLE_SCORE_STORES:
+            raise ValueError(
+                f'The {score_store_backend} score store would lose the scores '
+                f'when the workers exit.  Use one of '
+                f'{", ".join(DURABLE_SCORE_STORES)}'
+            )
+        if score_store_path is None:
+            raise ValueError('The score store path is required')
+        # Created here first, so that a store that cannot be opened fails the
+        # backfill before any worker starts.
+        create_score_store(score_store_backend, path=score_store_path)
+        initializer = init_worker
+
+    checkpoint = read_checkpoint(checkpoint_path)
+    input_size = os.path.getsize(input_path)
+    if checkpoint['offset'] > input_size:
+        raise ValueError(
+            f"The checkpoint offset {checkpoint['offset']} is past the end of "
+            f"{input_path}"
+        )
+    start_offset = checkpoint['offset']
+    start_lines = sum(checkpoint[outcome] for outcome in OUTCOMES)
+    start = time.monotonic()
+    next_report = start + progress_interval_s
+
+    def report(event: str):
+        elapsed_s = time.monotonic() - start
+        lines = sum(checkpoint[outcome] for outcome in OUTCOMES)
+        bytes_per_second = (checkpoint['offset'] - start_offset) / max(elapsed_s, 1e-6)
+        eta_s = (input_size - checkpoint['offset']) / max(bytes_per_second, 1e-6)
+        print(
+            f"{event} offset={checkpoint['offset']} size={input_size} "
+            f"percent={100 * checkpoint['offset'] / max(input_size, 1):.1f} "
+            + ' '.join(f"{outcome}={checkpoint[outcome]}" for outcome in OUTCOMES)
+            + f" images_per_second={(lines - start_lines) / max(elapsed_s, 1e-6):.1f}"
+            f" elapsed_s={elapsed_s:.0f} eta_s={eta_s:.0f}",
+            file=sys.stderr,
+            flush=True,
+        )
+
+    failures = open(failures_path, 'ab') if failures_path is not None else None
+    # The chunks submitted and not yet committed to the checkpoint, in input
+    # order, each with the offset just past it.
+    pending: 'deque[Tuple[Future, int]]' = deque()
+
+    def commit_finished(wait: bool):
+        """Adds the oldest chunks to the checkpoint once they finish."""
+        while pending and (wait or pending[0][0].done()):
+            future, end_offset = pending.popleft()
+            result = future.result()
+            for outcome in OUTCOMES:
+                checkpoint[outcome] += result[outcome]
+            if failures is not None:
+                failures.writelines(result['failed_lines'])
+            checkpoint['offset'] = end_offset
+            wait = False
+
+    def save_if_due():
+        """Saves the checkpoint and reports progress once the interval is up."""
+        nonlocal next_report
+        if time.monotonic() < next_report:
+            return
+        if failures is not None:
+            failures.flush()
+        write_checkpoint(checkpoint_path, checkpoint)
+        report('backfill_progress')
+        next_report = time.monotonic() + progress_interval_s
+
+    try:
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=initializer,
+            initargs=(score_store_backend, score_store_path),
+        ) as executor, open(input_path, 'rb') as f:
+            f.seek(start_offset)
+            for chunk, end_offset in _read_chunks(f, start_offset, chunk_lines):
+                # Bound the lines read ahead, keeping every worker busy.
+                commit_finished(wait=len(pending) >= workers * 4)
+                pending.append((executor.submit(score_chunk, chunk), end_offset))
+                save_if_due()
+            while pending:
+                commit_finished(wait=True)
+                save_if_due()
+            # Any blank lines at the end are done too.
+            checkpoint['offset'] = input_size
+    finally:
+        if failures is not None:
+            failures.close()
+        write_checkpoint(checkpoint_path, checkpoint)
+    report('backfill_finished')
+    return checkpoint
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('input', help='The JSONL file of analyze image requests')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument(
+        '--checkpoint', default=None, help='By default, the input path + .checkpoint'
+    )
+    parser.add_argument(
+        '--restart',
+        action='store_true',
+        help='Start from the beginning, ignoring the checkpoint',
+    )
+    parser.add_argument('--chunk-lines', type=int, default=32)
+    parser.add_argument('--progress-interval-s', type=float, default=10)
+    parser.add_argument(
+        '--failures', default=None, help='The file to append the failed lines to'
+    )
+    parser.add_argument(
+        '--score-store',
+        choices=DURABLE_SCORE_STORES,
+        default=os.environ.get('SPAM_SCORE_STORE', 'sqlite'),
+        help='The score store backend, by default SPAM_SCORE_STORE',
+    )
+    parser.add_argument(
+        '--score-store-path',
+        default=os.environ.get('SPAM_SCORE_STORE_PATH'),
+        help='The path to the score store, by default SPAM_SCORE_STORE_PATH',
+    )
+    args = parser.parse_args()
+    if args.score_store not in DURABLE_SCORE_STORES:
+        parser.error(
+            f'The {args.score_store} score store would lose the scores when the '
+            f'workers exit.  Use --score-store with one of '
+            f'{", ".join(DURABLE_SCORE_STORES)}'
+        )
+    if args.score_store_path is None:
+        parser.error('--score-store-path or SPAM_SCORE_STORE_PATH is required')
+
+    checkpoint_path = args.checkpoint or f'{args.input}.checkpoint'
+    if args.restart and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    checkpoint = run_backfill(
+        args.input,
+        args.workers,
+        checkpoint_path,
+        chunk_lines=args.chunk_lines,
+        progress_interval_s=args.progress_interval_s,
+        failures_path=args.failures,
+        score_store_backend=args.score_store,
+        score_store_path=args.score_store_path,
+    )
+    sys.exit(1 if checkpoint['failed'] else 0)
+
+
+if __name__ == '__main__':
+    main()
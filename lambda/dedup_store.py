@@ -0,0 +1,228 @@
+"""Records of the SNS messages that have been processed, so that redeliveries
+can be skipped.
+
+SNS delivers each message at least once, so a Lambda may receive a message it
+has already processed.  Processing it again is wasteful: a detection Lambda
+would fetch the image and call Rekognition again, and the update spam score
+Lambda would merge the score again.  A `DedupStore` holds a key for each
+message processed, such as its MessageId, for `ttl_seconds`, after which a
+redelivery is unlikely.
+
+Two backends are provided:
+
+* `InMemoryDedupStore` -- bounded to `max_entries` keys, shared by invocations
+  running in the same container.
+* `SqliteDedupStore` -- a durable SQLite database in WAL mode, which can be
+  shared by processes on the same host (or an EFS mount).
+
+Use `DedupStore.from_environment` to create the store configured for the
+container.
+"""
+
+import os
+import threading
+import time
+
+from collections import OrderedDict
+from typing import Callable, Iterable, Union
+
+from sqlite_database import SqliteDatabase
+
+
+class DedupStore:
+    """Base class for all dedup stores."""
+
+    @staticmethod
+    def from_environment() -> Union['DedupStore', None]:
+        """Creates a store configured by environment variables:
+
+        * `DEDUP_STORE` -- the backend, `memory` (the default), `sqlite` or
+          `none` to process every delivery.
+        * `DEDUP_STORE_PATH` -- the database path for the `sqlite` backend,
+          defaults to `/tmp/dedup.db`.
+        * `DEDUP_TTL_SECONDS` -- how long keys are kept, defaults to 3600.
+        * `DEDUP_MAX_ENTRIES` -- the most keys held by the `memory` backend,
+          defaults to 100000.
+
+        :return: The store, or None if deduplication is disabled.
+        """
+        backend = os.environ.get('DEDUP_STORE', 'memory').lower()
+        if backend == 'none':
+            return None
+        return create_dedup_store(
+            backend,
+            path=os.environ.get('DEDUP_STORE_PATH', '/tmp/dedup.db'),
+            ttl_seconds=float(os.environ.get('DEDUP_TTL_SECONDS', '3600')),
+            max_entries=int(os.environ.get('DEDUP_MAX_ENTRIES', '100000')),
+        )
+
+    def contains_any(self, keys: Iterable[str]) -> bool:
+        """
+        :param keys: The keys of a message.
+        :return: True if any of the keys was added and has not expired.
+        """
+        raise NotImplementedError()
+
+    def add(self, keys: Iterable[str]):
+        """Records that a message has been processed.
+
+        :param keys: The keys of the message.
+        """
+        raise NotImplementedError()
+
+
+class InMemoryDedupStore(DedupStore):
+    """Holds the most recently added keys in memory.
+
+    Once more than `max_entries` keys are held, the oldest are discarded, even
+    if they have not expired.
+    """
+
+    def __init__(
+        self,
+        ttl_seconds: float = 3600,
+        max_entries: int = 100000,
+        clock: Callable[[], float] = time.time,
+    ):
+        """Creates an instance.
+
+        :param ttl_seconds: How long keys are kept.
+        :param max_entries: The most keys held.
+        :param clock: Returns the current time in seconds.
+        """
+        self.__ttl_seconds = ttl_seconds
+        self.__max_entries = max_entries
+        self.__clock = clock
+        self.__lock = threading.Lock()
+        # Maps keys to their expiration time, in the order they were added.
+        # Every key has the same TTL, so this is also the order they expire.
+        self.__expirations: 'OrderedDict[str, float]' = OrderedDict()
+
+    def __len__(self) -> int:
+        """Returns the number of keys held, including expired ones that have
+        not been discarded yet.
+        """
+        return len(self.__expirations)
+
+    def contains_any(self, keys: Iterable[str]) -> bool:
+        now = self.__clock()
+        with self.__lock:
+            self.__discard_expired(now)
+            return any(key in self.__expirations for key in keys)
+
+    def add(self, keys: Iterable[str]):
+        now = self.__clock()
+        with self.__lock:
+            for key in keys:
+                self.__expirations.pop(key, None)
+                self.__expirations[key] = now + self.__ttl_seconds
+            self.__discard_expired(now)
+            while len(self.__expirations) > self.__max_entries:
+                self.__expirations.popitem(last=False)
+
+    def __discard_expired(self, now: float):
+        while self.__expirations:
+            key, expiration = next(iter(self.__expirations.items()))
+            if expiration > now:
+                break
+            del self.__expirations[key]
+
+
+class SqliteDedupStore(DedupStore):
+    """Holds the keys in a SQLite database.
+
+    Expired keys are deleted every `prune_interval` additions, so the database
+    only holds about `ttl_seconds` worth of keys.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        ttl_seconds: float = 3600,
+        prune_interval: int = 1000,
+        busy_timeout_ms: int = 5000,
+    ):
+        """Creates an instance, creating the database if it does not exist.
+
+        :param path: The path to the database file.
+        :param ttl_seconds: How long keys are kept.
+        :param prune_interval: How many additions between deletions of the
+            expired keys.
+        :param busy_timeout_ms: How long to wait for another writer to finish
+            before failing.
+        """
+        self.__database = SqliteDatabase(path, busy_timeout_ms=busy_timeout_ms)
+        self.__ttl_seconds = ttl_seconds
+        self.__prune_interval = prune_interval
+        self.__lock = threading.Lock()
+        self.__adds_since_prune = 0
+        connection = self.__database.connection()
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS dedup_keys ('
+            ' key TEXT PRIMARY KEY,'
+            ' expiration_time REAL NOT NULL)'
+        )
+        connection.execute(
+            'CREATE INDEX IF NOT EXISTS dedup_keys_expiration '
+            'ON dedup_keys (expiration_time)'
+        )
+
+    def contains_any(self, keys: Iterable[str]) -> bool:
+        keys = list(keys)
+        if not keys:
+            return False
+        row = (
+            self.__database.connection()
+            .execute(
+                'SELECT 1 FROM dedup_keys WHERE expiration_time > ? AND key IN '
+                f"({', '.join('?' for _ in keys)}) LIMIT 1",
+                [time.time()] + keys,
+            )
+            .fetchone()
+        )
+        return row is not None
+
+    def add(self, keys: Iterable[str]):
+        now = time.time()
+        connection = self.__database.connection()
+        # INSERT OR REPLACE rather than an upsert, since the SQLite in the
+        # Lambda runtime predates upsert support.
+        connection.executemany(
+            'INSERT OR REPLACE INTO dedup_keys VALUES (?, ?)',
+            [(key, now + self.__ttl_seconds) for key in keys],
+        )
+
+        with self.__lock:
+            self.__adds_since_prune += 1
+            prune = self.__adds_since_prune >= self.__prune_interval
+            if prune:
+                self.__adds_since_prune = 0
+        if prune:
+            connection.execute(
+                'DELETE FROM dedup_keys WHERE expiration_time <= ?', (now,)
+            )
+
+
+def create_dedup_store(
+    backend: str,
+    path: str = None,
+    ttl_seconds: float = 3600,
+    max_entries: int = 100000,
+) -> DedupStore:
+    """Creates a dedup store using the named backend.
+
+    :param backend: Either `memory` or `sqlite`.
+    :param path: The database path for the `sqlite` backend.
+    :param ttl_seconds: How long keys are kept.
+    :param max_entries: The most keys held by the `memory` backend.
+    :return: The store.
+    """
+    if backend == 'memory':
+        return InMemoryDedupStore(ttl_seconds=ttl_seconds, max_entries=max_entries)
+    if backend == 'sqlite':
+        if path is None:
+            raise ValueError('The sqlite dedup store requires a path')
+        return SqliteDedupStore(path, ttl_seconds=ttl_seconds)
+    raise ValueError(
+        f'Unknown dedup store backend "{backend}".  Must be memory, sqlite or none'
+    )
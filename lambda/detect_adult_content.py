@@ -1,4 +1,4 @@
-from lambda_common import DetectionHandler, ImagePayload, S3Url, rekognition
+from lambda_common import DetectionHandler, ImagePayload
 
 
 class DetectAdultContentHandler(DetectionHandler):
@@ -10,6 +10,9 @@ class DetectAdultContentHandler(DetectionHandler):
     confidence moderation label from Rekognition.
     """
 
+    # One paid Rekognition call.
+    COST_ORDER = 1
+
     def __init__(self):
         super().__init__('detect_adult_content')
 
@@ -19,14 +22,9 @@ class DetectAdultContentHandler(DetectionHandler):
         :param image_payload:
         :return: The spam score from this algorithm.
         """
-        s3_image = S3Url(image_payload.image_url)
-
         # Use Rekognition to detect adult-orientation moderation labels.
-        labels = rekognition(
-            self._log_context,
-            detect_moderation_labels={
-                'S3Object': {'Bucket': s3_image.bucket, 'Name': s3_image.key}
-            },
+        labels = self._get_image_context(image_payload).moderation_labels(
+            self._log_context
         )
 
         score = 0.0
@@ -0,0 +1,252 @@
+import contextvars
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Union
+
+from detect_adult_content import DetectAdultContentHandler
+from detect_known_bad_content import DetectKnownBadContentHandler
+from detect_spammy_words import DetectSpammyWordsHandler
+from image_context import ImageContext
+from lambda_common import (
+    DetectionHandler,
+    HandlerError,
+    ImagePayload,
+    LogContext,
+    UnexpectedRecordError,
+    handle_sns_records,
+    log_error,
+    receive_from_analyze_image_sns_record,
+)
+from score_store import ScoreStore
+from update_spam_score import is_spam, is_verdict_final, merge_scores, update_scores
+
+# The threads running the scorers.  The scorers spend most of their time
+# waiting on S3 and Rekognition, so running them concurrently overlaps that
+# I/O.  Shared by all invocations in the container.
+_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('DETECT_ALL_MAX_WORKERS', '3')),
+    thread_name_prefix='detect_all',
+)
+
+
+class DetectAllHandler:
+    """Runs every detection algorithm against an image in a single Lambda, and
+    then updates the image's spam scores directly.
+
+    This is the fused alternative to the fan-out topology, where each
+    detection algorithm runs in its own Lambda subscribed to the analyze image
+    topic and publishes its score to the update spam score topic.  Fusing them
+    saves two SNS hops and the extra Lambda invocations per image, and lets
+    the scorers share one fetch and decode of the image.
+
+    By default the scorers run concurrently.  In cascade mode they instead run
+    one at a time in ascending `COST_ORDER`, each score being recorded as soon
+    as it is computed, and the remaining scorers are skipped once they can no
+    longer change whether the image is spam.  This trades latency for fewer
+    paid Rekognition calls on spam-heavy traffic.
+    """
+
+    def __init__(
+        self,
+        scorers: List[DetectionHandler] = None,
+        score_store: ScoreStore = None,
+        cascade: bool = None,
+    ):
+        """Creates an instance.
+
+        :param scorers: The detection handlers to run.  If None, all of them
+            are run.
+        :param score_store: The store to update the scores in.  If None, the
+            container's store is used.
+        :param cascade: Whether to run the scorers in cascade mode.  If None,
+            the `DETECT_ALL_CASCADE` environment variable is used.
+        """
+        if scorers is None:
+            scorers = [
+                DetectKnownBadContentHandler(),
+                DetectSpammyWordsHandler(),
+                DetectAdultContentHandler(),
+            ]
+        if cascade is None:
+            cascade = os.environ.get('DETECT_ALL_CASCADE', 'false').lower() == 'true'
+        if cascade:
+            scorers = sorted(scorers, key=lambda scorer: scorer.COST_ORDER)
+        self.__scorers = scorers
+        self.__score_store = score_store
+        self.__cascade = cascade
+
+    def handle_request(self, event: dict, context) -> dict:
+        """Handles a Lambda invocation.
+
+        :param event: The event passed into the Lambda invocation.
+        :param context: The context passed into the Lambda invocation.
+        :return: The response to return for the Lambda invocation.
+        """
+        return handle_sns_records(
+            event,
+            context,
+            lambda record, trace_id: self._handle_record(record, context, trace_id),
+            'Hello, you have reached detect_all.',
+        )
+
+    def _handle_record(self, record: dict, context, trace_id: str):
+        """Scores the image in a single SNS record with every scorer and
+        updates its spam scores.
+
+        If some scorers fail, the scores from the others are still recorded,
+        and then the first failure is raised so the record is reported as
+        failed.
+
+        :param record: The SNS record.
+        :param context: The context passed into the Lambda invocation.
+        :param trace_id: The id of the trace for processing this record.
+        """
+        log_context = None
+        try:
+            image_payload = receive_from_analyze_image_sns_record(record)
+
+            log_context = LogContext(
+                'detect_all',
+                context.function_version,
+                root_trace=image_payload.root_trace_id,
+                parent_trace=image_payload.root_trace_id,
+                current_trace=trace_id,
+            )
+            log_context.log_start_message()
+
+            # All of the scorers read the image through one context, so it is
+            # fetched and decoded once.
+            image_context = ImageContext(image_payload)
+            if self.__cascade:
+                first_error = self.__score_cascade(
+                    image_payload, log_context, image_context
+                )
+            else:
+                first_error = self.__score_concurrently(
+                    image_payload, log_context, image_context
+                )
+
+            if first_error is not None:
+                if isinstance(first_error, HandlerError):
+                    raise first_error
+                raise UnexpectedRecordError(first_error)
+
+            log_context.log_end_message(200, "Success")
+        except HandlerError as e:
+            log_error(log_context, str(e), e)
+            if log_context is not None:
+                log_context.log_end_message(
+                    e.status_code, f"Failed due to exception: {e}"
+                )
+            raise
+        except Exception as e:
+            if log_context is not None:
+                log_context.log_end_message(500, f"Failed due to exception: {e!r}")
+            raise
+
+    def __score_concurrently(
+        self,
+        image_payload: ImagePayload,
+        log_context: LogContext,
+        image_context: ImageContext,
+    ) -> Union[Exception, None]:
+        """Runs every scorer at once, and then records their scores together.
+
+        :return: The first error raised by a scorer, if any.
+        """
+        futures = [
+            _executor.submit(
+                contextvars.copy_context().run,
+                scorer.score_image,
+                image_payload,
+                log_context,
+                image_context,
+            )
+            for scorer in self.__scorers
+        ]
+
+        scores = {}
+        first_error: Union[Exception, None] = None
+        for scorer, future in zip(self.__scorers, futures):
+            try:
+                scores[scorer.handler_name] = future.result()
+            except Exception as e:
+                _log_scorer_failed(scorer, e, log_context)
+                if first_error is None:
+                    first_error = e
+
+        if scores:
+            is_image_spam = update_scores(
+                scores,
+                image_payload.image_url,
+                image_payload.account_id,
+                score_store=self.__score_store,
+            )
+            log_context.log(f"spam_result is_spam={is_image_spam} scores={len(scores)}")
+        return first_error
+
+    def __score_cascade(
+        self,
+        image_payload: ImagePayload,
+        log_context: LogContext,
+        image_context: ImageContext,
+    ) -> Union[Exception, None]:
+        """Runs the scorers one at a time, cheapest first, recording each score
+        as it is computed, until the verdict is final.
+
+        :return: The first error raised by a scorer, if any, unless the
+            verdict was final regardless.
+        """
+        names = [scorer.handler_name for scorer in self.__scorers]
+        current_scores = {}
+        computed = 0
+        stages_run = 0
+        failed = []
+        first_error: Union[Exception, None] = None
+        for scorer in self.__scorers:
+            stages_run += 1
+            try:
+                score = scorer.score_image(image_payload, log_context, image_context)
+            except Exception as e:
+                _log_scorer_failed(scorer, e, log_context)
+                failed.append(scorer.handler_name)
+                if first_error is None:
+                    first_error = e
+                continue
+            computed += 1
+            current_scores = merge_scores(
+                {scorer.handler_name: score},
+                image_payload.image_url,
+                image_payload.account_id,
+                score_store=self.__score_store,
+            )
+            if is_verdict_final(current_scores, names[stages_run:]):
+                if is_verdict_final(current_scores, failed + names[stages_run:]):
+                    # The failed scorers could not have changed the verdict
+                    # either, so there is nothing to retry.
+                    first_error = None
+                break
+
+        skipped = names[stages_run:]
+        log_context.increment_end_field('cascade.skipped', len(skipped))
+        log_context.log(
+            f"cascade_result stages_run={stages_run} stages_skipped={len(skipped)} "
+            f"skipped={','.join(skipped) or '-'}"
+        )
+        if computed:
+            log_context.log(
+                f"spam_result is_spam={is_spam(current_scores)} scores={computed}"
+            )
+        return first_error
+
+
+def _log_scorer_failed(
+    scorer: DetectionHandler, error: Exception, log_context: LogContext
+):
+    log_context.log_error(f"Scorer {scorer.handler_name} failed: {error!r}", error)
+    log_context.log(f"scorer_failed algorithm={scorer.handler_name} error={error!r}")
+
+
+def handler(event, context):
+    return DetectAllHandler().handle_request(event, context)
@@ -1,22 +1,103 @@
-import boto3
-import imagehash
-import io
+import os
+import threading
 
-from PIL import Image
+from typing import Dict, List, Tuple, Union
 
 
-from lambda_common import DetectionHandler, ImagePayload, S3Url
+from aws_clients import lazy_import
+from hash_corpus import HASH_ALGORITHMS, CorpusFormatError, HashCorpus
+from hash_index import HashIndex, create_hash_index, hamming_distance
+from lambda_common import DetectionHandler, ImagePayload
 
-_s3 = boto3.client('s3')
+# The hashing engine pulls in NumPy, so it is only imported once it is needed.
+perceptual_hash = lazy_import('perceptual_hash')
 
-# The different between the perceptual image hashes and the confidence that
-# they are the same image.
+# The Hamming distance (in bits) between the perceptual image hashes and the
+# confidence that they are the same image.  Matches further apart than
+# `MAX_HASH_OFFSET` are not searched for, since they would not affect the score.
 # TODO: We should probably make this configurable using environment variables.
-MAX_HASH_OFFSET = 100000
+MAX_HASH_OFFSET = 8
 CONFIDENCE_10_PERCENT_HASH_OFFSET = MAX_HASH_OFFSET
-CONFIDENCE_50_PERCENT_HASH_OFFSET = MAX_HASH_OFFSET / 10
-CONFIDENCE_90_PERCENT_HASH_OFFSET = CONFIDENCE_50_PERCENT_HASH_OFFSET / 10
-CONFIDENCE_95_PERCENT_HASH_OFFSET = CONFIDENCE_90_PERCENT_HASH_OFFSET / 10
+CONFIDENCE_50_PERCENT_HASH_OFFSET = 6
+CONFIDENCE_90_PERCENT_HASH_OFFSET = 3
+CONFIDENCE_95_PERCENT_HASH_OFFSET = 1
+
+
+def _open_known_bad_corpora() -> List[HashCorpus]:
+    """Memory-maps the known bad image corpora named by the comma-separated
+    `KNOWN_BAD_CORPUS_PATH` environment variable.  Each corpus holds the hashes
+    of one algorithm.
+
+    The files are only mapped here.  Their pages are read lazily as they are
+    used, so this does not add to the cold start time.
+
+    :return: The corpora, which is empty if no corpus is configured.
+    """
+    paths = os.environ.get('KNOWN_BAD_CORPUS_PATH', None)
+    if not paths:
+        return []
+    corpora = []
+    for path in paths.split(','):
+        corpus = HashCorpus(path)
+        if corpus.algorithm not in HASH_ALGORITHMS or corpus.hash_size != 64:
+            raise CorpusFormatError(
+                f"Known bad corpus {path} holds {corpus.hash_size} bit "
+                f"{corpus.algorithm} hashes, but 64 bit hashes of one of "
+                f"{', '.join(HASH_ALGORITHMS)} are required"
+            )
+        if any(x.algorithm == corpus.algorithm for x in corpora):
+            raise CorpusFormatError(
+                f"More than one known bad corpus holds {corpus.algorithm} hashes"
+            )
+        corpora.append(corpus)
+    return corpora
+
+
+def _create_known_bad_indexes(
+    corpora: List[HashCorpus],
+) -> Dict[str, Tuple[HashIndex, HashCorpus]]:
+    """Creates an index over each known bad corpus.  The backend can be
+    selected with the `KNOWN_BAD_HASH_INDEX` environment variable.  Each index
+    is built lazily over its corpus on the first inexact lookup.
+
+    :param corpora: The known bad corpora.
+    :return: For each hash algorithm, its index and corpus.  If there are no
+        corpora, this holds an empty average hash index.
+    """
+    backend = os.environ.get('KNOWN_BAD_HASH_INDEX', 'auto')
+    if not corpora:
+        return {'ahash': (create_hash_index(backend), None)}
+    return {
+        corpus.algorithm: (
+            create_hash_index(
+                backend, hashes=corpus.hashes, image_ids=corpus.image_ids
+            ),
+            corpus,
+        )
+        for corpus in corpora
+    }
+
+
+# The corpora are opened, and checked, when the container starts.
+_known_bad_corpora = _open_known_bad_corpora()
+
+# The indexes over the corpora, shared by the container.  They are created on
+# first use rather than when the container starts, since the default backend
+# imports NumPy.  See `_get_known_bad_indexes`.
+_known_bad_indexes: Union[Dict[str, Tuple[HashIndex, HashCorpus]], None] = None
+_known_bad_indexes_lock = threading.Lock()
+
+
+def _get_known_bad_indexes() -> Dict[str, Tuple[HashIndex, HashCorpus]]:
+    """
+    :return: The indexes shared by the container, created if needed.  See
+        `_create_known_bad_indexes`.
+    """
+    global _known_bad_indexes
+    with _known_bad_indexes_lock:
+        if _known_bad_indexes is None:
+            _known_bad_indexes = _create_known_bad_indexes(_known_bad_corpora)
+        return _known_bad_indexes
 
 
 class DetectKnownBadContentHandler(DetectionHandler):
@@ -30,8 +111,32 @@ class DetectKnownBadContentHandler(DetectionHandler):
     score.
     """
 
-    def __init__(self):
+    # Hashing the image and searching the indexes is local, and the image is
+    # fetched anyway, so this is the cheapest scorer.
+    COST_ORDER = 0
+
+    def __init__(
+        self,
+        hash_index: HashIndex = None,
+        corpus: HashCorpus = None,
+        indexes: Dict[str, Tuple[HashIndex, Union[HashCorpus, None]]] = None,
+    ):
+        """Creates an instance.
+
+        :param hash_index: The index of known bad image average hashes to
+            search.  If None, the indexes shared by the container are used,
+            unless `indexes` is given.
+        :param corpus: The corpus used to look up exact matches before
+            searching `hash_index`.  May be None.
+        :param indexes: For each hash algorithm, the index of known bad image
+            hashes to search and the corpus used to look up exact matches,
+            which may be None.
+        """
         super().__init__('detect_known_bad_content')
+        if hash_index is not None:
+            indexes = {'ahash': (hash_index, corpus)}
+        # If None, the container's indexes are used, once they are needed.
+        self.__indexes = indexes
 
     def _score_image(self, image_payload: ImagePayload) -> float:
         """Score the image based on the known bad content.
@@ -39,29 +144,33 @@ class DetectKnownBadContentHandler(DetectionHandler):
         :param image_payload:
         :return: The spam score from this algorithm.
         """
-        # Fetch image from S3
-        # Emit about start/end of image fetch
-        s3_image = S3Url(image_payload.image_url)
-        obj = _s3.get_object(Bucket=s3_image.bucket, Key=s3_image.key)
-        image_content = Image.open(io.BytesIO(obj['Body'].read()))
-
-        # Use the perceptual hash algorithm.  Note, imagehash has many
-        # different perceptual hashes, so we could experiment to find
-        # which work best for this application.
-        ahash = imagehash.average_hash(image_content)
-
-        closest_hash, image_id = self.__find_closest_image(ahash)
-        # Emit about hash and closest image
-
-        if closest_hash is not None:
-            hash_diff = abs(closest_hash - ahash)
-            if hash_diff >= CONFIDENCE_95_PERCENT_HASH_OFFSET:
+        # Every hash type with a known bad index is computed from one shared
+        # grayscale thumbnail, so matching against more hash types improves
+        # recall at little extra cost.
+        indexes = self.__indexes
+        if indexes is None:
+            indexes = _get_known_bad_indexes()
+        thumbnail = self._get_image_context(image_payload).grayscale_thumbnail(
+            perceptual_hash.DOWNSCALE_SIZE, self._log_context
+        )
+        with self._log_context.span('known_bad.hash'):
+            hashes = perceptual_hash.compute_hashes(thumbnail, list(indexes))
+
+        with self._log_context.span('known_bad.lookup'):
+            hash_diff, algorithm, image_id = self.__find_closest_image(indexes, hashes)
+
+        if image_id is not None:
+            self._log_context.log(
+                f"known_bad_match image_id={image_id} hash_diff={hash_diff} "
+                f"algorithm={algorithm}"
+            )
+            if hash_diff <= CONFIDENCE_95_PERCENT_HASH_OFFSET:
                 return 0.95
-            elif hash_diff >= CONFIDENCE_90_PERCENT_HASH_OFFSET:
+            elif hash_diff <= CONFIDENCE_90_PERCENT_HASH_OFFSET:
                 return 0.90
-            elif hash_diff >= CONFIDENCE_50_PERCENT_HASH_OFFSET:
+            elif hash_diff <= CONFIDENCE_50_PERCENT_HASH_OFFSET:
                 return 0.50
-            elif hash_diff >= CONFIDENCE_10_PERCENT_HASH_OFFSET:
+            elif hash_diff <= CONFIDENCE_10_PERCENT_HASH_OFFSET:
                 return 0
             else:
                 return 0
@@ -69,24 +178,43 @@ class DetectKnownBadContentHandler(DetectionHandler):
             return 0
 
     @staticmethod
-    def __find_closest_image(_target_hash: int):
-        """Find the most similar known bad image to the target image.
+    def __find_closest_image(
+        indexes: Dict[str, Tuple[HashIndex, Union[HashCorpus, None]]],
+        target_hashes: Dict[str, int],
+    ):
+        """Find the most similar known bad image to the target image, across
+        the indexes of every hash algorithm.
 
         This will only return a match if there is a similar image within
         `MAX_HASH_OFFSET` to the target image.
 
-        :param _target_hash: The perceptual hash of the target image
-        :return: If a similar image is found, this returns a tuple of
-            perceptual hash for the image and its id.  Otherwise None, None
-            is returned.
-        :rtype: (int, str)
+        :param indexes: For each hash algorithm, the index to search and the
+            corpus used to look up exact matches.
+        :param target_hashes: The perceptual hashes of the target image, by
+            algorithm.
+        :return: If a similar image is found, this returns a tuple of the
+            Hamming distance to its hash, the algorithm of the hash and its
+            id.  Otherwise None, None, None is returned.
+        :rtype: (int, str, str)
         """
-        # Simulation fake:  We won't bother to really track a database of
-        # known bad content. To implement this for real, we would need to
-        # do a database lookup for a hash that is within MAX_HASH_DIFFERENCE
-        # of the target hash.  This should be pretty easy for a scanning
-        # database.
-        return None, None
+        best = None, None, None
+        for algorithm, (hash_index, corpus) in indexes.items():
+            target_hash = target_hashes[algorithm]
+            # Reposts of known bad images are the common case, and an exact
+            # match only needs a binary search of the corpus rather than the
+            # full index.
+            if corpus is not None:
+                image_id = corpus.find_exact(target_hash)
+                if image_id is not None:
+                    return 0, algorithm, image_id
+            closest_hash, image_id = hash_index.find_closest(
+                target_hash, MAX_HASH_OFFSET
+            )
+            if closest_hash is not None:
+                hash_diff = hamming_distance(closest_hash, target_hash)
+                if best[0] is None or hash_diff < best[0]:
+                    best = hash_diff, algorithm, image_id
+        return best
 
 
 def handler(event, context):
@@ -1,6 +1,38 @@
 import os
 
-from lambda_common import DetectionHandler, ImagePayload, S3Url, rekognition
+from typing import List
+
+from aws_clients import timed_cold_start_cost
+from lambda_common import DetectionHandler, ImagePayload
+from log_emitter import DEBUG
+from phrase_matcher import PhraseMatcher
+
+# The score is reached at this many spam phrases, so scanning stops there.
+MAX_BAD_WORDS = 10
+
+# The phrases used when `SPAM_PHRASES_PATH` is not set, as in the demo
+# deployment.  These are placeholders that match the demo's images rather than
+# real spam, so production deployments should configure a phrase list.
+DEFAULT_SPAM_PHRASES = ["red", "green", "blue", "yellow", "purple", "orange"]
+
+
+def _load_spam_phrase_matcher() -> PhraseMatcher:
+    """Compiles the spam phrase list named by the `SPAM_PHRASES_PATH`
+    environment variable, or `DEFAULT_SPAM_PHRASES` if it is not set.
+
+    This is done once per container, and the time it takes is reported with
+    the first invocation's cold start costs.
+
+    :return: The matcher.
+    """
+    path = os.environ.get('SPAM_PHRASES_PATH', None)
+    with timed_cold_start_cost('load_ms.spam_phrases'):
+        if path is None:
+            return PhraseMatcher(DEFAULT_SPAM_PHRASES)
+        return PhraseMatcher.from_file(path)
+
+
+_spam_phrase_matcher = _load_spam_phrase_matcher()
 
 
 class DetectSpammyWordsHandler(DetectionHandler):
@@ -14,8 +46,19 @@ class DetectSpammyWordsHandler(DetectionHandler):
     the spam score.
     """
 
-    def __init__(self):
+    # One paid Rekognition call, then matching the text against the phrases.
+    COST_ORDER = 2
+
+    def __init__(self, phrase_matcher: PhraseMatcher = None):
+        """Creates an instance.
+
+        :param phrase_matcher: The matcher for spam phrases.  If None, the
+            matcher shared by the container is used.
+        """
         super().__init__('detect_spammy_words')
+        self.__phrase_matcher = (
+            phrase_matcher if phrase_matcher is not None else _spam_phrase_matcher
+        )
 
     def _score_image(self, image_payload: ImagePayload) -> float:
         """Score the image based on whether or not it has spammy words.
@@ -23,12 +66,9 @@ class DetectSpammyWordsHandler(DetectionHandler):
         :param image_payload:
         :return: The spam score from this algorithm.
         """
-        s3_image = S3Url(image_payload.image_url)
-
         # Detect text with Rekognition and get a list of dicts with results
-        detected_text = rekognition(
-            self._log_context,
-            detect_text={'S3Object': {'Bucket': s3_image.bucket, 'Name': s3_image.key}},
+        detected_text = self._get_image_context(image_payload).text_detections(
+            self._log_context
         )
 
         # Get the confidence threshold to use
@@ -40,47 +80,68 @@ class DetectSpammyWordsHandler(DetectionHandler):
         else:
             __image_confidence_threshold = float(__image_confidence_threshold_value)
 
-        # Process the detected text values, if any bad words are found, update the
-        # Spam score and stop processing further
-        all_words_count = len(detected_text)
+        log_detected_text = self._log_context.is_enabled(DEBUG)
+        if log_detected_text:
+            for text in detected_text:
+                self._log_context.log_event(
+                    'detected_text',
+                    level=DEBUG,
+                    text=text["DetectedText"],
+                    confidence=f'{text["Confidence"]:.2f}',
+                    id=text["Id"],
+                    type=text["Type"],
+                )
+
+        # Scan the confident detections for spam phrases, stopping once enough
+        # are found to reach the maximum score.
         bad_words_count = 0
-        for text in detected_text:
-            print(
-                f'Detected text: {text["DetectedText"]}, '
-                f'Confidence: {text["Confidence"]:.2f}%, '
-                f'Id: {text["Id"]}, '
-                f'Type: {text["Type"]}'
-            )
+        for text in self.__texts_to_scan(detected_text):
             if text["Confidence"] >= __image_confidence_threshold:
-                if self.__is_bad_word(text["DetectedText"]) is True:
-                    bad_words_count += 1
+                bad_words_count += self.__phrase_matcher.count_matches(
+                    text["DetectedText"], limit=MAX_BAD_WORDS - bad_words_count
+                )
+                if bad_words_count >= MAX_BAD_WORDS:
+                    break
+
+        return self.__calculate_score(
+            self.__count_words(detected_text), bad_words_count
+        )
+
+    @staticmethod
+    def __texts_to_scan(detected_text: List[dict]) -> List[dict]:
+        """Rekognition returns each line of text, and each word of those lines
+        separately.  Lines are scanned, so that phrases spanning several words
+        are matched and words are not counted twice.
 
-        return self.__calculate_score(all_words_count, bad_words_count)
+        :param detected_text: The text detections.
+        :return: The detections to scan for spam phrases.
+        """
+        lines = [text for text in detected_text if text.get("Type") == "LINE"]
+        return lines if lines else detected_text
 
     @staticmethod
-    def __calculate_score(total_words_count: int, bad_words_count: int) -> float:
+    def __count_words(detected_text: List[dict]) -> int:
         """
-        Calculate a spam score given the number of words and bad words
-        :param total_words_count: int
-        :param bad_words_count: int
-        :return: float
+        :param detected_text: The text detections.
+        :return: The number of words detected.
         """
-        return float(min(bad_words_count, 10) / (min(10, total_words_count))) * 100
+        words = sum(1 for text in detected_text if text.get("Type") == "WORD")
+        return words if words else len(detected_text)
 
     @staticmethod
-    def __is_bad_word(word: str) -> bool:
+    def __calculate_score(total_words_count: int, bad_words_count: int) -> float:
         """
-        Returns true if the given word is in a bad words list
-        :param word:
-        :type word: str
-        :return: bool
+        Calculate a spam score given the number of words and bad words
+        :param total_words_count: int
+        :param bad_words_count: int
+        :return: float from 0 to 1
         """
-        bad_words = ["red", "green", "blue", "yellow", "purple", "orange"]
-
-        if word in bad_words:
-            return True
-        else:
-            return False
+        if total_words_count == 0:
+            return 0.0
+        return min(
+            1.0,
+            min(bad_words_count, MAX_BAD_WORDS) / min(MAX_BAD_WORDS, total_words_count),
+        )
 
 
 def handler(event, context):
@@ -0,0 +1,253 @@
+"""Compact, memory-mapped file format for the known bad image hash corpus.
+
+Parsing millions of hashes into Python objects on every cold start would make
+the `detect_known_bad_content` Lambda's cold starts very slow.  Instead, the
+corpus is stored in a binary file that is memory-mapped, so only the pages that
+are actually used are read from disk.
+
+All integers are little-endian.  The file is laid out as:
+
+* A 64 byte header:
+    - magic (8 bytes, `SKBHASH\\0`)
+    - format version (uint16)
+    - hash size in bits (uint16)
+    - hash algorithm name (16 bytes, ASCII, NUL padded), such as `ahash`
+    - number of entries (uint64)
+    - offset of the hash array (uint64)
+    - offset of the image id offset table (uint64)
+    - offset of the image id data (uint64)
+    - reserved (4 bytes)
+* The hashes, as a sorted array of uint64.
+* The image id offset table, as `count + 1` uint64 offsets into the image id
+  data.  The id of entry `i` is stored between offsets `i` and `i + 1`.
+* The image id data, as concatenated UTF-8 strings.
+
+A corpus can be built from a CSV file of `hash_hex,image_id` lines with:
+
+    python hash_corpus.py input.csv output.bin [algorithm]
+
+where the algorithm defaults to `ahash`.
+"""
+
+import bisect
+import csv
+import mmap
+import struct
+import sys
+
+from typing import Iterable, Sequence, Tuple, Union
+
+CORPUS_MAGIC = b'SKBHASH\0'
+CORPUS_VERSION = 1
+
+# The perceptual hash algorithms whose hashes a corpus may hold.  These are
+# defined here rather than taken from `perceptual_hash`, so that corpora can be
+# checked without importing NumPy.
+HASH_ALGORITHMS = ('ahash', 'dhash', 'phash', 'whash')
+
+_HEADER = struct.Struct('<8sHH16sQQQQ4x')
+_UINT64 = struct.Struct('<Q')
+
+
+class CorpusFormatError(Exception):
+    """Raised when a hash corpus file is invalid or uses an unsupported format.
+    """
+
+    pass
+
+
+class _ImageIdTable(Sequence[str]):
+    """A read-only sequence of the image ids in a corpus, decoded on access."""
+
+    def __init__(self, buffer: mmap.mmap, offsets: memoryview, data_offset: int):
+        self.__buffer = buffer
+        self.__offsets = offsets
+        self.__data_offset = data_offset
+
+    def __len__(self) -> int:
+        return len(self.__offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        start = self.__data_offset + self.__offsets[index]
+        end = self.__data_offset + self.__offsets[index + 1]
+        return self.__buffer[start:end].decode('utf-8')
+
+
+class HashCorpus:
+    """A memory-mapped known bad image hash corpus file.
+
+    The `hashes` and `image_ids` sequences read straight from the mapped file,
+    so they can be handed to a `HashIndex` without copying the corpus.
+    """
+
+    def __init__(self, path: str):
+        """Opens and memory-maps a corpus file.
+
+        `CorpusFormatError` is raised if the file is not a valid corpus.
+
+        :param path: The path to the corpus file.
+        """
+        if sys.byteorder != 'little':
+            raise CorpusFormatError('Hash corpus files require a little-endian host')
+
+        with open(path, 'rb') as file:
+            try:
+                self.__buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise CorpusFormatError(f'Hash corpus file {path} is empty')
+
+        if len(self.__buffer) < _HEADER.size:
+            raise CorpusFormatError(f'Hash corpus file {path} is truncated')
+        (
+            magic,
+            self.__version,
+            self.__hash_size,
+            algorithm,
+            count,
+            hashes_offset,
+            id_offsets_offset,
+            id_data_offset,
+        ) = _HEADER.unpack_from(self.__buffer, 0)
+
+        if magic != CORPUS_MAGIC:
+            raise CorpusFormatError(f'{path} is not a hash corpus file')
+        if self.__version != CORPUS_VERSION:
+            raise CorpusFormatError(
+                f'Unsupported hash corpus version {self.__version} in {path}'
+            )
+        if (
+            hashes_offset + 8 * count > id_offsets_offset
+            or id_offsets_offset + 8 * (count + 1) > id_data_offset
+            or id_data_offset > len(self.__buffer)
+        ):
+            raise CorpusFormatError(f'Hash corpus file {path} is truncated')
+        self.__algorithm = algorithm.rstrip(b'\0').decode('ascii')
+
+        view = memoryview(self.__buffer)
+        self.__hashes = view[hashes_offset : hashes_offset + 8 * count].cast('Q')
+        self.__image_ids = _ImageIdTable(
+            self.__buffer,
+            view[id_offsets_offset : id_offsets_offset + 8 * (count + 1)].cast('Q'),
+            id_data_offset,
+        )
+
+    @property
+    def version(self) -> int:
+        """
+        :return: The format version of the corpus file.
+        """
+        return self.__version
+
+    @property
+    def algorithm(self) -> str:
+        """
+        :return: The name of the perceptual hash algorithm, such as `ahash`.
+        """
+        return self.__algorithm
+
+    @property
+    def hash_size(self) -> int:
+        """
+        :return: The number of bits in each hash.
+        """
+        return self.__hash_size
+
+    @property
+    def hashes(self) -> Sequence[int]:
+        """
+        :return: The hashes, in ascending order.
+        """
+        return self.__hashes
+
+    @property
+    def image_ids(self) -> Sequence[str]:
+        """
+        :return: The image ids, parallel to `hashes`.
+        """
+        return self.__image_ids
+
+    def __len__(self) -> int:
+        return len(self.__hashes)
+
+    def find_exact(self, hash_value: int) -> Union[str, None]:
+        """Looks up an exact hash match with a binary search, which only
+        touches a handful of pages of the file.
+
+        :param hash_value: The hash to look up.
+        :return: The id of the image with that hash, or None.
+        """
+        position = bisect.bisect_left(self.__hashes, hash_value)
+        if position < len(self.__hashes) and self.__hashes[position] == hash_value:
+            return self.__image_ids[position]
+        return None
+
+
+def write_hash_corpus(
+    path: str,
+    entries: Iterable[Tuple[int, str]],
+    algorithm: str = 'ahash',
+    hash_size: int = 64,
+):
+    """Writes a corpus file.
+
+    :param path: The path of the file to write.
+    :param entries: The `(hash, image_id)` pairs to write.  They do not need
+        to be sorted.
+    :param algorithm: The name of the perceptual hash algorithm.
+    :param hash_size: The number of bits in each hash.
+    """
+    encoded_algorithm = algorithm.encode('ascii')
+    if len(encoded_algorithm) > 16:
+        raise ValueError(f'Hash algorithm name is too long: {algorithm}')
+
+    ordered = sorted(entries, key=lambda entry: entry[0])
+    encoded_ids = [image_id.encode('utf-8') for _, image_id in ordered]
+    count = len(ordered)
+    hashes_offset = _HEADER.size
+    id_offsets_offset = hashes_offset + 8 * count
+    id_data_offset = id_offsets_offset + 8 * (count + 1)
+
+    with open(path, 'wb') as file:
+        file.write(
+            _HEADER.pack(
+                CORPUS_MAGIC,
+                CORPUS_VERSION,
+                hash_size,
+                encoded_algorithm,
+                count,
+                hashes_offset,
+                id_offsets_offset,
+                id_data_offset,
+            )
+        )
+        for hash_value, _ in ordered:
+            file.write(_UINT64.pack(hash_value))
+        offset = 0
+        file.write(_UINT64.pack(offset))
+        for encoded_id in encoded_ids:
+            offset += len(encoded_id)
+            file.write(_UINT64.pack(offset))
+        for encoded_id in encoded_ids:
+            file.write(encoded_id)
+
+
+def _read_csv_entries(path: str) -> Iterable[Tuple[int, str]]:
+    with open(path, newline='') as file:
+        for row in csv.reader(file):
+            if row:
+                yield int(row[0], 16), row[1]
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (3, 4):
+        print(f'Usage: {sys.argv[0]} input.csv output.bin [algorithm]', file=sys.stderr)
+        sys.exit(1)
+    write_hash_corpus(
+        sys.argv[2],
+        _read_csv_entries(sys.argv[1]),
+        algorithm=sys.argv[3] if len(sys.argv) == 4 else 'ahash',
+    )
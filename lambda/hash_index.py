@@ -0,0 +1,406 @@
+"""Nearest-neighbour indexes over 64-bit perceptual image hashes.
+
+The `detect_known_bad_content` Lambda needs to find the known bad image whose
+perceptual hash is closest (in Hamming distance) to the hash of the image being
+scored.  The known bad corpus can hold millions of hashes, so comparing against
+every entry is not an option.  This module defines the `HashIndex` interface
+used by the handler, and the in-process backends implementing it, which
+`create_hash_index` selects by name:
+
+* `mih` -- `MultiIndexHashIndex`, multi-index hashing.  The hash is split into
+  disjoint chunks, each with its own exact-match table.  Fast and compact, and
+  the recommended index for very large corpora.
+* `bktree` -- `BKTreeHashIndex`, a Burkhard-Keller tree over the Hamming
+  metric.  Only competitive for very small radii, and uses much more memory
+  per entry.
+* `scan` -- a vectorized linear scan, implemented in `hash_scan.py`.  Faster
+  than the indexes for small and mid-sized corpora.
+* `auto` -- `scan`, or `mih` if NumPy is not available.
+
+New backends can be added with `register_hash_index_backend`.
+"""
+
+import itertools
+import math
+import threading
+
+from array import array
+from typing import Callable, Dict, List, Sequence, Tuple, Union
+
+# The number of bits in the perceptual hashes held by the indexes.
+HASH_BITS = 64
+
+
+def hamming_distance(first: int, second: int) -> int:
+    """
+    :param first: A hash value.
+    :param second: Another hash value.
+    :return: The number of bits that differ between the two hashes.
+    """
+    return bin(first ^ second).count('1')
+
+
+def image_hash_to_int(image_hash) -> int:
+    """Converts an `imagehash.ImageHash` into its integer representation.
+
+    :param image_hash: The hash computed by the `imagehash` library.
+    :return: The hash as an unsigned integer.
+    """
+    return int(str(image_hash), 16)
+
+
+class HashIndex:
+    """Base class for all indexes that find the closest known hash to a target.
+
+    Entries are held in two parallel sequences: the hash values and the ids of
+    the images they were computed from.  Derived classes only index positions
+    into those sequences, which lets the entries live in any sequence type
+    (such as an `array` or a memory-mapped corpus file).
+
+    Indexing is done lazily on the first query, so creating an index over a
+    large corpus does not slow down the Lambda's cold start.  An index may be
+    queried from several threads at once, as long as no entries are being
+    added.
+    """
+
+    def __init__(self, hashes: Sequence[int] = None, image_ids: Sequence[str] = None):
+        """Creates an instance.
+
+        :param hashes: The hashes to index.  If None, the index starts out
+            empty and entries can be added with `add`.
+        :param image_ids: The image ids, parallel to `hashes`.
+        """
+        if hashes is None:
+            hashes = array('Q')
+            image_ids = []
+        elif image_ids is None or len(image_ids) != len(hashes):
+            raise ValueError('hashes and image_ids must be the same length')
+        self._hashes = hashes
+        self._image_ids = image_ids
+        # The number of entries that have been added to the index structures.
+        # Only updated once they have all been added, under the lock.
+        self._indexed_count = 0
+        self.__index_lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._hashes)
+
+    def add(self, hash_value: int, image_id: str):
+        """Adds an entry to the index.
+
+        This is only supported if the index was created with mutable sequences.
+
+        :param hash_value: The perceptual hash of the image.
+        :param image_id: The id of the image.
+        """
+        self._hashes.append(hash_value)
+        self._image_ids.append(image_id)
+
+    def find_closest(
+        self, target_hash: int, max_distance: int
+    ) -> Tuple[Union[int, None], Union[str, None]]:
+        """Finds the indexed hash closest to the target hash.
+
+        :param target_hash: The hash to search for.
+        :param max_distance: The maximum Hamming distance of a match.
+        :return: A tuple of the closest hash and its image id, or `None, None`
+            if no hash is within `max_distance` of the target.
+        """
+        self._ensure_indexed()
+        position = self._find_closest_position(target_hash, max_distance)
+        if position is None:
+            return None, None
+        return self._hashes[position], self._image_ids[position]
+
+    def _ensure_indexed(self):
+        """Adds any entries that have not yet been indexed to the index.
+
+        Threads that query a new index at once wait for one of them to build
+        it, rather than all adding the same entries.
+        """
+        if self._indexed_count == len(self._hashes):
+            return
+        with self.__index_lock:
+            count = len(self._hashes)
+            if self._indexed_count != count:
+                self._index_entries(self._indexed_count, count)
+                self._indexed_count = count
+
+    def _index_entries(self, start: int, end: int):
+        """Adds the entries at positions `start` to `end` (exclusive) to the
+        index structures.  Only called while holding the index lock.
+
+        :param start: The position of the first entry to add.
+        :param end: The position after the last entry to add.
+        """
+        for position in range(start, end):
+            self._index_position(position)
+
+    def _index_position(self, position: int):
+        """Derived classes must override this to add the entry at `position`
+        to their index structures.
+
+        :param position: The position of the entry in the hash sequence.
+        """
+        raise NotImplementedError()
+
+    def _find_closest_position(
+        self, target_hash: int, max_distance: int
+    ) -> Union[int, None]:
+        """Derived classes must override this to search their index.
+
+        :param target_hash: The hash to search for.
+        :param max_distance: The maximum Hamming distance of a match.
+        :return: The position of the closest entry, or None if there is no
+            entry within `max_distance`.
+        """
+        raise NotImplementedError()
+
+
+class BKTreeHashIndex(HashIndex):
+    """A BK-tree over the Hamming distance between hashes.
+
+    Each node's children are keyed by their distance to the node, so by the
+    triangle inequality a query only needs to descend into children whose key
+    is within the current search radius of the query's distance to the node.
+    """
+
+    def __init__(self, hashes: Sequence[int] = None, image_ids: Sequence[str] = None):
+        super().__init__(hashes, image_ids)
+        # The entry position held by each node.  Node 0 is the root.
+        self.__node_positions = array('L')
+        # The children of each node, keyed by distance to the node.
+        self.__node_children: List[Dict[int, int]] = []
+
+    def _index_position(self, position: int):
+        hash_value = self._hashes[position]
+        if not self.__node_positions:
+            self.__add_node(position)
+            return
+
+        node = 0
+        while True:
+            distance = hamming_distance(
+                hash_value, self._hashes[self.__node_positions[node]]
+            )
+            if distance == 0:
+                # Duplicate hash.  The first image id added wins.
+                return
+            children = self.__node_children[node]
+            child = children.get(distance)
+            if child is None:
+                children[distance] = self.__add_node(position)
+                return
+            node = child
+
+    def __add_node(self, position: int) -> int:
+        self.__node_positions.append(position)
+        self.__node_children.append({})
+        return len(self.__node_positions) - 1
+
+    def _find_closest_position(
+        self, target_hash: int, max_distance: int
+    ) -> Union[int, None]:
+        if not self.__node_positions:
+            return None
+
+        best_position = None
+        radius = max_distance
+        pending = [0]
+        while pending:
+            node = pending.pop()
+            position = self.__node_positions[node]
+            distance = hamming_distance(target_hash, self._hashes[position])
+            if best_position is None or distance < radius:
+                is_better = distance <= radius
+            else:
+                is_better = distance == radius and position < best_position
+            if is_better:
+                best_position = position
+                radius = distance
+                if distance == 0:
+                    break
+            for child_distance, child in self.__node_children[node].items():
+                if abs(child_distance - distance) <= radius:
+                    pending.append(child)
+        return best_position
+
+
+class MultiIndexHashIndex(HashIndex):
+    """Multi-index hashing over the Hamming distance between hashes.
+
+    The hash is split into `chunk_count` disjoint chunks.  If two hashes are
+    within distance `r` of each other, then by the pigeonhole principle at
+    least one of their chunks is within `r // chunk_count`.  So a query only
+    has to probe, for each chunk, the table buckets whose key is within that
+    smaller radius of the query's chunk, and verify the candidates found there.
+
+    Query cost is lowest when each chunk has about `log2(len(index))` bits, so
+    that buckets hold only a handful of entries.  Unless a chunk count is
+    given, it is chosen that way from the number of entries when the index is
+    first built.
+    """
+
+    def __init__(
+        self,
+        hashes: Sequence[int] = None,
+        image_ids: Sequence[str] = None,
+        chunk_count: int = None,
+    ):
+        """Creates an instance.
+
+        :param hashes: The hashes to index.
+        :param image_ids: The image ids, parallel to `hashes`.
+        :param chunk_count: The number of chunks to split the hashes into.  If
+            None, it is chosen based on the number of entries.
+        """
+        super().__init__(hashes, image_ids)
+        if chunk_count is not None and not 1 <= chunk_count <= HASH_BITS:
+            raise ValueError(f'Invalid chunk_count: {chunk_count}')
+        self.__chunk_count = chunk_count
+        # The (shift, mask) used to extract each chunk from a hash.
+        self.__chunks: List[Tuple[int, int]] = []
+        # One table per chunk, mapping the chunk's value to entry positions.
+        self.__tables: List[Dict[int, array]] = []
+        # The flip masks to probe, keyed by chunk size and radius.
+        self.__flip_masks: Dict[Tuple[int, int], List[int]] = {}
+
+    def _index_entries(self, start: int, end: int):
+        if not self.__chunks:
+            self.__layout_chunks()
+        super()._index_entries(start, end)
+
+    def __layout_chunks(self):
+        """Splits the hash bits into chunks that are as even as possible."""
+        chunk_count = self.__chunk_count
+        if chunk_count is None:
+            target_bits = max(8.0, math.log2(max(1, len(self._hashes))))
+            chunk_count = max(2, min(8, round(HASH_BITS / target_bits)))
+        shift = 0
+        for i in range(chunk_count):
+            bits = HASH_BITS // chunk_count + (1 if i < HASH_BITS % chunk_count else 0)
+            self.__chunks.append((shift, (1 << bits) - 1))
+            self.__tables.append({})
+            shift += bits
+
+    def _index_position(self, position: int):
+        hash_value = self._hashes[position]
+        for (shift, mask), table in zip(self.__chunks, self.__tables):
+            key = (hash_value >> shift) & mask
+            bucket = table.get(key)
+            if bucket is None:
+                bucket = table[key] = array('I')
+            bucket.append(position)
+
+    def _find_closest_position(
+        self, target_hash: int, max_distance: int
+    ) -> Union[int, None]:
+        if not self.__chunks:
+            return None
+
+        best_position = None
+        best_distance = max_distance + 1
+        checked = set()
+        chunk_radius = max_distance // len(self.__chunks)
+
+        for (shift, mask), table in zip(self.__chunks, self.__tables):
+            key = (target_hash >> shift) & mask
+            for flip_mask in self.__get_flip_masks(mask.bit_length(), chunk_radius):
+                bucket = table.get(key ^ flip_mask)
+                if bucket is None:
+                    continue
+                for position in bucket:
+                    if position in checked:
+                        continue
+                    checked.add(position)
+                    distance = hamming_distance(target_hash, self._hashes[position])
+                    if distance < best_distance or (
+                        best_position is not None
+                        and distance == best_distance
+                        and position < best_position
+                    ):
+                        best_position = position
+                        best_distance = distance
+            if best_distance == 0:
+                break
+        return best_position
+
+    def __get_flip_masks(self, chunk_bits: int, chunk_radius: int) -> List[int]:
+        """
+        :param chunk_bits: The number of bits in the chunk.
+        :param chunk_radius: The maximum number of bits to flip in a chunk.
+        :return: Every chunk mask with at most `chunk_radius` bits set, in
+            increasing number of set bits.
+        """
+        masks = self.__flip_masks.get((chunk_bits, chunk_radius))
+        if masks is None:
+            masks = []
+            for bit_count in range(min(chunk_radius, chunk_bits) + 1):
+                for bits in itertools.combinations(range(chunk_bits), bit_count):
+                    mask = 0
+                    for bit in bits:
+                        mask |= 1 << bit
+                    masks.append(mask)
+            self.__flip_masks[(chunk_bits, chunk_radius)] = masks
+        return masks
+
+
+def _create_scan_index(
+    hashes: Sequence[int] = None, image_ids: Sequence[str] = None
+) -> HashIndex:
+    # Imported here so that NumPy is only required if this backend is used.
+    from hash_scan import VectorizedScanHashIndex
+
+    return VectorizedScanHashIndex(hashes=hashes, image_ids=image_ids)
+
+
+def _create_auto_index(
+    hashes: Sequence[int] = None, image_ids: Sequence[str] = None
+) -> HashIndex:
+    # Multi-index hashing answers queries faster than the scan only for very
+    # large corpora, and only once its tables are built.  They are built in
+    # Python on the first query, which takes seconds for those corpora and
+    # would be paid by the first request of every container.  See
+    # `benchmarks/bench_hash_scan.py`.
+    try:
+        return _create_scan_index(hashes=hashes, image_ids=image_ids)
+    except ImportError:
+        return MultiIndexHashIndex(hashes=hashes, image_ids=image_ids)
+
+
+_HASH_INDEX_BACKENDS: Dict[str, Callable[..., HashIndex]] = {
+    'bktree': BKTreeHashIndex,
+    'mih': MultiIndexHashIndex,
+    'scan': _create_scan_index,
+    'auto': _create_auto_index,
+}
+
+
+def register_hash_index_backend(name: str, factory: Callable[..., HashIndex]):
+    """Registers a new index backend that can be selected by name.
+
+    :param name: The name of the backend, such as `mih`.
+    :param factory: Called with `hashes` and `image_ids` keyword arguments
+        to create an instance of the backend.
+    """
+    _HASH_INDEX_BACKENDS[name] = factory
+
+
+def create_hash_index(
+    backend: str, hashes: Sequence[int] = None, image_ids: Sequence[str] = None
+) -> HashIndex:
+    """Creates an index using the named backend.
+
+    :param backend: The name of the backend, such as `mih`, `bktree`, `scan`
+        or `auto`.
+    :param hashes: The hashes to index, or None for an empty index.
+    :param image_ids: The image ids, parallel to `hashes`.
+    :return: The index.
+    """
+    factory = _HASH_INDEX_BACKENDS.get(backend)
+    if factory is None:
+        raise ValueError(
+            f'Unknown hash index backend "{backend}".  Must be one of '
+            f'{", ".join(sorted(_HASH_INDEX_BACKENDS))}'
+        )
+    return factory(hashes=hashes, image_ids=image_ids)
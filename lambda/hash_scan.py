@@ -0,0 +1,144 @@
+"""Vectorized brute-force scan over perceptual image hashes using NumPy.
+
+For small and mid-sized corpora, XOR-ing the query against every hash in a
+contiguous `uint64` array and counting the set bits is faster than walking an
+index structure, since the whole scan runs in a few tight NumPy loops.  This
+backend also answers batches of queries in one call.
+
+This module requires NumPy, which is only available to Lambdas that include the
+ImageHash layer.
+"""
+
+from array import array
+from typing import Sequence, Tuple, Union
+
+import numpy as np
+
+from hash_index import HashIndex
+
+# The number of corpus entries compared per block when computing top-k
+# matches, which bounds the size of the intermediate distance matrix.
+_TOP_K_BLOCK_SIZE = 1 << 20
+
+# The number of set bits in each byte value, used if NumPy is too old to have
+# `bitwise_count`.
+_POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def popcount(values: np.ndarray) -> np.ndarray:
+    """
+    :param values: An array of `uint64`.
+    :return: The number of set bits in each value, as `uint8`, with the same
+        shape as `values`.
+    """
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(values)
+    values = np.ascontiguousarray(values, dtype=np.uint64)
+    return (
+        _POPCOUNT_TABLE[values.view(np.uint8)]
+        .reshape(values.shape + (8,))
+        .sum(axis=-1, dtype=np.uint8)
+    )
+
+
+def as_hash_array(hashes: Sequence[int]) -> np.ndarray:
+    """Converts a sequence of hashes into a contiguous `uint64` array.
+
+    Memory-mapped hashes (such as those in a `HashCorpus`) are wrapped without
+    copying them.
+
+    :param hashes: The hashes.
+    :return: The array.
+    """
+    if isinstance(hashes, np.ndarray):
+        return np.ascontiguousarray(hashes, dtype=np.uint64)
+    if isinstance(hashes, memoryview):
+        return np.frombuffer(hashes, dtype=np.uint64)
+    # Copy anything else, since wrapping an `array` would prevent it from
+    # growing.
+    return np.array(hashes, dtype=np.uint64)
+
+
+class VectorizedScanHashIndex(HashIndex):
+    """Finds the closest hashes by computing the distance to every entry."""
+
+    def __init__(self, hashes: Sequence[int] = None, image_ids: Sequence[str] = None):
+        super().__init__(hashes, image_ids)
+        self.__array = np.empty(0, dtype=np.uint64)
+
+    def _index_entries(self, start: int, end: int):
+        if isinstance(self._hashes, array) and start > 0:
+            added = as_hash_array(self._hashes[start:end])
+            self.__array = np.concatenate((self.__array, added))
+        else:
+            self.__array = as_hash_array(self._hashes[:end])
+
+    def _find_closest_position(
+        self, target_hash: int, max_distance: int
+    ) -> Union[int, None]:
+        if len(self.__array) == 0:
+            return None
+        distances = popcount(self.__array ^ np.uint64(target_hash))
+        position = int(np.argmin(distances))
+        if distances[position] > max_distance:
+            return None
+        return position
+
+    def distances(self, query_hashes: Sequence[int]) -> np.ndarray:
+        """Computes the distance from each query to every indexed hash.
+
+        :param query_hashes: The hashes to compare.
+        :return: A `(len(query_hashes), len(self))` array of distances.
+        """
+        self._ensure_indexed()
+        queries = as_hash_array(query_hashes)
+        return popcount(queries[:, np.newaxis] ^ self.__array[np.newaxis, :])
+
+    def top_k(
+        self, query_hashes: Sequence[int], k: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Finds the `k` closest indexed hashes for each of a batch of queries.
+
+        :param query_hashes: The hashes to search for.
+        :param k: The number of matches to return per query.  If larger than
+            the number of indexed hashes, all of them are returned.
+        :return: A tuple of `(distances, positions)` arrays, each of shape
+            `(len(query_hashes), min(k, len(self)))`.  Each row is ordered by
+            ascending distance, with ties broken by position.
+        """
+        self._ensure_indexed()
+        queries = as_hash_array(query_hashes)
+        k = min(k, len(self.__array))
+        best_distances = np.empty((len(queries), 0), dtype=np.uint8)
+        best_positions = np.empty((len(queries), 0), dtype=np.int64)
+        if k == 0:
+            return best_distances, best_positions
+
+        # Keep the top k of each block, merged with the top k so far, so the
+        # full distance matrix never has to exist at once.
+        for start in range(0, len(self.__array), _TOP_K_BLOCK_SIZE):
+            block = self.__array[start : start + _TOP_K_BLOCK_SIZE]
+            distances = popcount(queries[:, np.newaxis] ^ block[np.newaxis, :])
+            positions = np.broadcast_to(
+                np.arange(start, start + len(block), dtype=np.int64), distances.shape
+            )
+            distances = np.concatenate((best_distances, distances), axis=1)
+            positions = np.concatenate((best_positions, positions), axis=1)
+            # Sort by distance, then position, by packing both into one key.
+            keys = distances.astype(np.int64) << 40 | positions
+            if keys.shape[1] > k:
+                keys = np.partition(keys, k - 1, axis=1)[:, :k]
+            keys.sort(axis=1)
+            best_distances = (keys >> 40).astype(np.uint8)
+            best_positions = keys & ((1 << 40) - 1)
+        return best_distances, best_positions
+
+    def image_ids_at(self, positions: np.ndarray) -> list:
+        """
+        :param positions: An array of positions, such as from `top_k`.
+        :return: The image ids at those positions, as nested lists with the
+            same shape.
+        """
+        return np.vectorize(lambda p: self._image_ids[p], otypes=[object])(
+            positions
+        ).tolist()
@@ -0,0 +1,325 @@
+"""The image a detection handler scores, fetched, decoded and analyzed at
+most once however many scorers read it.
+
+See `ImageContext`.
+"""
+
+import os
+import threading
+import time
+
+from collections import OrderedDict
+from typing import Callable, Dict, List, Tuple, Union
+
+from aws_clients import lazy_client, lazy_import
+from botocore.exceptions import ClientError
+from lambda_common import (
+    ImageLimitError,
+    ImagePayload,
+    LogContext,
+    S3FetchError,
+    S3Url,
+    Span,
+    clear_single_flights,
+    register_single_flight,
+    rekognition,
+    run_blocking,
+)
+from singleflight import SingleFlight
+
+# The container's S3 client.
+_s3 = lazy_client('s3')
+_pil_image = lazy_import('PIL.Image')
+_image_decode = lazy_import('image_decode')
+
+# Coalesces identical concurrent S3 requests, keyed by the operation and the
+# S3 object's bucket, key and version.  Results are only shared while in
+# flight, since the `ImageContext` of each recent image already keeps its
+# fetched bytes, and keeping them here too would hold a second reference to
+# images the context cache has evicted.
+_s3_flight = SingleFlight()
+register_single_flight('s3', _s3_flight)
+
+
+# Thumbnails are resized from an image decoded at no less than this many
+# times their size, so they barely differ from thumbnails of the full image.
+_THUMBNAIL_OVERSAMPLING = 8
+
+
+class ImageContext:
+    """Lazily provides everything the detection handlers derive from an image:
+    its raw bytes, ETag, decoded PIL image, grayscale thumbnails and
+    Rekognition results.
+
+    Each value is computed on first access and then memoized, so scorers that
+    share a context share one S3 fetch, one decode and one call per Rekognition
+    operation.  The context is thread-safe.  Concurrent accesses to a value
+    that is being computed wait for it rather than computing it again.
+
+    Errors are not memoized, so a later access retries the computation.
+
+    Use `for_payload` to get the context shared by the whole process for an
+    image.
+    """
+
+    # The contexts shared by the process, keyed by image URL, along with the
+    # time they were created.  This is kept small, since each context may hold
+    # a decoded image.
+    __shared: 'OrderedDict[str, Tuple[ImageContext, float]]' = OrderedDict()
+    __shared_lock = threading.Lock()
+    __shared_max_entries = int(os.environ.get('IMAGE_CONTEXT_CACHE_SIZE', '4'))
+    __shared_max_age_s = 60
+
+    def __init__(self, image_payload: ImagePayload):
+        """Creates an instance.  Nothing is fetched until it is first used.
+
+        :param image_payload: The image.
+        """
+        self.__image_payload = image_payload
+        self.__s3_url = S3Url(image_payload.image_url)
+        self.__lock = threading.Lock()
+        self.__values = {}
+        self.__value_locks: Dict[object, threading.Lock] = {}
+
+    @classmethod
+    def for_payload(cls, image_payload: ImagePayload) -> 'ImageContext':
+        """Returns the context shared by the process for the image, creating
+        it if needed.
+
+        The most recently used contexts are kept for a short time, so that
+        scorers running one after another in the same container reuse the
+        same fetch and decode.
+
+        :param image_payload: The image.
+        :return: The shared context.
+        """
+        now = time.time()
+        with cls.__shared_lock:
+            entry = cls.__shared.get(image_payload.image_url)
+            if entry is not None and now - entry[1] < cls.__shared_max_age_s:
+                cls.__shared.move_to_end(image_payload.image_url)
+                return entry[0]
+
+            image_context = ImageContext(image_payload)
+            cls.__shared[image_payload.image_url] = (image_context, now)
+            cls.__shared.move_to_end(image_payload.image_url)
+            while len(cls.__shared) > cls.__shared_max_entries:
+                cls.__shared.popitem(last=False)
+            return image_context
+
+    @classmethod
+    def clear_shared(cls):
+        """Discards all of the contexts shared by the process, along with the
+        recent S3 and Rekognition results shared by `SingleFlight`.
+        """
+        with cls.__shared_lock:
+            cls.__shared.clear()
+        clear_single_flights()
+
+    @property
+    def image_payload(self) -> ImagePayload:
+        return self.__image_payload
+
+    @property
+    def s3_url(self) -> 'S3Url':
+        return self.__s3_url
+
+    def image_bytes(self, log_context: LogContext = None) -> bytes:
+        """
+        :param log_context: If not None, used to report the timing of the
+            fetch.
+        :return: The raw bytes of the image, fetched from S3.
+        """
+        return self.__memoized('bytes', lambda: self.__fetch(log_context))
+
+    def etag(self, log_context: LogContext = None) -> str:
+        """Returns the ETag of the image's S3 object.  If the image has not been
+        fetched, only its metadata is requested.
+
+        :param log_context: If not None, used to report the timing of the
+            request.
+        :return: The ETag, without quotes.
+        """
+        with self.__lock:
+            if 'bytes' in self.__values:
+                return self.__values['etag']
+        return self.__memoized('etag', lambda: self.__head(log_context))
+
+    def image(self, log_context: LogContext = None):
+        """
+        :param log_context: If not None, used to report the timing of the
+            fetch.
+        :return: The decoded PIL image.
+        """
+        return self.__memoized('image', lambda: self.__decode(log_context))
+
+    def grayscale_thumbnail(self, size: int, log_context: LogContext = None):
+        """
+        :param size: The width and height of the thumbnail.
+        :param log_context: If not None, used to report the timing of the
+            fetch.
+        :return: The image converted to grayscale and resized to `size` by
+            `size` pixels, as a PIL image.
+        """
+        return self.__memoized(
+            ('grayscale_thumbnail', size),
+            lambda: self.__grayscale_thumbnail(size, log_context),
+        )
+
+    def moderation_labels(self, log_context: LogContext) -> List[dict]:
+        """
+        :param log_context: The log context used to report the Rekognition
+            call.
+        :return: The moderation labels Rekognition detected in the image.
+        """
+        return self.__memoized(
+            'moderation_labels',
+            lambda: rekognition(
+                log_context, detect_moderation_labels=self.__rekognition_image()
+            ),
+        )
+
+    def text_detections(self, log_context: LogContext) -> List[dict]:
+        """
+        :param log_context: The log context used to report the Rekognition
+            call.
+        :return: The text Rekognition detected in the image.
+        """
+        return self.__memoized(
+            'text_detections',
+            lambda: rekognition(log_context, detect_text=self.__rekognition_image()),
+        )
+
+    async def image_bytes_async(self, log_context: LogContext = None) -> bytes:
+        """Like `image_bytes`, but without blocking the event loop."""
+        return await run_blocking(self.image_bytes, log_context)
+
+    async def etag_async(self, log_context: LogContext = None) -> str:
+        """Like `etag`, but without blocking the event loop."""
+        return await run_blocking(self.etag, log_context)
+
+    async def image_async(self, log_context: LogContext = None):
+        """Like `image`, but without blocking the event loop."""
+        return await run_blocking(self.image, log_context)
+
+    async def grayscale_thumbnail_async(
+        self, size: int, log_context: LogContext = None
+    ):
+        """Like `grayscale_thumbnail`, but without blocking the event loop."""
+        return await run_blocking(self.grayscale_thumbnail, size, log_context)
+
+    async def moderation_labels_async(self, log_context: LogContext) -> List[dict]:
+        """Like `moderation_labels`, but without blocking the event loop."""
+        return await run_blocking(self.moderation_labels, log_context)
+
+    async def text_detections_async(self, log_context: LogContext) -> List[dict]:
+        """Like `text_detections`, but without blocking the event loop."""
+        return await run_blocking(self.text_detections, log_context)
+
+    def __memoized(self, key, compute: Callable[[], object]):
+        with self.__lock:
+            if key in self.__values:
+                return self.__values[key]
+            value_lock = self.__value_locks.setdefault(key, threading.Lock())
+
+        with value_lock:
+            with self.__lock:
+                if key in self.__values:
+                    return self.__values[key]
+            value = compute()
+            with self.__lock:
+                self.__values[key] = value
+            return value
+
+    def __rekognition_image(self) -> dict:
+        # Rekognition reads the object from S3 itself, which avoids uploading
+        # the image bytes with the request.
+        s3_object = {'Bucket': self.__s3_url.bucket, 'Name': self.__s3_url.key}
+        if self.__s3_url.version_id is not None:
+            s3_object['Version'] = self.__s3_url.version_id
+        return {'S3Object': s3_object}
+
+    def __call_s3(self, operation: str, log_context: Union[LogContext, None]) -> dict:
+        """Calls an S3 operation on the image's object.  Concurrent calls for
+        the same object share one request.  See `_s3_flight`.
+        """
+        if log_context is not None:
+            log_context.log(f"START s3.{operation}")
+        s3_url = self.__s3_url
+        with Span(f"s3.{operation}", log_context) as span:
+            try:
+                response, shared = _s3_flight.do(
+                    (operation, s3_url.bucket, s3_url.key, s3_url.version_id),
+                    lambda: self.__request_s3(operation),
+                )
+            except ClientError as e:
+                status_code = e.response['ResponseMetadata']['HTTPStatusCode']
+                if log_context is not None:
+                    log_context.log(
+                        f"END s3.{operation} status={status_code} "
+                        f"latency_ms={round(span.duration_ms)} message={e}"
+                    )
+                raise S3FetchError(status_code, str(e))
+        if log_context is not None:
+            coalesced = ''
+            if shared:
+                log_context.increment_end_field('coalesced.s3')
+                coalesced = ' coalesced=true'
+            log_context.log(
+                f"END s3.{operation} status=200 "
+                f"latency_ms={round(span.duration_ms)} "
+                f"bytes={response.get('ContentLength')}{coalesced}"
+            )
+        return response
+
+    def __request_s3(self, operation: str) -> dict:
+        params = {'Bucket': self.__s3_url.bucket, 'Key': self.__s3_url.key}
+        if self.__s3_url.version_id is not None:
+            params['VersionId'] = self.__s3_url.version_id
+        response = getattr(_s3, operation)(**params)
+        if operation == 'get_object':
+            # Read the body within the span, since that is where the bulk of the
+            # transfer happens.
+            try:
+                response['Body'] = _image_decode.read_limited(
+                    response['Body'], response.get('ContentLength')
+                )
+            except _image_decode.ImageTooLargeError as e:
+                response['Body'].close()
+                raise ImageLimitError(str(e))
+        return response
+
+    def __fetch(self, log_context: Union[LogContext, None]) -> bytes:
+        response = self.__call_s3('get_object', log_context)
+        with self.__lock:
+            self.__values['etag'] = response['ETag'].strip('"')
+        return response['Body']
+
+    def __head(self, log_context: Union[LogContext, None]) -> str:
+        return self.__call_s3('head_object', log_context)['ETag'].strip('"')
+
+    def __decode(self, log_context: Union[LogContext, None]):
+        image_bytes = self.image_bytes(log_context)
+        with Span('image.decode', log_context):
+            try:
+                return _image_decode.decode(image_bytes)
+            except _image_decode.ImageTooLargeError as e:
+                raise ImageLimitError(str(e))
+
+    def __grayscale_thumbnail(self, size: int, log_context: Union[LogContext, None]):
+        with self.__lock:
+            image = self.__values.get('image')
+        if image is None:
+            # Decoding straight to a reduced size avoids ever holding the
+            # full resolution image.
+            image_bytes = self.image_bytes(log_context)
+            min_size = size * _THUMBNAIL_OVERSAMPLING
+            with Span('image.decode_reduced', log_context):
+                try:
+                    image = _image_decode.decode_reduced(
+                        image_bytes, (min_size, min_size), 'L'
+                    )
+                except _image_decode.ImageTooLargeError as e:
+                    raise ImageLimitError(str(e))
+        with Span('image.thumbnail', log_context):
+            return image.convert('L').resize((size, size), _pil_image.LANCZOS)
@@ -0,0 +1,162 @@
+"""Bounded-memory reading and decoding of images.
+
+Uploaded images may be far larger than the scorers need: the perceptual hash of
+a 40 megapixel photo only looks at an 8x8 thumbnail, yet decoding it at full
+resolution costs over 100MB of memory and most of the CPU time of the scorer.
+
+`read_limited` reads an image's bytes from a stream in chunks, refusing images
+larger than a byte limit before reading them where the size is known up front.
+Its peak memory is about the size of the image, rather than twice it.
+
+`decode_reduced` decodes an image straight to a reduced size where the format
+supports it.  JPEG images are decoded in draft mode, which has the decoder
+itself scale the image down by up to 8 times (and skip the color channels when
+a grayscale image is wanted), so the full resolution image is never built.
+Formats without draft support are decoded in full and then reduced, after
+checking the image's dimensions, read from its header, against a pixel limit.
+
+`decode` decodes an image at full resolution, with the same pixel limit.
+
+The limits are read from the environment with `DecodeLimits.from_environment`:
+`IMAGE_MAX_BYTES` (default 32MiB) and `IMAGE_MAX_PIXELS` (default 100
+megapixels).
+"""
+
+import io
+import os
+
+from typing import BinaryIO, Tuple, Union
+
+from PIL import Image
+
+# The size of the chunks read from a stream.
+READ_CHUNK_BYTES = 256 * 1024
+
+
+class ImageTooLargeError(ValueError):
+    """Raised when an image exceeds a byte or pixel limit."""
+
+
+class DecodeLimits:
+    """The largest images that are read and decoded."""
+
+    def __init__(self, max_bytes: int = 32 * 1024 * 1024, max_pixels: int = 100000000):
+        """Creates an instance.
+
+        :param max_bytes: The largest encoded image, in bytes.
+        :param max_pixels: The largest image, in pixels, at full resolution.
+        """
+        self.max_bytes = max_bytes
+        self.max_pixels = max_pixels
+
+    @staticmethod
+    def from_environment() -> 'DecodeLimits':
+        """
+        :return: The limits set by the `IMAGE_MAX_BYTES` and `IMAGE_MAX_PIXELS`
+            environment variables.
+        """
+        defaults = DecodeLimits()
+        return DecodeLimits(
+            max_bytes=int(os.environ.get('IMAGE_MAX_BYTES', defaults.max_bytes)),
+            max_pixels=int(os.environ.get('IMAGE_MAX_PIXELS', defaults.max_pixels)),
+        )
+
+
+# The limits used when none are given.
+ENVIRONMENT_LIMITS = DecodeLimits.from_environment()
+
+
+def read_limited(
+    stream: BinaryIO,
+    content_length: Union[int, None] = None,
+    limits: DecodeLimits = None,
+) -> bytes:
+    """Reads a stream to its end, refusing to read more than the byte limit.
+
+    :param stream: The stream, such as the body of an S3 response.
+    :param content_length: The length of the stream, if known.  If it exceeds
+        the limit, nothing is read.
+    :param limits: The limits to enforce.  If None, `ENVIRONMENT_LIMITS`.
+    :return: The bytes read.
+    """
+    max_bytes = (limits or ENVIRONMENT_LIMITS).max_bytes
+    if content_length is not None and content_length > max_bytes:
+        raise ImageTooLargeError(
+            f"Image is {content_length} bytes, which exceeds the limit of {max_bytes}"
+        )
+    # The chunks are written to a BytesIO rather than joined, since joining
+    # holds the chunks and the result at once, twice the image's size.  The
+    # BytesIO grows its buffer in place where it can, and `getvalue` returns
+    # that buffer without copying it.
+    output = io.BytesIO()
+    while True:
+        chunk = stream.read(READ_CHUNK_BYTES)
+        if not chunk:
+            break
+        if output.tell() + len(chunk) > max_bytes:
+            raise ImageTooLargeError(f"Image exceeds the limit of {max_bytes} bytes")
+        output.write(chunk)
+    return output.getvalue()
+
+
+def _open(data: bytes, limits: Union[DecodeLimits, None]):
+    """Opens an image, reading only its header, and checks its size."""
+    limits = limits or ENVIRONMENT_LIMITS
+    try:
+        image = Image.open(io.BytesIO(data))
+    except Image.DecompressionBombError as e:
+        raise ImageTooLargeError(str(e))
+    width, height = image.size
+    if width * height > limits.max_pixels:
+        image.close()
+        raise ImageTooLargeError(
+            f"Image is {width}x{height} pixels, which exceeds the limit of "
+            f"{limits.max_pixels}"
+        )
+    return image
+
+
+def decode(data: bytes, limits: DecodeLimits = None):
+    """Decodes an image at full resolution.
+
+    :param data: The encoded image.
+    :param limits: The limits to enforce.  If None, `ENVIRONMENT_LIMITS`.
+    :return: The decoded PIL image.
+    """
+    image = _open(data, limits)
+    image.load()
+    return image
+
+
+def decode_reduced(
+    data: bytes, min_size: Tuple[int, int], mode: str, limits: DecodeLimits = None
+):
+    """Decodes an image reduced to about `min_size`, without decoding it at
+    full resolution where the format allows.
+
+    The result is at least `min_size` in each dimension (unless the image is
+    smaller), but is not exactly that size, so callers should resize it to the
+    size they need.
+
+    :param data: The encoded image.
+    :param min_size: The smallest width and height needed.
+    :param mode: The PIL mode of the result, such as `L` for grayscale.
+    :param limits: The limits to enforce.  If None, `ENVIRONMENT_LIMITS`.
+    :return: The decoded PIL image.
+    """
+    image = _open(data, limits)
+    # A no-op for formats without draft support.
+    image.draft(mode, min_size)
+    image.load()
+    if image.mode in ('1', 'P'):
+        # Bilevel and palette images cannot be reduced directly.
+        image = image.convert(mode)
+
+    factor = min(image.width // min_size[0], image.height // min_size[1])
+    if factor >= 2:
+        # reduce averages blocks of pixels, which is much cheaper than
+        # resampling and keeps enough detail for the final resize.
+        image = image.reduce(factor)
+    if image.mode != mode:
+        image = image.convert(mode)
+    return image
@@ -1,16 +1,51 @@
 import time
 
-import boto3
-import os
+import contextvars
+import functools
+import itertools
 import json
+import os
+import threading
 import traceback
 
-from typing import Union
-from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import (
+    TYPE_CHECKING,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Tuple,
+    Union,
+)
+from urllib.parse import parse_qs, urlparse
+from aws_clients import (
+    get_cold_start_tracker,
+    lazy_client,
+    lazy_import,
+    record_aws_calls_in,
+)
 from botocore.exceptions import ClientError
+from dedup_store import DedupStore
+from latency_histogram import LatencyHistograms
+from log_emitter import DEBUG, ERROR, INFO, DeadlineFlusher, LogEmitter
+from payload_codec import PayloadCodec, PayloadDecodeError
+from rate_limiter import AdaptiveRateLimiter, create_rate_limit_store
+from score_cache import ScoreCache
+from singleflight import SingleFlight
+
+if TYPE_CHECKING:
+    # Built on this module, so only imported here for type checking.
+    from image_context import ImageContext
+    from sns_publisher import SnsBatchPublisher
+
+# The innermost span open in the current thread.  See `Span`.
+_current_span = contextvars.ContextVar('current_span', default=None)
 
-_sns = boto3.client('sns')
-_rekognition_client = boto3.client('rekognition')
+_sns = lazy_client('sns')
+_rekognition_client = lazy_client('rekognition')
+_asyncio = lazy_import('asyncio')
 
 
 def _get_pipeline_lambda_version() -> str:
@@ -31,6 +66,91 @@ def _get_pipeline_lambda_version() -> str:
 
 _PIPELINE_LAMBDA_VERSION = _get_pipeline_lambda_version()
 
+# The log settings of the container.  See `LogEmitter.from_environment`.
+_log_emitter = LogEmitter.from_environment()
+
+# Flushes the logs of invocations that are about to time out.
+_deadline_flusher = DeadlineFlusher()
+
+# Encodes the payloads published to SNS, and decodes those received.
+_payload_codec = PayloadCodec.from_environment()
+
+# The latency of every span in the container, summarized in the logs every
+# `LATENCY_SUMMARY_INTERVAL_S` seconds.  See `Span`.
+_latency_histograms = LatencyHistograms(
+    float(os.environ.get('LATENCY_SUMMARY_INTERVAL_S', '60'))
+)
+
+# The score cache shared by all detection handlers in this container, or None if
+# caching is not enabled.  See `ScoreCache.from_environment`.
+_score_cache = ScoreCache.from_environment()
+
+# The records of the messages processed by the detection handlers in this
+# container, so that redeliveries are skipped, or None if deduplication is not
+# enabled.  See `DedupStore.from_environment`.
+_dedup_store = DedupStore.from_environment()
+
+# How long the results of Rekognition requests are shared with later identical
+# requests.  See `SingleFlight`.
+_SINGLEFLIGHT_RESULT_WINDOW_S = float(
+    os.environ.get('SINGLEFLIGHT_RESULT_WINDOW_S', '2')
+)
+
+# Coalesces identical concurrent Rekognition requests, keyed by the operation
+# and the S3 object's bucket, key and version.
+_rekognition_flight = SingleFlight(_SINGLEFLIGHT_RESULT_WINDOW_S, max_results=256)
+
+# The coalescers reported in the container's summary, by name.  See
+# `register_single_flight`.
+_single_flights = {'rekognition': _rekognition_flight}
+
+# When the current invocation must finish its work, as a `time.monotonic` time,
+# leaving a second to report its outcome.  None if the handler was not invoked
+# by Lambda, such as in a worker.  See `set_invocation_deadline`.
+_invocation_deadline: contextvars.ContextVar = contextvars.ContextVar(
+    'invocation_deadline', default=None
+)
+
+# The threads that `run_blocking` runs blocking calls on, such as the AWS calls
+# made by `AsyncDetectionHandler`.  No threads are started until first used.
+_blocking_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('ASYNC_MAX_BLOCKING_CALLS', '32')),
+    thread_name_prefix='blocking',
+)
+
+
+def register_single_flight(name: str, single_flight: SingleFlight):
+    """Adds a coalescer to those reported in the container's summary and
+    cleared by `clear_single_flights`.
+
+    :param name: The name of the requests it coalesces, such as "s3".
+    :param single_flight: The coalescer.
+    """
+    _single_flights[name] = single_flight
+
+
+def clear_single_flights():
+    """Discards the recent results shared by every registered coalescer."""
+    for single_flight in _single_flights.values():
+        single_flight.clear()
+
+
+async def run_blocking(function: Callable, *args, **kwargs):
+    """Runs a blocking function on a thread, so that it does not stall the
+    event loop, and returns its result.
+
+    The function runs with a copy of the caller's `contextvars` context, so the
+    AWS calls it makes are recorded in the caller's log context, and the spans
+    it opens are nested in the caller's span.
+
+    :param function: The function to run.
+    :param args: The positional arguments to pass to it.
+    :param kwargs: The keyword arguments to pass to it.
+    :return: The function's result.
+    """
+    call = functools.partial(contextvars.copy_context().run, function, *args, **kwargs)
+    return await _asyncio.get_running_loop().run_in_executor(_blocking_executor, call)
+
 
 class Constants:
     """Holds constants definitions for Lambdas.  This mostly contains string
@@ -83,6 +203,13 @@ class HandlerError(Exception):
         """
         return self.__status_code
 
+    @property
+    def is_retriable(self) -> bool:
+        """
+        :return: True if this error may be resolved if the handler is rerun.
+        """
+        return self.__is_retriable
+
     def create_response(self, for_sns_topic: bool = False) -> dict:
         """
         :param for_sns_topic:  True if this response is for an event for an
@@ -135,20 +262,49 @@ class MissingSnsTopicEnvironmentVariableException(HandlerError):
 
 class SnsPublishError(HandlerError):
     """Raised when an error occurs when publishing to an SNS Topic.
+
+    Server errors and throttling are retriable, but other client errors, such
+    as an invalid message, are not.
     """
 
-    def __init__(self, status_code, error_message):
+    def __init__(self, status_code, error_message, is_retriable: bool = None):
+        if is_retriable is None:
+            is_retriable = status_code >= 500
         super().__init__(
-            status_code, f"Failed during SNS publishing.  Error was \"{error_message}\""
+            status_code,
+            f"Failed during SNS publishing.  Error was \"{error_message}\"",
+            is_retriable=is_retriable,
         )
 
 
 class RekognitionError(HandlerError):
     """Raised when the Rekognition service returns a non-200.
+
+    Only throttling is retriable.
+    """
+
+    def __init__(self, status_code, message, is_retriable: bool = False):
+        super().__init__(status_code, message, is_retriable=is_retriable)
+
+
+class S3FetchError(HandlerError):
+    """Raised when an image could not be fetched from S3.
+
+    Server errors are retriable, but client errors such as a missing object
+    are not.
     """
 
     def __init__(self, status_code, message):
-        super().__init__(status_code, message, is_retriable=False)
+        super().__init__(status_code, message, is_retriable=status_code >= 500)
+
+
+class ImageLimitError(HandlerError):
+    """Raised when an image exceeds the byte or pixel limits set by
+    `IMAGE_MAX_BYTES` and `IMAGE_MAX_PIXELS`.  Retrying will not help.
+    """
+
+    def __init__(self, message: str):
+        super().__init__(413, message, is_retriable=False)
 
 
 class SnsReceiveError(HandlerError):
@@ -167,6 +323,15 @@ class InvalidHandlerInputError(HandlerError):
         super().__init__(500, message, is_retriable=False)
 
 
+class UnexpectedRecordError(HandlerError):
+    """Raised when processing a single record of a batch fails due to an
+    exception that is not a `HandlerError`.
+    """
+
+    def __init__(self, cause: Exception):
+        super().__init__(500, f"Unexpected error: {cause!r}")
+
+
 def calculate_latency_ms(start_time: Union[float, None]) -> int:
     """Determine the number of milliseconds that have elaspsed since the
     specified start time.
@@ -182,6 +347,89 @@ def calculate_latency_ms(start_time: Union[float, None]) -> int:
     return round((time.time() - start_time) * 1000)
 
 
+class Span:
+    """Times a stage of an invocation, such as an S3 fetch or an image decode.
+
+    Use it as a context manager, usually through `LogContext.span`.  A span is
+    the child of the span that is open in the same thread (or in the thread
+    whose `contextvars` context it runs in) when it starts, so nested spans
+    form a tree under the invocation's trace.
+
+    When a span ends, its duration is recorded in the container's latency
+    histogram for its name, and, if it has a log context, a `span` event is
+    logged at the DEBUG level with its id and its parent's id.  So every
+    invocation contributes to the periodic latency summary, while only the
+    traces sampled for detail log their full span tree.
+    """
+
+    __ids = itertools.count(1)
+
+    def __init__(self, name: str, log_context: 'LogContext' = None):
+        """Creates an instance.  Timing starts when the span is entered.
+
+        :param name: The name of the stage.  Spans with the same name share a
+            histogram.
+        :param log_context: If not None, the log context to log the span with.
+        """
+        self.__name = name
+        self.__log_context = log_context
+        self.__span_id = next(Span.__ids)
+        self.__parent: Union[Span, None] = None
+        self.__start_time: Union[float, None] = None
+        self.__end_time: Union[float, None] = None
+        self.__token = None
+
+    @property
+    def name(self) -> str:
+        return self.__name
+
+    @property
+    def span_id(self) -> int:
+        return self.__span_id
+
+    @property
+    def parent(self) -> Union['Span', None]:
+        return self.__parent
+
+    @property
+    def duration_ms(self) -> float:
+        """
+        :return: The duration of the span, or the time elapsed so far if it
+            has not ended.
+        """
+        if self.__start_time is None:
+            return 0.0
+        end_time = self.__end_time
+        if end_time is None:
+            end_time = time.perf_counter()
+        return (end_time - self.__start_time) * 1000
+
+    def __enter__(self) -> 'Span':
+        self.__parent = _current_span.get()
+        self.__token = _current_span.set(self)
+        self.__start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.__end_time = time.perf_counter()
+        _current_span.reset(self.__token)
+        duration_ms = self.duration_ms
+        _latency_histograms.record(self.__name, duration_ms)
+        if self.__log_context is not None and self.__log_context.is_enabled(DEBUG):
+            self.__log_context.log_event(
+                'span',
+                level=DEBUG,
+                name=self.__name,
+                span_id=self.__span_id,
+                parent_span_id=(
+                    self.__parent.span_id if self.__parent is not None else None
+                ),
+                duration_ms=round(duration_ms, 2),
+                status='ok' if exc_type is None else 'error',
+            )
+        return False
+
+
 # TODO: Maybe LogContext would be better implemented as part of Python's
 # logger functionality.
 class LogContext:
@@ -220,39 +468,159 @@ class LogContext:
         self.__pipeline_version = _PIPELINE_LAMBDA_VERSION
         # Used to track when the Lambda began execution.  Set in `log_start_message`.
         self.__start_time: Union[float, None] = None
+        # Extra fields to append to the end message, in insertion order.
+        self.__end_fields: Dict[str, object] = {}
+        # Scorers running concurrently may share a log context.
+        self.__end_fields_lock = threading.Lock()
+        # Holds the invocation's lines until the end message.  Whether the
+        # invocation logs in detail is decided by the root trace, so that all of
+        # the Lambdas handling an image make the same decision.
+        self.__log_buffer = _log_emitter.new_buffer(
+            root_trace if root_trace is not None else current_trace
+        )
 
     def log_start_message(self):
         """Emits the common start message for all Lambda invocations.
+
+        The first start message in a container also reports the container's
+        cold start costs.  See `ColdStartTracker`.
+
+        This also makes this the current log context, so that the AWS calls
+        made from this thread (and threads started with a copy of its
+        `contextvars` context) are recorded in the end message.
+
+        The start message is written at once, rather than buffered, so that it
+        is not lost if the invocation crashes.  If the invocation has a
+        deadline, its buffered messages are also written when the deadline
+        passes without the end message being emitted, such as when it is about
+        to time out.
         """
         self.__start_time = time.time()
-        print(
+        record_aws_calls_in(self)
+        deadline = _invocation_deadline.get()
+        if deadline is not None:
+            _deadline_flusher.watch(self.__log_buffer, deadline)
+        # The start and end messages are always in the key=value format,
+        # whatever the log format, since dashboards parse them.
+        self.__log_buffer.add_line(
             f"START Lambda execution: lambda={self.__lambda_name} "
             f"version={self.__pipeline_version} "
             f"aws_version={self.__function_version} "
             f"trace={self.__current_trace} "
             f"rtrace={self.__root_trace} "
             f"ptrace={self.__parent_trace}"
+            f"{get_cold_start_tracker().take_start_fields()}"
         )
+        self.__log_buffer.flush()
 
-    def log(self, message: str):
+    def log(self, message: str, level: int = INFO):
         """Can be used to emit a message while a Lambda is running.  This will
          include the current trace id and the version number (as defined in
          `VERSION`) of the Lambda code.
 
+        Messages are buffered until the end message is emitted.
+
         :param message: The message to emit.
+        :param level: The level of the message.  It is dropped if the level is
+            not enabled for this invocation.
         """
-        print(
-            f"{message} trace={self.__current_trace} version={self.__pipeline_version}"
+        self.__log_buffer.add_event(
+            level,
+            message,
+            {'trace': self.__current_trace, 'version': self.__pipeline_version},
         )
 
+    def log_error(self, message: str, error: BaseException = None):
+        """Emits an error message, with the traceback of the error if given.
+        Like `log`, this includes the current trace id and the version number.
+
+        The message is written at once, along with the messages buffered
+        before it, so that they are not lost if the invocation crashes.
+
+        :param message: The message to emit.
+        :param error: The error that caused it, if any.
+        """
+        fields = {'trace': self.__current_trace, 'version': self.__pipeline_version}
+        if error is not None:
+            fields['traceback'] = _format_traceback(error)
+        self.__log_buffer.add_event(ERROR, f"[ERROR] {message}", fields)
+        self.__log_buffer.flush()
+
+    def log_event(self, event: str, level: int = INFO, **fields):
+        """Emits a structured event while a Lambda is running.  Like `log`, this
+        includes the current trace id and the version number.
+
+        :param event: The name of the event.
+        :param level: The level of the event.  It is dropped if the level is
+            not enabled for this invocation.
+        :param fields: The fields of the event.
+        """
+        if not self.__log_buffer.is_enabled(level):
+            return
+        fields['trace'] = self.__current_trace
+        fields['version'] = self.__pipeline_version
+        self.__log_buffer.add_event(level, event, fields)
+
+    def is_enabled(self, level: int) -> bool:
+        """
+        :param level: A log level.
+        :return: True if messages of this level are emitted for this
+            invocation.  Use this to avoid building messages that would be
+            dropped.
+        """
+        return self.__log_buffer.is_enabled(level)
+
+    def span(self, name: str) -> Span:
+        """Returns a context manager that times a stage of the invocation.
+        For example::
+
+            with log_context.span('image.decode'):
+                image.load()
+
+        See `Span` for how spans are nested, recorded and logged.
+
+        :param name: The name of the stage.
+        :return: The span, which must be entered to start timing.
+        """
+        return Span(name, self)
+
+    def set_end_field(self, key: str, value):
+        """Sets a field to include in the end message, such as a counter
+        accumulated over the invocation.
+
+        :param key: The name of the field.
+        :param value: The value of the field.
+        """
+        self.__end_fields[key] = value
+
+    def increment_end_field(self, key: str, amount: int = 1):
+        """Adds to a numeric field included in the end message.  The field
+        starts at zero.
+
+        :param key: The name of the field.
+        :param amount: The amount to add.
+        """
+        with self.__end_fields_lock:
+            self.__end_fields[key] = self.__end_fields.get(key, 0) + amount
+
     def log_end_message(self, status_code: int, message: str):
         """Emits the end of Lambda message, recording the overall latency of
         the execution as well as the resulting status code.
 
+        Any fields set with `set_end_field` or `increment_end_field` are
+        appended after the standard fields, followed by any one-time costs,
+        such as building an AWS client, paid during the invocation.
+
+        This writes all of the invocation's buffered messages at once.
+
         :param status_code:
         :param message:
         """
-        print(
+        _deadline_flusher.unwatch(self.__log_buffer)
+        extra_fields = ''.join(
+            f" {key}={value}" for key, value in self.__end_fields.items()
+        )
+        self.__log_buffer.add_line(
             f"END Lambda execution: lambda={self.__lambda_name} "
             f"status_code={status_code} "
             f"latency_ms={calculate_latency_ms(self.__start_time)} "
@@ -261,20 +629,81 @@ class LogContext:
             f"trace={self.__current_trace} "
             f"rtrace={self.__root_trace} "
             f"ptrace={self.__parent_trace}"
+            f"{extra_fields}"
+            f"{get_cold_start_tracker().take_fields()}"
         )
+        self.__add_summaries()
+        self.__log_buffer.flush()
+
+    def __add_summaries(self):
+        """Adds the container's summaries if they are due: a `latency_summary`
+        line per span name, and a `coalesce_summary` line per kind of request
+        coalesced, with the fraction of requests that shared another's call.
+        Like the start and end messages, these lines are always emitted, in
+        the key=value format.
+        """
+        summary = _latency_histograms.take_summary_if_due()
+        if summary is None:
+            return
+        for name, stats in summary.items():
+            self.__log_buffer.add_line(
+                f"latency_summary lambda={self.__lambda_name} span={name} "
+                f"count={stats['count']} p50_ms={stats['p50_ms']} "
+                f"p90_ms={stats['p90_ms']} p99_ms={stats['p99_ms']} "
+                f"max_ms={stats['max_ms']} version={self.__pipeline_version}"
+            )
+        for name, single_flight in _single_flights.items():
+            calls, shared = single_flight.take_stats()
+            if calls:
+                self.__log_buffer.add_line(
+                    f"coalesce_summary lambda={self.__lambda_name} requests={name} "
+                    f"calls={calls} shared={shared} "
+                    f"ratio={round(shared / calls, 3)} "
+                    f"version={self.__pipeline_version}"
+                )
+
 
+def log_error(
+    log_context: Union[LogContext, None], message: str, error: BaseException = None
+):
+    """Emits an error message through a log context, or prints it if there is
+    no log context yet, such as when a record could not be parsed.
 
-def parse_json(payload: str, required_fields=None) -> dict:
+    :param log_context: The log context of the invocation, or None.
+    :param message: The message to emit.
+    :param error: The error that caused it, if any.  Its traceback is emitted
+        with the message.
+    """
+    if log_context is not None:
+        log_context.log_error(message, error)
+        return
+    print(f"[ERROR] {message}")
+    if error is not None:
+        print(_format_traceback(error))
+
+
+def _format_traceback(error: BaseException) -> str:
+    return ''.join(
+        traceback.format_exception(type(error), error, error.__traceback__)
+    ).rstrip()
+
+
+def parse_json(payload: str, required_fields: frozenset = None) -> dict:
     """Parses the payload as JSON.  This will raise a `InvalidJSON` exception
     if it is not valid JSON.
 
+    This is for payloads sent by clients, such as API Gateway request bodies,
+    so they are parsed as plain JSON.  Use `decode_sns_payload` for the
+    messages the Lambdas publish to each other.
+
     Optionally will verify the JSON has a set of required fields as top-level
     members.  If any are missing, then a `MissingRequiredField` exception
     is raised.
     :param payload: The string to parse as JSON.
     :param required_fields: The set of field names to ensure are present in
         the parsed object.  If any are missing, a `MissingRequiredField`
-        exception is thrown.
+        exception is thrown.  Callers should build this set once rather than
+        on every call.
     :return: The parsed JSON as a dict.
     """
     try:
@@ -283,12 +712,40 @@ def parse_json(payload: str, required_fields=None) -> dict:
         raise InvalidJSON(e.msg)
 
     if required_fields is not None:
-        for x in required_fields:
-            if x not in parsed:
-                raise MissingRequiredField(f'Missing required field {x}')
+        check_required_fields(parsed, required_fields)
     return parsed
 
 
+def decode_sns_payload(payload: str):
+    """Decodes a message published by `ImagePayload.to_json` or
+    `UpdateSpamScorePayload.to_json`, in any of the formats of
+    `payload_codec`.  This will raise a `InvalidJSON` exception if it cannot
+    be decoded.
+
+    :param payload: The message.
+    :return: The decoded payload.
+    """
+    try:
+        return _payload_codec.decode(payload)
+    except PayloadDecodeError as e:
+        raise InvalidJSON(str(e))
+
+
+def check_required_fields(parsed, required_fields: frozenset):
+    """Verifies a parsed payload is a dict holding a set of fields.
+
+    :param parsed: The parsed payload.
+    :param required_fields: The names of the fields that must be present.
+    """
+    if not isinstance(parsed, dict):
+        raise InvalidJSON('Expected a JSON object')
+    if required_fields <= parsed.keys():
+        return
+    for x in sorted(required_fields):
+        if x not in parsed:
+            raise MissingRequiredField(f'Missing required field {x}')
+
+
 def return_message(http_status_code: int, message: str) -> dict:
     """A dict that can be returned as the result of a Lambda invocation.
 
@@ -316,6 +773,26 @@ class ImagePayload:
     :return: A JSON payload for processing by the Lambdas
     """
 
+    __slots__ = (
+        'image_url',
+        'post_id',
+        'account_id',
+        'source_device',
+        'created_timestamp',
+        'root_trace_id',
+    )
+
+    REQUIRED_FIELDS = frozenset(
+        {
+            Constants.IMAGE_URL,
+            Constants.POST_ID,
+            Constants.ACCOUNT_ID,
+            Constants.SOURCE_DEVICE,
+            Constants.CREATED_TIMESTAMP,
+            Constants.ROOT_TRACE_ID,
+        }
+    )
+
     def __init__(
         self,
         image_url: str,
@@ -349,33 +826,23 @@ class ImagePayload:
 
     def to_json(self) -> str:
         """
-        :return: The JSON serialization of the object.
+        :return: The serialization of the object, in the wire format
+            configured by `PAYLOAD_FORMAT`.
         """
-        return json.dumps(self.to_dict())
+        return _payload_codec.encode(self.to_dict())
 
     @staticmethod
-    def from_json(payload: str):
-        """Parsed the JSON contained in `payload` and returns the result as
-        a ImagePayload.
+    def from_dict(parsed_payload: dict):
+        """Returns the ImagePayload held by an already parsed payload.
 
-        `InvalidJSON` and `MissingRequiredFields` may be thrown if any
-        errors are seen during processing.
+        `InvalidJSON` and `MissingRequiredFields` may be thrown if the payload
+        is not a dict or lacks any fields.
 
-        :param payload: The string containing the JSON.
-        :return: The parsed ImagePayload
+        :param parsed_payload: The parsed payload.
+        :return: The ImagePayload
         :rtype: ImagePayload
         """
-        parsed_payload = parse_json(
-            payload,
-            required_fields={
-                Constants.IMAGE_URL,
-                Constants.POST_ID,
-                Constants.ACCOUNT_ID,
-                Constants.SOURCE_DEVICE,
-                Constants.CREATED_TIMESTAMP,
-                Constants.ROOT_TRACE_ID,
-            },
-        )
+        check_required_fields(parsed_payload, ImagePayload.REQUIRED_FIELDS)
         return ImagePayload(
             parsed_payload[Constants.IMAGE_URL],
             parsed_payload[Constants.POST_ID],
@@ -385,12 +852,37 @@ class ImagePayload:
             parsed_payload[Constants.ROOT_TRACE_ID],
         )
 
+    @staticmethod
+    def from_json(payload: str):
+        """Parsed the JSON contained in `payload` and returns the result as
+        a ImagePayload.
+
+        `InvalidJSON` and `MissingRequiredFields` may be thrown if any
+        errors are seen during processing.
+
+        :param payload: The string containing the JSON.
+        :return: The parsed ImagePayload
+        :rtype: ImagePayload
+        """
+        return ImagePayload.from_dict(decode_sns_payload(payload))
+
 
 class UpdateSpamScorePayload:
     """Represents a spams core update that should be applied by the
     UpdateSpamScore Lambda.
     """
 
+    __slots__ = ('image_payload', 'scorer', 'score', 'scorer_trace_id')
+
+    REQUIRED_FIELDS = frozenset(
+        {
+            Constants.IMAGE_PAYLOAD,
+            Constants.SCORER,
+            Constants.SCORE,
+            Constants.SCORER_TRACE_ID,
+        }
+    )
+
     def __init__(
         self, image_payload: ImagePayload, scorer: str, score: float, scorer_trace_id
     ):
@@ -406,23 +898,50 @@ class UpdateSpamScorePayload:
         self.score = score
         self.scorer_trace_id = scorer_trace_id
 
-    def to_json(self) -> str:
+    def to_dict(self) -> dict:
         """
-        :return: The JSON representation of the object.
+        :return: The object as dict
         """
-        payload = {
+        return {
             Constants.IMAGE_PAYLOAD: self.image_payload.to_dict(),
             Constants.SCORER: self.scorer,
             Constants.SCORE: self.score,
             Constants.SCORER_TRACE_ID: self.scorer_trace_id,
         }
-        return json.dumps(payload)
+
+    def to_json(self) -> str:
+        """
+        :return: The serialization of the object, in the wire format
+            configured by `PAYLOAD_FORMAT`.
+        """
+        return _payload_codec.encode(self.to_dict())
+
+    @staticmethod
+    def from_dict(parsed_payload: dict):
+        """Returns the UpdateSpamScorePayload held by an already parsed
+        payload, including its nested image payload.
+
+        `InvalidJSON` and `MissingRequiredFields` may be thrown if the payload
+        is not a dict or lacks any fields.
+
+        :param parsed_payload: The parsed payload.
+        :return: The UpdateSpamScorePayload
+        :rtype: UpdateSpamScorePayload
+        """
+        check_required_fields(parsed_payload, UpdateSpamScorePayload.REQUIRED_FIELDS)
+        return UpdateSpamScorePayload(
+            ImagePayload.from_dict(parsed_payload[Constants.IMAGE_PAYLOAD]),
+            parsed_payload[Constants.SCORER],
+            parsed_payload[Constants.SCORE],
+            parsed_payload[Constants.SCORER_TRACE_ID],
+        )
 
     @staticmethod
     def from_json(payload: str):
         """Parsed the JSON contained in `payload` and returns the result as
         a UpdateSpamScorePayload.
 
+        The message is parsed once, including the nested image payload.
         `InvalidJSON` and `MissingRequiredFields` may be thrown if any
         errors are seen during processing.
 
@@ -430,26 +949,7 @@ class UpdateSpamScorePayload:
         :return: The parsed UpdateSpamScorePayload
         :rtype: UpdateSpamScorePayload
         """
-        parsed_payload = parse_json(
-            payload,
-            required_fields={
-                Constants.IMAGE_PAYLOAD,
-                Constants.SCORER,
-                Constants.SCORE,
-                Constants.SCORER_TRACE_ID,
-            },
-        )
-
-        # TODO: Fix inefficiency where we re-serialize the image payload.
-        image_payload = ImagePayload.from_json(
-            json.dumps(parsed_payload[Constants.IMAGE_PAYLOAD])
-        )
-        return UpdateSpamScorePayload(
-            image_payload,
-            parsed_payload[Constants.SCORER],
-            parsed_payload[Constants.SCORE],
-            parsed_payload[Constants.SCORER_TRACE_ID],
-        )
+        return UpdateSpamScorePayload.from_dict(decode_sns_payload(payload))
 
 
 def _publish_to_sns_topic(
@@ -478,34 +978,50 @@ def _publish_to_sns_topic(
     if log_context is not None:
         log_context.log(f"START publish_to_sns_topic topic={topic_name}")
 
-    start_time = time.time()
-
-    try:
-        sns_response = _sns.publish(TopicArn=topic_arn, Message=payload.to_json())
-        latency_ms = calculate_latency_ms(start_time)
-        if sns_response['ResponseMetadata']['HTTPStatusCode'] == 200:
-            if log_context is not None:
-                log_context.log(
-                    f"END publish_to_sns_topic topic={topic_name} "
-                    f"latency_ms={latency_ms} result=200"
-                )
-            return sns_response
-        else:
+    with Span('sns.publish', log_context) as span:
+        try:
+            sns_response = _sns.publish(TopicArn=topic_arn, Message=payload.to_json())
             status_code = sns_response['ResponseMetadata']['HTTPStatusCode']
             error_message = 'Unknown error occurred while publishing'
-    except ClientError as e:
-        error_message = str(e)
-        status_code = e.response['ResponseMetadata']['HTTPStatusCode']
+            is_retriable = True
+        except ClientError as e:
+            sns_response = None
+            error_message = str(e)
+            status_code = e.response['ResponseMetadata']['HTTPStatusCode']
+            is_retriable = is_retriable_sns_error(e)
+
+    if status_code == 200:
+        if log_context is not None:
+            log_context.log(
+                f"END publish_to_sns_topic topic={topic_name} "
+                f"latency_ms={round(span.duration_ms)} result=200"
+            )
+        return sns_response
 
     if log_context is not None:
-        latency_ms = calculate_latency_ms(start_time)
         log_context.log(
             f"END publish_to_sns_topic topic={topic_name} "
-            f"latency_ms={latency_ms} result={status_code} "
+            f"latency_ms={round(span.duration_ms)} result={status_code} "
             f"error=\"{error_message}\""
         )
 
-    raise SnsPublishError(status_code, error_message)
+    raise SnsPublishError(status_code, error_message, is_retriable=is_retriable)
+
+
+# The error codes SNS returns when a publish is throttled.  They are client
+# errors, but retrying fixes them.
+_SNS_THROTTLE_CODES = frozenset({'Throttled', 'Throttling', 'KMSThrottling'})
+
+
+def is_retriable_sns_error(e: ClientError) -> bool:
+    """
+    :param e: The error raised by an SNS call.
+    :return: True if retrying the call may succeed.
+    """
+    return (
+        e.response['ResponseMetadata']['HTTPStatusCode'] >= 500
+        or e.response.get('Error', {}).get('Code') in _SNS_THROTTLE_CODES
+    )
 
 
 def publish_to_analyze_image_sns_topic(
@@ -516,13 +1032,18 @@ def publish_to_analyze_image_sns_topic(
     created_timestamp: float,
     root_trace_id: str,
     log_context: LogContext = None,
-) -> dict:
+    publisher: 'SnsBatchPublisher' = None,
+) -> Union[dict, None]:
     """Publishes the specified image and its metadata to the `analyze_image`
     SNS Topic to be processed by the detection Lambdas.
 
     An appropriate HandlerException is raised if any errors are encountered
     or the SNS publish is not successful.
 
+    If `publisher` is given, the message is buffered in it instead of being
+    published immediately, and any publish error is reported by its `flush`
+    under `root_trace_id`.
+
     :param image_url: The URL of the image.
     :param post_id: The id of the post sharing the image.
     :param account_id: The account id that authored the post.
@@ -531,11 +1052,22 @@ def publish_to_analyze_image_sns_topic(
     :param root_trace_id: The id of the root trace that is initiating this
         processing.
     :param log_context: The log context to use to emit log messages.
-    :return: The response from SNS if the publish is successful.
+    :param publisher: If not None, the publisher to buffer the message in.
+    :return: The response from SNS if the publish is successful, or None if
+        the message was buffered.
     """
     payload = ImagePayload(
         image_url, post_id, account_id, source_device, created_timestamp, root_trace_id
     )
+    if publisher is not None:
+        publisher.publish(
+            'analyze_image',
+            'SNS_ANALYZE_IMAGE_TOPIC_ARN',
+            payload,
+            root_trace_id,
+            log_context=log_context,
+        )
+        return None
     return _publish_to_sns_topic(
         'analyze_image', 'SNS_ANALYZE_IMAGE_TOPIC_ARN', payload, log_context=log_context
     )
@@ -547,21 +1079,37 @@ def publish_to_update_spam_score_sns_topic(
     score: float,
     scorer_trace_id,
     log_context: LogContext = None,
-) -> dict:
+    publisher: 'SnsBatchPublisher' = None,
+) -> Union[dict, None]:
     """Publishes the specified image and its metadata to the `update_spam_score`
     SNS Topic to be processed by UpdateSpamScore Lambda.
 
     An appropriate HandlerException is raised if any errors are encountered
     or the SNS publish is not successful.
 
+    If `publisher` is given, the message is buffered in it instead of being
+    published immediately, and any publish error is reported by its `flush`
+    under `scorer_trace_id`.
+
     :param image_payload: The image payload that was scored
     :param scorer: The name of the scorer
     :param score: The score between 0 and 1.
     :param scorer_trace_id: The trace id that performed this scoring.
     :param log_context: The log context to use to emit log messages.
-    :return: The response from SNS if the publish is successful.
+    :param publisher: If not None, the publisher to buffer the message in.
+    :return: The response from SNS if the publish is successful, or None if
+        the message was buffered.
     """
     payload = UpdateSpamScorePayload(image_payload, scorer, score, scorer_trace_id)
+    if publisher is not None:
+        publisher.publish(
+            'update_spam_score',
+            'SNS_UPDATE_SPAM_SCORE_TOPIC_ARN',
+            payload,
+            scorer_trace_id,
+            log_context=log_context,
+        )
+        return None
     return _publish_to_sns_topic(
         'update_spam_score',
         'SNS_UPDATE_SPAM_SCORE_TOPIC_ARN',
@@ -570,20 +1118,86 @@ def publish_to_update_spam_score_sns_topic(
     )
 
 
-def _receive_from_sns_topic(event: dict) -> str:
-    """Receives an event from an SNS topic and extracts the underlying message.
+async def publish_to_update_spam_score_sns_topic_async(
+    image_payload: ImagePayload,
+    scorer: str,
+    score: float,
+    scorer_trace_id,
+    log_context: LogContext = None,
+    publisher: 'SnsBatchPublisher' = None,
+) -> Union[dict, None]:
+    """Like `publish_to_update_spam_score_sns_topic`, but without blocking the
+    event loop while publishing.
+    """
+    return await run_blocking(
+        publish_to_update_spam_score_sns_topic,
+        image_payload,
+        scorer,
+        score,
+        scorer_trace_id,
+        log_context=log_context,
+        publisher=publisher,
+    )
 
-    An appropriate HandlerException is raised if there are any errors.
+
+def receive_records_from_sns_topic(event: dict) -> List[dict]:
+    """Receives an event from an SNS topic and returns all of its records.
+
+    The records are not validated here, so that a bad record can be failed
+    without failing the rest of the batch.  Use `_get_sns_message` to extract
+    the message from each record.
 
     :param event: The event that triggered the Lambda.
+    :return: The records in the event.
+    """
+    try:
+        records = event['Records']
+    except KeyError as e:
+        raise SnsReceiveError(f"Missing field {e} when receiving sns event")
+    if not records:
+        raise SnsReceiveError("No records in sns event")
+    return records
+
+
+def _get_sns_message(record: dict) -> str:
+    """Extracts the underlying message from a single SNS record.
+
+    An appropriate HandlerException is raised if there are any errors.
+
+    :param record: One of the records of the event that triggered the Lambda.
     :return: The underlying message.
     """
     try:
-        return event['Records'][0]['Sns']['Message']
+        return record['Sns']['Message']
     except KeyError as e:
         raise SnsReceiveError(f"Missing field {e} when receiving sns event")
 
 
+def _get_sns_message_id(record: dict, index: int) -> str:
+    """
+    :param record: One of the records of the event that triggered the Lambda.
+    :param index: The index of the record within the event.
+    :return: The SNS MessageId of the record, or a placeholder based on its
+        index if the record does not have one.
+    """
+    try:
+        return record['Sns']['MessageId']
+    except (KeyError, TypeError):
+        return f"record-{index}"
+
+
+def _receive_from_sns_topic(event: dict) -> str:
+    """Receives an event from an SNS topic and extracts the underlying message
+    of its first record.
+
+    An appropriate HandlerException is raised if there are any errors.
+
+    :param event: The event that triggered the Lambda.
+    :return: The underlying message.
+    """
+    return _get_sns_message(receive_records_from_sns_topic(event)[0])
+
+
 def receive_from_analyze_image_sns_topic(event: dict) -> ImagePayload:
     """Receives an event from the analyze_image SNS topic and extracts
     the underlying ImagePayload object.
@@ -608,6 +1222,271 @@ def receive_from_update_spam_score_sns_topic(event: dict) -> UpdateSpamScorePayl
     return UpdateSpamScorePayload.from_json(_receive_from_sns_topic(event))
 
 
+def receive_from_analyze_image_sns_record(record: dict) -> ImagePayload:
+    """Extracts the ImagePayload from a single record of an analyze_image
+    SNS topic event.
+
+    An appropriate HandlerException is raised if there are any errors.
+
+    :param record: One of the records of the event that triggered the Lambda.
+    :return: The underlying ImagePayload.
+    """
+    return ImagePayload.from_json(_get_sns_message(record))
+
+
+def receive_from_update_spam_score_sns_record(record: dict) -> UpdateSpamScorePayload:
+    """Extracts the UpdateSpamScorePayload from a single record of an
+    update_spam_score SNS topic event.
+
+    An appropriate HandlerException is raised if there are any errors.
+
+    :param record: One of the records of the event that triggered the Lambda.
+    :return: The underlying UpdateSpamScorePayload.
+    """
+    return UpdateSpamScorePayload.from_json(_get_sns_message(record))
+
+
+def handle_sns_records(
+    event: dict,
+    context,
+    handle_record: Callable[[dict, str], Union[LogContext, None]],
+    success_message: str,
+    publisher: 'SnsBatchPublisher' = None,
+) -> dict:
+    """Invokes `handle_record` for every record in an SNS event.
+
+    Each record is processed independently, so an error processing one record
+    does not prevent the others from being processed.  `handle_record` is
+    expected to create its own `LogContext` and emit its own start message.
+
+    If `handle_record` buffered messages in `publisher`, it should return its
+    `LogContext` without emitting the end message.  Once all records have been
+    handled, the publisher is flushed and the end message is emitted with the
+    outcome of the record's publish, using the record's trace id as the tag.
+    Otherwise it should emit its own end message and return None.
+
+    The returned response lists the MessageIds of the records that failed with
+    a retriable error under `batchItemFailures`, so that only those need to be
+    redelivered.
+
+    :param event: The event that triggered the Lambda.
+    :param context: The context passed into the Lambda invocation.
+    :param handle_record: Called with each record and the trace id to use for
+        it.  It should raise a `HandlerError` if processing fails.
+    :param success_message: The response body to return if all records are
+        processed successfully.
+    :param publisher: If not None, the publisher that records' messages were
+        buffered in.
+    :return: The response to return for the Lambda invocation.
+    """
+    set_invocation_deadline(context)
+    try:
+        records = receive_records_from_sns_topic(event)
+    except HandlerError as e:
+        log_error(None, str(e), e)
+        return e.create_response(for_sns_topic=True)
+
+    trace_ids = [
+        get_record_trace_id(context, records, index) for index in range(len(records))
+    ]
+    outcomes = []
+    for record, trace_id in zip(records, trace_ids):
+        try:
+            outcomes.append(handle_record(record, trace_id))
+        except Exception as e:
+            outcomes.append(e)
+
+    return complete_sns_records(
+        records, trace_ids, outcomes, success_message, publisher=publisher
+    )
+
+
+def get_record_trace_id(context, records: List[dict], index: int) -> str:
+    """
+    :param context: The context passed into the Lambda invocation.
+    :param records: The records of the event that triggered the Lambda.
+    :param index: The index of a record.
+    :return: The id of the trace for processing the record.
+    """
+    # Give each record of a batch its own trace so their logs can be told
+    # apart.  A single record keeps the request id as its trace, as before.
+    if len(records) > 1:
+        return f"{context.aws_request_id}-{index}"
+    return context.aws_request_id
+
+
+def complete_sns_records(
+    records: List[dict],
+    trace_ids: List[str],
+    outcomes: List[Union[LogContext, None, Exception]],
+    success_message: str,
+    publisher: 'SnsBatchPublisher' = None,
+) -> dict:
+    """Finishes handling the records of an SNS event once every record has
+    been handled, as described in `handle_sns_records`.
+
+    :param records: The records of the event that triggered the Lambda.
+    :param trace_ids: The id of the trace for processing each record.
+    :param outcomes: For each record, what handling it returned, or the
+        exception it raised.
+    :param success_message: The response body to return if all records are
+        processed successfully.
+    :param publisher: If not None, the publisher that records' messages were
+        buffered in.
+    :return: The response to return for the Lambda invocation.
+    """
+    failures = []
+    # The records whose end message is waiting on the publisher to be flushed.
+    pending_records = []
+    for index, (record, trace_id, outcome) in enumerate(
+        zip(records, trace_ids, outcomes)
+    ):
+        message_id = _get_sns_message_id(record, index)
+        if isinstance(outcome, HandlerError):
+            failures.append((message_id, outcome))
+        elif isinstance(outcome, Exception):
+            log_error(
+                None,
+                f"Unexpected error processing record {index}: {outcome!r}",
+                outcome,
+            )
+            failures.append((message_id, UnexpectedRecordError(outcome)))
+        elif outcome is not None:
+            pending_records.append((message_id, trace_id, outcome))
+
+    publish_failures = publisher.flush() if publisher is not None else {}
+    for message_id, trace_id, log_context in pending_records:
+        error = publish_failures.get(trace_id)
+        if error is None:
+            log_context.log_end_message(200, "Success")
+        else:
+            log_context.log_error(str(error))
+            log_context.log_end_message(
+                error.status_code, f"Failed due to exception: {error}"
+            )
+            failures.append((message_id, error))
+
+    return create_sns_batch_response(len(records), failures, success_message)
+
+
+def create_sns_batch_response(
+    record_count: int, failures: list, success_message: str
+) -> dict:
+    """Creates the response for a Lambda invocation that processed a batch of
+    SNS records.
+
+    :param record_count: The number of records in the batch.
+    :param failures: A list of `(message_id, HandlerError)` tuples for the
+        records that failed.
+    :param success_message: The response body to return if no records failed.
+    :return: The response to return for the Lambda invocation.
+    """
+    retriable_failures = [
+        (message_id, error) for message_id, error in failures if error.is_retriable
+    ]
+    if not failures:
+        response = return_message(200, success_message)
+    else:
+        # As with a single record, non-retriable failures are reported with a
+        # 200 so that the events are not redelivered.
+        status_code = 200
+        if retriable_failures:
+            status_code = retriable_failures[0][1].status_code
+        details = '; '.join(f"{message_id}: {error}" for message_id, error in failures)
+        response = return_message(
+            status_code, f"Failed {len(failures)} of {record_count} records: {details}"
+        )
+    response['batchItemFailures'] = [
+        {'itemIdentifier': message_id} for message_id, _ in retriable_failures
+    ]
+    return response
+
+
+def get_dedup_keys(
+    consumer: str, record: dict, root_trace_id: str, scorer: str
+) -> List[str]:
+    """
+    :param consumer: The name of the handler processing the record.  Every
+        subscriber to a topic receives the same MessageId, so the keys are
+        specific to the consumer.
+    :param record: The SNS record.
+    :param root_trace_id: The root trace id of the record's image.
+    :param scorer: The name of the scorer the record is processed for.
+    :return: The keys of the record in a `DedupStore`: its SNS MessageId, and
+        its image's root trace id and scorer, which also match a message that
+        was published again under a new MessageId.  Empty if the record has no
+        MessageId, since its outcome cannot be told apart from other records'.
+    """
+    try:
+        message_id = record['Sns']['MessageId']
+    except (KeyError, TypeError):
+        return []
+    return [
+        f"{consumer}:message:{message_id}",
+        f"{consumer}:trace:{root_trace_id}:{scorer}",
+    ]
+
+
+def is_duplicate_record(
+    dedup_store: Union[DedupStore, None], keys: List[str], log_context: LogContext
+) -> bool:
+    """Checks whether a record has already been processed, counting it in the
+    `duplicates` field of the end message if so.
+
+    If the store cannot be read, the record is processed again, which is
+    wasteful but harmless.
+
+    :param dedup_store: The store of processed records, or None if
+        deduplication is not enabled.
+    :param keys: The keys of the record, from `get_dedup_keys`.
+    :param log_context: The record's log context.
+    :return: True if the record should be skipped.
+    """
+    if dedup_store is None or not keys:
+        return False
+    try:
+        duplicate = dedup_store.contains_any(keys)
+    except Exception as e:
+        log_context.log(f"[ERROR] Failed to read the dedup store: {e!r}")
+        return False
+    if duplicate:
+        log_context.increment_end_field('duplicates')
+        log_context.log(f"duplicate_skipped key={keys[0]}")
+    return duplicate
+
+
+def mark_records_processed(
+    dedup_store: Union[DedupStore, None],
+    response: dict,
+    processed_keys: Dict[str, List[str]],
+):
+    """Adds the records that were processed to the dedup store, once the
+    response to the invocation is known.
+
+    Records reported in the response's `batchItemFailures` are left out, so
+    that their redeliveries are processed, as are the records whose scores
+    failed to publish.
+
+    :param dedup_store: The store of processed records, or None if
+        deduplication is not enabled.
+    :param response: The response to the invocation.
+    :param processed_keys: The keys of the records that were processed, by
+        SNS MessageId.
+    """
+    if dedup_store is None:
+        return
+    failed = {
+        failure['itemIdentifier'] for failure in response.get('batchItemFailures', [])
+    }
+    for message_id, keys in processed_keys.items():
+        if message_id in failed:
+            continue
+        try:
+            dedup_store.add(keys)
+        except Exception as e:
+            log_error(None, f"Failed to update the dedup store: {e!r}")
+
+
 def rekognition(
     log_context: LogContext,
     detect_moderation_labels: dict = None,
@@ -618,6 +1497,13 @@ def rekognition(
     Exactly one of the `detect` parameters must be not None.  The rekognition invoked
     is determined by the parameter that is specified.
 
+    Concurrent requests for the same operation on the same S3 object share one
+    call to the service, as do requests shortly after it.  See
+    `_rekognition_flight`.
+
+    Calls are rate limited, and throttled calls are retried while the
+    invocation has time left.  See `_call_rekognition`.
+
     Note, this is not a scalable way to expose the rekognition service, but it
     works for now.
 
@@ -628,112 +1514,549 @@ def rekognition(
     :param detect_text:   If not None, rekognition will be invoked on it to detect text.
     :return: The list of moderation or text labels.
     """
-    if detect_text is not None:
-        operation = 'detect_text'
-    elif log_context is not None:
-        operation = 'detect_moderation_labels'
-    else:
-        raise Exception('rekognition needs at least one parameter')
+    operation, image = _get_rekognition_request(detect_moderation_labels, detect_text)
+    span = log_context.span(f"rekognition.{operation}")
+    log_context.log(f"START rekognition.{operation}")
+    try:
+        with span:
+            result, shared = _rekognition_flight.do(
+                _get_rekognition_flight_key(operation, image),
+                lambda: _call_rekognition(operation, image, log_context),
+            )
+    except (ClientError, RekognitionError) as e:
+        raise _rekognition_failed(log_context, operation, span, e)
+    _rekognition_succeeded(log_context, operation, span, result, shared)
+    return result
 
-    start_time = time.time()
 
+async def rekognition_async(
+    log_context: LogContext,
+    detect_moderation_labels: dict = None,
+    detect_text: dict = None,
+):
+    """Like `rekognition`, but without blocking the event loop while waiting
+    on the service.  Requests from asyncio tasks share calls with each other
+    and with requests from threads.
+    """
+    operation, image = _get_rekognition_request(detect_moderation_labels, detect_text)
+    span = log_context.span(f"rekognition.{operation}")
+    log_context.log(f"START rekognition.{operation}")
     try:
-        log_context.log(f"START rekognition.{operation}")
-        if detect_text is not None:
-            response = _rekognition_client.detect_text(Image=detect_text)
-            message_text = f"words={len(response['TextDetections'])}"
-            result = response['TextDetections']
-        else:
-            response = _rekognition_client.detect_moderation_labels(
-                Image=detect_moderation_labels
+        with span:
+            result, shared = await _rekognition_flight.do_async(
+                _get_rekognition_flight_key(operation, image),
+                lambda: run_blocking(_call_rekognition, operation, image, log_context),
             )
-            message_text = f"labels={len(response['ModerationLabels'])}"
-            result = response['ModerationLabels']
-        log_context.log(
-            f"END rekognition.{operation} status=200 "
-            f"latency_ms={calculate_latency_ms(start_time)} "
-            f"{message_text}"
+    except (ClientError, RekognitionError) as e:
+        raise _rekognition_failed(log_context, operation, span, e)
+    _rekognition_succeeded(log_context, operation, span, result, shared)
+    return result
+
+
+# The key of each Rekognition operation's results in its response, and the
+# name they are counted under in the log.
+_REKOGNITION_RESULTS = {
+    'detect_text': ('TextDetections', 'words'),
+    'detect_moderation_labels': ('ModerationLabels', 'labels'),
+}
+
+
+def _get_rekognition_request(
+    detect_moderation_labels: Union[dict, None], detect_text: Union[dict, None]
+) -> Tuple[str, dict]:
+    """
+    :return: The operation `rekognition` should invoke, and its image.
+    """
+    if detect_text is not None:
+        return 'detect_text', detect_text
+    if detect_moderation_labels is not None:
+        return 'detect_moderation_labels', detect_moderation_labels
+    raise Exception('rekognition needs at least one parameter')
+
+
+def _get_rekognition_flight_key(operation: str, image: dict) -> Union[tuple, None]:
+    """
+    :return: The key identifying requests for the operation on the image that
+        can share a call, or None if the image is not an S3 object.
+    """
+    s3_object = image.get('S3Object')
+    if s3_object is None:
+        return None
+    return (
+        operation,
+        s3_object['Bucket'],
+        s3_object['Name'],
+        s3_object.get('Version'),
+    )
+
+
+# The most calls per second to each Rekognition operation, which should be the
+# account's quota for it.  The limit adapts to throttling below this.  With the
+# `sqlite` store, the processes on a host share one budget.
+_REKOGNITION_MAX_TPS = float(os.environ.get('REKOGNITION_MAX_TPS', '50'))
+_rekognition_rate_limit_store = create_rate_limit_store(
+    os.environ.get('REKOGNITION_RATE_LIMIT_STORE', 'memory'),
+    path=os.environ.get(
+        'REKOGNITION_RATE_LIMIT_STORE_PATH', '/tmp/rekognition_rate_limits.db'
+    ),
+)
+_rekognition_rate_limiters = {
+    operation: AdaptiveRateLimiter(
+        operation, _REKOGNITION_MAX_TPS, store=_rekognition_rate_limit_store
+    )
+    for operation in _REKOGNITION_RESULTS
+}
+
+# The longest a Rekognition request waits for the rate limit or to retry a
+# throttled call, when it is not limited by the invocation's remaining time.
+_REKOGNITION_MAX_WAIT_S = float(os.environ.get('REKOGNITION_MAX_WAIT_S', '10'))
+
+# The error codes Rekognition returns when a call is throttled.
+_REKOGNITION_THROTTLE_CODES = frozenset(
+    {'ThrottlingException', 'ProvisionedThroughputExceededException'}
+)
+
+
+def _call_rekognition(
+    operation: str, image: dict, log_context: LogContext
+) -> List[dict]:
+    """Calls the operation once the rate limit allows, retrying after a jittered
+    backoff if it is throttled.  Waits never run past the invocation's deadline.
+
+    A retriable `RekognitionError` is raised if the rate limit leaves no time
+    to call, and the `ClientError` if the last attempt was throttled.
+    """
+    rate_limiter = _rekognition_rate_limiters[operation]
+    attempts = 0
+    while True:
+        waited_s = rate_limiter.acquire(_get_wait_budget_s())
+        if waited_s is None:
+            raise RekognitionError(
+                429,
+                f"The {operation} rate limit leaves no time to call it",
+                is_retriable=True,
+            )
+        if waited_s:
+            log_context.increment_end_field(
+                'rate_limited_ms.rekognition', round(waited_s * 1000)
+            )
+        try:
+            response = getattr(_rekognition_client, operation)(Image=image)
+        except ClientError as e:
+            if not _is_rekognition_throttle(e):
+                raise
+            log_context.increment_end_field('throttled.rekognition')
+            rate_limiter.on_throttle()
+            attempts += 1
+            backoff_s = rate_limiter.backoff_s(attempts)
+            if backoff_s > _get_wait_budget_s():
+                raise
+            time.sleep(backoff_s)
+            continue
+        rate_limiter.on_success()
+        return response[_REKOGNITION_RESULTS[operation][0]]
+
+
+def _is_rekognition_throttle(e: ClientError) -> bool:
+    return e.response.get('Error', {}).get('Code') in _REKOGNITION_THROTTLE_CODES
+
+
+def set_invocation_deadline(context):
+    """Records when the current invocation must finish its work, for waits such
+    as `_call_rekognition`'s to stay within.
+
+    :param context: The context passed into the Lambda invocation.
+    """
+    get_remaining_time_in_millis = getattr(
+        context, 'get_remaining_time_in_millis', None
+    )
+    deadline = None
+    if get_remaining_time_in_millis is not None:
+        deadline = time.monotonic() + get_remaining_time_in_millis() / 1000 - 1
+    _invocation_deadline.set(deadline)
+
+
+def _get_wait_budget_s() -> float:
+    """
+    :return: The longest the current Rekognition request may still wait to
+        call the service.
+    """
+    budget_s = _REKOGNITION_MAX_WAIT_S
+    deadline = _invocation_deadline.get()
+    if deadline is not None:
+        budget_s = min(budget_s, deadline - time.monotonic())
+    return max(0.0, budget_s)
+
+
+def _rekognition_succeeded(
+    log_context: LogContext, operation: str, span: Span, result: list, shared: bool
+):
+    coalesced = ''
+    if shared:
+        log_context.increment_end_field('coalesced.rekognition')
+        coalesced = ' coalesced=true'
+    log_context.log(
+        f"END rekognition.{operation} status=200 "
+        f"latency_ms={round(span.duration_ms)} "
+        f"{_REKOGNITION_RESULTS[operation][1]}={len(result)}{coalesced}"
+    )
+
+
+def _rekognition_failed(
+    log_context: LogContext,
+    operation: str,
+    span: Span,
+    e: Union[ClientError, RekognitionError],
+) -> 'RekognitionError':
+    if isinstance(e, RekognitionError):
+        error = e
+        throttled = e.status_code == 429
+    else:
+        throttled = _is_rekognition_throttle(e)
+        # The client does not retry, so server errors are failed as retriable
+        # for SNS to redeliver the record.
+        status_code = e.response['ResponseMetadata']['HTTPStatusCode']
+        error = RekognitionError(
+            status_code, str(e), is_retriable=throttled or status_code >= 500,
         )
+    log_context.log(
+        f"END rekognition.{operation} status={error.status_code} "
+        f"latency_ms={round(span.duration_ms)}"
+        f"{' throttled=true' if throttled else ''} "
+        f"message={e}"
+    )
+    return error
+
+
+def get_score_cache() -> Union[ScoreCache, None]:
+    """
+    :return: The score cache shared by all detection handlers in this
+        container, or None if caching is not enabled.
+    """
+    return _score_cache
+
 
-        return result
-    except ClientError as e:
+def get_dedup_store() -> Union[DedupStore, None]:
+    """
+    :return: The records of the messages processed by the detection handlers
+        in this container, or None if deduplication is not enabled.
+    """
+    return _dedup_store
+
+
+def log_score_computed(
+    log_context: LogContext, handler_name: str, image_payload: ImagePayload, score
+):
+    """Logs the score a handler computed for an image."""
+    # TODO:  Maybe we should make this raise an exception?
+    if score < 0 or score > 1:
         log_context.log(
-            f"END rekognition.detect_text status="
-            f"{e.response['ResponseMetadata']['HTTPStatusCode']} "
-            f"latency_ms={calculate_latency_ms(start_time)} "
-            f"message={e}"
+            f"Warning, invalid spam score computed. "
+            f"Should be between 0 and 1: {score}"
         )
-        raise RekognitionError(e.response['ResponseMetadata']['HTTPStatusCode'], str(e))
+
+    log_context.log(
+        f"score_computed algorithm={handler_name} "
+        f"score={score} image={image_payload.image_url} "
+        f"account_id={image_payload.account_id}"
+    )
+
+
+@contextmanager
+def handling_image_record(
+    handler_name: str, record: dict, context, trace_id: str
+) -> Iterator[Tuple[ImagePayload, LogContext]]:
+    """Receives the image payload of an SNS record and starts its log context,
+    for the body of the `with` statement to score the image.  Shared by
+    `DetectionHandler` and `AsyncDetectionHandler`.
+
+    If receiving the record or the body raises, the error is logged, as is the
+    record's end message once its log context has started, and the error is
+    re-raised.
+
+    :param handler_name: The name of the handler.
+    :param record: The SNS record.
+    :param context: The context passed into the Lambda invocation.
+    :param trace_id: The id of the trace for processing the record.
+    :return: The image payload and the record's log context.
+    """
+    log_context = None
+    try:
+        image_payload = receive_from_analyze_image_sns_record(record)
+
+        log_context = LogContext(
+            handler_name,
+            context.function_version,
+            root_trace=image_payload.root_trace_id,
+            parent_trace=image_payload.root_trace_id,
+            current_trace=trace_id,
+        )
+        # An `AsyncDetectionHandler` handles each record in its own asyncio
+        # task, so this only makes it the current log context of that task.
+        log_context.log_start_message()
+
+        yield image_payload, log_context
+    except HandlerError as e:
+        log_error(log_context, str(e), e)
+        if log_context is not None:
+            log_context.log_end_message(e.status_code, f"Failed due to exception: {e}")
+        raise
+    except Exception as e:
+        if log_context is not None:
+            log_context.log_end_message(500, f"Failed due to exception: {e!r}")
+        raise
+
+
+def get_cached_score(
+    score_cache: ScoreCache,
+    handler_name: str,
+    scorer_version: str,
+    content_id: Union[str, None],
+    log_context: LogContext,
+) -> Tuple[Union[tuple, None], Union[float, None]]:
+    """Looks up the cached score for an image, counting the cache hit, miss or
+    bypass in the end message.  Shared by `DetectionHandler` and
+    `AsyncDetectionHandler`.
+
+    :param score_cache: The cache of previously computed scores.
+    :param handler_name: The name of the handler.
+    :param scorer_version: The handler's `SCORER_VERSION`.
+    :param content_id: The S3 ETag of the image, or None if it is not known.
+    :param log_context: The log context to count the lookup in.
+    :return: A tuple of the image's cache key, which is None if the content is
+        not known, and its cached score, which is None if it must be scored.
+    """
+    if content_id is None:
+        # The content is unknown, so it cannot be looked up.
+        log_context.increment_end_field('score_cache_bypass')
+        return None, None
+
+    key = (handler_name, scorer_version, content_id)
+    score = score_cache.get(key)
+    if score is not None:
+        log_context.increment_end_field('score_cache_hits')
+    else:
+        log_context.increment_end_field('score_cache_misses')
+    return key, score
 
 
 class DetectionHandler:
     """Base class for all handlers that calculate a spam score for an image.
+
+    If a score cache is enabled, the score for an image is looked up by the
+    handler name, `SCORER_VERSION` and the image's S3 ETag before calling
+    `_score_image`, so reposts of the same image content are not rescored.
+
+    An instance scores one image at a time.  See `SyncDetectionHandlerAdapter`
+    to score the images of a batch concurrently.
     """
 
-    def __init__(self, handler_name: str):
+    # The version of the scoring algorithm.  Derived classes should override
+    # this if their scores can change independently of the pipeline version, so
+    # that stale cached scores are not reused.
+    SCORER_VERSION = _PIPELINE_LAMBDA_VERSION
+
+    # The relative cost of scoring an image.  In cascade mode (see
+    # `DetectAllHandler`), the cheapest scorers run first, so that the costly
+    # ones can be skipped once the verdict is known.  Derived classes should
+    # override this.
+    COST_ORDER = 100
+
+    def __init__(
+        self,
+        handler_name: str,
+        score_cache: ScoreCache = None,
+        dedup_store: DedupStore = None,
+    ):
         """Creates an instance.
 
         :param handler_name: The name of the handler deriving this class.
+        :param score_cache: The cache of previously computed scores.  If None,
+            the cache configured by the environment is used, if any.
+        :param dedup_store: The store of the records already processed.  If
+            None, the store configured by the environment is used, if any.
         """
         self.__handler_name = handler_name
+        self.__score_cache = score_cache if score_cache is not None else _score_cache
+        self.__dedup_store = dedup_store if dedup_store is not None else _dedup_store
+        self.__image_context: Union['ImageContext', None] = None
         self._log_context: Union[LogContext, None] = None
 
     def handle_request(self, event: dict, context) -> dict:
         """Handles a Lambda invocation.
 
+        Every record in the event is scored.  A failure scoring one record
+        does not prevent the others from being scored.  Records that were
+        already scored, as SNS may deliver a message more than once, are
+        skipped if a dedup store is enabled.
+
         :param event: The event passed into the Lambda invocation.
         :param context: The context passed into the Lambda invocation.
         :return: The response to return for the Lambda invocation.
         """
-        try:
-            image_payload = receive_from_analyze_image_sns_topic(event)
+        # Imported here, since the publisher is built on this module.
+        from sns_publisher import SnsBatchPublisher
+
+        publisher = SnsBatchPublisher()
+        processed_keys: Dict[str, List[str]] = {}
+        response = handle_sns_records(
+            event,
+            context,
+            lambda record, trace_id: self._handle_record(
+                record, context, trace_id, publisher, processed_keys
+            ),
+            'Hello, you have reached {}.'.format(self.__handler_name),
+            publisher=publisher,
+        )
+        # Only once the scores are published, so that a failed publish is
+        # retried on redelivery.
+        mark_records_processed(self.__dedup_store, response, processed_keys)
+        return response
 
-            self._log_context = LogContext(
+    def _handle_record(
+        self,
+        record: dict,
+        context,
+        trace_id: str,
+        publisher: 'SnsBatchPublisher',
+        processed_keys: Dict[str, List[str]],
+    ) -> Union[LogContext, None]:
+        """Scores the image in a single SNS record and buffers its score in
+        the publisher.
+
+        A `HandlerError` is raised if the record could not be processed.
+
+        :param record: The SNS record.
+        :param context: The context passed into the Lambda invocation.
+        :param trace_id: The id of the trace for processing this record.
+        :param publisher: The publisher to buffer the score in.
+        :param processed_keys: The dedup keys of the records scored, by SNS
+            MessageId, which this record's keys are added to.
+        :return: The record's log context, whose end message is emitted once
+            the publisher has been flushed, or None if the record was a
+            duplicate.
+        """
+        self._log_context = None
+        with handling_image_record(self.__handler_name, record, context, trace_id) as (
+            image_payload,
+            log_context,
+        ):
+            self._log_context = log_context
+            keys = get_dedup_keys(
+                self.__handler_name,
+                record,
+                image_payload.root_trace_id,
                 self.__handler_name,
-                context.function_version,
-                root_trace=image_payload.root_trace_id,
-                parent_trace=image_payload.root_trace_id,
-                current_trace=context.aws_request_id,
             )
-            self._log_context.log_start_message()
-
-            score = self._score_image(image_payload)
+            if is_duplicate_record(self.__dedup_store, keys, log_context):
+                log_context.log_end_message(200, "Skipped duplicate")
+                return None
 
-            # TODO:  Maybe we should make this raise an exception?
-            if score < 0 or score > 1:
-                self._log_context.log(
-                    f"Warning, invalid spam score computed. "
-                    f"Should be between 0 and 1: {score}"
-                )
-
-            self._log_context.log(
-                f"score_computed algorithm={self.__handler_name} "
-                f"score={score} image={image_payload.image_url} "
-                f"account_id={image_payload.account_id}"
-            )
+            score = self.score_image(image_payload, log_context)
 
             publish_to_update_spam_score_sns_topic(
                 image_payload,
                 self.__handler_name,
                 score,
-                context.aws_request_id,
-                log_context=self._log_context,
+                trace_id,
+                log_context=log_context,
+                publisher=publisher,
             )
 
-            self._log_context.log_end_message(200, "Success")
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'text/plain'},
-                'body': 'Hello, you have reached {}.'.format(self.__handler_name),
-            }
-        except HandlerError as e:
-            print(f"[ERROR] {e}: ")
-            traceback.print_exc()
-            if self._log_context is not None:
-                self._log_context.log_end_message(
-                    e.status_code, f"Failed due to exception: {e}"
-                )
-            return e.create_response(for_sns_topic=True)
+            if keys:
+                processed_keys[record['Sns']['MessageId']] = keys
+            return log_context
+
+    @property
+    def handler_name(self) -> str:
+        """
+        :return: The name of the handler, which is also the name of its
+            scoring algorithm.
+        """
+        return self.__handler_name
+
+    def score_image(
+        self,
+        image_payload: ImagePayload,
+        log_context: LogContext,
+        image_context: 'ImageContext' = None,
+    ) -> float:
+        """Scores an image, consulting the score cache if one is enabled.
+
+        This is used by `handle_request`, and may also be used to run the
+        scorer inside another handler.  An instance must only score one image
+        at a time.
+
+        :param image_payload: The image to score.
+        :param log_context: The log context to report the scoring with.
+        :param image_context: The context to read the image through.  If None,
+            the context shared by the process is used.
+        :return: The spam score from 0 to 1.
+        """
+        self._log_context = log_context
+        self.__image_context = image_context
+
+        with log_context.span(f"score.{self.__handler_name}"):
+            score = self.__score_image_with_cache(image_payload)
+
+        log_score_computed(log_context, self.__handler_name, image_payload, score)
+        return score
+
+    def _get_image_context(self, image_payload: ImagePayload) -> 'ImageContext':
+        """Derived classes should read the image they are scoring through the
+        context returned by this method.
+
+        :param image_payload: The image being scored.
+        :return: The context passed to `score_image`, if any, otherwise the
+            context shared by the process for the image.
+        """
+        if self.__image_context is not None:
+            return self.__image_context
+        # Imported here, since the context is built on this module.
+        from image_context import ImageContext
+
+        return ImageContext.for_payload(image_payload)
+
+    def __score_image_with_cache(self, image_payload: ImagePayload) -> float:
+        """Returns the cached score for the image if there is one, otherwise
+        scores it with `_score_image` and caches the result.
+
+        Cache hits and misses are counted in the end message.
+
+        :param image_payload: The image to score.
+        :return: The spam score from 0 to 1.
+        """
+        if self.__score_cache is None:
+            return self._score_image(image_payload)
+
+        key, score = get_cached_score(
+            self.__score_cache,
+            self.__handler_name,
+            self.SCORER_VERSION,
+            self._get_image_content_id(image_payload),
+            self._log_context,
+        )
+        if score is None:
+            score = self._score_image(image_payload)
+            if key is not None:
+                self.__score_cache.put(key, score)
+        return score
+
+    def _get_image_content_id(self, image_payload: ImagePayload) -> Union[str, None]:
+        """Returns an identifier for the content of the image, used as part of
+        its score cache key.
+
+        This is the ETag of the S3 object, which changes whenever the object's
+        content does.  It is taken from the image's shared `ImageContext`, so it
+        costs no extra request if the image has already been fetched.
+
+        :param image_payload: The image.
+        :return: The content identifier, or None if it could not be determined.
+        """
+        try:
+            return self._get_image_context(image_payload).etag(self._log_context)
+        except S3FetchError:
+            return None
 
     # noinspection PyMethodMayBeStatic
     def _score_image(self, _image_payload: ImagePayload) -> float:
@@ -760,6 +2083,7 @@ class S3Url(object):
 
             self._bucket = self._parsed.netloc
             self._key = self._parsed.path.lstrip('/')
+            self._version_id = parse_qs(self._parsed.query).get('versionId', [None])[0]
             self._url = self._parsed.geturl()
         except ValueError:
             print("exception while attempting to urlparse: {}".format(url))
@@ -773,6 +2097,14 @@ class S3Url(object):
     def key(self) -> str:
         return self._key
 
+    @property
+    def version_id(self) -> Union[str, None]:
+        """
+        :return: The version of the object given by a `versionId` query
+            parameter, if any.
+        """
+        return self._version_id
+
     @property
     def url(self) -> str:
         return self._url
@@ -0,0 +1,151 @@
+"""Bounded-memory latency histograms.
+
+`LatencyHistogram` counts latencies in logarithmically sized buckets, in the
+style of HDR histograms: every bucket is a fixed fraction wider than the one
+before it, so any percentile is reported within that relative error no matter
+how the latencies are distributed, and the memory used is fixed by the range
+of latencies covered rather than by the number recorded.
+
+`LatencyHistograms` holds one histogram per name and hands out a summary of
+them periodically, starting a fresh window each time.
+"""
+
+import math
+import threading
+import time
+
+from array import array
+from typing import Dict, Union
+
+# The range of latencies covered, in milliseconds.  Latencies outside of it
+# are counted in the first or last bucket.
+MIN_LATENCY_MS = 0.01
+MAX_LATENCY_MS = 15 * 60 * 1000
+
+
+class LatencyHistogram:
+    """Counts latencies in buckets whose width grows geometrically."""
+
+    def __init__(self, relative_error: float = 0.02):
+        """Creates an instance.
+
+        :param relative_error: The maximum relative error of the reported
+            percentiles.  Smaller values use more buckets.
+        """
+        self.__log_growth = math.log1p(2 * relative_error)
+        self.__bucket_count = (
+            int(math.log(MAX_LATENCY_MS / MIN_LATENCY_MS) / self.__log_growth) + 2
+        )
+        self.__counts = array('Q', bytes(8 * self.__bucket_count))
+        self.__count = 0
+        self.__sum_ms = 0.0
+        self.__max_ms = 0.0
+
+    @property
+    def count(self) -> int:
+        return self.__count
+
+    @property
+    def max_ms(self) -> float:
+        return self.__max_ms
+
+    @property
+    def mean_ms(self) -> float:
+        return self.__sum_ms / self.__count if self.__count else 0.0
+
+    def record(self, latency_ms: float):
+        """
+        :param latency_ms: The latency to count.
+        """
+        if latency_ms <= MIN_LATENCY_MS:
+            index = 0
+        else:
+            index = min(
+                self.__bucket_count - 1,
+                int(math.log(latency_ms / MIN_LATENCY_MS) / self.__log_growth) + 1,
+            )
+        self.__counts[index] += 1
+        self.__count += 1
+        self.__sum_ms += latency_ms
+        if latency_ms > self.__max_ms:
+            self.__max_ms = latency_ms
+
+    def percentile(self, fraction: float) -> float:
+        """
+        :param fraction: The percentile, from 0 to 1.
+        :return: The latency at the percentile, as the midpoint of its bucket,
+            or 0 if nothing has been recorded.
+        """
+        if self.__count == 0:
+            return 0.0
+        rank = max(1, math.ceil(fraction * self.__count))
+        seen = 0
+        for index, bucket_count in enumerate(self.__counts):
+            seen += bucket_count
+            if seen >= rank:
+                if index == self.__bucket_count - 1:
+                    # The last bucket holds everything beyond the range.
+                    return self.__max_ms
+                return min(self.__bucket_midpoint(index), self.__max_ms)
+        return self.__max_ms
+
+    def __bucket_midpoint(self, index: int) -> float:
+        if index == 0:
+            return MIN_LATENCY_MS
+        lower = MIN_LATENCY_MS * math.exp((index - 1) * self.__log_growth)
+        upper = lower * math.exp(self.__log_growth)
+        return (lower + upper) / 2
+
+
+class LatencyHistograms:
+    """A histogram per name, summarized and reset periodically."""
+
+    def __init__(self, summary_interval_s: float = 60):
+        """Creates an instance.
+
+        :param summary_interval_s: How often `take_summary_if_due` returns a
+            summary.
+        """
+        self.__summary_interval_s = summary_interval_s
+        self.__lock = threading.Lock()
+        self.__histograms: Dict[str, LatencyHistogram] = {}
+        self.__window_start = time.monotonic()
+
+    def record(self, name: str, latency_ms: float):
+        """
+        :param name: The name of the operation, such as `s3.get_object`.
+        :param latency_ms: Its latency.
+        """
+        with self.__lock:
+            histogram = self.__histograms.get(name)
+            if histogram is None:
+                histogram = self.__histograms[name] = LatencyHistogram()
+            histogram.record(latency_ms)
+
+    def take_summary_if_due(self) -> Union[Dict[str, dict], None]:
+        """Returns a summary of the current window if it has lasted at least
+        the summary interval, and starts a new window.
+
+        :return: For each name, its `count`, `p50_ms`, `p90_ms`, `p99_ms` and
+            `max_ms`, or None if a summary is not yet due or there is nothing
+            to summarize.
+        """
+        now = time.monotonic()
+        with self.__lock:
+            if now - self.__window_start < self.__summary_interval_s:
+                return None
+            histograms = self.__histograms
+            self.__histograms = {}
+            self.__window_start = now
+        if not histograms:
+            return None
+        return {
+            name: {
+                'count': histogram.count,
+                'p50_ms': round(histogram.percentile(0.50), 2),
+                'p90_ms': round(histogram.percentile(0.90), 2),
+                'p99_ms': round(histogram.percentile(0.99), 2),
+                'max_ms': round(histogram.max_ms, 2),
+            }
+            for name, histogram in sorted(histograms.items())
+        }
@@ -0,0 +1,275 @@
+"""Buffered, structured emission of the logs of a Lambda invocation.
+
+Writing each log line to stdout as it happens costs a system call per line, and
+CloudWatch Logs bills for every byte ingested.  A `LogEmitter` holds the
+container's log settings, and hands out a `LogBuffer` per invocation that
+collects the invocation's lines and writes them all at once when flushed.
+
+The settings control:
+
+* The format of events: `kv` (the existing `message key=value` format) or
+  `json` (one JSON object per line).
+* The minimum level of events that are emitted.
+* Detail sampling: a deterministic fraction of traces emit every event, even
+  those below the minimum level, so that full detail is available for a
+  sample of traces while the rest only emit a summary.
+
+The settings are read from the environment with `LogEmitter.from_environment`:
+`LOG_FORMAT` (default `kv`), `LOG_LEVEL` (default `INFO`) and
+`LOG_DETAIL_SAMPLE_RATE` (default `0.01`).
+
+A Lambda that times out is stopped without a chance to flush, so a
+`DeadlineFlusher` can flush a buffer shortly before the invocation's deadline.
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+import zlib
+
+from typing import Dict, List, TextIO, Union
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+_LEVELS_BY_NAME = {'DEBUG': DEBUG, 'INFO': INFO, 'WARNING': WARNING, 'ERROR': ERROR}
+
+# Buffers are flushed early once they hold this many characters, to bound the
+# memory used by an invocation that logs heavily.
+MAX_BUFFERED_CHARS = 64 * 1024
+
+
+class LogEmitter:
+    """The log settings of the container."""
+
+    def __init__(
+        self,
+        log_format: str = 'kv',
+        level: int = INFO,
+        detail_sample_rate: float = 0.01,
+        stream: TextIO = None,
+    ):
+        """Creates an instance.
+
+        :param log_format: Either `kv` or `json`.
+        :param level: The minimum level of events emitted for traces that are
+            not sampled for detail.
+        :param detail_sample_rate: The fraction of traces, from 0 to 1, that
+            emit events of every level.
+        :param stream: The stream to write to.  If None, the current
+            `sys.stdout` is used at the time of each write.
+        """
+        if log_format not in ('kv', 'json'):
+            raise ValueError(f'Unknown log format "{log_format}".  Must be kv or json')
+        self.__log_format = log_format
+        self.__level = level
+        self.__detail_sample_rate = detail_sample_rate
+        self.__stream = stream
+
+    @staticmethod
+    def from_environment() -> 'LogEmitter':
+        """
+        :return: An emitter configured by the `LOG_FORMAT`, `LOG_LEVEL` and
+            `LOG_DETAIL_SAMPLE_RATE` environment variables.
+        """
+        level_name = os.environ.get('LOG_LEVEL', 'INFO').upper()
+        if level_name not in _LEVELS_BY_NAME:
+            raise ValueError(f'Unknown log level "{level_name}"')
+        return LogEmitter(
+            log_format=os.environ.get('LOG_FORMAT', 'kv').lower(),
+            level=_LEVELS_BY_NAME[level_name],
+            detail_sample_rate=float(os.environ.get('LOG_DETAIL_SAMPLE_RATE', '0.01')),
+        )
+
+    @property
+    def log_format(self) -> str:
+        return self.__log_format
+
+    def is_detailed(self, trace_id: str) -> bool:
+        """Returns whether a trace is sampled for detail.
+
+        The decision is a deterministic function of the trace id, so every
+        Lambda handling the same trace makes the same decision.
+
+        :param trace_id: The id of the trace.
+        :return: True if the trace should emit events of every level.
+        """
+        if self.__detail_sample_rate <= 0 or trace_id is None:
+            return False
+        if self.__detail_sample_rate >= 1:
+            return True
+        bucket = zlib.crc32(str(trace_id).encode('utf-8')) / 0x100000000
+        return bucket < self.__detail_sample_rate
+
+    def new_buffer(self, trace_id: str) -> 'LogBuffer':
+        """
+        :param trace_id: The id of the trace used to decide whether the
+            invocation is sampled for detail.
+        :return: A buffer for the lines of one invocation.
+        """
+        level = DEBUG if self.is_detailed(trace_id) else self.__level
+        return LogBuffer(self, level)
+
+    def format_event(self, event: str, fields: Dict[str, object]) -> str:
+        """
+        :param event: The message or name of the event.
+        :param fields: The fields of the event.
+        :return: The event formatted as a single line.
+        """
+        if self.__log_format == 'json':
+            document = {'message': event}
+            document.update(fields)
+            return json.dumps(document, default=str)
+        return event + ''.join(f" {key}={value}" for key, value in fields.items())
+
+    def write(self, lines: List[str]):
+        """Writes lines to the stream with a single write.
+
+        :param lines: The lines, without line endings.
+        """
+        if not lines:
+            return
+        stream = self.__stream if self.__stream is not None else sys.stdout
+        stream.write('\n'.join(lines) + '\n')
+        stream.flush()
+
+
+class LogBuffer:
+    """Collects the log lines of one invocation until they are flushed.
+
+    Thread-safe, so that scorers running concurrently may share a buffer.
+    """
+
+    def __init__(self, emitter: LogEmitter, level: int):
+        """Creates an instance.  Use `LogEmitter.new_buffer` rather than
+        calling this directly.
+
+        :param emitter: The emitter to format and write lines with.
+        :param level: The minimum level of events to keep.
+        """
+        self.__emitter = emitter
+        self.__level = level
+        self.__lock = threading.Lock()
+        self.__lines: List[str] = []
+        self.__chars = 0
+
+    def is_enabled(self, level: int) -> bool:
+        """
+        :param level: The level of an event.
+        :return: True if events of this level are kept.  Callers can use this
+            to skip building events that would be dropped.
+        """
+        return level >= self.__level
+
+    def add_line(self, line: str):
+        """Adds a preformatted line, regardless of level.
+
+        :param line: The line, without a line ending.
+        """
+        with self.__lock:
+            self.__lines.append(line)
+            self.__chars += len(line)
+            if self.__chars >= MAX_BUFFERED_CHARS:
+                self.__flush_locked()
+
+    def add_event(self, level: int, event: str, fields: Dict[str, object]):
+        """Adds an event, if its level is enabled.
+
+        :param level: The level of the event.
+        :param event: The message or name of the event.
+        :param fields: The fields of the event.
+        """
+        if level >= self.__level:
+            self.add_line(self.__emitter.format_event(event, fields))
+
+    def flush(self):
+        """Writes the buffered lines with a single write.  Lines added
+        afterwards are buffered again.
+        """
+        with self.__lock:
+            self.__flush_locked()
+
+    def __flush_locked(self):
+        # Written while holding the lock, so that lines from concurrent
+        # flushes are not reordered.
+        self.__emitter.write(self.__lines)
+        self.__lines = []
+        self.__chars = 0
+
+
+class DeadlineFlusher:
+    """Flushes buffers whose invocations reach their deadline without being
+    finished, such as one about to time out.
+
+    A single daemon thread, started on first use, waits for the earliest
+    deadline, so that watching a buffer costs no more than a dictionary entry.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        """Creates an instance.
+
+        :param clock: Returns the current time in seconds.  The deadlines are
+            measured by it.
+        """
+        self.__clock = clock
+        self.__condition = threading.Condition()
+        # The deadline of each watched buffer.
+        self.__deadlines: Dict[LogBuffer, float] = {}
+        self.__thread: Union[threading.Thread, None] = None
+
+    def watch(self, buffer: 'LogBuffer', deadline: float):
+        """Flushes a buffer at a deadline, unless it is unwatched first.
+
+        :param buffer: The buffer.
+        :param deadline: When to flush it, as returned by the clock.
+        """
+        with self.__condition:
+            self.__deadlines[buffer] = deadline
+            if self.__thread is None:
+                self.__thread = threading.Thread(
+                    target=self.__run, name='log-deadline-flusher', daemon=True
+                )
+                self.__thread.start()
+            self.__condition.notify()
+
+    def unwatch(self, buffer: 'LogBuffer'):
+        """Stops watching a buffer.
+
+        :param buffer: The buffer, which need not be watched.
+        """
+        with self.__condition:
+            self.__deadlines.pop(buffer, None)
+
+    def flush_due(self) -> int:
+        """Flushes and stops watching the buffers whose deadline has passed.
+
+        :return: The number of buffers flushed.
+        """
+        with self.__condition:
+            now = self.__clock()
+            due = [
+                buffer
+                for buffer, deadline in self.__deadlines.items()
+                if deadline <= now
+            ]
+            for buffer in due:
+                del self.__deadlines[buffer]
+        for buffer in due:
+            buffer.add_line('[ERROR] Flushing the logs of an unfinished invocation')
+            buffer.flush()
+        return len(due)
+
+    def __run(self):
+        while True:
+            with self.__condition:
+                if self.__deadlines:
+                    timeout = min(self.__deadlines.values()) - self.__clock()
+                else:
+                    timeout = None
+                if timeout is None or timeout > 0:
+                    self.__condition.wait(timeout)
+            self.flush_due()
@@ -0,0 +1,142 @@
+"""Encoding of the payloads the Lambdas exchange through SNS.
+
+Payloads are documents of JSON-compatible values.  They are sent in one of two
+wire formats:
+
+* `json` -- the document as JSON text.  This is the default, and the format of
+  every message sent before the other format existed.
+* `msgpack-v1` -- the document packed with MessagePack and base64 encoded, in a
+  JSON envelope of the form `{"Format": "msgpack-v1", "Data": "..."}`.  The
+  base64 encoding is needed since SNS messages must be text.
+
+The format of a message is negotiated by its `Format` field: a message without
+one is plain JSON.  So receivers read both formats, whatever format they send,
+and the format can be changed one sender at a time once every receiver reads
+it.
+
+When the `orjson` package is available it is used to encode and decode JSON,
+and when the `msgpack` package is available the `msgpack-v1` format can be
+used.  Both are optional.
+
+The format sent is read from the environment with `PayloadCodec.from_environment`:
+`PAYLOAD_FORMAT` (default `json`).
+"""
+
+import base64
+import binascii
+import json
+import os
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+FORMAT_FIELD = 'Format'
+DATA_FIELD = 'Data'
+
+JSON = 'json'
+MSGPACK_V1 = 'msgpack-v1'
+
+WIRE_FORMATS = (JSON, MSGPACK_V1)
+
+
+class PayloadDecodeError(ValueError):
+    """Raised when a message cannot be decoded."""
+
+
+class PayloadCodec:
+    """Encodes payloads in a wire format, and decodes payloads in any."""
+
+    def __init__(self, wire_format: str = JSON, fast_json: bool = True):
+        """Creates an instance.
+
+        :param wire_format: The format to encode payloads in.  One of
+            `WIRE_FORMATS`.
+        :param fast_json: If True, `orjson` is used for JSON when it is
+            available.  Otherwise the standard library is always used.
+        """
+        if wire_format not in WIRE_FORMATS:
+            raise ValueError(
+                f'Unknown payload format "{wire_format}".  Must be one of '
+                f'{", ".join(WIRE_FORMATS)}'
+            )
+        if wire_format == MSGPACK_V1 and msgpack is None:
+            raise ValueError(
+                f'The payload format "{wire_format}" requires the msgpack package'
+            )
+        self.__wire_format = wire_format
+        self.__orjson = orjson if fast_json else None
+
+    @staticmethod
+    def from_environment() -> 'PayloadCodec':
+        """
+        :return: A codec that encodes in the format named by the
+            `PAYLOAD_FORMAT` environment variable.
+        """
+        return PayloadCodec(os.environ.get('PAYLOAD_FORMAT', JSON).lower())
+
+    @property
+    def wire_format(self) -> str:
+        return self.__wire_format
+
+    def encode(self, document: dict) -> str:
+        """
+        :param document: The payload.
+        :return: The payload encoded in this codec's wire format.
+        """
+        if self.__wire_format == MSGPACK_V1:
+            data = base64.b64encode(msgpack.packb(document, use_bin_type=True))
+            document = {FORMAT_FIELD: MSGPACK_V1, DATA_FIELD: data.decode('ascii')}
+        return self.__dumps(document)
+
+    def decode(self, message) -> object:
+        """Decodes a message in any of the wire formats.
+
+        :param message: The message, as text or UTF-8 bytes.
+        :return: The decoded payload.  This is a dict for any message sent by
+            `encode`, but may be any JSON value for other messages.
+        """
+        document = self.__loads(message)
+        if isinstance(document, dict) and FORMAT_FIELD in document:
+            document = self.__unwrap(document)
+        return document
+
+    def __dumps(self, document: dict) -> str:
+        if self.__orjson is not None:
+            try:
+                return self.__orjson.dumps(document).decode('utf-8')
+            except TypeError:
+                # orjson is stricter, such as about integers beyond 64 bits.
+                pass
+        return json.dumps(document)
+
+    def __loads(self, message):
+        try:
+            if self.__orjson is not None:
+                return self.__orjson.loads(message)
+            return json.loads(message)
+        except ValueError as e:
+            # Both libraries raise subclasses of ValueError.
+            raise PayloadDecodeError(getattr(e, 'msg', str(e)))
+
+    @staticmethod
+    def __unwrap(envelope: dict) -> object:
+        wire_format = envelope[FORMAT_FIELD]
+        if wire_format != MSGPACK_V1:
+            raise PayloadDecodeError(f'Unknown payload format "{wire_format}"')
+        if msgpack is None:
+            raise PayloadDecodeError(
+                f'The payload format "{wire_format}" requires the msgpack package'
+            )
+        try:
+            return msgpack.unpackb(
+                base64.b64decode(envelope[DATA_FIELD], validate=True), raw=False
+            )
+        except (KeyError, TypeError, ValueError, binascii.Error) as e:
+            raise PayloadDecodeError(f'Invalid {wire_format} payload: {e}')
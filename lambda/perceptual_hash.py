@@ -0,0 +1,171 @@
+"""Perceptual image hashes computed with NumPy from one shared downscale.
+
+Computing several hashes with the `imagehash` library converts and resizes
+the image from scratch for each one.  Here, every hash is instead derived from
+a single `DOWNSCALE_SIZE` by `DOWNSCALE_SIZE` grayscale thumbnail, so adding
+hash types costs only a few small matrix products.  Thumbnails can also be
+stacked into a batch and hashed in one vectorized call.
+
+The 64 bit hashes are:
+
+* `ahash` -- the average hash: the thumbnail resized to 8x8, with each bit set
+  where the pixel is above the mean.
+* `dhash` -- the difference hash: the thumbnail resized to 9x8, with each bit
+  set where a pixel is brighter than its left neighbour.
+* `phash` -- the perceptual hash: the lowest 8x8 frequencies of the
+  thumbnail's 2D DCT, with each bit set where the coefficient is above their
+  median.
+* `whash` -- the wavelet hash: the 8x8 Haar approximation coefficients of the
+  thumbnail, with the overall mean removed, with each bit set where the
+  coefficient is above their median.  The Haar approximation coefficients are
+  proportional to the means of blocks of pixels, so they are computed that way.
+
+The resizes use PIL's Lanczos filter coefficients, as `imagehash` does, as
+matrices applied to each side of the thumbnail.
+
+Bits are ordered row by row, with the first bit the most significant, which is
+the same order as `imagehash`, so the integers can be compared with those from
+`hash_index.image_hash_to_int`.  The hashes follow the `imagehash` definitions,
+but since they are resized from the shared thumbnail rather than from the
+original image, a few bits near the threshold may differ from `imagehash`'s.
+"""
+
+from typing import Dict, Iterable, Sequence
+
+import numpy as np
+
+from hash_corpus import HASH_ALGORITHMS
+
+ALGORITHMS = HASH_ALGORITHMS
+
+HASH_SIZE = 8
+
+# The width and height of the shared thumbnail.
+DOWNSCALE_SIZE = 32
+
+# Weights of the bits of a hash, most significant first.
+_BIT_WEIGHTS = np.left_shift(
+    np.uint64(1), np.arange(HASH_SIZE * HASH_SIZE - 1, -1, -1, dtype=np.uint64)
+)
+
+
+def _lanczos(x: float) -> float:
+    if -3 < x < 3:
+        return float(np.sinc(x) * np.sinc(x / 3))
+    return 0.0
+
+
+def _lanczos_matrix(source_size: int, target_size: int) -> np.ndarray:
+    """Returns the `target_size` by `source_size` matrix that resizes a vector
+    with the same Lanczos filter coefficients as PIL, which `imagehash` uses.
+    """
+    matrix = np.zeros((target_size, source_size))
+    scale = source_size / target_size
+    filter_scale = max(scale, 1.0)
+    support = 3 * filter_scale
+    for target in range(target_size):
+        center = (target + 0.5) * scale
+        start = max(int(center - support + 0.5), 0)
+        end = min(int(center + support + 0.5), source_size)
+        for source in range(start, end):
+            matrix[target, source] = _lanczos((source - center + 0.5) / filter_scale)
+        matrix[target] /= matrix[target].sum()
+    return matrix
+
+
+def _area_matrix(source_size: int, target_size: int) -> np.ndarray:
+    """Returns the `target_size` by `source_size` matrix that resizes a vector
+    by averaging the source elements in each target element.  `source_size`
+    must be a multiple of `target_size`.
+    """
+    block = source_size // target_size
+    return np.kron(np.eye(target_size), np.full(block, 1 / block))
+
+
+def _dct_matrix(size: int, coefficients: int) -> np.ndarray:
+    """Returns the first `coefficients` rows of the (unnormalized) DCT-II
+    matrix for vectors of length `size`.
+    """
+    k = np.arange(coefficients)[:, None]
+    n = np.arange(size)[None, :]
+    return np.cos(np.pi * (2 * n + 1) * k / (2 * size))
+
+
+_LANCZOS_8 = _lanczos_matrix(DOWNSCALE_SIZE, HASH_SIZE)
+_LANCZOS_9 = _lanczos_matrix(DOWNSCALE_SIZE, HASH_SIZE + 1)
+_AREA_8 = _area_matrix(DOWNSCALE_SIZE, HASH_SIZE)
+_DCT_8 = _dct_matrix(DOWNSCALE_SIZE, HASH_SIZE)
+
+
+def _pack(bits: np.ndarray) -> np.ndarray:
+    """Packs an (n, 8, 8) boolean array into n 64 bit hashes."""
+    flat = bits.reshape(len(bits), -1).astype(np.uint64)
+    return (flat * _BIT_WEIGHTS).sum(axis=1, dtype=np.uint64)
+
+
+def _above_median(values: np.ndarray) -> np.ndarray:
+    flat = values.reshape(len(values), -1)
+    return values > np.median(flat, axis=1)[:, None, None]
+
+
+def _ahash(pixels: np.ndarray) -> np.ndarray:
+    reduced = _LANCZOS_8 @ pixels @ _LANCZOS_8.T
+    return _pack(reduced > reduced.mean(axis=(1, 2), keepdims=True))
+
+
+def _dhash(pixels: np.ndarray) -> np.ndarray:
+    reduced = _LANCZOS_8 @ pixels @ _LANCZOS_9.T
+    return _pack(reduced[:, :, 1:] > reduced[:, :, :-1])
+
+
+def _phash(pixels: np.ndarray) -> np.ndarray:
+    return _pack(_above_median(_DCT_8 @ pixels @ _DCT_8.T))
+
+
+def _whash(pixels: np.ndarray) -> np.ndarray:
+    # Removing the mean shifts every coefficient equally, so it does not change
+    # which are above the median, but it is kept to follow the definition.
+    reduced = _AREA_8 @ pixels @ _AREA_8.T
+    return _pack(_above_median(reduced - reduced.mean(axis=(1, 2), keepdims=True)))
+
+
+_HASH_FUNCTIONS = {
+    'ahash': _ahash,
+    'dhash': _dhash,
+    'phash': _phash,
+    'whash': _whash,
+}
+
+
+def hash_batch(
+    thumbnails: np.ndarray, algorithms: Iterable[str] = ALGORITHMS
+) -> Dict[str, np.ndarray]:
+    """Hashes a batch of thumbnails.
+
+    :param thumbnails: An array of shape (n, `DOWNSCALE_SIZE`,
+        `DOWNSCALE_SIZE`) holding the grayscale thumbnails.
+    :param algorithms: The hashes to compute.
+    :return: For each algorithm, an array of the n hashes, as uint64.
+    """
+    pixels = np.asarray(thumbnails, dtype=np.float64)
+    if pixels.ndim != 3 or pixels.shape[1:] != (DOWNSCALE_SIZE, DOWNSCALE_SIZE):
+        raise ValueError(
+            f"Expected thumbnails of shape (n, {DOWNSCALE_SIZE}, {DOWNSCALE_SIZE}), "
+            f"not {pixels.shape}"
+        )
+    return {algorithm: _HASH_FUNCTIONS[algorithm](pixels) for algorithm in algorithms}
+
+
+def compute_hashes(thumbnail, algorithms: Sequence[str] = ALGORITHMS) -> Dict[str, int]:
+    """Hashes a single thumbnail.
+
+    :param thumbnail: The `DOWNSCALE_SIZE` by `DOWNSCALE_SIZE` grayscale
+        thumbnail, as a PIL image or a 2D array.
+    :param algorithms: The hashes to compute.
+    :return: For each algorithm, the hash as an unsigned integer.
+    """
+    pixels = np.asarray(thumbnail, dtype=np.float64)[None]
+    return {
+        algorithm: int(hashes[0])
+        for algorithm, hashes in hash_batch(pixels, algorithms).items()
+    }
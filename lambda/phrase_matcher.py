@@ -0,0 +1,186 @@
+"""Matching of text against a large list of phrases in a single pass.
+
+`PhraseMatcher` compiles a list of phrases into an Aho-Corasick automaton over
+words, so scanning a text costs one step per word however many phrases there
+are, and phrases are matched wherever they appear in the text rather than only
+when they make up all of it.
+
+Both the phrases and the scanned text are normalized the same way by
+`normalize`, so that matches are not defeated by:
+
+* Case -- text is case folded.
+* Unicode variants -- text is NFKC normalized, so full width and other
+  compatibility forms match their plain equivalents, and accents are removed.
+* Common character substitutions -- such as `0` for `o`, `3` for `e` or `$`
+  for `s`.
+* Punctuation and spacing -- text is split into words at anything that is not
+  a letter, a digit or a substituted symbol, and trailing `!` and `|` are
+  treated as punctuation.
+
+A phrase list is a text file with one phrase per line.  Blank lines and lines
+starting with `#` are ignored.
+"""
+
+import re
+import unicodedata
+
+from array import array
+from typing import Dict, Iterable, List, Tuple
+
+# Characters commonly substituted for letters to evade filters.
+SUBSTITUTIONS = {
+    '0': 'o',
+    '1': 'i',
+    '3': 'e',
+    '4': 'a',
+    '5': 's',
+    '7': 't',
+    '@': 'a',
+    '$': 's',
+    '!': 'i',
+    '|': 'l',
+}
+
+_SUBSTITUTION_TABLE = str.maketrans(SUBSTITUTIONS)
+_WORD = re.compile(r'[\w$@!|]+')
+
+
+def normalize(text: str) -> List[str]:
+    """
+    :param text: The text to normalize.
+    :return: The normalized words of the text.
+    """
+    text = unicodedata.normalize('NFKC', text).casefold()
+    if not text.isascii():
+        # Decompose accented letters so the accents can be dropped.
+        text = ''.join(
+            c
+            for c in unicodedata.normalize('NFD', text)
+            if not unicodedata.combining(c)
+        )
+    words = []
+    for word in _WORD.findall(text):
+        word = word.rstrip('!|').translate(_SUBSTITUTION_TABLE)
+        if word:
+            words.append(word)
+    return words
+
+
+class PhraseMatcher:
+    """Counts the occurrences of any of a list of phrases in texts.
+
+    The automaton's states are numbered, and its transitions are held in a
+    single dict keyed by the state and the number of the word, which takes far
+    less memory than a dict per state for lists of 100k+ phrases.  Words that
+    appear in no phrase are not numbered, and reset the scan.
+    """
+
+    def __init__(self, phrases: Iterable[str]):
+        """Builds the automaton.
+
+        :param phrases: The phrases to match.  Phrases that normalize to no
+            words are ignored.
+        """
+        self.__word_ids: Dict[str, int] = {}
+        self.__transitions: Dict[int, int] = {}
+        self.__phrase_count = 0
+        # The number of phrases ending at each state, including those ending
+        # at the states along its failure links.
+        matches = array('l', [0])
+        children: List[List[Tuple[int, int]]] = [[]]
+
+        for phrase in phrases:
+            words = normalize(phrase)
+            if not words:
+                continue
+            state = 0
+            for word in words:
+                word_id = self.__word_ids.setdefault(word, len(self.__word_ids))
+                # Transitions are keyed by the state in the high bits and the
+                # word in the low bits.
+                key = (state << 32) | word_id
+                next_state = self.__transitions.get(key)
+                if next_state is None:
+                    next_state = len(children)
+                    self.__transitions[key] = next_state
+                    children[state].append((word_id, next_state))
+                    children.append([])
+                    matches.append(0)
+                state = next_state
+            if matches[state] == 0:
+                self.__phrase_count += 1
+            matches[state] = 1
+
+        self.__failures = array('l', bytes(matches.itemsize * len(children)))
+        self.__matches = matches
+        self.__link_failures(children)
+
+    @staticmethod
+    def from_file(path: str) -> 'PhraseMatcher':
+        """
+        :param path: The path of a phrase list file.
+        :return: A matcher for the phrases in the file.
+        """
+        with open(path, encoding='utf-8') as file:
+            return PhraseMatcher(
+                line for line in file if line.strip() and not line.startswith('#')
+            )
+
+    @property
+    def phrase_count(self) -> int:
+        """
+        :return: The number of distinct phrases matched.
+        """
+        return self.__phrase_count
+
+    def count_matches(self, text: str, limit: int = None) -> int:
+        """Counts the occurrences of the phrases in a text.  Overlapping
+        occurrences are each counted.
+
+        :param text: The text to scan.
+        :param limit: If not None, the scan stops once this many occurrences
+            have been found.
+        :return: The number of occurrences, or `limit` if it was reached.
+        """
+        word_ids = self.__word_ids
+        transitions = self.__transitions
+        failures = self.__failures
+        matches = self.__matches
+
+        count = 0
+        state = 0
+        for word in normalize(text):
+            word_id = word_ids.get(word)
+            if word_id is None:
+                state = 0
+                continue
+            while True:
+                next_state = transitions.get((state << 32) | word_id)
+                if next_state is not None:
+                    state = next_state
+                    break
+                if state == 0:
+                    break
+                state = failures[state]
+            count += matches[state]
+            if limit is not None and count >= limit:
+                return limit
+        return count
+
+    def __link_failures(self, children: List[List[Tuple[int, int]]]):
+        """Computes the failure link of every state, breadth first."""
+        transitions = self.__transitions
+        failures = self.__failures
+        matches = self.__matches
+        queue = [next_state for _, next_state in children[0]]
+        for state in queue:
+            for word_id, next_state in children[state]:
+                failure = failures[state]
+                while True:
+                    target = transitions.get((failure << 32) | word_id)
+                    if target is not None or failure == 0:
+                        break
+                    failure = failures[failure]
+                failures[next_state] = target if target is not None else 0
+                matches[next_state] += matches[failures[next_state]]
+                queue.append(next_state)
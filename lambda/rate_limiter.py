@@ -0,0 +1,305 @@
+"""Client-side rate limiting of calls to a service with a TPS quota, such as
+Rekognition.
+
+An `AdaptiveRateLimiter` is a token bucket whose rate adapts to the service's
+throttling, in the manner of TCP congestion control (AIMD):
+
+* Each successful call raises the rate by `increase_tps_per_s / rate`, so that
+  calling at the full rate raises it by about `increase_tps_per_s` every
+  second, up to `max_tps`.
+* Each throttled call multiplies the rate by `decrease_factor`, down to
+  `min_tps`, and empties the bucket.  Throttles within `decrease_cooldown_s`
+  of the last decrease are ignored, since a burst of concurrent calls is
+  usually throttled together and should only back off once.
+
+Callers wait for a token rather than calling, but never past their deadline.
+After a throttle they should also wait `backoff_s` before retrying.
+
+The state of the buckets is kept in a `RateLimitStore`, which updates it with a
+single atomic read-modify-write.  Two backends are provided:
+
+* `InMemoryRateLimitStore` -- shared by the threads of one process.
+* `SqliteRateLimitStore` -- a SQLite database in WAL mode, shared by the
+  processes on the same host, so that co-located workers share one budget.
+"""
+
+import random
+import threading
+import time
+
+from typing import Callable, Dict, Tuple, TypeVar, Union
+
+from sqlite_database import SqliteDatabase
+
+T = TypeVar('T')
+
+
+class BucketState:
+    """The state of one token bucket."""
+
+    __slots__ = ('rate', 'tokens', 'updated_time', 'decreased_time')
+
+    def __init__(
+        self, rate: float, tokens: float, updated_time: float, decreased_time: float
+    ):
+        """Creates an instance.
+
+        :param rate: The rate tokens are added, per second.
+        :param tokens: The tokens in the bucket at `updated_time`.  Negative
+            if tokens have been reserved by callers that are waiting.
+        :param updated_time: When the state was last updated.
+        :param decreased_time: When the rate was last decreased.
+        """
+        self.rate = rate
+        self.tokens = tokens
+        self.updated_time = updated_time
+        self.decreased_time = decreased_time
+
+
+class RateLimitStore:
+    """Base class for all stores of token bucket state."""
+
+    def update(
+        self,
+        key: str,
+        function: Callable[[Union[BucketState, None]], Tuple[BucketState, T]],
+    ) -> T:
+        """Atomically updates the state of a bucket.
+
+        :param key: Identifies the bucket.
+        :param function: Called with the bucket's state, or None if it has
+            none yet.  Returns the new state and the value to return.
+        :return: The value returned by `function`.
+        """
+        raise NotImplementedError()
+
+
+class InMemoryRateLimitStore(RateLimitStore):
+    """Holds the state of the buckets in memory."""
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__states: Dict[str, BucketState] = {}
+
+    def update(
+        self,
+        key: str,
+        function: Callable[[Union[BucketState, None]], Tuple[BucketState, T]],
+    ) -> T:
+        with self.__lock:
+            state, value = function(self.__states.get(key))
+            self.__states[key] = state
+            return value
+
+
+class SqliteRateLimitStore(RateLimitStore):
+    """Holds the state of the buckets in a SQLite database.
+
+    Each update runs in an immediate transaction, so that concurrent updates,
+    even from other processes, are serialized.
+    """
+
+    def __init__(self, path: str, busy_timeout_ms: int = 5000):
+        """Creates an instance, creating the database if it does not exist.
+
+        :param path: The path to the database file.
+        :param busy_timeout_ms: How long to wait for another writer to finish
+            before failing.
+        """
+        self.__database = SqliteDatabase(path, busy_timeout_ms=busy_timeout_ms)
+        self.__database.connection().execute(
+            'CREATE TABLE IF NOT EXISTS rate_limits ('
+            ' key TEXT PRIMARY KEY,'
+            ' rate REAL NOT NULL,'
+            ' tokens REAL NOT NULL,'
+            ' updated_time REAL NOT NULL,'
+            ' decreased_time REAL NOT NULL)'
+        )
+
+    def update(
+        self,
+        key: str,
+        function: Callable[[Union[BucketState, None]], Tuple[BucketState, T]],
+    ) -> T:
+        with self.__database.transaction() as connection:
+            row = connection.execute(
+                'SELECT rate, tokens, updated_time, decreased_time '
+                'FROM rate_limits WHERE key = ?',
+                (key,),
+            ).fetchone()
+            state, value = function(BucketState(*row) if row is not None else None)
+            connection.execute(
+                'INSERT OR REPLACE INTO rate_limits VALUES (?, ?, ?, ?, ?)',
+                (
+                    key,
+                    state.rate,
+                    state.tokens,
+                    state.updated_time,
+                    state.decreased_time,
+                ),
+            )
+        return value
+
+
+def create_rate_limit_store(backend: str, path: str = None) -> RateLimitStore:
+    """Creates a rate limit store using the named backend.
+
+    :param backend: Either `memory` or `sqlite`.
+    :param path: The database path for the `sqlite` backend.
+    :return: The store.
+    """
+    if backend == 'memory':
+        return InMemoryRateLimitStore()
+    if backend == 'sqlite':
+        if path is None:
+            raise ValueError('The sqlite rate limit store requires a path')
+        return SqliteRateLimitStore(path)
+    raise ValueError(
+        f'Unknown rate limit store backend "{backend}".  Must be memory or sqlite'
+    )
+
+
+class AdaptiveRateLimiter:
+    """Limits the rate of calls to a service, adapting to its throttling."""
+
+    def __init__(
+        self,
+        key: str,
+        max_tps: float,
+        store: RateLimitStore = None,
+        min_tps: float = 1.0,
+        burst_s: float = 1.0,
+        increase_tps_per_s: float = 1.0,
+        decrease_factor: float = 0.7,
+        decrease_cooldown_s: float = 1.0,
+        base_backoff_s: float = 0.1,
+        max_backoff_s: float = 5.0,
+        clock: Callable[[], float] = time.time,
+        sleep: Callable[[float], None] = time.sleep,
+        rng: random.Random = None,
+    ):
+        """Creates an instance.
+
+        :param key: Identifies the bucket in the store, such as the name of the
+            operation.  Limiters with the same key and store share a budget.
+        :param max_tps: The most calls per second, such as the service quota.
+            This is also the initial rate.
+        :param store: The store of the bucket's state.  If None, a store of
+            its own is used.
+        :param min_tps: The least calls per second, however often the calls
+            are throttled.
+        :param burst_s: The bucket holds this many seconds of tokens at the
+            current rate, and at least one.
+        :param increase_tps_per_s: How fast the rate recovers.
+        :param decrease_factor: What the rate is multiplied by on a throttle.
+        :param decrease_cooldown_s: How long after a decrease further throttles
+            are ignored.
+        :param base_backoff_s: The backoff before the first retry.
+        :param max_backoff_s: The most a backoff may be.
+        :param clock: Returns the current time in seconds.  Must be comparable
+            between processes sharing the store.
+        :param sleep: Sleeps for a number of seconds.
+        :param rng: The source of backoff jitter.
+        """
+        self.__key = key
+        self.__max_tps = max_tps
+        self.__store = store if store is not None else InMemoryRateLimitStore()
+        self.__min_tps = min_tps
+        self.__burst_s = burst_s
+        self.__increase_tps_per_s = increase_tps_per_s
+        self.__decrease_factor = decrease_factor
+        self.__decrease_cooldown_s = decrease_cooldown_s
+        self.__base_backoff_s = base_backoff_s
+        self.__max_backoff_s = max_backoff_s
+        self.__clock = clock
+        self.__sleep = sleep
+        self.__rng = rng if rng is not None else random.Random()
+
+    @property
+    def rate(self) -> float:
+        """
+        :return: The current rate, in calls per second.
+        """
+
+        def get_rate(state):
+            state, _ = self.__refill(state)
+            return state, state.rate
+
+        return self.__store.update(self.__key, get_rate)
+
+    def acquire(self, max_wait_s: float) -> Union[float, None]:
+        """Takes a token, waiting for one if the bucket is empty.
+
+        :param max_wait_s: The longest to wait.
+        :return: How long was waited, or None if no token could be taken
+            within `max_wait_s`, in which case none is taken.
+        """
+
+        def reserve(state):
+            state, _ = self.__refill(state)
+            # A negative balance reserves the token for when it is added.
+            wait_s = max(0.0, (1 - state.tokens) / state.rate)
+            if wait_s > max_wait_s:
+                return state, None
+            state.tokens -= 1
+            return state, wait_s
+
+        wait_s = self.__store.update(self.__key, reserve)
+        if wait_s:
+            self.__sleep(wait_s)
+        return wait_s
+
+    def on_success(self):
+        """Records a call that was not throttled."""
+
+        def increase(state):
+            state, _ = self.__refill(state)
+            state.rate = min(
+                self.__max_tps, state.rate + self.__increase_tps_per_s / state.rate
+            )
+            return state, None
+
+        self.__store.update(self.__key, increase)
+
+    def on_throttle(self) -> bool:
+        """Records a call that was throttled.
+
+        :return: True if the rate was decreased, or False if it was already
+            decreased within the cooldown.
+        """
+
+        def decrease(state):
+            state, now = self.__refill(state)
+            if now - state.decreased_time < self.__decrease_cooldown_s:
+                return state, False
+            state.rate = max(self.__min_tps, state.rate * self.__decrease_factor)
+            state.tokens = min(state.tokens, 0.0)
+            state.decreased_time = now
+            return state, True
+
+        return self.__store.update(self.__key, decrease)
+
+    def backoff_s(self, attempt: int) -> float:
+        """
+        :param attempt: The number of throttled attempts so far, from 1.
+        :return: How long to wait before the next attempt, with full jitter so
+            that throttled callers spread out their retries.
+        """
+        cap = min(self.__max_backoff_s, self.__base_backoff_s * 2 ** (attempt - 1))
+        return self.__rng.uniform(0, cap)
+
+    def __refill(self, state: Union[BucketState, None]) -> Tuple[BucketState, float]:
+        """
+        :return: The state with the tokens added since it was last updated,
+            and the current time.
+        """
+        now = self.__clock()
+        if state is None:
+            return BucketState(self.__max_tps, 1.0, now, 0.0), now
+        # The limits may have been lowered since the state was stored.
+        state.rate = min(self.__max_tps, max(self.__min_tps, state.rate))
+        capacity = max(1.0, state.rate * self.__burst_s)
+        elapsed_s = max(0.0, now - state.updated_time)
+        state.tokens = min(capacity, state.tokens + elapsed_s * state.rate)
+        state.updated_time = now
+        return state, now
@@ -0,0 +1,200 @@
+"""Content-addressed cache of spam scores.
+
+Spammers repost the same image constantly, and every repost would otherwise
+re-run the S3 fetches, image decoding and Rekognition calls of every scorer.
+`ScoreCache` remembers the score each scorer computed for a given image
+content, keyed by `(scorer name, scorer version, content id)`, where the
+content id is the S3 ETag or a digest of the image bytes.
+
+The cache has two tiers:
+
+* A memory tier, local to the warm container, with LRU eviction.
+* An optional file tier in a local directory, which is shared by every process
+  (or container) that can see the directory, such as `/tmp` or an EFS mount.
+
+Entries in both tiers expire after `ttl_seconds`.
+
+The cache is opt-in.  `ScoreCache.from_environment` creates one only if the
+`SCORE_CACHE_ENABLED` environment variable is `true`.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+from collections import OrderedDict
+from typing import Tuple, Union
+
+# A cache key of (scorer name, scorer version, content id).
+ScoreCacheKey = Tuple[str, str, str]
+
+
+class ScoreCache:
+    """A two tier cache of spam scores."""
+
+    def __init__(
+        self,
+        ttl_seconds: float = 3600,
+        max_entries: int = 10000,
+        directory: str = None,
+        max_files: int = 100000,
+    ):
+        """Creates an instance.
+
+        :param ttl_seconds: How long a cached score remains valid.
+        :param max_entries: The maximum number of scores held in memory.
+        :param directory: The directory of the file tier, or None to only cache
+            in memory.  It is created if it does not exist.
+        :param max_files: The maximum number of scores held in the file tier.
+        """
+        self.__ttl_seconds = ttl_seconds
+        self.__max_entries = max_entries
+        self.__directory = directory
+        self.__max_files = max_files
+        self.__lock = threading.Lock()
+        # Maps keys to (score, expiration time).
+        self.__memory: 'OrderedDict[ScoreCacheKey, Tuple[float, float]]' = (
+            OrderedDict()
+        )
+        # The number of files written since the file tier was last pruned.
+        self.__writes_since_prune = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def from_environment() -> Union['ScoreCache', None]:
+        """Creates a cache configured by environment variables:
+
+        * `SCORE_CACHE_ENABLED` -- must be `true` for a cache to be created.
+        * `SCORE_CACHE_TTL_SECONDS` -- defaults to 3600.
+        * `SCORE_CACHE_MAX_ENTRIES` -- the memory tier size, defaults to 10000.
+        * `SCORE_CACHE_DIRECTORY` -- the file tier directory.  If not set,
+          there is no file tier.
+        * `SCORE_CACHE_MAX_FILES` -- the file tier size, defaults to 100000.
+
+        :return: The cache, or None if caching is not enabled.
+        """
+        if os.environ.get('SCORE_CACHE_ENABLED', 'false').lower() != 'true':
+            return None
+        return ScoreCache(
+            ttl_seconds=float(os.environ.get('SCORE_CACHE_TTL_SECONDS', '3600')),
+            max_entries=int(os.environ.get('SCORE_CACHE_MAX_ENTRIES', '10000')),
+            directory=os.environ.get('SCORE_CACHE_DIRECTORY', None),
+            max_files=int(os.environ.get('SCORE_CACHE_MAX_FILES', '100000')),
+        )
+
+    def get(self, key: ScoreCacheKey) -> Union[float, None]:
+        """Looks up a score, first in memory and then in the file tier.  A
+        score found in the file tier is promoted to memory.
+
+        :param key: The cache key.
+        :return: The cached score, or None if there is no valid entry.
+        """
+        now = time.time()
+        with self.__lock:
+            entry = self.__memory.get(key)
+            if entry is not None:
+                if entry[1] > now:
+                    self.__memory.move_to_end(key)
+                    return entry[0]
+                del self.__memory[key]
+
+        if self.__directory is None:
+            return None
+        entry = self.__read_file(key, now)
+        if entry is None:
+            return None
+        with self.__lock:
+            self.__put_memory(key, entry)
+        return entry[0]
+
+    def put(self, key: ScoreCacheKey, score: float):
+        """Caches a score in both tiers.
+
+        :param key: The cache key.
+        :param score: The score.
+        """
+        entry = (score, time.time() + self.__ttl_seconds)
+        with self.__lock:
+            self.__put_memory(key, entry)
+        if self.__directory is not None:
+            self.__write_file(key, entry)
+
+    def __put_memory(self, key: ScoreCacheKey, entry: Tuple[float, float]):
+        self.__memory[key] = entry
+        self.__memory.move_to_end(key)
+        while len(self.__memory) > self.__max_entries:
+            self.__memory.popitem(last=False)
+
+    def __path(self, key: ScoreCacheKey) -> str:
+        digest = hashlib.sha256('\0'.join(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.__directory, digest + '.json')
+
+    def __read_file(
+        self, key: ScoreCacheKey, now: float
+    ) -> Union[Tuple[float, float], None]:
+        path = self.__path(key)
+        try:
+            with open(path) as file:
+                cached = json.load(file)
+        except (OSError, ValueError):
+            return None
+        # Guard against hash collisions, however unlikely.
+        if cached.get('key') != list(key):
+            return None
+        if cached['expires'] <= now:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        return cached['score'], cached['expires']
+
+    def __write_file(self, key: ScoreCacheKey, entry: Tuple[float, float]):
+        # Write to a temporary file and rename it, so that readers in other
+        # processes never see a partially written entry.
+        fd, temp_path = tempfile.mkstemp(dir=self.__directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as file:
+                json.dump(
+                    {'key': list(key), 'score': entry[0], 'expires': entry[1]}, file
+                )
+            os.replace(temp_path, self.__path(key))
+        except OSError:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            return
+
+        with self.__lock:
+            self.__writes_since_prune += 1
+            should_prune = self.__writes_since_prune >= max(1, self.__max_files // 10)
+            if should_prune:
+                self.__writes_since_prune = 0
+        if should_prune:
+            self.__prune_files()
+
+    def __prune_files(self):
+        """Removes the oldest files once the file tier holds more than
+        `max_files` entries.
+        """
+        entries = []
+        with os.scandir(self.__directory) as it:
+            for dir_entry in it:
+                if dir_entry.name.endswith('.json'):
+                    try:
+                        entries.append((dir_entry.stat().st_mtime, dir_entry.path))
+                    except OSError:
+                        pass
+        if len(entries) <= self.__max_files:
+            return
+        entries.sort()
+        for _, path in entries[: len(entries) - self.__max_files]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
@@ -0,0 +1,201 @@
+"""Storage for the per-scorer spam scores of each image.
+
+The `update_spam_score` Lambda receives one score at a time from each of the
+detection Lambdas, and needs all of an image's scores to decide whether it is
+spam.  A `ScoreStore` holds the scores keyed by `(account_id, image_url)`, and
+merges each new score in with a single atomic read-modify-write so concurrent
+updates for the same image never lose a score.
+
+Two backends are provided:
+
+* `InMemoryScoreStore` -- a bounded LRU map, shared by invocations running in
+  the same container.
+* `SqliteScoreStore` -- a durable SQLite database in WAL mode, which can be
+  shared by processes on the same host (or an EFS mount).
+
+A service such as DynamoDB can be added later by implementing `ScoreStore`,
+using a conditional or `ADD`/`SET` update for the merge.
+"""
+
+import sqlite3
+import threading
+import time
+
+from collections import OrderedDict
+from typing import Dict, Tuple
+
+from sqlite_database import SqliteDatabase
+
+
+class ScoreStore:
+    """Base class for all spam score stores."""
+
+    def merge_score(
+        self, account_id: str, image_url: str, scorer: str, score: float
+    ) -> Dict[str, float]:
+        """Atomically records the score from one scorer for an image.
+
+        :param account_id: The account id posting the image.
+        :param image_url: The image URL.
+        :param scorer: The name of the scoring algorithm.
+        :param score: The score from 0 to 1.
+        :return: All of the image's scores after the merge, keyed by scorer.
+        """
+        raise NotImplementedError()
+
+    def merge_scores(
+        self, account_id: str, image_url: str, scores: Dict[str, float]
+    ) -> Dict[str, float]:
+        """Atomically records the scores from several scorers for an image.
+
+        :param account_id: The account id posting the image.
+        :param image_url: The image URL.
+        :param scores: The scores from 0 to 1, keyed by scorer.
+        :return: All of the image's scores after the merge, keyed by scorer.
+        """
+        raise NotImplementedError()
+
+    def get_scores(self, account_id: str, image_url: str) -> Dict[str, float]:
+        """
+        :param account_id: The account id posting the image.
+        :param image_url: The image URL.
+        :return: The image's current scores, keyed by scorer.
+        """
+        raise NotImplementedError()
+
+
+class InMemoryScoreStore(ScoreStore):
+    """Holds the scores of the most recently updated images in memory.
+
+    Once more than `max_entries` images are held, the least recently used
+    image is evicted.
+    """
+
+    def __init__(self, max_entries: int = 100000):
+        """Creates an instance.
+
+        :param max_entries: The maximum number of images to hold scores for.
+        """
+        if max_entries < 1:
+            raise ValueError(f"Invalid max_entries: {max_entries}")
+        self.__max_entries = max_entries
+        self.__lock = threading.Lock()
+        self.__scores: 'OrderedDict[Tuple[str, str], Dict[str, float]]' = (
+            OrderedDict()
+        )
+
+    def __len__(self) -> int:
+        return len(self.__scores)
+
+    def merge_score(
+        self, account_id: str, image_url: str, scorer: str, score: float
+    ) -> Dict[str, float]:
+        return self.merge_scores(account_id, image_url, {scorer: score})
+
+    def merge_scores(
+        self, account_id: str, image_url: str, scores: Dict[str, float]
+    ) -> Dict[str, float]:
+        key = (account_id, image_url)
+        with self.__lock:
+            current_scores = self.__scores.get(key)
+            if current_scores is None:
+                current_scores = self.__scores[key] = {}
+                if len(self.__scores) > self.__max_entries:
+                    self.__scores.popitem(last=False)
+            else:
+                self.__scores.move_to_end(key)
+            current_scores.update(scores)
+            return dict(current_scores)
+
+    def get_scores(self, account_id: str, image_url: str) -> Dict[str, float]:
+        key = (account_id, image_url)
+        with self.__lock:
+            scores = self.__scores.get(key)
+            if scores is None:
+                return {}
+            self.__scores.move_to_end(key)
+            return dict(scores)
+
+
+class SqliteScoreStore(ScoreStore):
+    """Holds the scores in a SQLite database.
+
+    The database uses WAL mode, so readers never block the writer, and each
+    merge runs in an immediate transaction so that concurrent merges for the
+    same image, even from other processes, are serialized.
+    """
+
+    def __init__(self, path: str, busy_timeout_ms: int = 5000):
+        """Creates an instance, creating the database if it does not exist.
+
+        :param path: The path to the database file.
+        :param busy_timeout_ms: How long to wait for another writer to finish
+            before failing.
+        """
+        self.__database = SqliteDatabase(path, busy_timeout_ms=busy_timeout_ms)
+        self.__database.connection().execute(
+            'CREATE TABLE IF NOT EXISTS spam_scores ('
+            ' account_id TEXT NOT NULL,'
+            ' image_url TEXT NOT NULL,'
+            ' scorer TEXT NOT NULL,'
+            ' score REAL NOT NULL,'
+            ' updated_time REAL NOT NULL,'
+            ' PRIMARY KEY (account_id, image_url, scorer))'
+        )
+
+    def merge_score(
+        self, account_id: str, image_url: str, scorer: str, score: float
+    ) -> Dict[str, float]:
+        return self.merge_scores(account_id, image_url, {scorer: score})
+
+    def merge_scores(
+        self, account_id: str, image_url: str, scores: Dict[str, float]
+    ) -> Dict[str, float]:
+        with self.__database.transaction() as connection:
+            # INSERT OR REPLACE rather than an upsert, since the SQLite in the
+            # Lambda runtime predates upsert support.
+            updated_time = time.time()
+            connection.executemany(
+                'INSERT OR REPLACE INTO spam_scores VALUES (?, ?, ?, ?, ?)',
+                [
+                    (account_id, image_url, scorer, score, updated_time)
+                    for scorer, score in scores.items()
+                ],
+            )
+            return self.__select_scores(connection, account_id, image_url)
+
+    def get_scores(self, account_id: str, image_url: str) -> Dict[str, float]:
+        return self.__select_scores(self.__database.connection(), account_id, image_url)
+
+    @staticmethod
+    def __select_scores(
+        connection: sqlite3.Connection, account_id: str, image_url: str
+    ) -> Dict[str, float]:
+        rows = connection.execute(
+            'SELECT scorer, score FROM spam_scores '
+            'WHERE account_id = ? AND image_url = ?',
+            (account_id, image_url),
+        )
+        return {scorer: score for scorer, score in rows}
+
+
+def create_score_store(
+    backend: str, path: str = None, max_entries: int = 100000
+) -> ScoreStore:
+    """Creates a score store using the named backend.
+
+    :param backend: Either `memory` or `sqlite`.
+    :param path: The database path for the `sqlite` backend.
+    :param max_entries: The maximum number of images held by the `memory`
+        backend.
+    :return: The store.
+    """
+    if backend == 'memory':
+        return InMemoryScoreStore(max_entries=max_entries)
+    if backend == 'sqlite':
+        if path is None:
+            raise ValueError('The sqlite score store requires a path')
+        return SqliteScoreStore(path)
+    raise ValueError(
+        f'Unknown score store backend "{backend}".  Must be memory or sqlite'
+    )
@@ -0,0 +1,168 @@
+"""Coalescing of identical concurrent requests.
+
+When the same image arrives many times within a few seconds, every copy would
+otherwise fetch it from S3 and send it to Rekognition separately.  A
+`SingleFlight` lets concurrent callers asking for the same key share a single
+call: the first caller (the leader) makes the call, and the others wait for
+its result (or exception) instead of making their own.  Callers may be
+threads, using `do`, or asyncio tasks, using `do_async`, and the two may share
+a call.
+
+Successful results are also kept for a short window after the call finishes,
+so that callers arriving just after it share it too.  Exceptions are only
+shared with the callers waiting at the time.
+
+The number of calls and how many of them were shared are counted, and can be
+taken with `take_stats`.
+"""
+
+import threading
+import time
+
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Awaitable, Callable, Dict, Hashable, Tuple, TypeVar, Union
+
+T = TypeVar('T')
+
+
+class SingleFlight:
+    """Coalesces concurrent calls that have the same key."""
+
+    def __init__(
+        self,
+        result_window_s: float = 0.0,
+        max_results: int = 128,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        """Creates an instance.
+
+        :param result_window_s: How long a successful result is kept after its
+            call finishes.  If 0, results are only shared while in flight.
+        :param max_results: The most results kept.  The oldest are discarded
+            first.
+        :param clock: Returns the current time in seconds.
+        """
+        self.__result_window_s = result_window_s
+        self.__max_results = max_results
+        self.__clock = clock
+        self.__lock = threading.Lock()
+        # The calls in flight, keyed by their key.
+        self.__in_flight: Dict[Hashable, Future] = {}
+        # The recent results, as finished futures with the time they expire, in
+        # the order they finished.
+        self.__results: 'OrderedDict[Hashable, Tuple[Future, float]]' = OrderedDict()
+        self.__calls = 0
+        self.__shared = 0
+
+    def do(
+        self, key: Union[Hashable, None], function: Callable[[], T]
+    ) -> Tuple[T, bool]:
+        """Calls the function, unless a call with the same key is in flight or
+        recently finished, in which case its result is used.
+
+        :param key: Identifies the call.  If None, the call is never shared.
+        :param function: Makes the call.
+        :return: The result, and whether it came from another caller's call.
+        """
+        future, is_leader = self.__join(key)
+        if not is_leader:
+            return future.result(), True
+        try:
+            value = function()
+        except BaseException as e:
+            self.__finish(key, future, error=e)
+            raise
+        self.__finish(key, future, value=value)
+        return value, False
+
+    async def do_async(
+        self, key: Union[Hashable, None], function: Callable[[], Awaitable[T]]
+    ) -> Tuple[T, bool]:
+        """Like `do`, but for asyncio tasks.  Waiting on another caller's call
+        does not block the event loop.
+
+        :param key: Identifies the call.  If None, the call is never shared.
+        :param function: Returns an awaitable that makes the call.
+        :return: The result, and whether it came from another caller's call.
+        """
+        # Imported here, since most Lambdas never use asyncio.
+        import asyncio
+
+        future, is_leader = self.__join(key)
+        if not is_leader:
+            return await asyncio.wrap_future(future), True
+        try:
+            value = await function()
+        except BaseException as e:
+            self.__finish(key, future, error=e)
+            raise
+        self.__finish(key, future, value=value)
+        return value, False
+
+    def clear(self):
+        """Discards the recent results.  Calls in flight are unaffected."""
+        with self.__lock:
+            self.__results.clear()
+
+    def take_stats(self) -> Tuple[int, int]:
+        """Returns the number of calls since the last call to this method, and
+        how many of them were shared.
+        """
+        with self.__lock:
+            stats = (self.__calls, self.__shared)
+            self.__calls = 0
+            self.__shared = 0
+        return stats
+
+    def __join(self, key: Union[Hashable, None]) -> Tuple[Future, bool]:
+        """Returns the future for the key's call, and whether the caller must
+        make the call.
+        """
+        with self.__lock:
+            self.__calls += 1
+            if key is not None:
+                future = self.__in_flight.get(key)
+                if future is None:
+                    future = self.__recent_result(key)
+                if future is not None:
+                    self.__shared += 1
+                    return future, False
+            future = Future()
+            if key is not None:
+                self.__in_flight[key] = future
+            return future, True
+
+    def __recent_result(self, key: Hashable) -> Union[Future, None]:
+        entry = self.__results.get(key)
+        if entry is None:
+            return None
+        if entry[1] <= self.__clock():
+            del self.__results[key]
+            return None
+        return entry[0]
+
+    def __finish(
+        self, key: Union[Hashable, None], future: Future, value=None, error=None
+    ):
+        """Records the outcome of the key's call and wakes its waiters."""
+        with self.__lock:
+            if key is not None:
+                self.__in_flight.pop(key, None)
+                if error is None and self.__result_window_s > 0:
+                    self.__add_result(key, future)
+        if error is None:
+            future.set_result(value)
+        else:
+            future.set_exception(error)
+
+    def __add_result(self, key: Hashable, future: Future):
+        now = self.__clock()
+        self.__results.pop(key, None)
+        self.__results[key] = (future, now + self.__result_window_s)
+        # Results expire in the order they were added.
+        while self.__results:
+            oldest_key, (_, expiry) = next(iter(self.__results.items()))
+            if expiry > now and len(self.__results) <= self.__max_results:
+                break
+            del self.__results[oldest_key]
@@ -0,0 +1,179 @@
+"""Batched publishing of messages to SNS topics.
+
+Publishing each score with its own `publish` call costs a round trip per
+message.  A `SnsBatchPublisher` buffers the messages of an invocation and
+publishes them with `publish_batch`, up to ten at a time, reporting the
+messages that failed by the tag they were added with.
+"""
+
+import os
+import threading
+import time
+
+from typing import Dict, List, Tuple, Union
+
+from aws_clients import lazy_client
+from botocore.exceptions import ClientError
+from lambda_common import (
+    LogContext,
+    MissingSnsTopicEnvironmentVariableException,
+    SnsPublishError,
+    Span,
+    calculate_latency_ms,
+    is_retriable_sns_error,
+)
+
+# The container's SNS client.
+_sns = lazy_client('sns')
+
+
+class _PendingSnsEntry:
+    """A message buffered by `SnsBatchPublisher`, waiting to be published."""
+
+    def __init__(self, payload, tag: str, log_context: Union[LogContext, None]):
+        self.payload = payload
+        self.tag = tag
+        self.log_context = log_context
+        self.enqueued_time = time.time()
+
+
+class SnsBatchPublisher:
+    """Buffers messages for SNS topics and publishes them with `publish_batch`,
+    rather than paying for one `publish` round trip per message.
+
+    A topic's buffer is flushed when it holds `max_batch_size` messages, when
+    its oldest message has waited `max_delay_ms` (checked whenever a message is
+    added), and when `flush` is called.  Handlers should call `flush` before
+    they exit, since nothing is published in the background.
+
+    Each message is added with a tag, such as the trace id of the record that
+    produced it.  Messages that fail to publish are reported by `flush` as a
+    `SnsPublishError` keyed by their tag.  A failed entry does not prevent the
+    rest of its batch from being published.
+    """
+
+    # The maximum number of entries SNS accepts in one `publish_batch` call.
+    MAX_BATCH_SIZE = 10
+
+    def __init__(self, max_batch_size: int = MAX_BATCH_SIZE, max_delay_ms: int = 50):
+        """Creates an instance.
+
+        :param max_batch_size: The number of messages at which a topic's buffer
+            is flushed.  At most `MAX_BATCH_SIZE`.
+        :param max_delay_ms: The longest a message should be buffered.
+        """
+        if not 1 <= max_batch_size <= SnsBatchPublisher.MAX_BATCH_SIZE:
+            raise ValueError(f"Invalid max_batch_size: {max_batch_size}")
+        self.__max_batch_size = max_batch_size
+        self.__max_delay_ms = max_delay_ms
+        self.__lock = threading.Lock()
+        # The buffered entries, keyed by topic name and ARN.
+        self.__pending: Dict[Tuple[str, str], List[_PendingSnsEntry]] = {}
+        # The entries that have failed since the last `flush`, keyed by tag.
+        self.__failures: Dict[str, SnsPublishError] = {}
+
+    def publish(
+        self,
+        topic_name: str,
+        topic_arn_environment_var: str,
+        payload,
+        tag: str,
+        log_context: LogContext = None,
+    ):
+        """Adds a message to the topic's buffer.
+
+        `MissingSnsTopicEnvironmentVariableException` is raised immediately if
+        the topic is not configured.  Publish failures are reported by `flush`.
+
+        :param topic_name: The name of the SNS topic.
+        :param topic_arn_environment_var: The name of the environment variable
+            containing the ARN of the SNS Topic.
+        :param payload: The payload to publish.  This object must have a
+            to_json method.
+        :param tag: Identifies the message in the failures returned by `flush`.
+        :param log_context: The log context to use to emit log messages about
+            the batch that includes this message.
+        """
+        topic_arn = os.environ.get(topic_arn_environment_var, None)
+        if topic_arn is None:
+            raise MissingSnsTopicEnvironmentVariableException(topic_arn_environment_var)
+
+        with self.__lock:
+            topic = (topic_name, topic_arn)
+            entries = self.__pending.setdefault(topic, [])
+            entries.append(_PendingSnsEntry(payload, tag, log_context))
+            if (
+                len(entries) >= self.__max_batch_size
+                or calculate_latency_ms(entries[0].enqueued_time) >= self.__max_delay_ms
+            ):
+                self.__publish_batch(topic, self.__pending.pop(topic))
+
+    def flush(self) -> Dict[str, SnsPublishError]:
+        """Publishes all buffered messages.
+
+        :return: The errors for the messages that failed to publish since the
+            last call to `flush`, keyed by the tag of the message.
+        """
+        with self.__lock:
+            pending = self.__pending
+            self.__pending = {}
+            for topic, entries in pending.items():
+                for start in range(0, len(entries), self.__max_batch_size):
+                    self.__publish_batch(
+                        topic, entries[start : start + self.__max_batch_size]
+                    )
+            failures = self.__failures
+            self.__failures = {}
+        return failures
+
+    def __publish_batch(self, topic: Tuple[str, str], entries: List[_PendingSnsEntry]):
+        """Publishes one batch of entries, recording any failures.
+
+        :param topic: The name and ARN of the topic.
+        :param entries: The entries to publish.  At most `MAX_BATCH_SIZE`.
+        """
+        topic_name, topic_arn = topic
+        log_context = next(
+            (x.log_context for x in entries if x.log_context is not None), None
+        )
+        if log_context is not None:
+            log_context.log(
+                f"START publish_batch_to_sns_topic topic={topic_name} "
+                f"entries={len(entries)}"
+            )
+
+        max_wait_ms = calculate_latency_ms(entries[0].enqueued_time)
+        failed = {}
+        with Span('sns.publish_batch', log_context) as span:
+            try:
+                sns_response = _sns.publish_batch(
+                    TopicArn=topic_arn,
+                    PublishBatchRequestEntries=[
+                        {'Id': str(i), 'Message': entry.payload.to_json()}
+                        for i, entry in enumerate(entries)
+                    ],
+                )
+                for failure in sns_response.get('Failed', []):
+                    # Sender faults will not be fixed by retrying the same message.
+                    status_code = 400 if failure.get('SenderFault') else 500
+                    failed[int(failure['Id'])] = SnsPublishError(
+                        status_code, f"{failure['Code']}: {failure.get('Message', '')}"
+                    )
+                status_code = sns_response['ResponseMetadata']['HTTPStatusCode']
+            except ClientError as e:
+                status_code = e.response['ResponseMetadata']['HTTPStatusCode']
+                for i in range(len(entries)):
+                    failed[i] = SnsPublishError(
+                        status_code, str(e), is_retriable=is_retriable_sns_error(e)
+                    )
+
+        for i, error in failed.items():
+            self.__failures[entries[i].tag] = error
+
+        if log_context is not None:
+            log_context.log(
+                f"END publish_batch_to_sns_topic topic={topic_name} "
+                f"latency_ms={round(span.duration_ms)} result={status_code} "
+                f"entries={len(entries)} failed={len(failed)} "
+                f"max_wait_ms={max_wait_ms}"
+            )
@@ -0,0 +1,71 @@
+"""The SQLite database behind the local stores and queues, such as
+`SqliteScoreStore`.
+
+Every database is opened in WAL mode, so that readers never block the writer,
+with `synchronous=NORMAL`, which survives a crash of the process but may lose
+the last transactions if the host fails.  A database may be shared by the
+threads of a process and by other processes on the same host (or an EFS
+mount).
+"""
+
+import sqlite3
+import threading
+
+from contextlib import contextmanager
+from typing import Iterator
+
+
+class SqliteDatabase:
+    """Opens a SQLite database for each thread that uses it.
+
+    The connections are in autocommit mode, so statements outside of
+    `transaction` are committed as they run.
+    """
+
+    def __init__(self, path: str, busy_timeout_ms: int = 5000):
+        """Creates an instance.  The database is created on first use if it
+        does not exist.
+
+        :param path: The path to the database file.
+        :param busy_timeout_ms: How long to wait for another writer to finish
+            before failing.
+        """
+        self.__path = path
+        self.__busy_timeout_ms = busy_timeout_ms
+        # sqlite3 connections may not be shared between threads.
+        self.__local = threading.local()
+
+    def connection(self) -> sqlite3.Connection:
+        """
+        :return: The current thread's connection to the database.
+        """
+        connection = getattr(self.__local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(
+                self.__path,
+                timeout=self.__busy_timeout_ms / 1000,
+                isolation_level=None,
+            )
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.__local.connection = connection
+        return connection
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """Runs the statements in the `with` block in an immediate transaction,
+        which is committed when the block exits, or rolled back if it raises.
+
+        An immediate transaction takes the write lock up front, so that
+        read-modify-writes, even from other processes, are serialized.
+
+        :return: The current thread's connection to the database.
+        """
+        connection = self.connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
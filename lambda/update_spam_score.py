@@ -1,54 +1,192 @@
-import traceback
+import os
 
+from typing import Collection, Dict, List
+
+from dedup_store import DedupStore
 from lambda_common import (
-    receive_from_update_spam_score_sns_topic,
+    receive_from_update_spam_score_sns_record,
+    get_dedup_keys,
+    handle_sns_records,
+    is_duplicate_record,
+    log_error,
+    mark_records_processed,
     HandlerError,
-    return_message,
     LogContext,
     InvalidHandlerInputError,
 )
+from score_store import ScoreStore, create_score_store
+
+# The store holding the spam scores.  The backend is selected with the
+# `SPAM_SCORE_STORE` environment variable.  Note, the `memory` backend only
+# combines scores delivered to the same container, so a durable backend should
+# be used when the scores for one image may land on different containers.
+_score_store = create_score_store(
+    os.environ.get('SPAM_SCORE_STORE', 'memory'),
+    path=os.environ.get('SPAM_SCORE_STORE_PATH', '/tmp/spam_scores.db'),
+    max_entries=int(os.environ.get('SPAM_SCORE_STORE_MAX_ENTRIES', '100000')),
+)
+
+# The records of the score updates applied in this container, so that
+# redeliveries are not merged again, or None if deduplication is not enabled.
+# See `DedupStore.from_environment`.
+_dedup_store = DedupStore.from_environment()
+
+# An image with any score above this is spam, whatever its other scores.
+SPAM_SCORE_THRESHOLD = 0.75
 
 
-def get_current_scores(_image_url: str, _account_id: str) -> dict:
+def get_current_scores(
+    image_url: str, account_id: str, score_store: ScoreStore = None
+) -> dict:
     """Retrieves the current spam scores for the specified image.
 
-    :param _image_url: The image URL.
-    :param _account_id: The account id.
+    :param image_url: The image URL.
+    :param account_id: The account id.
+    :param score_store: The store to read from.  If None, the container's
+        store is used.
     :return: The spam scores in a dict, an entry for each algorithm.
     """
-    # Simulation cheat:  We aren't really bothering to store the
-    # spam scores
-    return {}
+    if score_store is None:
+        score_store = _score_store
+    return score_store.get_scores(account_id, image_url)
+
 
+def update_score(
+    scorer: str,
+    score: float,
+    image_url: str,
+    account_id: str,
+    score_store: ScoreStore = None,
+) -> bool:
+    """Updates the spam score for the specified image and determines whether
+    the image is spam based on all of its scores so far.
 
-def update_score(scorer: str, score: float, image_url: str, account_id: str) -> bool:
-    """Simulates updating the spam score for the specified image.
     :param scorer:  The name of the scoring algorithm that computed the score.
     :param score: The score
     :param image_url: The image URL.
     :param account_id: The account id posting the image.
+    :param score_store: The store to update.  If None, the container's store
+        is used.
+    :return: True if the image is spam.
     """
-    if score < 0 or score > 1:
-        raise InvalidHandlerInputError(f"Invalid score: score={score}")
+    return update_scores({scorer: score}, image_url, account_id, score_store)
+
+
+def update_scores(
+    scores: Dict[str, float],
+    image_url: str,
+    account_id: str,
+    score_store: ScoreStore = None,
+) -> bool:
+    """Updates the spam scores from several scoring algorithms for the
+    specified image in one step, and determines whether the image is spam
+    based on all of its scores so far.
+
+    :param scores: The scores, keyed by the name of the scoring algorithm that
+        computed them.
+    :param image_url: The image URL.
+    :param account_id: The account id posting the image.
+    :param score_store: The store to update.  If None, the container's store
+        is used.
+    :return: True if the image is spam.
+    """
+    return is_spam(merge_scores(scores, image_url, account_id, score_store))
+
 
-    current_scores = get_current_scores(image_url, account_id)
+def merge_scores(
+    scores: Dict[str, float],
+    image_url: str,
+    account_id: str,
+    score_store: ScoreStore = None,
+) -> Dict[str, float]:
+    """Updates the spam scores from several scoring algorithms for the
+    specified image in one step.
 
-    current_scores[scorer] = score
+    :param scores: The scores, keyed by the name of the scoring algorithm that
+        computed them.
+    :param image_url: The image URL.
+    :param account_id: The account id posting the image.
+    :param score_store: The store to update.  If None, the container's store
+        is used.
+    :return: All of the image's scores so far, keyed by scoring algorithm.
+    """
+    for score in scores.values():
+        if score < 0 or score > 1:
+            raise InvalidHandlerInputError(f"Invalid score: score={score}")
+
+    if score_store is None:
+        score_store = _score_store
+    return score_store.merge_scores(account_id, image_url, scores)
 
-    max_score = max(current_scores.values())
-    average_score = sum(current_scores.values()) / len(current_scores)
 
-    is_spam = max_score > 0.75 or (average_score > 0.5 and len(current_scores) == 3)
-    # Simulation fake:  We should write the score here.
-    return is_spam
+def is_spam(scores: Dict[str, float]) -> bool:
+    """
+    :param scores: All of an image's scores, keyed by scoring algorithm.
+    :return: True if the image is spam.
+    """
+    max_score = max(scores.values())
+    average_score = sum(scores.values()) / len(scores)
+    return max_score > SPAM_SCORE_THRESHOLD or (
+        average_score > 0.5 and len(scores) == 3
+    )
+
+
+def is_verdict_final(scores: Dict[str, float], remaining: Collection[str]) -> bool:
+    """Determines whether the scoring algorithms yet to run can still change
+    whether an image is spam.
+
+    :param scores: All of the image's scores so far, keyed by scoring
+        algorithm.
+    :param remaining: The names of the scoring algorithms yet to run.  Their
+        scores so far, if any, will be replaced.
+    :return: True if the image is spam, or not, whatever the remaining
+        algorithms score.
+    """
+    if not remaining:
+        return True
+    # Any remaining algorithm could score above the threshold, which alone
+    # makes the image spam, so only a spam verdict from the scores that will
+    # not be replaced is final.
+    return any(
+        score > SPAM_SCORE_THRESHOLD
+        for scorer, score in scores.items()
+        if scorer not in remaining
+    )
 
 
 def handler(event, context):
+    processed_keys: Dict[str, List[str]] = {}
+    response = handle_sns_records(
+        event,
+        context,
+        lambda record, trace_id: _handle_record(
+            record, context, trace_id, processed_keys
+        ),
+        f"Event: {event}",
+    )
+    mark_records_processed(_dedup_store, response, processed_keys)
+    return response
+
+
+def _handle_record(
+    record: dict, context, trace_id: str, processed_keys: Dict[str, List[str]]
+):
+    """Applies the spam score update in a single SNS record, unless it has
+    already been applied.
+
+    A `HandlerError` is raised if the record could not be processed.
+
+    :param record: The SNS record.
+    :param context: The context passed into the Lambda invocation.
+    :param trace_id: The id of the trace for processing this record.
+    :param processed_keys: The dedup keys of the records applied, by SNS
+        MessageId, which this record's keys are added to.
+    """
     log_context = None
     scorer = None
 
     try:
-        update_spam_score_payload = receive_from_update_spam_score_sns_topic(event)
+        update_spam_score_payload = receive_from_update_spam_score_sns_record(record)
         scorer = update_spam_score_payload.scorer
 
         log_context = LogContext(
@@ -56,11 +194,21 @@ def handler(event, context):
             context.function_version,
             root_trace=update_spam_score_payload.image_payload.root_trace_id,
             parent_trace=update_spam_score_payload.scorer_trace_id,
-            current_trace=context.aws_request_id,
+            current_trace=trace_id,
         )
 
         log_context.log_start_message()
 
+        keys = get_dedup_keys(
+            'update_spam_score',
+            record,
+            update_spam_score_payload.image_payload.root_trace_id,
+            update_spam_score_payload.scorer,
+        )
+        if is_duplicate_record(_dedup_store, keys, log_context):
+            log_context.log_end_message(200, "Skipped duplicate")
+            return
+
         log_context.log(
             f"update_spam_score algorithm={update_spam_score_payload.scorer} "
             f"score={update_spam_score_payload.score} "
@@ -76,11 +224,15 @@ def handler(event, context):
 
         log_context.log(f"spam_result is_spam={is_spam}")
 
+        if keys:
+            processed_keys[record['Sns']['MessageId']] = keys
         log_context.log_end_message(200, "Success")
-        return return_message(200, f"Event: {event}")
     except HandlerError as e:
-        print(f"[ERROR] Error while processing request from {scorer}: {e}:")
-        traceback.print_exc()
+        log_error(log_context, f"Error while processing request from {scorer}: {e}", e)
         if log_context is not None:
             log_context.log_end_message(e.status_code, f"Failed due to exception: {e}")
-        return e.create_response(for_sns_topic=True)
+        raise
+    except Exception as e:
+        if log_context is not None:
+            log_context.log_end_message(500, f"Failed due to exception: {e!r}")
+        raise
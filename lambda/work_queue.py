@@ -0,0 +1,330 @@
+"""Queues of work for the long-running detection workers.
+
+A `WorkQueue` follows the semantics of an SQS standard queue: a received
+message is hidden from other consumers for a visibility timeout, during which
+the consumer must delete it once it is processed, or extend the timeout if it
+needs longer.  A message that is neither deleted nor extended becomes visible
+again and is redelivered.
+
+Two backends are provided:
+
+* `SqliteWorkQueue` -- a local SQLite database in WAL mode, which may be
+  shared by processes on the same host.  It is meant for development,
+  benchmarks and single-host deployments.
+* `SqsWorkQueue` -- an SQS queue, for a fleet of workers.  Messages should be
+  delivered to it from the analyze image SNS topic with raw message delivery
+  enabled, so that each message's body is the image payload itself.
+"""
+
+import time
+import uuid
+
+from typing import List
+
+from sqlite_database import SqliteDatabase
+
+
+class QueueMessage:
+    """A message received from a `WorkQueue`."""
+
+    __slots__ = ('message_id', 'receipt_handle', 'body', 'receive_count')
+
+    def __init__(
+        self, message_id: str, receipt_handle: str, body: str, receive_count: int
+    ):
+        """Creates an instance.
+
+        :param message_id: The id of the message, which is the same every time
+            it is received.
+        :param receipt_handle: Identifies this receipt of the message, to
+            delete it or change its visibility.
+        :param body: The body of the message.
+        :param receive_count: The number of times the message has been
+            received, including this one.
+        """
+        self.message_id = message_id
+        self.receipt_handle = receipt_handle
+        self.body = body
+        self.receive_count = receive_count
+
+
+class WorkQueue:
+    """Base class for all work queues."""
+
+    # The most messages that may be sent, received or deleted in one call.
+    MAX_BATCH_SIZE = 10
+
+    def send_messages(self, bodies: List[str]) -> List[str]:
+        """Adds messages to the queue.
+
+        :param bodies: The bodies of the messages.  At most `MAX_BATCH_SIZE`.
+        :return: The ids of the messages.
+        """
+        raise NotImplementedError()
+
+    def receive_messages(
+        self, max_messages: int, wait_time_s: float, visibility_timeout_s: float
+    ) -> List[QueueMessage]:
+        """Receives messages, waiting for some to become visible if there are
+        none.
+
+        :param max_messages: The most messages to receive.  At most
+            `MAX_BATCH_SIZE`.
+        :param wait_time_s: The longest to wait for a message.  If no message
+            becomes visible within this time, no messages are returned.
+        :param visibility_timeout_s: How long the messages are hidden from
+            other consumers.
+        :return: The messages.
+        """
+        raise NotImplementedError()
+
+    def delete_messages(self, receipt_handles: List[str]):
+        """Deletes processed messages.
+
+        :param receipt_handles: The receipt handles of the messages.  At most
+            `MAX_BATCH_SIZE`.
+        """
+        raise NotImplementedError()
+
+    def change_visibility(self, receipt_handle: str, visibility_timeout_s: float):
+        """Hides a received message for longer, or makes it visible again.
+
+        :param receipt_handle: The receipt handle of the message.
+        :param visibility_timeout_s: How long from now the message is hidden.
+            If 0, it is visible again immediately.
+        """
+        raise NotImplementedError()
+
+
+class SqliteWorkQueue(WorkQueue):
+    """Holds the messages in a SQLite database.
+
+    Receiving a message runs in an immediate transaction, so a message is never
+    received by two consumers at once, even from other processes.  Waiting for
+    messages is emulated by polling.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        queue_name: str = 'default',
+        poll_interval_s: float = 0.05,
+        busy_timeout_ms: int = 5000,
+    ):
+        """Creates an instance, creating the database if it does not exist.
+
+        :param path: The path to the database file.
+        :param queue_name: The name of the queue.  A database may hold several.
+        :param poll_interval_s: How often to check for visible messages while
+            waiting for one.
+        :param busy_timeout_ms: How long to wait for another writer to finish
+            before failing.
+        """
+        self.__database = SqliteDatabase(path, busy_timeout_ms=busy_timeout_ms)
+        self.__queue_name = queue_name
+        self.__poll_interval_s = poll_interval_s
+        connection = self.__database.connection()
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS work_queue ('
+            ' sequence INTEGER PRIMARY KEY AUTOINCREMENT,'
+            ' queue_name TEXT NOT NULL,'
+            ' message_id TEXT NOT NULL,'
+            ' body TEXT NOT NULL,'
+            ' visible_time REAL NOT NULL,'
+            ' receive_count INTEGER NOT NULL,'
+            ' receipt_handle TEXT)'
+        )
+        connection.execute(
+            'CREATE INDEX IF NOT EXISTS work_queue_visible '
+            'ON work_queue (queue_name, visible_time)'
+        )
+        connection.execute(
+            'CREATE INDEX IF NOT EXISTS work_queue_receipt '
+            'ON work_queue (receipt_handle)'
+        )
+
+    def __len__(self) -> int:
+        """Returns the number of messages in the queue, visible or not."""
+        (count,) = (
+            self.__database.connection()
+            .execute(
+                'SELECT COUNT(*) FROM work_queue WHERE queue_name = ?',
+                (self.__queue_name,),
+            )
+            .fetchone()
+        )
+        return count
+
+    def send_messages(self, bodies: List[str]) -> List[str]:
+        _check_batch_size(len(bodies))
+        message_ids = [str(uuid.uuid4()) for _ in bodies]
+        now = time.time()
+        self.__database.connection().executemany(
+            'INSERT INTO work_queue '
+            '(queue_name, message_id, body, visible_time, receive_count) '
+            'VALUES (?, ?, ?, ?, 0)',
+            [
+                (self.__queue_name, message_id, body, now)
+                for message_id, body in zip(message_ids, bodies)
+            ],
+        )
+        return message_ids
+
+    def receive_messages(
+        self, max_messages: int, wait_time_s: float, visibility_timeout_s: float
+    ) -> List[QueueMessage]:
+        _check_batch_size(max_messages)
+        deadline = time.monotonic() + wait_time_s
+        while True:
+            messages = self.__receive_visible(max_messages, visibility_timeout_s)
+            if messages or time.monotonic() >= deadline:
+                return messages
+            time.sleep(
+                min(self.__poll_interval_s, max(0.0, deadline - time.monotonic()))
+            )
+
+    def __receive_visible(
+        self, max_messages: int, visibility_timeout_s: float
+    ) -> List[QueueMessage]:
+        with self.__database.transaction() as connection:
+            now = time.time()
+            rows = connection.execute(
+                'SELECT sequence, message_id, body, receive_count FROM work_queue '
+                'WHERE queue_name = ? AND visible_time <= ? '
+                'ORDER BY sequence LIMIT ?',
+                (self.__queue_name, now, max_messages),
+            ).fetchall()
+            messages = [
+                QueueMessage(message_id, str(uuid.uuid4()), body, receive_count + 1)
+                for _, message_id, body, receive_count in rows
+            ]
+            connection.executemany(
+                'UPDATE work_queue SET visible_time = ?, '
+                'receive_count = receive_count + 1, receipt_handle = ? '
+                'WHERE sequence = ?',
+                [
+                    (now + visibility_timeout_s, message.receipt_handle, row[0])
+                    for row, message in zip(rows, messages)
+                ],
+            )
+        return messages
+
+    def delete_messages(self, receipt_handles: List[str]):
+        _check_batch_size(len(receipt_handles))
+        self.__database.connection().executemany(
+            'DELETE FROM work_queue WHERE receipt_handle = ?',
+            [(receipt_handle,) for receipt_handle in receipt_handles],
+        )
+
+    def change_visibility(self, receipt_handle: str, visibility_timeout_s: float):
+        self.__database.connection().execute(
+            'UPDATE work_queue SET visible_time = ? WHERE receipt_handle = ?',
+            (time.time() + visibility_timeout_s, receipt_handle),
+        )
+
+
+class SqsWorkQueue(WorkQueue):
+    """Receives messages from an SQS queue."""
+
+    # The longest SQS waits for messages in one receive call.
+    MAX_WAIT_TIME_S = 20
+
+    def __init__(self, queue_url: str, sqs_client):
+        """Creates an instance.
+
+        :param queue_url: The URL of the queue.
+        :param sqs_client: The SQS client.  Its read timeout must be longer
+            than the wait time of the receives.
+        """
+        self.__queue_url = queue_url
+        self.__sqs = sqs_client
+
+    def send_messages(self, bodies: List[str]) -> List[str]:
+        _check_batch_size(len(bodies))
+        response = self.__sqs.send_message_batch(
+            QueueUrl=self.__queue_url,
+            Entries=[
+                {'Id': str(index), 'MessageBody': body}
+                for index, body in enumerate(bodies)
+            ],
+        )
+        _raise_for_failures(response, 'send')
+        message_ids = {
+            entry['Id']: entry['MessageId'] for entry in response['Successful']
+        }
+        return [message_ids[str(index)] for index in range(len(bodies))]
+
+    def receive_messages(
+        self, max_messages: int, wait_time_s: float, visibility_timeout_s: float
+    ) -> List[QueueMessage]:
+        _check_batch_size(max_messages)
+        response = self.__sqs.receive_message(
+            QueueUrl=self.__queue_url,
+            MaxNumberOfMessages=max_messages,
+            WaitTimeSeconds=min(SqsWorkQueue.MAX_WAIT_TIME_S, int(round(wait_time_s))),
+            VisibilityTimeout=int(round(visibility_timeout_s)),
+            AttributeNames=['ApproximateReceiveCount'],
+        )
+        return [
+            QueueMessage(
+                message['MessageId'],
+                message['ReceiptHandle'],
+                message['Body'],
+                int(message.get('Attributes', {}).get('ApproximateReceiveCount', 1)),
+            )
+            for message in response.get('Messages', [])
+        ]
+
+    def delete_messages(self, receipt_handles: List[str]):
+        _check_batch_size(len(receipt_handles))
+        response = self.__sqs.delete_message_batch(
+            QueueUrl=self.__queue_url,
+            Entries=[
+                {'Id': str(index), 'ReceiptHandle': receipt_handle}
+                for index, receipt_handle in enumerate(receipt_handles)
+            ],
+        )
+        _raise_for_failures(response, 'delete')
+
+    def change_visibility(self, receipt_handle: str, visibility_timeout_s: float):
+        self.__sqs.change_message_visibility(
+            QueueUrl=self.__queue_url,
+            ReceiptHandle=receipt_handle,
+            VisibilityTimeout=int(round(visibility_timeout_s)),
+        )
+
+
+def _check_batch_size(size: int):
+    if not 1 <= size <= WorkQueue.MAX_BATCH_SIZE:
+        raise ValueError(f"Invalid batch size: {size}")
+
+
+def _raise_for_failures(response: dict, action: str):
+    failed = response.get('Failed', [])
+    if failed:
+        raise RuntimeError(
+            f"Failed to {action} {len(failed)} messages: "
+            + '; '.join(f"{entry['Id']}: {entry.get('Code')}" for entry in failed)
+        )
+
+
+def create_work_queue(
+    backend: str, path: str = None, queue_url: str = None, sqs_client=None
+) -> WorkQueue:
+    """Creates a work queue using the named backend.
+
+    :param backend: Either `sqlite` or `sqs`.
+    :param path: The database path for the `sqlite` backend.
+    :param queue_url: The queue URL for the `sqs` backend.
+    :param sqs_client: The SQS client for the `sqs` backend.
+    :return: The queue.
+    """
+    if backend == 'sqlite':
+        if path is None:
+            raise ValueError('The sqlite work queue requires a path')
+        return SqliteWorkQueue(path)
+    if backend == 'sqs':
+        if queue_url is None or sqs_client is None:
+            raise ValueError('The sqs work queue requires a queue URL and client')
+        return SqsWorkQueue(queue_url, sqs_client)
+    raise ValueError(f'Unknown work queue backend "{backend}".  Must be sqlite or sqs')
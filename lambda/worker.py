@@ -0,0 +1,381 @@
+"""Runs a detection handler as a long-running worker that consumes a work
+queue, rather than as a Lambda invoked once per SNS delivery.
+
+For steady, high volume traffic this avoids paying the per-invocation
+overhead of Lambda for every image.  The worker:
+
+* Long-polls the queue for batches of messages, keeping up to `prefetch`
+  received messages buffered so that the handlers never wait on the queue.
+* Scores up to `concurrency` images at once, each on its own thread with its
+  own handler instance, since a `DetectionHandler` scores one image at a time.
+* Extends the visibility timeout of the messages it holds while they are
+  buffered or being scored, so that slow images are not redelivered to
+  another worker.
+* On SIGTERM or SIGINT, stops receiving once the receive in progress returns,
+  makes the buffered messages visible again for other workers, and finishes
+  scoring the images in progress before exiting.
+
+Each message's body is an analyze image payload, as published to the analyze
+image SNS topic (see `work_queue.py`).  It is handed to the handler as a one
+record SNS event.  Messages are deleted once scored, or if they can never be
+scored.  Messages that failed with a retriable error are left to become
+visible again, to be retried.
+
+Usage:
+    python lambda/worker.py detect_spammy_words --queue-backend sqs \\
+        --queue-url https://sqs.us-east-1.amazonaws.com/123456789012/images
+
+The options default to the `WORKER_*` environment variables listed by
+`--help`.
+"""
+
+import argparse
+import importlib
+import os
+import signal
+import threading
+import time
+import traceback
+
+from collections import deque
+from typing import Callable, Dict
+
+from aws_clients import create_aws_client
+from work_queue import QueueMessage, WorkQueue, create_work_queue
+
+# The module and class of each handler the worker can run.
+HANDLERS = {
+    'detect_known_bad_content': (
+        'detect_known_bad_content',
+        'DetectKnownBadContentHandler',
+    ),
+    'detect_spammy_words': ('detect_spammy_words', 'DetectSpammyWordsHandler'),
+    'detect_adult_content': ('detect_adult_content', 'DetectAdultContentHandler'),
+    'detect_all': ('detect_all', 'DetectAllHandler'),
+}
+
+
+def load_handler_class(name: str):
+    """Imports a handler, so that only the handler run pays for loading its
+    module, such as a known bad hash corpus.
+
+    :param name: The name of the handler, one of `HANDLERS`.
+    :return: The handler's class.
+    """
+    module_name, class_name = HANDLERS[name]
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+class _WorkerContext:
+    """Stands in for the context passed to a Lambda handler."""
+
+    function_version = 'worker'
+
+    def __init__(self, request_id: str):
+        self.aws_request_id = request_id
+
+
+class _HeldMessage:
+    """A message the worker holds, and the time its visibility timeout ends."""
+
+    __slots__ = ('message', 'visible_time')
+
+    def __init__(self, message: QueueMessage, visible_time: float):
+        self.message = message
+        self.visible_time = visible_time
+
+
+class Worker:
+    """Consumes a work queue, scoring each message's image with a handler."""
+
+    def __init__(
+        self,
+        queue: WorkQueue,
+        handler_factory: Callable[[], object],
+        concurrency: int = 8,
+        prefetch: int = None,
+        visibility_timeout_s: float = 60,
+        wait_time_s: float = 20,
+    ):
+        """Creates an instance.
+
+        :param queue: The queue to consume.
+        :param handler_factory: Creates a handler, such as a `DetectionHandler`
+            subclass.  One is created per thread.
+        :param concurrency: The most images scored at once.
+        :param prefetch: The most received messages buffered while waiting to
+            be scored.  If None, `concurrency`.
+        :param visibility_timeout_s: The visibility timeout of received
+            messages, which is extended while they are held.
+        :param wait_time_s: The longest to wait for messages in one receive.
+        """
+        if concurrency < 1:
+            raise ValueError(f"Invalid concurrency: {concurrency}")
+        self.__queue = queue
+        self.__handler_factory = handler_factory
+        self.__concurrency = concurrency
+        self.__prefetch = max(1, prefetch if prefetch is not None else concurrency)
+        self.__visibility_timeout_s = visibility_timeout_s
+        self.__wait_time_s = wait_time_s
+
+        # Guards the buffer, the number of messages being scored and the
+        # counters, and is notified whenever any of them changes.
+        self.__condition = threading.Condition()
+        self.__buffer = deque()
+        self.__scoring = 0
+        self.__stopping = False
+        self.__stats = {'received': 0, 'processed': 0, 'failed': 0, 'released': 0}
+        # The messages received and not yet deleted or given up on, keyed by
+        # receipt handle.
+        self.__held: Dict[str, _HeldMessage] = {}
+        self.__held_lock = threading.Lock()
+
+    def stop(self):
+        """Asks the worker to drain and stop.  This may be called from a signal
+        handler or any thread.  `run` returns once the worker has stopped.
+        """
+        with self.__condition:
+            self.__stopping = True
+            self.__condition.notify_all()
+
+    def run(self, exit_when_idle: bool = False) -> Dict[str, int]:
+        """Consumes the queue until `stop` is called.
+
+        :param exit_when_idle: If True, also stop once a receive finds the
+            queue empty and every received message has been scored.
+        :return: The number of messages `received`, `processed` (deleted after
+            scoring or failing permanently), `failed` (left to be retried) and
+            `released` (made visible again, unscored, while stopping).
+        """
+        threads = [
+            threading.Thread(target=self.__score_messages, name=f'worker-{i}')
+            for i in range(self.__concurrency)
+        ]
+        extender_done = threading.Event()
+        extender = threading.Thread(
+            target=self.__extend_visibility, args=(extender_done,), name='extender'
+        )
+        for thread in threads + [extender]:
+            thread.start()
+
+        try:
+            self.__receive_messages(exit_when_idle)
+        finally:
+            self.stop()
+            self.__release_buffered()
+            for thread in threads:
+                thread.join()
+            extender_done.set()
+            extender.join()
+
+        with self.__condition:
+            return dict(self.__stats)
+
+    def __receive_messages(self, exit_when_idle: bool):
+        """Keeps the buffer filled until the worker is stopped."""
+        while True:
+            with self.__condition:
+                while len(self.__buffer) >= self.__prefetch and not self.__stopping:
+                    self.__condition.wait()
+                if self.__stopping:
+                    return
+                room = self.__prefetch - len(self.__buffer)
+
+            try:
+                messages = self.__queue.receive_messages(
+                    min(WorkQueue.MAX_BATCH_SIZE, room),
+                    self.__wait_time_s,
+                    self.__visibility_timeout_s,
+                )
+            except Exception as e:
+                print(f"[ERROR] Failed to receive messages: {e!r}")
+                traceback.print_exc()
+                with self.__condition:
+                    # Back off rather than spinning on a failing queue.
+                    self.__condition.wait(1)
+                continue
+
+            visible_time = time.monotonic() + self.__visibility_timeout_s
+            with self.__held_lock:
+                for message in messages:
+                    self.__held[message.receipt_handle] = _HeldMessage(
+                        message, visible_time
+                    )
+            with self.__condition:
+                self.__stats['received'] += len(messages)
+                self.__buffer.extend(messages)
+                self.__condition.notify_all()
+                if (
+                    exit_when_idle
+                    and not messages
+                    and not self.__buffer
+                    and self.__scoring == 0
+                ):
+                    return
+
+    def __score_messages(self):
+        """Run by each scoring thread, with its own handler."""
+        handler = self.__handler_factory()
+        while True:
+            with self.__condition:
+                while not self.__buffer and not self.__stopping:
+                    self.__condition.wait()
+                if self.__stopping:
+                    # The buffered messages are released by `run`.
+                    return
+                message = self.__buffer.popleft()
+                self.__scoring += 1
+                self.__condition.notify_all()
+            try:
+                outcome = self.__score_message(handler, message)
+            finally:
+                with self.__condition:
+                    self.__scoring -= 1
+                    self.__condition.notify_all()
+            with self.__condition:
+                self.__stats[outcome] += 1
+
+    def __score_message(self, handler, message: QueueMessage) -> str:
+        """Scores one message's image, deleting the message unless it should
+        be retried.
+
+        :return: The counter for the outcome, `processed` or `failed`.
+        """
+        event = {
+            'Records': [
+                {'Sns': {'MessageId': message.message_id, 'Message': message.body}}
+            ]
+        }
+        try:
+            response = handler.handle_request(event, _WorkerContext(message.message_id))
+            retry = bool(response.get('batchItemFailures'))
+        except Exception as e:
+            print(f"[ERROR] Unexpected error scoring {message.message_id}: {e!r}")
+            traceback.print_exc()
+            retry = True
+
+        with self.__held_lock:
+            self.__held.pop(message.receipt_handle, None)
+        if retry:
+            # Left to become visible again once its visibility timeout ends.
+            return 'failed'
+        try:
+            self.__queue.delete_messages([message.receipt_handle])
+        except Exception as e:
+            # It will be redelivered and scored again.
+            print(f"[ERROR] Failed to delete {message.message_id}: {e!r}")
+        return 'processed'
+
+    def __release_buffered(self):
+        """Makes the messages that were never scored visible again, so that
+        other workers can score them without waiting for their timeouts.
+        """
+        with self.__condition:
+            released = list(self.__buffer)
+            self.__buffer.clear()
+            self.__stats['released'] += len(released)
+        for message in released:
+            with self.__held_lock:
+                self.__held.pop(message.receipt_handle, None)
+            try:
+                self.__queue.change_visibility(message.receipt_handle, 0)
+            except Exception as e:
+                print(f"[ERROR] Failed to release {message.message_id}: {e!r}")
+
+    def __extend_visibility(self, done: threading.Event):
+        """Run by the extender thread.  Extends the visibility timeout of the
+        held messages whose timeout ends within half of the timeout.
+        """
+        interval_s = max(0.1, self.__visibility_timeout_s / 4)
+        while not done.wait(interval_s):
+            now = time.monotonic()
+            with self.__held_lock:
+                expiring = [
+                    held
+                    for held in self.__held.values()
+                    if held.visible_time - now < self.__visibility_timeout_s / 2
+                ]
+            for held in expiring:
+                try:
+                    self.__queue.change_visibility(
+                        held.message.receipt_handle, self.__visibility_timeout_s
+                    )
+                    held.visible_time = now + self.__visibility_timeout_s
+                except Exception as e:
+                    print(f"[ERROR] Failed to extend {held.message.message_id}: {e!r}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('handler', choices=sorted(HANDLERS))
+    parser.add_argument(
+        '--queue-backend',
+        choices=['sqlite', 'sqs'],
+        default=os.environ.get('WORKER_QUEUE_BACKEND', 'sqlite'),
+        help='WORKER_QUEUE_BACKEND',
+    )
+    parser.add_argument(
+        '--queue-path',
+        default=os.environ.get('WORKER_QUEUE_PATH', '/tmp/work_queue.db'),
+        help='WORKER_QUEUE_PATH, for the sqlite backend',
+    )
+    parser.add_argument(
+        '--queue-url',
+        default=os.environ.get('WORKER_QUEUE_URL'),
+        help='WORKER_QUEUE_URL, for the sqs backend',
+    )
+    parser.add_argument(
+        '--concurrency',
+        type=int,
+        default=int(os.environ.get('WORKER_CONCURRENCY', '8')),
+        help='WORKER_CONCURRENCY',
+    )
+    parser.add_argument(
+        '--prefetch',
+        type=int,
+        default=os.environ.get('WORKER_PREFETCH'),
+        help='WORKER_PREFETCH, by default the concurrency',
+    )
+    parser.add_argument(
+        '--visibility-timeout-s',
+        type=float,
+        default=float(os.environ.get('WORKER_VISIBILITY_TIMEOUT_S', '60')),
+        help='WORKER_VISIBILITY_TIMEOUT_S',
+    )
+    parser.add_argument(
+        '--wait-time-s',
+        type=float,
+        default=float(os.environ.get('WORKER_WAIT_TIME_S', '20')),
+        help='WORKER_WAIT_TIME_S',
+    )
+    args = parser.parse_args()
+
+    sqs_client = None
+    if args.queue_backend == 'sqs':
+        sqs_client = create_aws_client('sqs')
+    queue = create_work_queue(
+        args.queue_backend,
+        path=args.queue_path,
+        queue_url=args.queue_url,
+        sqs_client=sqs_client,
+    )
+    worker = Worker(
+        queue,
+        load_handler_class(args.handler),
+        concurrency=args.concurrency,
+        prefetch=int(args.prefetch) if args.prefetch is not None else None,
+        visibility_timeout_s=args.visibility_timeout_s,
+        wait_time_s=args.wait_time_s,
+    )
+    for signal_number in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signal_number, lambda _signal_number, _frame: worker.stop())
+
+    stats = worker.run()
+    print(
+        f"worker_stopped handler={args.handler} "
+        + ' '.join(f"{key}={value}" for key, value in stats.items())
+    )
+
+
+if __name__ == '__main__':
+    main()
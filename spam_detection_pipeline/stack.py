@@ -21,6 +21,20 @@ if IMAGE_HASH_LAYER_ARN is None:
     print("Error, IMAGE_HASH_LAYER_ARN is not set in the environment", file=sys.stderr)
     sys.exit(1)
 
+# How the detection algorithms are deployed.  With `fanout`, each algorithm
+# runs in its own Lambda subscribed to the analyze requests topic, and reports
+# its score through the update spam score topic.  With `fused`, a single
+# DetectAll Lambda runs every algorithm concurrently and updates the spam
+# score itself.
+PIPELINE_TOPOLOGY = os.environ.get('PIPELINE_TOPOLOGY', 'fanout')
+
+if PIPELINE_TOPOLOGY not in ('fanout', 'fused'):
+    print(
+        f"Error, PIPELINE_TOPOLOGY must be fanout or fused, not {PIPELINE_TOPOLOGY}",
+        file=sys.stderr,
+    )
+    sys.exit(1)
+
 
 def _get_pipeline_lambda_version() -> str:
     """Returns the current version number for the Pipeline Lambdas.
@@ -138,39 +152,9 @@ class SpamDetectionPipelineStack(core.Stack):
         )
 
         self.__analyze_image = PipelineLambda(self, lambda_app, 'AnalyzeImage')
-        self.__detect_known_bad_content = PipelineLambda(
-            self, lambda_app, 'DetectKnownBadContent'
-        )
-        self.__detect_spammy_words = PipelineLambda(
-            self, lambda_app, 'DetectSpammyWords'
-        )
-        self.__detect_adult_content = PipelineLambda(
-            self, lambda_app, 'DetectAdultContent'
-        )
-        self.__update_spam_score = PipelineLambda(self, lambda_app, 'UpdateSpamScore')
-
-        # Only the DetectKnownBadContent needs the ImageHash layer.
-        self.__detect_known_bad_content.function.add_layers(self.__image_hash_layer)
-
-        all_lambdas = [
-            self.__analyze_image,
-            self.__detect_known_bad_content,
-            self.__detect_spammy_words,
-            self.__detect_adult_content,
-            self.__update_spam_score,
-        ]
-
-        # Define an API gateway and map the initial and final Lambda
-        self.__api = apigw.LambdaRestApi(
-            self, 'spam_detection_api', handler=self.__analyze_image.alias, proxy=False
-        )
-        for pipeline_lambda in all_lambdas:
-            self.__map_post_to_lambda_alias(pipeline_lambda)
 
         # Create an SNS topic to use for fan-out from the initial Lambda
         self.__analyze_requests_topic = sns.Topic(self, "analyze_requests")
-        # Create an SNS topic to use for fan-in from the detection Lambdas
-        self.__update_spam_score_topic = sns.Topic(self, "update_spam_score")
 
         self.__enable_publish_from_lambda(
             self.__analyze_requests_topic,
@@ -178,42 +162,72 @@ class SpamDetectionPipelineStack(core.Stack):
             'SNS_ANALYZE_IMAGE_TOPIC_ARN',
         )
 
-        # noinspection PyTypeChecker
-        self.__update_spam_score_topic.add_subscription(
-            sns_subscriptions.LambdaSubscription(self.__update_spam_score.alias)
+        if PIPELINE_TOPOLOGY == 'fused':
+            detection_lambdas = [PipelineLambda(self, lambda_app, 'DetectAll')]
+            all_lambdas = [self.__analyze_image] + detection_lambdas
+        else:
+            detection_lambdas = [
+                PipelineLambda(self, lambda_app, 'DetectKnownBadContent'),
+                PipelineLambda(self, lambda_app, 'DetectSpammyWords'),
+                PipelineLambda(self, lambda_app, 'DetectAdultContent'),
+            ]
+            self.__update_spam_score = PipelineLambda(
+                self, lambda_app, 'UpdateSpamScore'
+            )
+            all_lambdas = (
+                [self.__analyze_image] + detection_lambdas + [self.__update_spam_score]
+            )
+
+            # Create an SNS topic to use for fan-in from the detection Lambdas
+            self.__update_spam_score_topic = sns.Topic(self, "update_spam_score")
+
+            # noinspection PyTypeChecker
+            self.__update_spam_score_topic.add_subscription(
+                sns_subscriptions.LambdaSubscription(self.__update_spam_score.alias)
+            )
+
+        # Define an API gateway and map the initial and final Lambda
+        self.__api = apigw.LambdaRestApi(
+            self, 'spam_detection_api', handler=self.__analyze_image.alias, proxy=False
         )
+        for pipeline_lambda in all_lambdas:
+            self.__map_post_to_lambda_alias(pipeline_lambda)
 
         # For each detection Lambda:
-        # - Allow it to invoke the UpdateSpamScore Lambda to report results
         # - Add a subscription to the SNS Topic so it receives processing requests
+        # - Allow it to publish to the UpdateSpamScore topic to report results,
+        #   unless it updates the score itself
         # - Allow it to invoke AWS Rekognition via AWS Managed IAM Policy
         # - Add a PolicyStatement for access to the S3 bucket
-        for aws_lambda in all_lambdas:
-            if aws_lambda.name.startswith('Detect'):
-                # noinspection PyTypeChecker
-                self.__analyze_requests_topic.add_subscription(
-                    sns_subscriptions.LambdaSubscription(aws_lambda.alias)
-                )
+        for aws_lambda in detection_lambdas:
+            # Only the known bad content detection needs the ImageHash layer.
+            if aws_lambda.name in ('DetectKnownBadContent', 'DetectAll'):
+                aws_lambda.function.add_layers(self.__image_hash_layer)
+
+            # noinspection PyTypeChecker
+            self.__analyze_requests_topic.add_subscription(
+                sns_subscriptions.LambdaSubscription(aws_lambda.alias)
+            )
 
+            if PIPELINE_TOPOLOGY == 'fanout':
                 self.__enable_publish_from_lambda(
                     self.__update_spam_score_topic,
                     aws_lambda,
                     'SNS_UPDATE_SPAM_SCORE_TOPIC_ARN',
                 )
 
-                aws_lambda.function.add_environment('IMAGE_CONFIDENCE_THRESHOLD', '0.6')
+            aws_lambda.function.add_environment('IMAGE_CONFIDENCE_THRESHOLD', '0.6')
 
-                aws_lambda.function.role.add_managed_policy(
-                    _iam.ManagedPolicy.from_aws_managed_policy_name(
-                        'AmazonRekognitionFullAccess'
-                    )
+            aws_lambda.function.role.add_managed_policy(
+                _iam.ManagedPolicy.from_aws_managed_policy_name(
+                    'AmazonRekognitionFullAccess'
                 )
-                aws_lambda.function.role.add_to_policy(
-                    _iam.PolicyStatement(
-                        actions=['*'],
-                        resources=['arn:aws:s3:::scalyr-serverless-demo/*'],
-                    )
+            )
+            aws_lambda.function.role.add_to_policy(
+                _iam.PolicyStatement(
+                    actions=['*'], resources=['arn:aws:s3:::scalyr-serverless-demo/*'],
                 )
+            )
 
     def __map_post_to_lambda_alias(self, pipeline_lambda: PipelineLambda):
         """Maps POSTs from /{lambda_name} to the prod alias for the specified Lambda.
@@ -0,0 +1,92 @@
+"""Fakes shared by the unit tests."""
+
+from typing import List
+
+from lambda_common import DetectionHandler
+
+
+def sns_record(message_id: str, message: str) -> dict:
+    """Returns an SNS record of a Lambda event, with only the fields the
+    handlers read.
+    """
+    return {'Sns': {'MessageId': message_id, 'Message': message}}
+
+
+class FakeContext:
+    """Stands in for the context passed to a Lambda handler."""
+
+    function_version = 1
+    aws_request_id = 'request-id'
+
+
+class FakeClock:
+    """A clock that only moves when a test moves it, or something sleeps."""
+
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+        self.sleeps: List[float] = []
+
+    def __call__(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class FakeImageContext:
+    """Stands in for an `ImageContext`, returning canned image data."""
+
+    def __init__(self, thumbnail=None, texts: List[dict] = None):
+        self.thumbnail = thumbnail
+        self.texts = texts
+        self.thumbnail_sizes: List[int] = []
+
+    def grayscale_thumbnail(self, size: int, log_context=None):
+        self.thumbnail_sizes.append(size)
+        return self.thumbnail
+
+    def text_detections(self, log_context):
+        return self.texts
+
+
+class CountingHandler(DetectionHandler):
+    """Scores every image 0.5, counting the images it scored."""
+
+    def __init__(self, **kwargs):
+        super().__init__('counting', **kwargs)
+        self.calls = 0
+
+    def _score_image(self, image_payload):
+        self.calls += 1
+        return 0.5
+
+
+class FakeSnsClient:
+    """Stands in for the SNS client, recording the batches published."""
+
+    def __init__(self, failed_ids=(), sender_fault=False, error=None):
+        self.batches = []
+        self.failed_ids = failed_ids
+        self.sender_fault = sender_fault
+        self.error = error
+
+    def publish_batch(self, TopicArn, PublishBatchRequestEntries):
+        self.batches.append((TopicArn, PublishBatchRequestEntries))
+        if self.error is not None:
+            raise self.error
+        failed = [
+            {'Id': e['Id'], 'Code': 'InternalError', 'SenderFault': self.sender_fault}
+            for e in PublishBatchRequestEntries
+            if e['Id'] in self.failed_ids
+        ]
+        successful = [
+            {'Id': e['Id'], 'MessageId': 'x'}
+            for e in PublishBatchRequestEntries
+            if e['Id'] not in self.failed_ids
+        ]
+        return {
+            'Successful': successful,
+            'Failed': failed,
+            'ResponseMetadata': {'HTTPStatusCode': 200},
+        }
@@ -0,0 +1,144 @@
+import asyncio
+import contextlib
+import io
+import json
+import os
+import threading
+import unittest
+
+import sns_publisher
+from async_handler import AsyncDetectionHandler, SyncDetectionHandlerAdapter
+from dedup_store import InMemoryDedupStore
+from lambda_common import DetectionHandler, ImagePayload, LogContext
+from score_cache import ScoreCache
+
+from tests.unit.fakes import FakeContext, FakeSnsClient, sns_record
+
+
+class _FakeAsyncHandler(AsyncDetectionHandler):
+    def __init__(self, max_concurrency, score_cache=None):
+        super().__init__(
+            'fake_async',
+            score_cache=score_cache,
+            max_concurrency=max_concurrency,
+            dedup_store=InMemoryDedupStore(),
+        )
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.calls = 0
+
+    async def _score_image(self, image_payload, log_context, image_context):
+        self.calls += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0.01)
+        self.in_flight -= 1
+        return 0.5
+
+
+class _FakeSyncHandler(DetectionHandler):
+    # Only returns once two images are being scored at the same time.
+    barrier = threading.Barrier(2, timeout=5)
+
+    def __init__(self):
+        super().__init__('fake_sync')
+
+    def _score_image(self, image_payload):
+        self.barrier.wait()
+        return 0.25
+
+
+class TestAsyncDetectionHandler(unittest.TestCase):
+    def setUp(self):
+        self.original_sns = sns_publisher._sns
+        sns_publisher._sns = FakeSnsClient()
+        os.environ['SNS_UPDATE_SPAM_SCORE_TOPIC_ARN'] = 'arn:topic'
+
+    def tearDown(self):
+        sns_publisher._sns = self.original_sns
+        del os.environ['SNS_UPDATE_SPAM_SCORE_TOPIC_ARN']
+
+    @staticmethod
+    def __event(count, bad_indexes=()):
+        return {
+            'Records': [
+                sns_record(
+                    f"m{i}",
+                    'not json'
+                    if i in bad_indexes
+                    else ImagePayload(
+                        f"s3://bucket/{i}.png", "post", "account", "iOS", "1", "root"
+                    ).to_json(),
+                )
+                for i in range(count)
+            ]
+        }
+
+    def test_records_scored_concurrently(self):
+        handler = _FakeAsyncHandler(max_concurrency=3)
+
+        response = handler.handle_request(self.__event(7), FakeContext())
+
+        assert response['statusCode'] == 200
+        assert response['batchItemFailures'] == []
+        assert handler.max_in_flight == 3
+        published = [
+            json.loads(entry['Message'])
+            for _, batch in sns_publisher._sns.batches
+            for entry in batch
+        ]
+        assert sorted(payload['ScorerTraceID'] for payload in published) == [
+            f"request-id-{i}" for i in range(7)
+        ]
+        assert all(payload['Score'] == 0.5 for payload in published)
+
+    def test_failures_are_isolated(self):
+        response = _FakeAsyncHandler(max_concurrency=2).handle_request(
+            self.__event(3, bad_indexes={1}), FakeContext()
+        )
+
+        assert 'Failed 1 of 3 records: m1' in response['body']
+        assert response['batchItemFailures'] == []
+        assert sum(len(batch) for _, batch in sns_publisher._sns.batches) == 2
+
+    def test_score_cache(self):
+        class _EtagImageContext:
+            async def etag_async(self, log_context):
+                return 'etag'
+
+        handler = _FakeAsyncHandler(max_concurrency=1, score_cache=ScoreCache())
+        payload = ImagePayload(
+            "s3://bucket/0.png", "post", "account", "iOS", "1", "root"
+        )
+        log_context = LogContext('test', 1)
+        for _ in range(2):
+            score = asyncio.run(
+                handler.score_image(payload, log_context, _EtagImageContext())
+            )
+            assert score == 0.5
+
+        assert handler.calls == 1
+
+    def test_sync_handler_adapter(self):
+        adapter = SyncDetectionHandlerAdapter(
+            _FakeSyncHandler, max_concurrency=2, dedup_store=InMemoryDedupStore()
+        )
+        assert adapter.handler_name == 'fake_sync'
+
+        response = adapter.handle_request(self.__event(4), FakeContext())
+
+        assert response['statusCode'] == 200
+        assert sum(len(batch) for _, batch in sns_publisher._sns.batches) == 4
+
+    def test_redelivery_skipped(self):
+        handler = _FakeAsyncHandler(max_concurrency=2)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            handler.handle_request(self.__event(2), FakeContext())
+            response = handler.handle_request(self.__event(3), FakeContext())
+
+        assert response['statusCode'] == 200
+        # m0 and m1 were redelivered; m2 is new, but every image has the same
+        # root trace id.
+        assert handler.calls == 2
+        assert output.getvalue().count('duplicates=1') == 3
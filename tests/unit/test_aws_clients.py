@@ -0,0 +1,92 @@
+import contextlib
+import io
+import os
+import unittest
+
+from botocore.stub import Stubber
+
+import aws_clients
+from aws_clients import AwsClientRegistry, ColdStartTracker, create_aws_client
+from lambda_common import LogContext
+
+
+class TestColdStartTracker(unittest.TestCase):
+    def test_costs_reported_once(self):
+        tracker = ColdStartTracker(0)
+        tracker.record('import_ms.module', 12.7)
+
+        start_fields = tracker.take_start_fields()
+        assert start_fields.startswith(' cold_start=true init_to_handler_ms=')
+        assert start_fields.endswith(' import_ms.module=12')
+        assert tracker.take_fields() == ''
+
+        with tracker.timed('client_ms.s3'):
+            pass
+        assert tracker.take_start_fields() == ''
+        assert tracker.take_fields() == ' client_ms.s3=0'
+
+    def test_record_once(self):
+        tracker = ColdStartTracker(0)
+        tracker.record_once('ttfb_ms.s3', 40.2)
+        tracker.record_once('ttfb_ms.s3', 3.1)
+
+        assert tracker.take_fields() == ' ttfb_ms.s3=40'
+        tracker.record_once('ttfb_ms.s3', 2.8)
+        assert tracker.take_fields() == ''
+
+
+class TestAwsClientRegistry(unittest.TestCase):
+    def test_clients_built_once_on_first_use(self):
+        registry = AwsClientRegistry()
+        client = registry.lazy('sns')
+
+        assert client.meta.service_model.service_name == 'sns'
+        assert registry.get('sns') is registry.get('sns')
+
+
+class TestCreateAwsClient(unittest.TestCase):
+    def setUp(self):
+        os.environ['SNS_CLIENT_MAX_POOL_CONNECTIONS'] = '3'
+
+    def tearDown(self):
+        del os.environ['SNS_CLIENT_MAX_POOL_CONNECTIONS']
+
+    def test_settings_and_call_hooks(self):
+        client = create_aws_client('sns')
+        assert client.meta.config.max_pool_connections == 3
+        assert client.meta.config.retries['mode'] == 'adaptive'
+
+        stubber = Stubber(client)
+        stubber.add_response('publish', {'MessageId': 'id'})
+        log_context = LogContext('test', 1)
+        log_context.log_start_message()
+        with stubber:
+            client.publish(TopicArn='arn:aws:sns:us-east-1:123456789012:t', Message='m')
+
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            log_context.log_end_message(200, 'Success')
+        assert ' aws_calls.sns=1 aws_ms.sns=' in output.getvalue()
+
+    def test_rekognition_client_does_not_retry(self):
+        client = create_aws_client('rekognition')
+        assert client.meta.config.retries['mode'] == 'standard'
+        assert client.meta.config.retries['total_max_attempts'] == 1
+
+    def test_first_call_ttfb_recorded(self):
+        original_cold_start = aws_clients._cold_start
+        aws_clients._cold_start = ColdStartTracker(0)
+        try:
+            client = create_aws_client('sns')
+            stubber = Stubber(client)
+            stubber.add_response('publish', {'MessageId': 'id'})
+            stubber.add_response('publish', {'MessageId': 'id'})
+            with stubber:
+                for _ in range(2):
+                    client.publish(
+                        TopicArn='arn:aws:sns:us-east-1:123456789012:t', Message='m'
+                    )
+            fields = aws_clients._cold_start.take_fields()
+        finally:
+            aws_clients._cold_start = original_cold_start
+        assert fields.count(' ttfb_ms.sns=') == 1
@@ -0,0 +1,165 @@
+import json
+import os
+import tempfile
+import unittest
+
+from typing import List, Tuple
+
+import backfill
+
+from backfill import init_worker, read_checkpoint, run_backfill, score_lines
+from detect_all import DetectAllHandler
+
+
+def _request(image_url: str) -> dict:
+    return {
+        'ImageURL': image_url,
+        'PostID': 'post',
+        'AccountID': 'account',
+        'SourceDevice': 'iOS',
+        'CreatedTimestamp': '1572457843',
+    }
+
+
+def _fake_score_lines(lines: List[Tuple[int, bytes]]) -> dict:
+    """Fails the images named `retry`, and fails the whole chunk for `crash`,
+    as if the process had died.
+    """
+    result = {'processed': 0, 'invalid': 0, 'failed': 0, 'failed_lines': []}
+    for _, line in lines:
+        image_url = json.loads(line)['ImageURL']
+        if image_url == 'crash':
+            raise RuntimeError('crash')
+        if image_url == 'retry':
+            result['failed'] += 1
+            result['failed_lines'].append(line)
+        else:
+            result['processed'] += 1
+    return result
+
+
+class _FakeHandler:
+    def __init__(self, failures: bool):
+        self.failures = failures
+        self.events = []
+
+    def handle_request(self, event, context):
+        self.events.append(event)
+        if self.failures:
+            return {'batchItemFailures': [{'itemIdentifier': 'x'}]}
+        return {'statusCode': 200}
+
+
+class TestBackfill(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.input_path = os.path.join(self.directory.name, 'input.jsonl')
+        self.checkpoint_path = os.path.join(self.directory.name, 'checkpoint')
+
+    def tearDown(self):
+        self.directory.cleanup()
+        backfill._handler = None
+
+    def write_input(self, image_urls: List[str]):
+        with open(self.input_path, 'w') as f:
+            for image_url in image_urls:
+                f.write(json.dumps(_request(image_url)) + '\n')
+            f.write('\n')
+
+    def run_backfill(self, **kwargs) -> dict:
+        return run_backfill(
+            self.input_path,
+            2,
+            self.checkpoint_path,
+            chunk_lines=3,
+            score_chunk=_fake_score_lines,
+            **kwargs,
+        )
+
+    def test_scores_every_line(self):
+        self.write_input([f'image-{i}' for i in range(20)] + ['retry'])
+        failures_path = os.path.join(self.directory.name, 'failures.jsonl')
+
+        checkpoint = self.run_backfill(failures_path=failures_path)
+
+        assert checkpoint == {
+            'offset': os.path.getsize(self.input_path),
+            'processed': 20,
+            'invalid': 0,
+            'failed': 1,
+        }
+        assert read_checkpoint(self.checkpoint_path) == checkpoint
+        with open(failures_path) as f:
+            assert [json.loads(line)['ImageURL'] for line in f] == ['retry']
+
+    def test_resumes_from_checkpoint(self):
+        image_urls = [f'image-{i}' for i in range(10)]
+        self.write_input(image_urls[:6] + ['crash'] + image_urls[6:])
+
+        with self.assertRaises(RuntimeError):
+            self.run_backfill()
+        # The two chunks before the crash were committed.
+        checkpoint = read_checkpoint(self.checkpoint_path)
+        assert checkpoint['processed'] == 6
+        with open(self.input_path, 'rb') as f:
+            assert json.loads(f.read()[checkpoint['offset'] :].split(b'\n')[0]) == (
+                _request('crash')
+            )
+
+        # Skip past the crash, as a fixed scorer would.
+        with open(self.input_path) as f:
+            lines = f.readlines()
+        lines[6] = json.dumps(_request('fixed')) + '\n'
+        with open(self.input_path, 'w') as f:
+            f.writelines(lines)
+        checkpoint = self.run_backfill()
+        assert checkpoint['processed'] == 11
+        assert checkpoint['offset'] == os.path.getsize(self.input_path)
+
+    def test_score_lines_validates(self):
+        backfill._handler = _FakeHandler(failures=False)
+        lines = [
+            json.dumps(_request('image')).encode('utf-8'),
+            b'not json',
+            json.dumps({'ImageURL': 'image'}).encode('utf-8'),
+        ]
+
+        result = score_lines(list(enumerate(lines)))
+
+        assert result == {
+            'processed': 1,
+            'invalid': 2,
+            'failed': 0,
+            'failed_lines': [],
+        }
+        (event,) = backfill._handler.events
+        message = json.loads(event['Records'][0]['Sns']['Message'])
+        assert message['ImageURL'] == 'image'
+        assert message['RootTraceID'] == event['Records'][0]['Sns']['MessageId']
+
+    def test_score_lines_failures(self):
+        backfill._handler = _FakeHandler(failures=True)
+        line = json.dumps(_request('image')).encode('utf-8')
+        result = score_lines([(0, line)])
+        assert result['failed'] == 1
+        assert result['failed_lines'] == [line + b'\n']
+
+    def test_requires_durable_score_store(self):
+        self.write_input(['image'])
+        with self.assertRaises(ValueError):
+            run_backfill(self.input_path, 1, self.checkpoint_path)
+        with self.assertRaises(ValueError):
+            run_backfill(
+                self.input_path,
+                1,
+                self.checkpoint_path,
+                score_store_backend='memory',
+                score_store_path='unused',
+            )
+        assert not os.path.exists(self.checkpoint_path)
+
+    def test_init_worker(self):
+        path = os.path.join(self.directory.name, 'scores.db')
+        init_worker('sqlite', path)
+        assert isinstance(backfill._handler, DetectAllHandler)
+        assert os.path.exists(path)
@@ -0,0 +1,61 @@
+import os
+import tempfile
+import unittest
+
+from dedup_store import InMemoryDedupStore, SqliteDedupStore, create_dedup_store
+
+from tests.unit.fakes import FakeClock
+
+
+class TestDedupStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'dedup.db')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_contains_any(self):
+        for store in [InMemoryDedupStore(), SqliteDedupStore(self.path)]:
+            assert not store.contains_any(['a', 'b'])
+            store.add(['a', 'b'])
+            assert store.contains_any(['b', 'c'])
+            assert not store.contains_any(['c'])
+            assert not store.contains_any([])
+
+    def test_keys_expire(self):
+        clock = FakeClock()
+        store = InMemoryDedupStore(ttl_seconds=10, clock=clock)
+        store.add(['a'])
+        clock.now += 5
+        store.add(['b'])
+
+        clock.now += 6
+        assert not store.contains_any(['a'])
+        assert store.contains_any(['b'])
+        assert len(store) == 1
+
+    def test_bounded_entries(self):
+        store = InMemoryDedupStore(max_entries=2)
+        store.add(['a'])
+        store.add(['b'])
+        store.add(['c'])
+
+        assert len(store) == 2
+        assert not store.contains_any(['a'])
+        assert store.contains_any(['b'])
+
+    def test_sqlite_is_shared(self):
+        SqliteDedupStore(self.path).add(['a'])
+        assert SqliteDedupStore(self.path).contains_any(['a'])
+
+        expired = SqliteDedupStore(self.path, ttl_seconds=-1, prune_interval=1)
+        expired.add(['b'])
+        assert not expired.contains_any(['b'])
+
+    def test_create_dedup_store(self):
+        assert isinstance(create_dedup_store('memory'), InMemoryDedupStore)
+        with self.assertRaises(ValueError):
+            create_dedup_store('sqlite')
+        with self.assertRaises(ValueError):
+            create_dedup_store('redis')
@@ -0,0 +1,149 @@
+import json
+import unittest
+
+from detect_all import DetectAllHandler
+from lambda_common import DetectionHandler, RekognitionError
+from score_store import InMemoryScoreStore
+from update_spam_score import is_verdict_final
+
+from tests.unit.fakes import FakeContext
+
+
+class _FixedScorer(DetectionHandler):
+    def __init__(self, name, score, cost_order=100):
+        super().__init__(name)
+        self.score = score
+        self.COST_ORDER = cost_order
+        self.image_contexts = []
+
+    def _score_image(self, image_payload):
+        self.image_contexts.append(self._get_image_context(image_payload))
+        if isinstance(self.score, Exception):
+            raise self.score
+        return self.score
+
+
+def _event():
+    message = json.dumps(
+        {
+            'ImageURL': 's3://bucket/image.png',
+            'PostID': 'post',
+            'AccountID': 'account',
+            'SourceDevice': 'iOS',
+            'CreatedTimestamp': '1',
+            'RootTraceID': 'root',
+        }
+    )
+    return {'Records': [{'Sns': {'MessageId': 'message', 'Message': message}}]}
+
+
+class TestDetectAllHandler(unittest.TestCase):
+    def test_all_scores_updated_together(self):
+        store = InMemoryScoreStore()
+        scorers = [_FixedScorer('a', 0.1), _FixedScorer('b', 0.9), _FixedScorer('c', 0)]
+
+        response = DetectAllHandler(scorers, score_store=store).handle_request(
+            _event(), FakeContext()
+        )
+
+        assert response['batchItemFailures'] == []
+        assert store.get_scores('account', 's3://bucket/image.png') == {
+            'a': 0.1,
+            'b': 0.9,
+            'c': 0,
+        }
+        # The scorers read the image through the same context.
+        assert len({id(scorer.image_contexts[0]) for scorer in scorers}) == 1
+
+    def test_failed_scorer_keeps_other_scores(self):
+        store = InMemoryScoreStore()
+        scorers = [
+            _FixedScorer('a', 0.1),
+            _FixedScorer('b', RekognitionError(400, 'bad image')),
+        ]
+
+        response = DetectAllHandler(scorers, score_store=store).handle_request(
+            _event(), FakeContext()
+        )
+
+        # Rekognition errors are not retriable.
+        assert response['batchItemFailures'] == []
+        assert response['statusCode'] == 200
+        assert store.get_scores('account', 's3://bucket/image.png') == {'a': 0.1}
+
+    def test_cascade_skips_once_verdict_final(self):
+        store = InMemoryScoreStore()
+        scorers = [
+            _FixedScorer('text', 0.1, cost_order=2),
+            _FixedScorer('moderation', 0.9, cost_order=1),
+            _FixedScorer('hash', RekognitionError(500, 'failed'), cost_order=0),
+        ]
+
+        response = DetectAllHandler(
+            scorers, score_store=store, cascade=True
+        ).handle_request(_event(), FakeContext())
+
+        # The failed hash stage could not have changed the verdict, so the
+        # record is not retried.
+        assert response['batchItemFailures'] == []
+        assert store.get_scores('account', 's3://bucket/image.png') == {
+            'moderation': 0.9
+        }
+        assert [len(scorer.image_contexts) for scorer in scorers] == [0, 1, 1]
+
+    def test_cascade_failure_ignored_once_last_stage_finds_spam(self):
+        store = InMemoryScoreStore()
+        scorers = [
+            _FixedScorer(
+                'hash', RekognitionError(429, 'throttled', is_retriable=True), 0
+            ),
+            _FixedScorer('moderation', 0.9, cost_order=1),
+        ]
+
+        response = DetectAllHandler(
+            scorers, score_store=store, cascade=True
+        ).handle_request(_event(), FakeContext())
+
+        assert response['batchItemFailures'] == []
+        assert store.get_scores('account', 's3://bucket/image.png') == {
+            'moderation': 0.9
+        }
+
+    def test_cascade_failure_retried_if_image_may_be_spam(self):
+        scorers = [
+            _FixedScorer(
+                'hash', RekognitionError(429, 'throttled', is_retriable=True), 0
+            ),
+            _FixedScorer('moderation', 0.1, cost_order=1),
+        ]
+
+        response = DetectAllHandler(
+            scorers, score_store=InMemoryScoreStore(), cascade=True
+        ).handle_request(_event(), FakeContext())
+
+        assert response['batchItemFailures'] == [{'itemIdentifier': 'message'}]
+
+    def test_cascade_runs_every_stage_for_clean_images(self):
+        store = InMemoryScoreStore()
+        scorers = [
+            _FixedScorer('text', 0.2, cost_order=2),
+            _FixedScorer('hash', 0, cost_order=0),
+            _FixedScorer('moderation', 0.5, cost_order=1),
+        ]
+
+        DetectAllHandler(scorers, score_store=store, cascade=True).handle_request(
+            _event(), FakeContext()
+        )
+
+        assert store.get_scores('account', 's3://bucket/image.png') == {
+            'hash': 0,
+            'moderation': 0.5,
+            'text': 0.2,
+        }
+
+    def test_is_verdict_final(self):
+        assert is_verdict_final({'a': 0.1}, [])
+        assert not is_verdict_final({'a': 0.7}, ['b'])
+        assert is_verdict_final({'a': 0.8}, ['b'])
+        # A score that is about to be replaced does not settle the verdict.
+        assert not is_verdict_final({'a': 0.1, 'b': 0.9}, ['b'])
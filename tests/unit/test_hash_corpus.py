@@ -0,0 +1,40 @@
+import os
+import tempfile
+import unittest
+
+from hash_corpus import CorpusFormatError, HashCorpus, write_hash_corpus
+
+
+class TestHashCorpus(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'corpus.bin')
+        self.entries = [(2 ** 64 - 1, 'last'), (5, 'five'), (0, 'zero'), (42, 'ünï')]
+        write_hash_corpus(self.path, self.entries, algorithm='ahash')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_header(self):
+        corpus = HashCorpus(self.path)
+        assert corpus.version == 1
+        assert corpus.algorithm == 'ahash'
+        assert corpus.hash_size == 64
+        assert len(corpus) == 4
+
+    def test_entries_are_sorted(self):
+        corpus = HashCorpus(self.path)
+        assert list(corpus.hashes) == [0, 5, 42, 2 ** 64 - 1]
+        assert list(corpus.image_ids) == ['zero', 'five', 'ünï', 'last']
+
+    def test_find_exact(self):
+        corpus = HashCorpus(self.path)
+        assert corpus.find_exact(42) == 'ünï'
+        assert corpus.find_exact(2 ** 64 - 1) == 'last'
+        assert corpus.find_exact(6) is None
+
+    def test_invalid_file(self):
+        with open(self.path, 'wb') as file:
+            file.write(b'not a corpus file at all' * 4)
+        with self.assertRaises(CorpusFormatError):
+            HashCorpus(self.path)
@@ -0,0 +1,80 @@
+import random
+import threading
+import time
+import unittest
+
+from concurrent.futures import ThreadPoolExecutor
+
+from hash_index import MultiIndexHashIndex, create_hash_index, hamming_distance
+
+
+class _SlowMultiIndexHashIndex(MultiIndexHashIndex):
+    """Counts how many times each entry is indexed, and indexes slowly enough
+    for concurrent first queries to overlap."""
+
+    def __init__(self, hashes, image_ids):
+        super().__init__(hashes, image_ids, chunk_count=2)
+        self.index_counts = [0] * len(hashes)
+
+    def _index_position(self, position: int):
+        self.index_counts[position] += 1
+        time.sleep(0.0001)
+        super()._index_position(position)
+
+
+class TestHashIndex(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(7)
+        self.hashes = [rng.getrandbits(64) for _ in range(500)]
+        self.image_ids = [f"image-{i}" for i in range(len(self.hashes))]
+
+    def __create_index(self, backend):
+        index = create_hash_index(backend)
+        for hash_value, image_id in zip(self.hashes, self.image_ids):
+            index.add(hash_value, image_id)
+        return index
+
+    def test_hamming_distance(self):
+        assert hamming_distance(0b1011, 0b0001) == 2
+        assert hamming_distance(2 ** 64 - 1, 0) == 64
+
+    def test_find_closest_matches_linear_scan(self):
+        rng = random.Random(11)
+        for backend in ('mih', 'bktree'):
+            index = self.__create_index(backend)
+            for _ in range(100):
+                target = self.hashes[rng.randrange(len(self.hashes))]
+                for bit in rng.sample(range(64), rng.randint(0, 10)):
+                    target ^= 1 << bit
+
+                distances = [hamming_distance(h, target) for h in self.hashes]
+                best = min(range(len(distances)), key=lambda i: distances[i])
+                expected = (None, None)
+                if distances[best] <= 8:
+                    expected = (self.hashes[best], self.image_ids[best])
+
+                assert index.find_closest(target, 8) == expected
+
+    def test_concurrent_first_queries(self):
+        index = _SlowMultiIndexHashIndex(self.hashes, self.image_ids)
+        # 5 bits away, which is only found with a chunk radius of 2.
+        target = self.hashes[42] ^ 0b11111
+        start = threading.Barrier(8)
+
+        def query(_):
+            start.wait()
+            return index.find_closest(target, 5)
+
+        with ThreadPoolExecutor(8) as executor:
+            results = list(executor.map(query, range(8)))
+
+        assert results == [(self.hashes[42], 'image-42')] * 8
+        assert index.index_counts == [1] * len(self.hashes)
+
+    def test_empty_index(self):
+        for backend in ('mih', 'bktree'):
+            assert create_hash_index(backend).find_closest(123, 8) == (None, None)
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            create_hash_index('does-not-exist')
@@ -0,0 +1,49 @@
+import random
+import unittest
+
+from array import array
+
+import numpy as np
+
+import hash_scan
+from hash_index import create_hash_index, hamming_distance
+
+
+class TestVectorizedScanHashIndex(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(3)
+        self.hashes = array('Q', (rng.getrandbits(64) for _ in range(300)))
+        self.image_ids = [f"image-{i}" for i in range(len(self.hashes))]
+        self.index = create_hash_index(
+            'scan', hashes=self.hashes, image_ids=self.image_ids
+        )
+        self.queries = [rng.getrandbits(64) for _ in range(10)]
+
+    def test_popcount(self):
+        values = np.array([0, 1, 0xFF, 2 ** 64 - 1], dtype=np.uint64)
+        assert hash_scan.popcount(values).tolist() == [0, 1, 8, 64]
+
+    def test_find_closest_matches_mih(self):
+        mih = create_hash_index('mih', hashes=self.hashes, image_ids=self.image_ids)
+        for query in list(self.hashes[:10]) + self.queries:
+            assert self.index.find_closest(query, 8) == mih.find_closest(query, 8)
+
+    def test_top_k(self):
+        distances, positions = self.index.top_k(self.queries, 3)
+        assert distances.shape == (10, 3)
+        for query, row_distances, row_positions in zip(
+            self.queries, distances, positions
+        ):
+            expected = sorted(
+                (hamming_distance(query, h), i) for i, h in enumerate(self.hashes)
+            )[:3]
+            assert list(zip(row_distances.tolist(), row_positions.tolist())) == expected
+
+    def test_add_after_query(self):
+        self.index.find_closest(0, 0)
+        self.index.add(12345, 'new-image')
+        assert self.index.find_closest(12345, 0) == (12345, 'new-image')
+
+    def test_auto_uses_scan(self):
+        index = create_hash_index('auto', hashes=self.hashes, image_ids=self.image_ids)
+        assert isinstance(index, hash_scan.VectorizedScanHashIndex)
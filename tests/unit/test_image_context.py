@@ -0,0 +1,120 @@
+import contextlib
+import io
+import threading
+import unittest
+
+from PIL import Image
+
+import image_context
+import image_decode
+import lambda_common
+from image_context import ImageContext
+from lambda_common import ImageLimitError, ImagePayload
+
+
+class _FakeImageS3Client:
+    def __init__(self, data):
+        self.data = data
+        self.calls = []
+
+    def get_object(self, Bucket, Key):
+        self.calls.append('get_object')
+        return {
+            'Body': io.BytesIO(self.data),
+            'ETag': '"etag"',
+            'ContentLength': len(self.data),
+        }
+
+    def head_object(self, Bucket, Key):
+        self.calls.append('head_object')
+        return {'ETag': '"etag"', 'ContentLength': len(self.data)}
+
+
+class _FakeRekognitionClient:
+    def __init__(self):
+        self.calls = 0
+
+    def detect_text(self, Image):
+        self.calls += 1
+        return {'TextDetections': [{'DetectedText': 'red'}]}
+
+
+class TestImageContext(unittest.TestCase):
+    def setUp(self):
+        self.original_s3 = image_context._s3
+        self.original_rekognition = lambda_common._rekognition_client
+        output = io.BytesIO()
+        Image.new('RGB', (64, 32), (200, 10, 10)).save(output, format='PNG')
+        image_context._s3 = _FakeImageS3Client(output.getvalue())
+        lambda_common._rekognition_client = _FakeRekognitionClient()
+        self.image_payload = ImagePayload(
+            "s3://bucket/image.png", "post", "account", "iOS", "1", "root"
+        )
+        ImageContext.clear_shared()
+
+    def tearDown(self):
+        image_context._s3 = self.original_s3
+        lambda_common._rekognition_client = self.original_rekognition
+        ImageContext.clear_shared()
+
+    def test_fetches_and_decodes_once(self):
+        context = ImageContext.for_payload(self.image_payload)
+        threads = [
+            threading.Thread(target=context.grayscale_thumbnail, args=(8,))
+            for _ in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        thumbnail = context.grayscale_thumbnail(8)
+        assert thumbnail.size == (8, 8)
+        assert thumbnail.mode == 'L'
+        assert context.image().size == (64, 32)
+        assert context.etag() == 'etag'
+        assert image_context._s3.calls == ['get_object']
+
+    def test_etag_without_fetch(self):
+        assert ImageContext.for_payload(self.image_payload).etag() == 'etag'
+        assert image_context._s3.calls == ['head_object']
+
+    def test_shared_by_process(self):
+        log_context = lambda_common.LogContext('test', 1)
+        first = ImageContext.for_payload(self.image_payload)
+        second = ImageContext.for_payload(self.image_payload)
+
+        assert first is second
+        assert first.text_detections(log_context) == [{'DetectedText': 'red'}]
+        assert second.text_detections(log_context) == [{'DetectedText': 'red'}]
+        assert lambda_common._rekognition_client.calls == 1
+
+    def test_identical_requests_coalesced(self):
+        log_context = lambda_common.LogContext('test', 1)
+        log_context.log_start_message()
+        # Separate contexts, as when a detect_all Lambda and a detect_spammy_words
+        # Lambda in the same container score the same image.
+        for _ in range(3):
+            context = ImageContext(self.image_payload)
+            assert context.text_detections(log_context) == [{'DetectedText': 'red'}]
+            context.image_bytes(log_context)
+
+        # S3 results are only shared while in flight, since the contexts keep
+        # the fetched images.
+        assert lambda_common._rekognition_client.calls == 1
+        assert image_context._s3.calls == ['get_object'] * 3
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            log_context.log_end_message(200, 'Success')
+        assert ' coalesced.rekognition=2' in output.getvalue()
+        assert ' coalesced.s3=' not in output.getvalue()
+
+    def test_image_limits(self):
+        original_limits = image_decode.ENVIRONMENT_LIMITS
+        image_decode.ENVIRONMENT_LIMITS = image_decode.DecodeLimits(max_bytes=10)
+        try:
+            with self.assertRaises(ImageLimitError) as raised:
+                ImageContext.for_payload(self.image_payload).grayscale_thumbnail(8)
+        finally:
+            image_decode.ENVIRONMENT_LIMITS = original_limits
+        assert not raised.exception.is_retriable
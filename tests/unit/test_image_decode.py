@@ -0,0 +1,52 @@
+import io
+import unittest
+
+from PIL import Image
+
+from image_decode import DecodeLimits, ImageTooLargeError, decode_reduced, read_limited
+
+
+def _encode(image, image_format: str) -> bytes:
+    output = io.BytesIO()
+    image.save(output, image_format)
+    return output.getvalue()
+
+
+class TestReadLimited(unittest.TestCase):
+    def test_reads_within_limit(self):
+        data = bytes(range(256)) * 5000
+        read = read_limited(io.BytesIO(data), len(data))
+        assert isinstance(read, bytes)
+        assert read == data
+
+    def test_rejects_oversized_streams(self):
+        limits = DecodeLimits(max_bytes=1000)
+        stream = io.BytesIO(bytes(1001))
+        # Refused up front when the length is known.
+        with self.assertRaises(ImageTooLargeError):
+            read_limited(stream, 1001, limits)
+        assert stream.tell() == 0
+        # Otherwise refused once the limit is passed.
+        with self.assertRaises(ImageTooLargeError):
+            read_limited(stream, limits=limits)
+
+
+class TestDecodeReduced(unittest.TestCase):
+    def test_jpeg_decoded_at_reduced_size(self):
+        data = _encode(Image.new('RGB', (2048, 1024), (200, 50, 50)), 'JPEG')
+        image = decode_reduced(data, (64, 64), 'L')
+        assert image.mode == 'L'
+        assert 64 <= image.height < 128
+        assert image.width == 2 * image.height
+
+    def test_formats_without_draft_support(self):
+        for mode in ('RGB', 'P'):
+            data = _encode(Image.new(mode, (1000, 300)), 'PNG')
+            image = decode_reduced(data, (64, 64), 'L')
+            assert image.mode == 'L'
+            assert 64 <= image.height < 128
+
+    def test_pixel_limit(self):
+        data = _encode(Image.new('L', (1000, 1000)), 'PNG')
+        with self.assertRaises(ImageTooLargeError):
+            decode_reduced(data, (8, 8), 'L', DecodeLimits(max_pixels=999999))
@@ -1,7 +1,38 @@
+import contextlib
+import contextvars
+import io
+import os
 import unittest
 import json
 
-from lambda_common import S3Url, ImagePayload
+from botocore.exceptions import ClientError
+
+import lambda_common
+import sns_publisher
+from dedup_store import InMemoryDedupStore
+from log_emitter import DeadlineFlusher, LogEmitter
+from payload_codec import MSGPACK_V1, PayloadCodec
+from rate_limiter import AdaptiveRateLimiter
+from lambda_common import (
+    S3Url,
+    ImagePayload,
+    InvalidJSON,
+    MissingRequiredField,
+    RekognitionError,
+    SnsReceiveError,
+    Span,
+    UpdateSpamScorePayload,
+    handle_sns_records,
+    parse_json,
+)
+
+from tests.unit.fakes import (
+    CountingHandler,
+    FakeClock,
+    FakeContext,
+    FakeSnsClient,
+    sns_record,
+)
 
 
 class TestS3URL(unittest.TestCase):
@@ -13,6 +44,12 @@ class TestS3URL(unittest.TestCase):
         assert self.s3_url.key == "path/file.jpeg"
         assert self.s3_url.url == "s3://bucket/path/file.jpeg"
 
+    def test_version_id(self):
+        s3_url = S3Url('s3://bucket/path/file.jpeg?versionId=v1')
+        assert s3_url.key == 'path/file.jpeg'
+        assert s3_url.version_id == 'v1'
+        assert S3Url('s3://bucket/path/file.jpeg').version_id is None
+
 
 class TestImagePayload(unittest.TestCase):
     def setUp(self):
@@ -35,3 +72,319 @@ class TestImagePayload(unittest.TestCase):
             "RootTraceID": "Root=1-5dc424fe-34aaedd01ccd08b4a54a3bd8",
         }
         assert json.loads(self.image_payload.to_json()) == __json
+
+    def test_update_spam_score_payload_round_trip(self):
+        payload = UpdateSpamScorePayload(self.image_payload, 'scorer', 0.5, 'trace')
+        parsed = UpdateSpamScorePayload.from_json(payload.to_json())
+        assert parsed.to_dict() == payload.to_dict()
+        assert not hasattr(parsed, '__dict__')
+
+    def test_nested_image_payload_validated(self):
+        message = json.dumps(
+            {
+                'ImagePayload': {'ImageURL': 's3://bucket/key'},
+                'Scorer': 'scorer',
+                'Score': 0.5,
+                'ScorerTraceID': 'trace',
+            }
+        )
+        with self.assertRaises(MissingRequiredField):
+            UpdateSpamScorePayload.from_json(message)
+        with self.assertRaises(InvalidJSON):
+            ImagePayload.from_json('[]')
+
+    def test_envelopes_only_decoded_for_sns_messages(self):
+        message = PayloadCodec(MSGPACK_V1).encode(self.image_payload.to_dict())
+        assert ImagePayload.from_json(message).to_dict() == (
+            self.image_payload.to_dict()
+        )
+        with self.assertRaises(MissingRequiredField):
+            parse_json(message, required_fields=ImagePayload.REQUIRED_FIELDS)
+
+
+class TestHandleSnsRecords(unittest.TestCase):
+    def test_all_records_processed(self):
+        handled = []
+        event = {'Records': [sns_record('m1', 'a'), sns_record('m2', 'b')]}
+
+        response = handle_sns_records(
+            event,
+            FakeContext(),
+            lambda record, trace_id: handled.append(
+                (record['Sns']['Message'], trace_id)
+            ),
+            'done',
+        )
+
+        assert handled == [('a', 'request-id-0'), ('b', 'request-id-1')]
+        assert response['statusCode'] == 200
+        assert response['body'] == 'done'
+        assert response['batchItemFailures'] == []
+
+    def test_failures_are_isolated(self):
+        handled = []
+
+        def handle_record(record, _trace_id):
+            message = record['Sns']['Message']
+            if message == 'retry':
+                raise SnsReceiveError('try again')
+            if message == 'bad':
+                raise InvalidJSON('not json')
+            handled.append(message)
+
+        event = {
+            'Records': [
+                sns_record('m1', 'retry'),
+                sns_record('m2', 'ok'),
+                sns_record('m3', 'bad'),
+            ]
+        }
+        response = handle_sns_records(event, FakeContext(), handle_record, 'done')
+
+        assert handled == ['ok']
+        assert response['statusCode'] == 500
+        assert 'Failed 2 of 3 records' in response['body']
+        # Only the retriable failure should be redelivered.
+        assert response['batchItemFailures'] == [{'itemIdentifier': 'm1'}]
+
+    def test_single_record_keeps_request_id_as_trace(self):
+        trace_ids = []
+        handle_sns_records(
+            {'Records': [sns_record('m1', 'a')]},
+            FakeContext(),
+            lambda _record, trace_id: trace_ids.append(trace_id),
+            'done',
+        )
+        assert trace_ids == ['request-id']
+
+
+class _ThrottlingRekognitionClient:
+    """Throttles the first `throttles` calls."""
+
+    def __init__(self, throttles: int):
+        self.throttles = throttles
+        self.calls = 0
+
+    def detect_text(self, Image):
+        self.calls += 1
+        if self.calls <= self.throttles:
+            raise ClientError(
+                {
+                    'Error': {'Code': 'ProvisionedThroughputExceededException'},
+                    'ResponseMetadata': {'HTTPStatusCode': 400},
+                },
+                'DetectText',
+            )
+        return {'TextDetections': [{'DetectedText': 'red'}]}
+
+
+class _FailingRekognitionClient:
+    """Fails every call with the status code."""
+
+    def __init__(self, status_code: int):
+        self.status_code = status_code
+        self.calls = 0
+
+    def detect_text(self, Image):
+        self.calls += 1
+        raise ClientError(
+            {
+                'Error': {'Code': 'InternalServerError'},
+                'ResponseMetadata': {'HTTPStatusCode': self.status_code},
+            },
+            'DetectText',
+        )
+
+
+class TestRekognitionRateLimit(unittest.TestCase):
+    def setUp(self):
+        self.original_rekognition = lambda_common._rekognition_client
+        self.original_limiters = lambda_common._rekognition_rate_limiters
+        self.original_max_wait_s = lambda_common._REKOGNITION_MAX_WAIT_S
+        lambda_common._rekognition_rate_limiters = {
+            'detect_text': AdaptiveRateLimiter('detect_text', 50, base_backoff_s=0.01)
+        }
+        lambda_common.clear_single_flights()
+
+    def tearDown(self):
+        lambda_common._rekognition_client = self.original_rekognition
+        lambda_common._rekognition_rate_limiters = self.original_limiters
+        lambda_common._REKOGNITION_MAX_WAIT_S = self.original_max_wait_s
+        lambda_common.clear_single_flights()
+
+    def detect_text(self) -> str:
+        log_context = lambda_common.LogContext('test', 1)
+        log_context.log_start_message()
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            try:
+                lambda_common.rekognition(
+                    log_context,
+                    detect_text={'S3Object': {'Bucket': 'bucket', 'Name': 'a.png'}},
+                )
+            finally:
+                log_context.log_end_message(200, 'Success')
+        return output.getvalue()
+
+    def test_throttled_call_retried(self):
+        lambda_common._rekognition_client = _ThrottlingRekognitionClient(2)
+
+        output = self.detect_text()
+
+        assert lambda_common._rekognition_client.calls == 3
+        assert ' throttled.rekognition=2' in output
+        # Concurrent throttles only decrease the rate once.
+        rate = lambda_common._rekognition_rate_limiters['detect_text'].rate
+        assert 34 < rate < 36
+
+    def test_throttle_retriable_once_out_of_time(self):
+        lambda_common._rekognition_client = _ThrottlingRekognitionClient(100)
+        lambda_common._REKOGNITION_MAX_WAIT_S = 0
+
+        with self.assertRaises(RekognitionError) as raised:
+            self.detect_text()
+
+        assert raised.exception.is_retriable
+        assert lambda_common._rekognition_client.calls == 1
+
+    def test_server_error_retriable_without_retrying(self):
+        lambda_common._rekognition_client = _FailingRekognitionClient(500)
+
+        with self.assertRaises(RekognitionError) as raised:
+            self.detect_text()
+
+        assert raised.exception.is_retriable
+        assert lambda_common._rekognition_client.calls == 1
+
+
+class TestDetectionHandlerDedup(unittest.TestCase):
+    def setUp(self):
+        self.original_sns = sns_publisher._sns
+        os.environ['SNS_UPDATE_SPAM_SCORE_TOPIC_ARN'] = 'arn:topic'
+        self.handler = CountingHandler(dedup_store=InMemoryDedupStore())
+
+    def tearDown(self):
+        sns_publisher._sns = self.original_sns
+        del os.environ['SNS_UPDATE_SPAM_SCORE_TOPIC_ARN']
+
+    @staticmethod
+    def __event(message_id, root_trace_id='root'):
+        payload = ImagePayload(
+            "s3://bucket/image.png", "post", "account", "iOS", "1", root_trace_id
+        )
+        return {'Records': [sns_record(message_id, payload.to_json())]}
+
+    def test_redelivery_skipped(self):
+        sns_publisher._sns = FakeSnsClient()
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.handler.handle_request(self.__event('m1'), FakeContext())
+            response = self.handler.handle_request(self.__event('m1'), FakeContext())
+            # The same image republished under a new MessageId.
+            self.handler.handle_request(self.__event('m2'), FakeContext())
+            self.handler.handle_request(self.__event('m3', 'other'), FakeContext())
+
+        assert response['statusCode'] == 200
+        assert self.handler.calls == 2
+        assert len(sns_publisher._sns.batches) == 2
+        assert output.getvalue().count('duplicates=1') == 2
+
+    def test_failed_publish_not_recorded(self):
+        sns_publisher._sns = FakeSnsClient(failed_ids={'0'})
+        with contextlib.redirect_stdout(io.StringIO()):
+            response = self.handler.handle_request(self.__event('m1'), FakeContext())
+            assert response['batchItemFailures'] == [{'itemIdentifier': 'm1'}]
+
+            sns_publisher._sns = FakeSnsClient()
+            response = self.handler.handle_request(self.__event('m1'), FakeContext())
+
+        assert response['batchItemFailures'] == []
+        assert self.handler.calls == 2
+
+
+class TestLogContext(unittest.TestCase):
+    def setUp(self):
+        self.stream = io.StringIO()
+        self.original_emitter = lambda_common._log_emitter
+        lambda_common._log_emitter = LogEmitter(stream=self.stream)
+
+    def tearDown(self):
+        lambda_common._log_emitter = self.original_emitter
+
+    def test_start_and_errors_written_at_once(self):
+        log_context = lambda_common.LogContext('test', 1, current_trace='trace')
+        log_context.log_start_message()
+        assert self.stream.getvalue().startswith('START Lambda execution: ')
+
+        log_context.log('buffered')
+        try:
+            raise ValueError('bad')
+        except ValueError as e:
+            log_context.log_error('failed', e)
+        lines = self.stream.getvalue().splitlines()
+        assert lines[1].startswith('buffered trace=trace ')
+        assert lines[2].startswith('[ERROR] failed trace=trace ')
+        assert lines[-1] == 'ValueError: bad'
+
+    def test_flushed_at_deadline(self):
+        clock = FakeClock()
+        original_flusher = lambda_common._deadline_flusher
+        lambda_common._deadline_flusher = DeadlineFlusher(clock=clock)
+        deadline = lambda_common._invocation_deadline.set(clock.now + 60)
+        try:
+            log_context = lambda_common.LogContext('test', 1, current_trace='trace')
+            log_context.log_start_message()
+            log_context.log('buffered')
+            clock.sleep(60)
+            lambda_common._deadline_flusher.flush_due()
+        finally:
+            lambda_common._invocation_deadline.reset(deadline)
+            lambda_common._deadline_flusher = original_flusher
+        lines = self.stream.getvalue().splitlines()
+        assert lines[1:] == [
+            f"buffered trace=trace version={lambda_common._PIPELINE_LAMBDA_VERSION}",
+            '[ERROR] Flushing the logs of an unfinished invocation',
+        ]
+
+
+class TestSpan(unittest.TestCase):
+    def setUp(self):
+        self.stream = io.StringIO()
+        self.original_emitter = lambda_common._log_emitter
+        lambda_common._log_emitter = LogEmitter(
+            detail_sample_rate=1, stream=self.stream
+        )
+
+    def tearDown(self):
+        lambda_common._log_emitter = self.original_emitter
+
+    def test_nested_spans(self):
+        log_context = lambda_common.LogContext('test', 1, current_trace='trace')
+        with log_context.span('outer') as outer:
+            with log_context.span('inner') as inner:
+                assert inner.parent is outer
+            # Spans started in other threads from a copy of the context are
+            # children of the span that was open.
+            child = contextvars.copy_context().run(lambda: Span('child').__enter__())
+            assert child.parent is outer
+        assert outer.parent is None
+        assert outer.duration_ms >= inner.duration_ms
+
+        log_context.log_end_message(200, 'Success')
+        lines = self.stream.getvalue().splitlines()
+        assert lines[0] == (
+            f"span name=inner span_id={inner.span_id} "
+            f"parent_span_id={outer.span_id} duration_ms={round(inner.duration_ms, 2)} "
+            f"status=ok trace=trace version={lambda_common._PIPELINE_LAMBDA_VERSION}"
+        )
+        assert lines[1].startswith(
+            f"span name=outer span_id={outer.span_id} parent_span_id=None "
+        )
+
+    def test_failed_span(self):
+        log_context = lambda_common.LogContext('test', 1, current_trace='trace')
+        with self.assertRaises(ValueError):
+            with log_context.span('failing'):
+                raise ValueError()
+        log_context.log_end_message(500, 'Failed')
+        assert ' status=error ' in self.stream.getvalue()
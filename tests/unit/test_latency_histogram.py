@@ -0,0 +1,47 @@
+import random
+import unittest
+
+from unittest import mock
+
+from latency_histogram import LatencyHistogram, LatencyHistograms
+
+
+class TestLatencyHistogram(unittest.TestCase):
+    def test_percentiles_within_relative_error(self):
+        rng = random.Random(7)
+        latencies = sorted(rng.lognormvariate(3, 1) for _ in range(10000))
+        histogram = LatencyHistogram(relative_error=0.02)
+        for latency in latencies:
+            histogram.record(latency)
+
+        assert histogram.count == len(latencies)
+        for fraction in (0.5, 0.9, 0.99):
+            expected = latencies[int(fraction * len(latencies)) - 1]
+            assert abs(histogram.percentile(fraction) - expected) <= 0.03 * expected
+
+    def test_out_of_range_latencies(self):
+        histogram = LatencyHistogram()
+        histogram.record(0)
+        histogram.record(10 ** 9)
+        assert histogram.percentile(0.5) > 0
+        assert histogram.percentile(1) == 10 ** 9
+
+    def test_empty(self):
+        assert LatencyHistogram().percentile(0.5) == 0
+
+
+class TestLatencyHistograms(unittest.TestCase):
+    def test_summary_due_after_interval(self):
+        with mock.patch('time.monotonic', return_value=100.0):
+            histograms = LatencyHistograms(summary_interval_s=60)
+            histograms.record('s3.get_object', 10)
+            histograms.record('s3.get_object', 20)
+            assert histograms.take_summary_if_due() is None
+
+        with mock.patch('time.monotonic', return_value=160.0):
+            summary = histograms.take_summary_if_due()
+            assert list(summary) == ['s3.get_object']
+            assert summary['s3.get_object']['count'] == 2
+            assert summary['s3.get_object']['max_ms'] == 20
+            # A new window has started.
+            assert histograms.take_summary_if_due() is None
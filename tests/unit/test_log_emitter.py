@@ -0,0 +1,71 @@
+import io
+import json
+import unittest
+
+from log_emitter import DEBUG, INFO, DeadlineFlusher, LogEmitter
+
+from tests.unit.fakes import FakeClock
+
+
+class _CountingStream(io.StringIO):
+    def __init__(self):
+        super().__init__()
+        self.writes = 0
+
+    def write(self, text):
+        self.writes += 1
+        return super().write(text)
+
+
+class TestLogEmitter(unittest.TestCase):
+    def test_buffer_written_once(self):
+        stream = _CountingStream()
+        buffer = LogEmitter(detail_sample_rate=0, stream=stream).new_buffer('trace')
+        buffer.add_line('START')
+        buffer.add_event(INFO, 'kept', {'a': 1})
+        buffer.add_event(DEBUG, 'dropped', {'a': 2})
+        buffer.add_line('END')
+        assert stream.writes == 0
+
+        buffer.flush()
+        assert stream.writes == 1
+        assert stream.getvalue() == 'START\nkept a=1\nEND\n'
+
+    def test_json_format(self):
+        emitter = LogEmitter(log_format='json')
+        line = emitter.format_event('event', {'a': 1, 'trace': 't'})
+        assert json.loads(line) == {'message': 'event', 'a': 1, 'trace': 't'}
+
+    def test_detail_sampling_is_deterministic(self):
+        emitter = LogEmitter(detail_sample_rate=0.1)
+        traces = [f'trace-{i}' for i in range(10000)]
+        detailed = [trace for trace in traces if emitter.is_detailed(trace)]
+
+        assert 800 < len(detailed) < 1200
+        assert all(emitter.is_detailed(trace) for trace in detailed)
+        assert emitter.new_buffer(detailed[0]).is_enabled(DEBUG)
+        assert not LogEmitter(detail_sample_rate=0).new_buffer('t').is_enabled(DEBUG)
+
+
+class TestDeadlineFlusher(unittest.TestCase):
+    def test_flushes_unfinished_buffers_at_deadline(self):
+        clock = FakeClock()
+        flusher = DeadlineFlusher(clock=clock)
+        stream = io.StringIO()
+        emitter = LogEmitter(stream=stream)
+        unfinished = emitter.new_buffer('unfinished')
+        finished = emitter.new_buffer('finished')
+        flusher.watch(unfinished, clock.now + 60)
+        flusher.watch(finished, clock.now + 60)
+        unfinished.add_line('span')
+        finished.add_line('END')
+        finished.flush()
+        flusher.unwatch(finished)
+
+        assert flusher.flush_due() == 0
+        clock.sleep(60)
+        assert flusher.flush_due() == 1
+        assert stream.getvalue() == (
+            'END\nspan\n[ERROR] Flushing the logs of an unfinished invocation\n'
+        )
+        assert flusher.flush_due() == 0
@@ -0,0 +1,43 @@
+import json
+import unittest
+
+from payload_codec import MSGPACK_V1, PayloadCodec, PayloadDecodeError
+
+_DOCUMENT = {
+    'ImagePayload': {'ImageURL': 's3://bucket/key', 'CreatedTimestamp': 1572457843},
+    'Scorer': 'detect_adult_content',
+    'Score': 0.25,
+}
+
+
+class TestPayloadCodec(unittest.TestCase):
+    def test_json_round_trip(self):
+        for fast_json in (True, False):
+            codec = PayloadCodec(fast_json=fast_json)
+            message = codec.encode(_DOCUMENT)
+            assert json.loads(message) == _DOCUMENT
+            assert codec.decode(message) == _DOCUMENT
+
+    def test_msgpack_readable_alongside_json(self):
+        message = PayloadCodec(MSGPACK_V1).encode(_DOCUMENT)
+        assert json.loads(message)['Format'] == MSGPACK_V1
+
+        # Receivers decode either format, whatever format they send.
+        for codec in (PayloadCodec(), PayloadCodec(MSGPACK_V1)):
+            assert codec.decode(message) == _DOCUMENT
+            assert codec.decode(json.dumps(_DOCUMENT)) == _DOCUMENT
+
+    def test_invalid_messages(self):
+        codec = PayloadCodec()
+        for message in (
+            '{not json',
+            '{"Format": "unknown-v9", "Data": ""}',
+            '{"Format": "msgpack-v1", "Data": "not base64!"}',
+            '{"Format": "msgpack-v1"}',
+        ):
+            with self.assertRaises(PayloadDecodeError):
+                codec.decode(message)
+
+    def test_unknown_format(self):
+        with self.assertRaises(ValueError):
+            PayloadCodec('xml')
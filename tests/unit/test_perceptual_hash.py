@@ -0,0 +1,103 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import imagehash
+import numpy as np
+
+from PIL import Image
+
+import detect_known_bad_content
+import lambda_common
+from detect_known_bad_content import DetectKnownBadContentHandler
+from hash_corpus import write_hash_corpus
+from hash_index import create_hash_index, image_hash_to_int
+from perceptual_hash import ALGORITHMS, DOWNSCALE_SIZE, compute_hashes, hash_batch
+
+from tests.unit.fakes import FakeImageContext
+
+
+def _thumbnail(seed: int) -> Image.Image:
+    rng = np.random.default_rng(seed)
+    coarse = Image.fromarray((rng.random((6, 6)) * 255).astype(np.uint8))
+    return coarse.resize((DOWNSCALE_SIZE, DOWNSCALE_SIZE), Image.BICUBIC)
+
+
+class TestPerceptualHash(unittest.TestCase):
+    def test_matches_imagehash(self):
+        # The thumbnail is already the size imagehash resizes to for the
+        # perceptual hash, so those hashes agree exactly.  The average and
+        # difference hashes only differ by rounding in PIL's resize.
+        for seed in range(20):
+            thumbnail = _thumbnail(seed)
+            hashes = compute_hashes(thumbnail)
+            assert hashes['phash'] == image_hash_to_int(imagehash.phash(thumbnail))
+            for algorithm, expected in (
+                ('ahash', imagehash.average_hash(thumbnail)),
+                ('dhash', imagehash.dhash(thumbnail)),
+            ):
+                distance = bin(hashes[algorithm] ^ image_hash_to_int(expected))
+                assert distance.count('1') <= 2
+
+    def test_batch_matches_single(self):
+        thumbnails = [_thumbnail(seed) for seed in range(5)]
+        batch = hash_batch(np.stack([np.asarray(x) for x in thumbnails]))
+        for i, thumbnail in enumerate(thumbnails):
+            hashes = compute_hashes(thumbnail)
+            for algorithm in ALGORITHMS:
+                assert int(batch[algorithm][i]) == hashes[algorithm]
+
+    def test_rejects_wrong_size(self):
+        with self.assertRaises(ValueError):
+            hash_batch(np.zeros((1, 8, 8)))
+
+
+class TestDetectKnownBadContentHandler(unittest.TestCase):
+    def test_matches_any_hash_type(self):
+        thumbnail = _thumbnail(0)
+        phash = compute_hashes(thumbnail)['phash']
+        handler = DetectKnownBadContentHandler(
+            indexes={
+                'ahash': (create_hash_index('bktree'), None),
+                'phash': (
+                    create_hash_index('bktree', hashes=[phash ^ 1], image_ids=['bad']),
+                    None,
+                ),
+            }
+        )
+        payload = lambda_common.ImagePayload(
+            's3://bucket/image.png', 'post', 'account', 'iOS', '1', 'root'
+        )
+        log_context = lambda_common.LogContext('test', 1)
+
+        image_context = FakeImageContext(thumbnail=thumbnail)
+        score = handler.score_image(payload, log_context, image_context=image_context)
+        assert score == 0.95
+        assert image_context.thumbnail_sizes == [DOWNSCALE_SIZE]
+
+    def test_corpora_opened_without_numpy(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'phash.bin')
+            write_hash_corpus(path, [(1, 'bad')], algorithm='phash')
+            environment = dict(
+                os.environ,
+                KNOWN_BAD_CORPUS_PATH=path,
+                PYTHONPATH=os.path.dirname(detect_known_bad_content.__file__),
+            )
+            output = subprocess.run(
+                [
+                    sys.executable,
+                    '-c',
+                    'import sys, detect_known_bad_content; '
+                    'print(sorted(detect_known_bad_content._known_bad_corpora[0].hashes), '
+                    '"numpy" in sys.modules)',
+                ],
+                check=True,
+                env=environment,
+                stdout=subprocess.PIPE,
+                universal_newlines=True,
+            ).stdout
+        # Other messages, such as about the missing VERSION file, come first.
+        assert output.splitlines()[-1] == '[1] False'
@@ -0,0 +1,71 @@
+import os
+import tempfile
+import unittest
+
+from unittest import mock
+
+import lambda_common
+from detect_spammy_words import DetectSpammyWordsHandler
+from phrase_matcher import PhraseMatcher, normalize
+
+from tests.unit.fakes import FakeImageContext
+
+
+class TestPhraseMatcher(unittest.TestCase):
+    def setUp(self):
+        self.matcher = PhraseMatcher(
+            ['low mortgage rates', 'mortgage', 'rates call', 'Call NOW', 'free sale']
+        )
+
+    def test_normalize(self):
+        assert normalize('Crème  BRÛLÉE | fr3e!!') == ['creme', 'brulee', 'free']
+        assert normalize('ｃａｌｌ ｎｏｗ') == ['call', 'now']
+
+    def test_matches_within_text(self):
+        assert self.matcher.phrase_count == 5
+        # Overlapping phrases are each counted.
+        assert self.matcher.count_matches('L0W Mortgage rates! Call now...') == 4
+        assert self.matcher.count_matches('FR33 $ALE') == 1
+        assert self.matcher.count_matches('low rates') == 0
+        assert self.matcher.count_matches('') == 0
+
+    def test_stops_at_limit(self):
+        assert self.matcher.count_matches('mortgage ' * 100, limit=10) == 10
+
+    def test_from_file(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as file:
+            file.write('# Spam phrases\n\nwork from home\nwork\n')
+        try:
+            matcher = PhraseMatcher.from_file(file.name)
+        finally:
+            os.unlink(file.name)
+        assert matcher.phrase_count == 2
+        assert matcher.count_matches('Work from home today') == 2
+
+
+def _detection(text, text_type, confidence=99.0):
+    return {'DetectedText': text, 'Confidence': confidence, 'Id': 0, 'Type': text_type}
+
+
+class TestDetectSpammyWordsHandler(unittest.TestCase):
+    def score(self, texts):
+        handler = DetectSpammyWordsHandler(PhraseMatcher(['low mortgage rates']))
+        payload = lambda_common.ImagePayload(
+            's3://bucket/image.png', 'post', 'account', 'iOS', '1', 'root'
+        )
+        with mock.patch.dict(os.environ, {'IMAGE_CONFIDENCE_THRESHOLD': '90'}):
+            return handler.score_image(
+                payload,
+                lambda_common.LogContext('test', 1),
+                image_context=FakeImageContext(texts=texts),
+            )
+
+    def test_phrases_matched_in_lines(self):
+        words = ['low', 'mortgage', 'rates', 'call', 'now', 'for', 'a', 'quote']
+        texts = [_detection(' '.join(words), 'LINE')]
+        texts += [_detection(word, 'WORD') for word in words]
+        assert self.score(texts) == 1 / 8
+
+    def test_low_confidence_and_no_text(self):
+        assert self.score([_detection('low mortgage rates', 'LINE', 50)]) == 0
+        assert self.score([]) == 0
@@ -0,0 +1,63 @@
+import os
+import random
+import tempfile
+import unittest
+
+from rate_limiter import AdaptiveRateLimiter, SqliteRateLimitStore
+
+from tests.unit.fakes import FakeClock
+
+
+def _limiter(clock: FakeClock, **kwargs) -> AdaptiveRateLimiter:
+    return AdaptiveRateLimiter(
+        'detect_text', clock=clock, sleep=clock.sleep, rng=random.Random(0), **kwargs
+    )
+
+
+class TestAdaptiveRateLimiter(unittest.TestCase):
+    def test_waits_for_tokens(self):
+        clock = FakeClock()
+        limiter = _limiter(clock, max_tps=10)
+
+        assert limiter.acquire(1) == 0
+        for _ in range(5):
+            assert abs(limiter.acquire(1) - 0.1) < 1e-9
+        # The wait would be too long, so no token is taken.
+        assert limiter.acquire(0.05) is None
+        assert abs(limiter.acquire(1) - 0.1) < 1e-9
+
+    def test_aimd(self):
+        clock = FakeClock()
+        limiter = _limiter(clock, max_tps=10, decrease_factor=0.5)
+
+        assert limiter.on_throttle()
+        assert not limiter.on_throttle()
+        assert limiter.rate == 5
+        clock.now += 1
+        assert limiter.on_throttle()
+        assert limiter.rate == 2.5
+        for _ in range(100):
+            limiter.on_success()
+        assert limiter.rate == 10
+        for _ in range(10):
+            clock.now += 1
+            limiter.on_throttle()
+        assert limiter.rate == 1
+
+    def test_backoff_jittered_and_capped(self):
+        limiter = _limiter(FakeClock(), max_tps=10, max_backoff_s=1)
+        backoffs = [limiter.backoff_s(attempt) for attempt in range(1, 20)]
+        assert all(0 <= backoff <= 1 for backoff in backoffs)
+        assert len(set(backoffs)) == len(backoffs)
+
+    def test_sqlite_store_shared(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'rate_limits.db')
+            clock = FakeClock()
+            first = _limiter(clock, max_tps=10, store=SqliteRateLimitStore(path))
+            second = _limiter(clock, max_tps=10, store=SqliteRateLimitStore(path))
+
+            assert first.acquire(1) == 0
+            assert abs(second.acquire(1) - 0.1) < 1e-9
+            first.on_throttle()
+            assert second.rate == 7
@@ -0,0 +1,94 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+
+import image_context
+import lambda_common
+from image_context import ImageContext
+from score_cache import ScoreCache
+
+from tests.unit.fakes import CountingHandler, FakeContext
+
+
+class TestScoreCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_memory_tier_lru(self):
+        cache = ScoreCache(max_entries=2)
+        cache.put(('scorer', '1', 'a'), 0.1)
+        cache.put(('scorer', '1', 'b'), 0.2)
+        assert cache.get(('scorer', '1', 'a')) == 0.1
+        cache.put(('scorer', '1', 'c'), 0.3)
+
+        assert cache.get(('scorer', '1', 'b')) is None
+        assert cache.get(('scorer', '1', 'a')) == 0.1
+        assert cache.get(('scorer', '2', 'a')) is None
+
+    def test_entries_expire(self):
+        cache = ScoreCache(ttl_seconds=0.01, directory=self.directory.name)
+        cache.put(('scorer', '1', 'a'), 0.5)
+        time.sleep(0.02)
+        assert cache.get(('scorer', '1', 'a')) is None
+
+    def test_file_tier_is_shared(self):
+        ScoreCache(directory=self.directory.name).put(('scorer', '1', 'a'), 0.5)
+        assert (
+            ScoreCache(directory=self.directory.name).get(('scorer', '1', 'a')) == 0.5
+        )
+
+    def test_file_tier_is_pruned(self):
+        cache = ScoreCache(directory=self.directory.name, max_files=10)
+        for i in range(25):
+            cache.put(('scorer', '1', str(i)), 0.5)
+        assert len(os.listdir(self.directory.name)) <= 10
+
+    def test_from_environment_is_opt_in(self):
+        os.environ.pop('SCORE_CACHE_ENABLED', None)
+        assert ScoreCache.from_environment() is None
+
+
+class _FakeS3Client:
+    def head_object(self, Bucket, Key):
+        return {'ETag': f'"{Bucket}-{Key}"'}
+
+
+class TestDetectionHandlerScoreCache(unittest.TestCase):
+    def setUp(self):
+        self.original_s3 = image_context._s3
+        self.original_publish = lambda_common.publish_to_update_spam_score_sns_topic
+        image_context._s3 = _FakeS3Client()
+        lambda_common.publish_to_update_spam_score_sns_topic = lambda *a, **k: None
+        ImageContext.clear_shared()
+
+    def tearDown(self):
+        image_context._s3 = self.original_s3
+        lambda_common.publish_to_update_spam_score_sns_topic = self.original_publish
+
+    def test_reposts_are_not_rescored(self):
+        handler = CountingHandler(score_cache=ScoreCache())
+        message = json.dumps(
+            {
+                'ImageURL': 's3://bucket/image.png',
+                'PostID': 'post',
+                'AccountID': 'account',
+                'SourceDevice': 'iOS',
+                'CreatedTimestamp': '1',
+                'RootTraceID': 'root',
+            }
+        )
+        event = {
+            'Records': [
+                {'Sns': {'MessageId': str(i), 'Message': message}} for i in range(3)
+            ]
+        }
+
+        response = handler.handle_request(event, FakeContext())
+
+        assert response['batchItemFailures'] == []
+        assert handler.calls == 1
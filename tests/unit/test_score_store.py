@@ -0,0 +1,125 @@
+import contextlib
+import io
+import os
+import tempfile
+import threading
+import unittest
+
+import update_spam_score
+from dedup_store import InMemoryDedupStore
+from lambda_common import ImagePayload, UpdateSpamScorePayload
+from score_store import InMemoryScoreStore, SqliteScoreStore, create_score_store
+from update_spam_score import update_score
+
+from tests.unit.fakes import FakeContext
+
+
+class TestScoreStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'scores.db')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def __stores(self):
+        return [InMemoryScoreStore(), SqliteScoreStore(self.path)]
+
+    def test_merge_score(self):
+        for store in self.__stores():
+            assert store.merge_score('a', 'url', 'first', 0.1) == {'first': 0.1}
+            assert store.merge_score('a', 'url', 'second', 0.2) == {
+                'first': 0.1,
+                'second': 0.2,
+            }
+            assert store.merge_score('a', 'url', 'first', 0.3) == {
+                'first': 0.3,
+                'second': 0.2,
+            }
+            assert store.get_scores('b', 'url') == {}
+
+    def test_merge_scores(self):
+        for store in self.__stores():
+            store.merge_score('a', 'url', 'first', 0.1)
+            assert store.merge_scores('a', 'url', {'second': 0.2, 'third': 0.3}) == {
+                'first': 0.1,
+                'second': 0.2,
+                'third': 0.3,
+            }
+
+    def test_lru_eviction(self):
+        store = InMemoryScoreStore(max_entries=2)
+        store.merge_score('a', 'one', 'scorer', 0.1)
+        store.merge_score('a', 'two', 'scorer', 0.1)
+        store.get_scores('a', 'one')
+        store.merge_score('a', 'three', 'scorer', 0.1)
+
+        assert len(store) == 2
+        assert store.get_scores('a', 'two') == {}
+        assert store.get_scores('a', 'one') == {'scorer': 0.1}
+
+    def test_sqlite_is_durable(self):
+        SqliteScoreStore(self.path).merge_score('a', 'url', 'scorer', 0.5)
+        assert SqliteScoreStore(self.path).get_scores('a', 'url') == {'scorer': 0.5}
+
+    def test_concurrent_merges_are_not_lost(self):
+        for store in self.__stores():
+
+            def merge(worker):
+                for i in range(50):
+                    store.merge_score('a', 'url', f'scorer-{worker}-{i}', 0.5)
+
+            threads = [threading.Thread(target=merge, args=(w,)) for w in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            assert len(store.get_scores('a', 'url')) == 200
+
+    def test_update_score_averages_all_scorers(self):
+        store = create_score_store('memory')
+        assert not update_score('first', 0.6, 'url', 'a', score_store=store)
+        assert not update_score('second', 0.6, 'url', 'a', score_store=store)
+        assert update_score('third', 0.6, 'url', 'a', score_store=store)
+
+
+class TestUpdateSpamScoreHandler(unittest.TestCase):
+    def setUp(self):
+        self.original_stores = (
+            update_spam_score._score_store,
+            update_spam_score._dedup_store,
+        )
+        update_spam_score._score_store = InMemoryScoreStore()
+        update_spam_score._dedup_store = InMemoryDedupStore()
+
+    def tearDown(self):
+        (
+            update_spam_score._score_store,
+            update_spam_score._dedup_store,
+        ) = self.original_stores
+
+    @staticmethod
+    def __event(message_id, scorer):
+        image_payload = ImagePayload("url", "post", "a", "iOS", "1", "root")
+        payload = UpdateSpamScorePayload(image_payload, scorer, 0.9, 'trace')
+        return {
+            'Records': [
+                {'Sns': {'MessageId': message_id, 'Message': payload.to_json()}}
+            ]
+        }
+
+    def test_redelivery_skipped(self):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            update_spam_score.handler(self.__event('m1', 'first'), FakeContext())
+            update_spam_score.handler(self.__event('m1', 'first'), FakeContext())
+            update_spam_score.handler(self.__event('m2', 'first'), FakeContext())
+            update_spam_score.handler(self.__event('m3', 'second'), FakeContext())
+
+        assert output.getvalue().count('spam_result') == 2
+        assert output.getvalue().count('duplicates=1') == 2
+        assert update_spam_score.get_current_scores('url', 'a') == {
+            'first': 0.9,
+            'second': 0.9,
+        }
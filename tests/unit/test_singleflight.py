@@ -0,0 +1,120 @@
+import asyncio
+import threading
+import unittest
+
+from singleflight import SingleFlight
+
+from tests.unit.fakes import FakeClock
+
+
+class TestSingleFlight(unittest.TestCase):
+    def test_concurrent_calls_share_one_call(self):
+        single_flight = SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def call():
+            calls.append(1)
+            release.wait(5)
+            return 'result'
+
+        results = []
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(single_flight.do('key', call))
+            )
+            for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        # Wait for every thread to join the call before letting it finish.
+        calls_seen, shared = 0, 0
+        while calls_seen < 5:
+            stats = single_flight.take_stats()
+            calls_seen, shared = calls_seen + stats[0], shared + stats[1]
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        assert shared == 4
+
+        assert len(calls) == 1
+        assert sorted(results) == [('result', False)] + [('result', True)] * 4
+
+    def test_result_window(self):
+        clock = FakeClock(0.0)
+        single_flight = SingleFlight(result_window_s=2, clock=clock)
+
+        assert single_flight.do('key', lambda: 1) == (1, False)
+        clock.now = 1.5
+        assert single_flight.do('key', lambda: 2) == (1, True)
+        assert single_flight.do('other', lambda: 3) == (3, False)
+        clock.now = 2.5
+        assert single_flight.do('key', lambda: 4) == (4, False)
+        assert single_flight.do(None, lambda: 5) == (5, False)
+        assert single_flight.do(None, lambda: 6) == (6, False)
+        assert single_flight.take_stats() == (6, 1)
+        assert single_flight.take_stats() == (0, 0)
+
+        single_flight.clear()
+        assert single_flight.do('key', lambda: 7) == (7, False)
+
+    def test_errors_not_kept(self):
+        single_flight = SingleFlight(result_window_s=60)
+
+        def fail():
+            raise ValueError('failed')
+
+        with self.assertRaises(ValueError):
+            single_flight.do('key', fail)
+        assert single_flight.do('key', lambda: 1) == (1, False)
+
+    def test_asyncio_tasks_share_call_with_threads(self):
+        single_flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+
+        def call():
+            started.set()
+            release.wait(5)
+            return 'result'
+
+        thread_results = []
+        thread = threading.Thread(
+            target=lambda: thread_results.append(single_flight.do('key', call))
+        )
+        thread.start()
+        started.wait(5)
+
+        async def follow():
+            async def unexpected():
+                raise AssertionError('Should have shared the call')
+
+            results = asyncio.gather(
+                *(single_flight.do_async('key', unexpected) for _ in range(3))
+            )
+            # The event loop keeps running while the tasks wait.
+            await asyncio.sleep(0.01)
+            release.set()
+            return await results
+
+        assert asyncio.run(follow()) == [('result', True)] * 3
+        thread.join()
+        assert thread_results == [('result', False)]
+
+    def test_asyncio_leader(self):
+        single_flight = SingleFlight()
+        calls = []
+
+        async def call():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return 'result'
+
+        async def run():
+            return await asyncio.gather(
+                *(single_flight.do_async('key', call) for _ in range(3))
+            )
+
+        assert asyncio.run(run()) == [('result', False)] + [('result', True)] * 2
+        assert len(calls) == 1
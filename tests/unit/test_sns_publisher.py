@@ -0,0 +1,84 @@
+import os
+import unittest
+
+from botocore.exceptions import ClientError
+
+import sns_publisher
+from lambda_common import (
+    ImagePayload,
+    SnsPublishError,
+    publish_to_update_spam_score_sns_topic,
+)
+from sns_publisher import SnsBatchPublisher
+
+from tests.unit.fakes import FakeSnsClient
+
+
+class TestSnsBatchPublisher(unittest.TestCase):
+    def setUp(self):
+        self.original_sns = sns_publisher._sns
+        self.original_arn = os.environ.get('SNS_UPDATE_SPAM_SCORE_TOPIC_ARN')
+        os.environ['SNS_UPDATE_SPAM_SCORE_TOPIC_ARN'] = 'arn:topic'
+        self.image_payload = ImagePayload(
+            "s3://bucket/image.png", "post", "account", "iOS", "1", "root"
+        )
+
+    def tearDown(self):
+        sns_publisher._sns = self.original_sns
+        if self.original_arn is None:
+            del os.environ['SNS_UPDATE_SPAM_SCORE_TOPIC_ARN']
+        else:
+            os.environ['SNS_UPDATE_SPAM_SCORE_TOPIC_ARN'] = self.original_arn
+
+    def __publish(self, publisher, count):
+        for i in range(count):
+            publish_to_update_spam_score_sns_topic(
+                self.image_payload, 'scorer', 0.5, f"trace-{i}", publisher=publisher
+            )
+
+    def test_flushes_in_batches_of_ten(self):
+        sns_publisher._sns = FakeSnsClient()
+        publisher = SnsBatchPublisher(max_delay_ms=60000)
+
+        self.__publish(publisher, 23)
+        assert [len(batch) for _, batch in sns_publisher._sns.batches] == [10, 10]
+
+        assert publisher.flush() == {}
+        assert [len(batch) for _, batch in sns_publisher._sns.batches] == [10, 10, 3]
+        assert sns_publisher._sns.batches[0][0] == 'arn:topic'
+
+    def test_failures_mapped_to_tags(self):
+        sns_publisher._sns = FakeSnsClient(failed_ids={'1'})
+        publisher = SnsBatchPublisher(max_delay_ms=60000)
+
+        self.__publish(publisher, 3)
+        failures = publisher.flush()
+
+        assert list(failures) == ['trace-1']
+        assert isinstance(failures['trace-1'], SnsPublishError)
+        assert failures['trace-1'].status_code == 500
+        assert failures['trace-1'].is_retriable
+        assert len(sns_publisher._sns.batches[0][1]) == 3
+
+    def test_client_errors_not_retriable(self):
+        def client_error(status_code, code):
+            return ClientError(
+                {
+                    'Error': {'Code': code, 'Message': 'error'},
+                    'ResponseMetadata': {'HTTPStatusCode': status_code},
+                },
+                'PublishBatch',
+            )
+
+        for sns, is_retriable in [
+            (FakeSnsClient(failed_ids={'0'}, sender_fault=True), False),
+            (FakeSnsClient(error=client_error(400, 'InvalidParameter')), False),
+            (FakeSnsClient(error=client_error(400, 'Throttling')), True),
+            (FakeSnsClient(error=client_error(503, 'ServiceUnavailable')), True),
+        ]:
+            sns_publisher._sns = sns
+            publisher = SnsBatchPublisher(max_delay_ms=60000)
+
+            self.__publish(publisher, 1)
+
+            assert publisher.flush()['trace-0'].is_retriable == is_retriable
@@ -0,0 +1,41 @@
+import os
+import tempfile
+import threading
+import unittest
+
+from sqlite_database import SqliteDatabase
+
+
+class TestSqliteDatabase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.database = SqliteDatabase(os.path.join(self.directory.name, 'test.db'))
+        self.database.connection().execute('CREATE TABLE t (value INTEGER)')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def __values(self):
+        rows = self.database.connection().execute('SELECT value FROM t')
+        return sorted(value for value, in rows)
+
+    def test_transaction_rolled_back_on_error(self):
+        with self.database.transaction() as connection:
+            connection.execute('INSERT INTO t VALUES (1)')
+        with self.assertRaises(ValueError):
+            with self.database.transaction() as connection:
+                connection.execute('INSERT INTO t VALUES (2)')
+                raise ValueError()
+
+        assert self.__values() == [1]
+
+    def test_connection_per_thread(self):
+        connections = []
+        thread = threading.Thread(
+            target=lambda: connections.append(self.database.connection())
+        )
+        thread.start()
+        thread.join()
+
+        assert connections[0] is not self.database.connection()
+        assert self.database.connection() is self.database.connection()
@@ -0,0 +1,68 @@
+import os
+import tempfile
+import time
+import unittest
+
+from work_queue import SqliteWorkQueue, create_work_queue
+
+
+class TestSqliteWorkQueue(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.queue = SqliteWorkQueue(
+            os.path.join(self.directory.name, 'queue.db'), poll_interval_s=0.01
+        )
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_receive_hides_messages(self):
+        message_ids = self.queue.send_messages(['a', 'b', 'c'])
+        messages = self.queue.receive_messages(2, 0, 60)
+        assert [message.body for message in messages] == ['a', 'b']
+        assert [message.message_id for message in messages] == message_ids[:2]
+        assert all(message.receive_count == 1 for message in messages)
+        assert [message.body for message in self.queue.receive_messages(10, 0, 60)] == [
+            'c'
+        ]
+        assert self.queue.receive_messages(10, 0, 60) == []
+        assert len(self.queue) == 3
+
+    def test_delete(self):
+        self.queue.send_messages(['a', 'b'])
+        messages = self.queue.receive_messages(10, 0, 60)
+        self.queue.delete_messages([message.receipt_handle for message in messages])
+        assert len(self.queue) == 0
+
+    def test_redelivered_after_visibility_timeout(self):
+        self.queue.send_messages(['a'])
+        (first,) = self.queue.receive_messages(1, 0, 0.05)
+        (second,) = self.queue.receive_messages(1, 1, 60)
+        assert second.message_id == first.message_id
+        assert second.receive_count == 2
+        assert second.receipt_handle != first.receipt_handle
+        # The first receipt no longer deletes the message.
+        self.queue.delete_messages([first.receipt_handle])
+        assert len(self.queue) == 1
+
+    def test_change_visibility(self):
+        self.queue.send_messages(['a'])
+        (message,) = self.queue.receive_messages(1, 0, 60)
+        self.queue.change_visibility(message.receipt_handle, 0)
+        (message,) = self.queue.receive_messages(1, 0, 0.05)
+        self.queue.change_visibility(message.receipt_handle, 60)
+        time.sleep(0.1)
+        assert self.queue.receive_messages(1, 0, 60) == []
+
+    def test_shared_between_instances(self):
+        other = SqliteWorkQueue(os.path.join(self.directory.name, 'queue.db'))
+        other.send_messages(['a'])
+        assert [message.body for message in self.queue.receive_messages(1, 0, 60)] == [
+            'a'
+        ]
+
+    def test_invalid_batch_size(self):
+        with self.assertRaises(ValueError):
+            self.queue.send_messages([str(i) for i in range(11)])
+        with self.assertRaises(ValueError):
+            create_work_queue('sqs', queue_url='https://example.com/queue')
@@ -0,0 +1,98 @@
+import json
+import os
+import tempfile
+import threading
+import unittest
+
+from work_queue import SqliteWorkQueue
+from worker import HANDLERS, Worker, load_handler_class
+
+
+class _FakeHandler:
+    """Fails the images named `retry`, and records the others."""
+
+    def __init__(
+        self,
+        scored: list,
+        started: threading.Event = None,
+        release: threading.Event = None,
+    ):
+        self.scored = scored
+        self.started = started
+        self.release = release
+
+    def handle_request(self, event, context):
+        (record,) = event['Records']
+        image_url = json.loads(record['Sns']['Message'])['image_url']
+        if self.started is not None:
+            self.started.set()
+            self.release.wait(5)
+        if image_url == 'retry':
+            return {'batchItemFailures': [{'itemIdentifier': context.aws_request_id}]}
+        self.scored.append(image_url)
+        return {'statusCode': 200}
+
+
+def _message(image_url: str) -> str:
+    return json.dumps({'image_url': image_url})
+
+
+class TestWorker(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.queue = SqliteWorkQueue(
+            os.path.join(self.directory.name, 'queue.db'), poll_interval_s=0.01
+        )
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_scores_every_message(self):
+        for batch in range(3):
+            self.queue.send_messages(
+                [_message(f'image-{batch}-{i}') for i in range(10)]
+            )
+        self.queue.send_messages([_message('retry')])
+        scored = []
+        worker = Worker(
+            self.queue, lambda: _FakeHandler(scored), concurrency=4, wait_time_s=0.1
+        )
+
+        stats = worker.run(exit_when_idle=True)
+
+        assert len(scored) == 30
+        assert stats == {'received': 31, 'processed': 30, 'failed': 1, 'released': 0}
+        # Only the failed message is left, to be retried.
+        assert len(self.queue) == 1
+
+    def test_stop_releases_buffered_messages(self):
+        self.queue.send_messages([_message(f'image-{i}') for i in range(5)])
+        started = threading.Event()
+        release = threading.Event()
+        scored = []
+        worker = Worker(
+            self.queue,
+            lambda: _FakeHandler(scored, started, release),
+            concurrency=1,
+            prefetch=4,
+            wait_time_s=0.1,
+        )
+        thread = threading.Thread(target=lambda: setattr(self, 'stats', worker.run()))
+        thread.start()
+        assert started.wait(5)
+        worker.stop()
+        release.set()
+        thread.join(5)
+
+        # The image being scored was finished, and the rest were released.
+        assert len(scored) == 1
+        assert self.stats['processed'] == 1
+        assert self.stats['released'] == self.stats['received'] - 1
+        assert len(self.queue) == 4
+        assert len(self.queue.receive_messages(10, 0, 60)) == 4
+
+    def test_load_handler_class(self):
+        assert set(HANDLERS) >= {'detect_spammy_words', 'detect_adult_content'}
+        assert load_handler_class('detect_spammy_words').__name__ == (
+            'DetectSpammyWordsHandler'
+        )